@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of the authenticated requests (GET /files/<path> of a small file).
+
+It compares, on a single core:
+ - the password verified at every request (credentials cache disabled);
+ - the password of a cached verified credential;
+ - the session token obtained from POST /tokens.
+
+Usage:
+    $ python benchmarks/bench_auth.py [N]    # default: 200 requests per case
+"""
+import os
+import sys
+import time
+import json
+import base64
+import shutil
+import tempfile
+import logging
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'server')
+sys.path.insert(0, SERVER_DIR)
+
+import server
+
+USER, PASSWORD = 'user@mail.com', 'Password_85'
+FILE_URL = '{}/files/Projects/Projects.txt'.format(server.URL_PREFIX)
+
+
+def auth_headers(password):
+    return {'Authorization': 'Basic ' + base64.b64encode('{}:{}'.format(USER, password))}
+
+
+def requests_per_second(app, headers, n):
+    start = time.time()
+    for _ in xrange(n):
+        assert app.get(FILE_URL, headers=headers).status_code == server.HTTP_OK
+    return n / (time.time() - start)
+
+
+def main(n):
+    server.logger.setLevel(logging.CRITICAL)
+    work_dir = tempfile.mkdtemp()
+    os.chdir(work_dir)
+    try:
+        state = server.init_user_directory(USER)
+        state.update({server.PWD: server._encrypt_password(PASSWORD), server.USER_IS_ACTIVE: True,
+                      server.USER_CREATION_TIME: 0, 'shared_with_me': {}, 'shared_with_others': {}})
+        server.userdata[USER] = state
+        app = server.app.test_client()
+
+        cache_size = server.credentials_cache.max_size
+        server.credentials_cache.max_size = 0
+        results = [('password', requests_per_second(app, auth_headers(PASSWORD), n))]
+        server.credentials_cache.max_size = cache_size
+        results.append(('cached password', requests_per_second(app, auth_headers(PASSWORD), n)))
+
+        token = json.loads(app.post('{}/tokens'.format(server.URL_PREFIX), headers=auth_headers(PASSWORD)).data)
+        server.credentials_cache.clear()
+        results.append(('session token', requests_per_second(app, auth_headers(token['token']), n)))
+
+        for label, rate in results:
+            print '{:<20} {:>10.1f} req/s {:>8.1f}x'.format(label, rate, rate / results[0][1])
+    finally:
+        os.chdir(SERVER_DIR)
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bytes sent uploading near-duplicates of stored files, with the upload by chunks (see client/chunking.py and
+server/chunks.py) and with the upload by hash (see Preflight), that finds the whole identical files only.
+
+Every corpus is made of FILES random files of a few MB (the stored ones) and of a variant of each one,
+made as users do with their files:
+ - copy: the same content (i.e. a renamed export);
+ - append: data appended to the file (i.e. a log or a database dump);
+ - prepend: a header added at the beginning, that shifts all the content;
+ - edits: some bytes changed here and there (i.e. a new version of a document);
+ - insert: a block inserted in the middle;
+ - new: an unrelated file (nothing to deduplicate).
+The bytes sent by chunks include the metadata: the md5s of the chunks, sent twice as json.
+
+Usage:
+    $ python benchmarks/bench_chunks.py [FILES]    # default: 5
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import StringIO
+
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'client')
+sys.path.insert(0, CLIENT_DIR)
+
+from chunking import iter_chunks
+
+FILE_SIZES = [2 ** 21, 2 ** 22, 2 ** 23]
+
+
+def edited(data, edits=10, edit_size=100):
+    data = bytearray(data)
+    for _ in range(edits):
+        offset = random.randrange(len(data) - edit_size)
+        data[offset:offset + edit_size] = os.urandom(edit_size)
+    return str(data)
+
+
+VARIANTS = [
+    ('copy', lambda data: data),
+    ('append', lambda data: data + os.urandom(len(data) // 100)),
+    ('prepend', lambda data: os.urandom(1000) + data),
+    ('edits', edited),
+    ('insert', lambda data: data[:len(data) // 2] + os.urandom(50000) + data[len(data) // 2:]),
+    ('new', lambda data: os.urandom(len(data))),
+]
+
+
+def chunk_md5s(data):
+    return [(hashlib.md5(chunk).hexdigest(), len(chunk)) for chunk in iter_chunks(StringIO.StringIO(data))]
+
+
+def bytes_sent_by_chunks(data, stored_chunks):
+    """
+    Return the bytes sent uploading <data> by chunks to a server that has <stored_chunks> (md5s).
+    """
+    chunks = chunk_md5s(data)
+    needed = set(md5 for md5, _ in chunks) - stored_chunks
+    sent = sum(size for md5, size in dict(chunks).items() if md5 in needed)
+    metadata = len(json.dumps(list(set(md5 for md5, _ in chunks)))) + len(json.dumps(chunks))
+    return sent + metadata
+
+
+def main(files):
+    random.seed(0)
+    stored = [os.urandom(random.choice(FILE_SIZES)) for _ in range(files)]
+    start = time.time()
+    stored_chunks = set(md5 for data in stored for md5, _ in chunk_md5s(data))
+    elapsed = time.time() - start
+    stored_md5s = set(hashlib.md5(data).hexdigest() for data in stored)
+    total_size = sum(len(data) for data in stored)
+    print 'Chunking: {:.1f} MB/s, {:,} chunks of {:,} bytes on average\n'.format(
+        total_size / elapsed / 2 ** 20, len(stored_chunks), total_size // len(stored_chunks))
+
+    print '{:<10} {:>14} {:>16} {:>10} {:>16} {:>10}'.format(
+        'variant', 'file bytes', 'sent by chunks', 'ratio', 'sent by hash', 'ratio')
+    for name, make_variant in VARIANTS:
+        file_bytes = by_chunks = by_hash = 0
+        for data in stored:
+            variant = make_variant(data)
+            file_bytes += len(variant)
+            by_chunks += bytes_sent_by_chunks(variant, stored_chunks)
+            by_hash += 0 if hashlib.md5(variant).hexdigest() in stored_md5s else len(variant)
+        print '{:<10} {:>14,} {:>16,} {:>9.1f}% {:>16,} {:>9.1f}%'.format(
+            name, file_bytes, by_chunks, 100.0 * by_chunks / file_bytes, by_hash, 100.0 * by_hash / file_bytes)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Latency of copying a file with the strategies of the copy action (see server/blobs.py), for a few file sizes:
+ - copy: a real copy of the content (shutil.copyfile);
+ - reflink: a copy-on-write clone (FICLONE), on the filesystems that support it (btrfs, xfs, ...);
+ - hardlink: a link to the same inode (what Actions._copy does, through BlobStore.link).
+
+The files are created in each of the given directories, so that different filesystems can be compared,
+e.g. tmpfs and btrfs/xfs loopback images:
+
+    $ truncate -s 4G btrfs.img && mkfs.btrfs btrfs.img && sudo mount -o loop btrfs.img /mnt/btrfs
+    $ truncate -s 4G xfs.img && mkfs.xfs -m reflink=1 xfs.img && sudo mount -o loop xfs.img /mnt/xfs
+
+Usage:
+    $ python benchmarks/bench_copy.py [DIRECTORY ...]    # default: the temporary directory and /dev/shm
+"""
+import os
+import sys
+import time
+import errno
+import shutil
+import tempfile
+import subprocess
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'server')
+sys.path.insert(0, SERVER_DIR)
+
+from blobs import reflink
+
+SIZES = [2 ** 20, 2 ** 24, 2 ** 28]
+REPEAT = 5
+STRATEGIES = [('copy', shutil.copyfile), ('reflink', reflink), ('hardlink', os.link)]
+
+
+def filesystem(directory):
+    try:
+        return subprocess.check_output(['stat', '-f', '-c', '%T', directory]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return '?'
+
+
+def make_file(filepath, size):
+    block = os.urandom(2 ** 20)
+    with open(filepath, 'wb') as fp:
+        for _ in range(size // len(block)):
+            fp.write(block)
+        fp.write(block[:size % len(block)])
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def time_copy(copy, src, dst):
+    """
+    Return the best time of REPEAT copies of <src>, in seconds, or None if the strategy is not supported.
+    """
+    best = None
+    for _ in range(REPEAT):
+        start = time.time()
+        try:
+            copy(src, dst)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.EXDEV, errno.ENOTTY):
+                return None
+            raise
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+        os.remove(dst)
+    return best
+
+
+def main(directories):
+    print '{:<20} {:<10} {:>10} {:>12} {:>12} {:>12}'.format(
+        'directory', 'fs', 'size', *['{} (ms)'.format(name) for name, _ in STRATEGIES])
+    for directory in directories:
+        work_dir = tempfile.mkdtemp(dir=directory)
+        try:
+            for size in SIZES:
+                src, dst = os.path.join(work_dir, 'src'), os.path.join(work_dir, 'dst')
+                make_file(src, size)
+                times = [time_copy(copy, src, dst) for _, copy in STRATEGIES]
+                print '{:<20} {:<10} {:>8} MB {:>12} {:>12} {:>12}'.format(
+                    directory, filesystem(directory), size // 2 ** 20,
+                    *['n/a' if seconds is None else '{:.3f}'.format(seconds * 1000) for seconds in times])
+                os.remove(src)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or [d for d in (tempfile.gettempdir(), '/dev/shm') if os.path.isdir(d)])
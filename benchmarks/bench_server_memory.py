@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark of the server user data: the old dicts vs SnapshotTree and the share mount references.
+
+Every measure runs in a fresh process and reports the growth of the peak resident memory (max RSS):
+ - files: a user snapshot of N synthetic files (100 files per directory, 3 directory levels),
+   as the old {u'<path>': [<timestamp>, u'<md5>']} dict loaded from userdata.json, or as a SnapshotTree;
+ - shares: a folder of SHARED_FILES files shared with SHARES recipients: the old 'shared_files' dicts
+   copied the entries of the folder for every recipient, the mount references keep only the shared path
+   (the recipient view is built at read time, see server.shared_view).
+
+Usage:
+    $ python benchmarks/bench_server_memory.py [N ...]    # default: 1000000
+"""
+import os
+import sys
+import time
+import hashlib
+import resource
+import subprocess
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'server')
+sys.path.insert(0, SERVER_DIR)
+
+DEFAULT_SIZES = (1000000,)
+SHARED_FILES = 1000
+SHARES = 1000
+
+
+def iter_entries(n):
+    timestamp = long(time.time() * 10000)
+    for i in xrange(n):
+        path = u'projects/project{}/src/module{}/file{}.py'.format(i // 100000, i // 100, i)
+        yield path, [timestamp + i, unicode(hashlib.md5(str(i)).hexdigest())]
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def copy_value(value):
+    """
+    Return a copy of the [<timestamp>, <md5>] <value> as json.load builds it, with a new md5 string.
+    """
+    timestamp, md5 = value
+    return [timestamp, unicode(md5.encode('ascii'))]
+
+
+def make_snapshot(kind, entries):
+    if kind == 'dict':
+        return dict(entries)
+    from snapshot import SnapshotTree
+    return SnapshotTree(entries)
+
+
+def measure(kind, what, n):
+    """
+    Build the data in the current process and print the used memory in bytes per file or per share.
+    """
+    if what == 'files':
+        baseline = max_rss_kb()
+        snapshot = make_snapshot(kind, iter_entries(n))
+        print (max_rss_kb() - baseline) * 1024.0 / n
+        return
+    owner_files = make_snapshot(kind, iter_entries(SHARED_FILES))
+    baseline = max_rss_kb()
+    recipients = []
+    for i in xrange(SHARES):
+        if kind == 'dict':
+            shared_files = dict((u'shared/owner/' + path, copy_value(value))
+                                for path, value in owner_files.iteritems())
+            recipients.append({'shared_with_me': {u'owner': [u'projects']}, 'shared_files': shared_files})
+        else:
+            recipients.append({'shared_with_me': {u'owner': [u'projects']}})
+    print (max_rss_kb() - baseline) * 1024.0 / SHARES
+
+
+def run(kind, what, n):
+    return float(subprocess.check_output([sys.executable, __file__, '--measure', kind, what, str(n)]))
+
+
+def main(sizes):
+    print '{:>10} {:>18} {:>18} {:>8}'.format('files', 'dict (bytes/file)', 'tree (bytes/file)', 'ratio')
+    for n in sizes:
+        old, new = run('dict', 'files', n), run('tree', 'files', n)
+        print '{:>10,} {:>18,.1f} {:>18,.1f} {:>8.2f}'.format(n, old, new, old / new)
+    old, new = run('dict', 'shares', 0), run('tree', 'shares', 0)
+    print '\nshares of {:,} files: {:,.0f} bytes/share copied, {:,.0f} bytes/share as mount references'.format(
+        SHARED_FILES, old, new)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
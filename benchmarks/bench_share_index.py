@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the share operations on a big shared folder.
+
+It builds an owner snapshot with N files in a folder (default: 200,000) and measures:
+ - the share creation (POST /shares/<folder>/<user>) and removal;
+ - the computation of the recipient shared view (the 'shared_files' of its snapshot);
+ - a subtree listing of the same folder (GET /files/?subtree=<folder>).
+
+Usage:
+    $ python benchmarks/bench_share_index.py [N]
+"""
+import os
+import sys
+import time
+import base64
+import shutil
+import hashlib
+import tempfile
+import logging
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'server')
+sys.path.insert(0, SERVER_DIR)
+
+import server
+
+OWNER, RECIPIENT, PASSWORD = 'owner@mail.com', 'recipient@mail.com', 'password'
+SHARED_FOLDER = 'Projects'
+
+
+def auth_headers(user):
+    return {'Authorization': 'Basic ' + base64.b64encode('{}:{}'.format(user, PASSWORD))}
+
+
+def timed(label, func):
+    start = time.time()
+    result = func()
+    print '{:<40} {:>10.1f} ms'.format(label, (time.time() - start) * 1000)
+    return result
+
+
+def main(n):
+    server.logger.setLevel(logging.CRITICAL)
+    work_dir = tempfile.mkdtemp()
+    os.chdir(work_dir)
+    try:
+        enc_pass = server._encrypt_password(PASSWORD)
+        for user in (OWNER, RECIPIENT):
+            state = server.init_user_directory(user)
+            state.update({server.PWD: enc_pass, server.USER_IS_ACTIVE: True, server.USER_CREATION_TIME: 0,
+                          'shared_with_me': {}, 'shared_with_others': {}})
+            server.userdata[user] = state
+        snapshot = server.userdata[OWNER][server.SNAPSHOT]
+        timestamp = server.now_timestamp()
+        for i in xrange(n):
+            path = '{}/module{}/file{}.py'.format(SHARED_FOLDER, i // 100, i)
+            snapshot[path] = [timestamp, hashlib.md5(str(i)).hexdigest()]
+        # The metadata dump is not what we measure here.
+        server.save_userdata = lambda: None
+
+        app = server.app.test_client()
+        share_url = '{}/shares/{}/{}'.format(server.URL_PREFIX, SHARED_FOLDER, RECIPIENT)
+        print 'Owner snapshot: {:,} files'.format(len(snapshot))
+        resp = timed('share creation', lambda: app.post(share_url, headers=auth_headers(OWNER)))
+        assert resp.status_code < server.HTTP_BAD_REQUEST, resp.status_code
+        view = timed('recipient shared view', lambda: server.shared_view(RECIPIENT))
+        assert len(view) == len(snapshot.subtree(SHARED_FOLDER))
+        subtree_url = '{}/files/?subtree={}'.format(server.URL_PREFIX, SHARED_FOLDER)
+        timed('subtree listing (GET)', lambda: app.get(subtree_url, headers=auth_headers(OWNER)))
+        resp = timed('share removal', lambda: app.delete(share_url, headers=auth_headers(OWNER)))
+        assert resp.status_code < server.HTTP_BAD_REQUEST, resp.status_code
+    finally:
+        os.chdir(os.path.dirname(work_dir))
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
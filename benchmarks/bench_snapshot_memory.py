@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark of the client snapshot: plain dict vs CompactSnapshot.
+
+Every measure runs in a fresh process and reports the peak resident memory (max RSS)
+needed to hold a snapshot of N synthetic files (100 files per directory, 3 directory levels).
+
+Usage:
+    $ python benchmarks/bench_snapshot_memory.py [N ...]    # default: 1000000 5000000
+"""
+import os
+import sys
+import time
+import hashlib
+import resource
+import subprocess
+
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'client')
+sys.path.insert(0, CLIENT_DIR)
+
+DEFAULT_SIZES = (1000000, 5000000)
+
+
+def iter_entries(n):
+    timestamp = long(time.time() * 10000)
+    for i in xrange(n):
+        path = 'projects/project{}/src/module{}/file{}.py'.format(i // 100000, i // 100, i)
+        yield path, [timestamp + i, hashlib.md5(str(i)).hexdigest()]
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(kind, n):
+    """
+    Build the snapshot in the current process and print the used memory in KB.
+    """
+    if kind == 'dict':
+        snapshot = {}
+    else:
+        from snapshot import CompactSnapshot
+        snapshot = CompactSnapshot()
+    baseline = max_rss_kb()
+    for path, value in iter_entries(n):
+        snapshot[path] = value
+    print max_rss_kb() - baseline
+
+
+def main(sizes):
+    print '{:>10} {:>14} {:>14} {:>8}'.format('entries', 'dict (MB)', 'compact (MB)', 'ratio')
+    for n in sizes:
+        results = {}
+        for kind in ('dict', 'compact'):
+            out = subprocess.check_output([sys.executable, __file__, '--measure', kind, str(n)])
+            results[kind] = int(out) / 1024.0
+        print '{:>10,} {:>14,.1f} {:>14,.1f} {:>8.2f}'.format(n, results['dict'], results['compact'],
+                                                            results['dict'] / results['compact'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], int(sys.argv[3]))
+    else:
+        main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bytes on the wire and times of the snapshot representations of GET /files/ (see server.negotiate_snapshot):
+json (indented as jsonify did, or compact) or the binary format of snapshot_codec, not compressed or
+compressed with gzip or deflate.
+
+The snapshot of N synthetic files (100 files per directory, 3 directory levels) is a server SnapshotTree.
+The encode time is the server one (serialization and compression), the parse time the client one
+(decompression and parsing). The garbage collector is disabled, otherwise its runs over the millions of
+objects of the parsed snapshots make the times noisy.
+
+Usage:
+    $ python benchmarks/bench_snapshot_wire.py [N ...]    # default: 100000 1000000
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import gc
+import hashlib
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'server')
+sys.path.insert(0, SERVER_DIR)
+
+from snapshot import SnapshotTree
+import snapshot_codec
+
+DEFAULT_SIZES = (100000, 1000000)
+COMPRESSION_LEVEL = 6
+
+
+def make_document(n):
+    timestamp = long(time.time() * 10000)
+    tree = SnapshotTree()
+    for i in xrange(n):
+        path = u'projects/project{}/src/module{}/file{}.py'.format(i // 100000, i // 100, i)
+        tree[path] = [timestamp + i, hashlib.md5(str(i)).hexdigest()]
+    return {'server_timestamp': timestamp, 'files': tree, 'shared_files': SnapshotTree()}
+
+
+def to_json(document, **kwargs):
+    return json.dumps(dict((key, dict(value.iteritems()) if isinstance(value, SnapshotTree) else value)
+                           for key, value in document.iteritems()), **kwargs)
+
+
+def gzip(data):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gunzip(data):
+    return zlib.decompress(data, zlib.MAX_WBITS | 16)
+
+
+def identity(data):
+    return data
+
+
+FORMATS = [
+    ('json indented', lambda document: to_json(document, indent=2), json.loads),
+    ('json', lambda document: to_json(document, separators=(',', ':')), json.loads),
+    ('binary', snapshot_codec.encode, snapshot_codec.decode),
+]
+
+ENCODINGS = [
+    ('', identity, identity),
+    ('+gzip', gzip, gunzip),
+    ('+deflate', lambda data: zlib.compress(data, COMPRESSION_LEVEL), zlib.decompress),
+]
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main(sizes):
+    gc.disable()
+    print '{:>10} {:<22} {:>14} {:>8} {:>12} {:>12}'.format(
+        'entries', 'representation', 'bytes', 'ratio', 'encode (s)', 'parse (s)')
+    for n in sizes:
+        document = make_document(n)
+        baseline = None
+        for format_name, encode, parse in FORMATS:
+            body, encode_time = timed(encode, document)
+            for encoding_name, compress, decompress in ENCODINGS:
+                wire, compress_time = timed(compress, body)
+                baseline = baseline or len(wire)
+                start = time.time()
+                parsed = parse(decompress(wire))
+                parse_time = time.time() - start
+                assert len(parsed['files']) == n
+                del parsed
+                print '{:>10,} {:<22} {:>14,} {:>7.1f}% {:>12.2f} {:>12.2f}'.format(
+                    n, format_name + encoding_name, len(wire), 100.0 * len(wire) / baseline,
+                    encode_time + compress_time, parse_time)
+        print
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
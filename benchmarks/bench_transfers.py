@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Many concurrent slow (throttled) clients uploading and then downloading a file, against:
+ - the streaming transfer service (server/transfers.py), a single event loop thread;
+ - the Flask app on the threaded werkzeug server, a thread for each connection.
+
+Each client sends and receives at most <rate> bytes per second, so every transfer lasts a few seconds
+and all the clients are connected together. The peak number of threads and the peak resident memory
+of the server process are sampled from /proc during the run.
+
+Usage:
+    $ python benchmarks/bench_transfers.py [CLIENTS] [SIZE] [RATE]    # default: 1000 16384 8192
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import signal
+import socket
+import asyncore
+import hashlib
+import logging
+import tempfile
+
+import werkzeug.serving
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'server')
+sys.path.insert(0, SERVER_DIR)
+
+import server
+from transfers import TransferServer
+
+HOST = '127.0.0.1'
+USER, PASSWORD = 'user@mail.com', 'Password_85'
+IO_SIZE = 1024
+
+
+class ThrottledClient(asyncore.dispatcher):
+    """
+    Send a request and read the response, IO_SIZE bytes at a time, at most <rate> bytes per second.
+    """
+    def __init__(self, port, request, rate, results, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.request = request
+        self.interval = IO_SIZE / float(rate)
+        # Don't start all together
+        self.next_io = time.time() + random.random() * self.interval
+        self.response = []
+        self.results = results
+        self.connect((HOST, port))
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return bool(self.request) and time.time() >= self.next_io
+
+    def readable(self):
+        return time.time() >= self.next_io
+
+    def handle_write(self):
+        sent = self.send(self.request[:IO_SIZE])
+        self.request = self.request[sent:]
+        self.next_io = time.time() + self.interval
+
+    def handle_read(self):
+        self.response.append(self.recv(IO_SIZE))
+        self.next_io = time.time() + self.interval
+
+    def handle_close(self):
+        self.close()
+        response = ''.join(self.response)
+        self.results.append(int(response.split(' ', 2)[1]) if response else None)
+
+
+def auth_header(token):
+    return 'Authorization: Basic ' + base64.b64encode('{}:{}'.format(USER, token))
+
+
+def transfers_upload(path, content, token):
+    return '\r\n'.join([
+        'POST {}/files/{}?md5={} HTTP/1.0'.format(server.URL_PREFIX, path, hashlib.md5(content).hexdigest()),
+        auth_header(token), 'Content-Length: {}'.format(len(content)), '', content])
+
+
+def flask_upload(path, content, token):
+    boundary = 'BENCHMARKBOUNDARY'
+    body = '\r\n'.join([
+        '--' + boundary, 'Content-Disposition: form-data; name="md5"', '', hashlib.md5(content).hexdigest(),
+        '--' + boundary, 'Content-Disposition: form-data; name="file"; filename="file.bin"',
+        'Content-Type: application/octet-stream', '', content, '--' + boundary + '--', ''])
+    return '\r\n'.join([
+        'POST {}/files/{} HTTP/1.0'.format(server.URL_PREFIX, path), auth_header(token),
+        'Content-Type: multipart/form-data; boundary=' + boundary, 'Content-Length: {}'.format(len(body)), '', body])
+
+
+def download(path, content, token):
+    return '\r\n'.join(['GET {}/files/{} HTTP/1.0'.format(server.URL_PREFIX, path), auth_header(token), '', ''])
+
+
+def process_stats(pid):
+    """
+    Return the (threads, resident memory in MB) of the process <pid>.
+    """
+    stats = {}
+    with open('/proc/{}/status'.format(pid)) as fp:
+        for line in fp:
+            name, _, value = line.partition(':')
+            stats[name] = value.split()
+    return int(stats['Threads'][0]), int(stats['VmRSS'][0]) / 1024.0
+
+
+def run_clients(port, server_pid, requests, rate):
+    """
+    Run a client for each request, and return (seconds, succeeded requests, peak threads, peak memory).
+    """
+    client_map = {}
+    results = []
+    for request in requests:
+        ThrottledClient(port, request, rate, results, client_map)
+    peak_threads, peak_memory = process_stats(server_pid)
+    start = time.time()
+    next_sample = start
+    while client_map:
+        asyncore.loop(timeout=0.01, use_poll=True, map=client_map, count=1)
+        if time.time() >= next_sample:
+            threads, memory = process_stats(server_pid)
+            peak_threads, peak_memory = max(peak_threads, threads), max(peak_memory, memory)
+            next_sample = time.time() + 0.2
+    succeeded = sum(1 for status in results if status is not None and status < 400)
+    return time.time() - start, succeeded, peak_threads, peak_memory
+
+
+def start_server(serve):
+    pid = os.fork()
+    if pid == 0:
+        logging.getLogger('werkzeug').setLevel(logging.CRITICAL)
+        try:
+            serve()
+        finally:
+            os._exit(0)
+    return pid
+
+
+def main(clients, size, rate):
+    server.logger.setLevel(logging.CRITICAL)
+    work_dir = tempfile.mkdtemp()
+    os.chdir(work_dir)
+    try:
+        state = server.init_user_directory(USER)
+        state.update({server.PWD: server._encrypt_password(PASSWORD), server.USER_IS_ACTIVE: True,
+                      server.USER_CREATION_TIME: 0, 'shared_with_me': {}, 'shared_with_others': {}})
+        server.userdata[USER] = state
+        # A session token, to skip the slow password verification
+        token = server.session_tokens().issue(USER, state[server.PWD])
+
+        print '{} clients, {} bytes per file, {} bytes/s per client'.format(clients, size, rate)
+        for label, make_upload in (('transfers', transfers_upload), ('flask', flask_upload)):
+            if label == 'transfers':
+                transfers = TransferServer(HOST, 0)
+                port, serve = transfers.port, transfers.serve_forever
+            else:
+                httpd = werkzeug.serving.make_server(HOST, 0, server.app, threaded=True)
+                httpd.socket.listen(clients)
+                port, serve = httpd.server_port, httpd.serve_forever
+            server_pid = start_server(serve)
+            try:
+                paths = ['Bench/{}/file{}.bin'.format(label, i) for i in range(clients)]
+                contents = [os.urandom(size) for _ in paths]
+                for phase, make_request in (('upload', make_upload), ('download', download)):
+                    requests = [make_request(path, content, token) for path, content in zip(paths, contents)]
+                    seconds, succeeded, threads, memory = run_clients(port, server_pid, requests, rate)
+                    print '{:<10} {:<9} {:>6.1f} s  {:>5}/{} ok  peak threads: {:>5}  peak memory: {:>7.1f} MB'.format(
+                        label, phase, seconds, succeeded, clients, threads, memory)
+            finally:
+                os.kill(server_pid, signal.SIGTERM)
+                os.waitpid(server_pid, 0)
+    finally:
+        os.chdir(SERVER_DIR)
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [1000, 2 ** 14, 2 ** 13][len(args):]))
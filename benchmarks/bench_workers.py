@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Throughput of the multi-process server (see server/prefork.py) by number of worker processes.
+
+For 1, 2, 4, ... workers it runs a local server and <clients> client processes, each one doing for
+<seconds> seconds authenticated requests of one kind:
+ - snapshot: GET /files/ of an user with <files> files;
+ - upload: POST /files/<path> of a small new file.
+
+The workers can only scale up to the number of cpu cores (shared with the clients).
+
+Usage:
+    $ python benchmarks/bench_workers.py [MAX_WORKERS] [CLIENTS] [SECONDS]    # default: 4 8 5
+"""
+import os
+import sys
+import time
+import base64
+import shutil
+import signal
+import socket
+import hashlib
+import httplib
+import logging
+import tempfile
+import multiprocessing
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'server')
+sys.path.insert(0, SERVER_DIR)
+
+import server
+import prefork
+
+HOST = '127.0.0.1'
+USERS = ['user{}@mail.com'.format(i) for i in range(4)]
+PASSWORD = 'Password_85'
+FILES = 2000
+
+
+def auth_headers(user):
+    return {'Authorization': 'Basic ' + base64.b64encode('{}:{}'.format(user, PASSWORD))}
+
+
+def create_users():
+    for user in USERS:
+        state = server.init_user_directory(user)
+        state.update({server.PWD: server._encrypt_password(PASSWORD), server.USER_IS_ACTIVE: True,
+                      server.USER_CREATION_TIME: 0, 'shared_with_me': {}, 'shared_with_others': {}})
+        # Metadata only: the snapshot request doesn't read the files.
+        for i in xrange(FILES):
+            state[server.SNAPSHOT]['Work/dir{}/file{}.txt'.format(i % 20, i)] = [0, hashlib.md5(str(i)).hexdigest()]
+        server.userdata[user] = state
+    server.save_userdata()
+
+
+def start_server(port, workers):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            prefork.PreforkServer(HOST, port, workers).run()
+        finally:
+            os._exit(0)
+    # Wait for the workers
+    for _ in xrange(100):
+        try:
+            connection = httplib.HTTPConnection(HOST, port)
+            connection.request('GET', '{}/files/'.format(server.URL_PREFIX), headers=auth_headers(USERS[0]))
+            response = connection.getresponse()
+            response.read()
+            if response.status == server.HTTP_OK:
+                return pid
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('Server not started')
+
+
+def snapshot_request(connection, user, i):
+    connection.request('GET', '{}/files/'.format(server.URL_PREFIX), headers=auth_headers(user))
+
+
+def upload_request(connection, user, i):
+    content = 'file {} of {}'.format(i, os.getpid())
+    boundary = 'BENCHMARKBOUNDARY'
+    body = '\r\n'.join([
+        '--' + boundary, 'Content-Disposition: form-data; name="md5"', '', hashlib.md5(content).hexdigest(),
+        '--' + boundary, 'Content-Disposition: form-data; name="file"; filename="file.txt"',
+        'Content-Type: text/plain', '', content, '--' + boundary + '--', ''])
+    headers = auth_headers(user)
+    headers['Content-Type'] = 'multipart/form-data; boundary=' + boundary
+    path = 'Bench/{}/file{}.txt'.format(os.getpid(), i)
+    connection.request('POST', '{}/files/{}'.format(server.URL_PREFIX, path), body, headers)
+
+
+def client(port, make_request, client_id, seconds, results):
+    user = USERS[client_id % len(USERS)]
+    done = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        connection = httplib.HTTPConnection(HOST, port)
+        make_request(connection, user, done)
+        response = connection.getresponse()
+        response.read()
+        assert response.status < 400, response.status
+        done += 1
+    results.put(done)
+
+
+def requests_per_second(port, make_request, clients, seconds):
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=client, args=(port, make_request, i, seconds, results))
+                 for i in range(clients)]
+    for process in processes:
+        process.start()
+    total = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return total / float(seconds)
+
+
+def main(max_workers, clients, seconds):
+    server.logger.setLevel(logging.CRITICAL)
+    logging.getLogger('werkzeug').setLevel(logging.CRITICAL)
+    print 'cpu cores: {}, clients: {}, files per user: {}'.format(multiprocessing.cpu_count(), clients, FILES)
+    workers = 1
+    while workers <= max_workers:
+        work_dir = tempfile.mkdtemp()
+        os.chdir(work_dir)
+        server.reset_userdata()
+        sock = socket.socket()
+        sock.bind((HOST, 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        try:
+            create_users()
+            server_pid = start_server(port, workers)
+            try:
+                snapshot_rate = requests_per_second(port, snapshot_request, clients, seconds)
+                upload_rate = requests_per_second(port, upload_request, clients, seconds)
+            finally:
+                os.kill(server_pid, signal.SIGTERM)
+                os.waitpid(server_pid, 0)
+            print 'workers: {:<3} snapshot: {:>8.1f} req/s   upload: {:>8.1f} req/s'.format(
+                workers, snapshot_rate, upload_rate)
+        finally:
+            os.chdir(SERVER_DIR)
+            shutil.rmtree(work_dir)
+        workers *= 2
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [4, 8, 5][len(args):]))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Content-defined chunking of the files to upload, so that the server stores the chunks and the files that share
+most of their bytes with the stored ones (renamed exports, versioned copies, appended data...) are uploaded
+by their new chunks only (see ConnectionManager.do_upload_chunks).
+
+A chunk ends where the gear hash of the bytes before (a rolling hash of the last 32 bytes) has its top MASK_BITS
+bits at 0, so the boundaries depend on the content around them, not on their offset: an insertion or a removal
+changes the chunks near it only. The chunks are CHUNK_MIN_SIZE bytes at least (the hash is not checked before)
+and CHUNK_MAX_SIZE at most, CHUNK_MIN_SIZE + 2 ** MASK_BITS on average.
+"""
+
+import struct
+import hashlib
+
+
+CHUNK_MIN_SIZE = 2 ** 14
+CHUNK_MAX_SIZE = 2 ** 18
+MASK_BITS = 16
+READ_SIZE = 2 ** 22
+
+# The hash "forgets" a byte after 32 shifts
+_WINDOW = 32
+_HASH_MASK = 0xffffffff
+_BOUNDARY_MASK = ((1 << MASK_BITS) - 1) << (32 - MASK_BITS)
+# A fixed random value for each byte value
+_GEAR = [struct.unpack('>I', hashlib.md5(chr(i)).digest()[:4])[0] for i in range(256)]
+
+
+def _boundary(data, start, end):
+    """
+    Return the end of the chunk that starts at <start> in <data>, looking for a boundary before <end>.
+    """
+    if end - start <= CHUNK_MIN_SIZE:
+        return end
+    limit = min(end, start + CHUNK_MAX_SIZE)
+    gear = _GEAR
+    h = 0
+    # Only the last _WINDOW bytes count: the hash is warmed up with the bytes before the minimum size
+    for i in xrange(start + CHUNK_MIN_SIZE - _WINDOW, start + CHUNK_MIN_SIZE):
+        h = ((h << 1) + gear[data[i]]) & _HASH_MASK
+    for i in xrange(start + CHUNK_MIN_SIZE, limit):
+        h = ((h << 1) + gear[data[i]]) & _HASH_MASK
+        if not h & _BOUNDARY_MASK:
+            return i + 1
+    return limit
+
+
+def iter_chunks(fp):
+    """
+    Yield the chunks (str) of the file object <fp>.
+    """
+    data = bytearray()
+    eof = False
+    while True:
+        if not eof and len(data) < CHUNK_MAX_SIZE:
+            chunk = fp.read(READ_SIZE)
+            eof = not chunk
+            data += chunk
+            continue
+        if not data:
+            return
+        start = 0
+        # The last chunk of a read can be cut by the end of the data, unless it is the end of the file
+        while len(data) - start >= CHUNK_MAX_SIZE or (eof and start < len(data)):
+            end = _boundary(data, start, len(data))
+            yield str(data[start:end])
+            start = end
+        del data[:start]
+
+
+def file_chunks(fp):
+    """
+    Return the [<md5>, <size>] list of the chunks of the file object <fp>.
+    :return: list
+    """
+    return [[hashlib.md5(chunk).hexdigest(), len(chunk)] for chunk in iter_chunks(fp)]
@@ -182,6 +182,15 @@ class CommandParser(cmd.Cmd):
         print response['content']
         return 'exit'
 
+    def do_sync(self, line):
+        """
+        Synchronize now with the server
+        """
+        message = {'sync': ()}
+        response = self._send_to_daemon(message)
+        print response['content']
+        return response
+
     def do_register(self, line):
         """
         Create new user:
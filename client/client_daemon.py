@@ -10,6 +10,9 @@ import hashlib
 import logging
 import datetime
 import argparse
+import threading
+import time
+import random
 from sys import exit as exit
 from collections import OrderedDict
 from shutil import copy2, move
@@ -17,10 +20,11 @@ from shutil import copy2, move
 # we import PollingObserver instead of Observer because the deleted event
 # is not capturing https://github.com/gorakhargosh/watchdog/issues/46
 from watchdog.observers.polling import PollingObserver as Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import FileSystemEventHandler, EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, EVENT_TYPE_MOVED
 import keyring
 
 from connection_manager import ConnectionManager
+from snapshot import CompactSnapshot, SnapshotCollector, SnapshotDiff
 
 
 # Logging configuration
@@ -68,10 +72,95 @@ class SkipObserver(Observer):
                 skip = True
         if not skip:
             self._dispatch_event(event, watch)
+        if event_queue.empty():
+            # No more events for now: the handlers complete the operations they kept waiting (see Daemon.on_idle).
+            # They send requests to the server: the lock is released meanwhile, not to block schedule/unschedule.
+            with self._lock:
+                handlers = list(self._handlers.get(watch, ()))
+            for handler in handlers:
+                if hasattr(handler, 'on_idle'):
+                    handler.on_idle()
 
         event_queue.task_done()
 
 
+class ChangeListener(threading.Thread):
+    """
+    Thread waiting for the changes of the user data on the server (long-poll requests, see the server
+    notifications.py), that calls on_change() at each one. <listening> is False while the server can't be asked
+    (i.e. it is down, or it doesn't notify the changes): meanwhile the daemon polls it.
+    """
+    WAIT_TIMEOUT = 60
+    RETRY_DELAY = 30
+
+    def __init__(self, conn_mng, on_change):
+        threading.Thread.__init__(self, name='ChangeListener')
+        self.daemon = True
+        self.conn_mng = conn_mng
+        self.on_change = on_change
+        self.listening = False
+        self._stopped = False
+
+    def run(self):
+        version = None
+        while not self._stopped:
+            response = self.conn_mng.dispatch_request('wait_changes', {'since': version, 'timeout': self.WAIT_TIMEOUT})
+            if self._stopped:
+                break
+            if not response['successful']:
+                if self.listening:
+                    logger.warning(response['content'])
+                self.listening = False
+                # The changes made meanwhile are found polling
+                version = None
+                time.sleep(self.RETRY_DELAY)
+                continue
+            if version is not None and response['content'] > version:
+                self.on_change()
+            version = response['content']
+            self.listening = True
+
+    def stop(self):
+        self._stopped = True
+
+
+class PollScheduler(object):
+    """
+    When to sync with the server, if it doesn't notify the changes: MIN_INTERVAL seconds after a change
+    (local or on the server), then less and less often while nothing changes, doubling the interval at each poll
+    up to MAX_INTERVAL. A random jitter of the intervals keeps apart the polls of the clients started together.
+    """
+    MIN_INTERVAL = 3
+    MAX_INTERVAL = 60 * 5
+    JITTER = 0.2
+
+    def __init__(self, now=time.time):
+        self._now = now
+        self.interval = self.MIN_INTERVAL
+        self.next_poll = now() + self.interval
+
+    def is_due(self):
+        return self._now() >= self.next_poll
+
+    def polled(self, changed, interval=None):
+        """
+        Schedule the next poll after a poll that found changes (<changed>) or not.
+        :param interval: a fixed interval to the next poll (i.e. while the server notifies the changes)
+        """
+        if changed:
+            self.interval = self.MIN_INTERVAL
+        else:
+            self.interval = min(self.interval * 2, self.MAX_INTERVAL)
+        self.next_poll = self._now() + (interval or self.interval * random.uniform(1 - self.JITTER, 1 + self.JITTER))
+
+    def activity(self):
+        """
+        Something has changed locally: poll again soon.
+        """
+        self.interval = self.MIN_INTERVAL
+        self.next_poll = min(self.next_poll, self._now() + self.MIN_INTERVAL)
+
+
 def is_directory(method):
     def wrapper(self, e):
         if e.is_directory:
@@ -97,6 +186,28 @@ class Daemon(FileSystemEventHandler):
     # Calculate int size in the machine architecture
     INT_SIZE = struct.calcsize('!i')
 
+    # Max number of actions sent to the server in a single batch request
+    ACTIONS_BATCH_SIZE = 1000
+    # Many new small files are uploaded together in tar archives (see _upload_archive)
+    ARCHIVE_MIN_FILES = 10
+    ARCHIVE_FILE_MAX_SIZE = 2 ** 20
+    ARCHIVE_MAX_SIZE = 2 ** 26
+    ARCHIVE_DOWNLOAD_PATHS = 200
+    # The modified files of this size at least are transferred as deltas (see delta.py)
+    DELTA_MIN_SIZE = 2 ** 20
+    # The new files of this size at least are uploaded by chunks (see chunking.py)
+    CHUNKS_MIN_SIZE = 2 ** 20
+    # The modified files of this size at least are checked for appended data (see _hash_modified): their old
+    # content, read again, must have the md5 of the synced version
+    APPEND_MIN_SIZE = 2 ** 20
+    # A single file is preflighted (see _send_file) if it has this size at least: for the smaller ones the request
+    # costs more than it can save. The files of a sync or of a batch of create events are preflighted together.
+    PREFLIGHT_MIN_SIZE = 2 ** 20
+
+    # Seconds between two syncs with the server while it notifies the changes (see ChangeListener),
+    # otherwise the syncs are scheduled by PollScheduler
+    SAFETY_POLL_INTERVAL = 60 * 5
+
     # Allowed operation before user is activated
     ALLOWED_OPERATION = {'register', 'activate', 'login'}
 
@@ -105,11 +216,25 @@ class Daemon(FileSystemEventHandler):
         # Just Initialize variable the Daemon.start() do the other things
         self.daemon_state = 'down'  # TODO implement the daemon state (disconnected, connected, syncronizing, ready...)
         self.running = 0
-        self.client_snapshot = {}  # EXAMPLE {'<filepath1>: ['<timestamp>', '<md5>', '<filepath2>: ...}
-        self.shared_snapshot = {}
+        self.client_snapshot = CompactSnapshot()  # EXAMPLE {'<filepath1>: ['<timestamp>', '<md5>', '<filepath2>: ...}
+        self.shared_snapshot = CompactSnapshot()
+        # The ETag of the server snapshot of the last synchronization (see sync_with_server)
+        self.snapshot_etag = None
         self.local_dir_state = {}  # EXAMPLE {'last_timestamp': '<timestamp>', 'global_md5': '<md5>'}
         self.listener_socket = None
         self.observer = None
+        # Relative paths of the deleted files (or directories) not yet deleted on the server (see on_deleted)
+        self.pending_deletes = []
+        # Move events not yet sent to the server (see dispatch)
+        self.pending_moves = []
+        # (<relative path>, <md5>) of the created files not yet uploaded (see on_created)
+        self.pending_uploads = []
+        # Set by the ChangeListener thread when the server data has changed
+        self.server_changed = threading.Event()
+        self.change_listener = None
+        self.poll_scheduler = PollScheduler()
+        # {<absolute path>: <size>} of the big hashed files (see _hash_modified)
+        self.file_sizes = {}
         self.cfg = self._load_cfg(cfg_path, sharing_path)
         self.password = self._load_pass()
         self._init_sharing_path(sharing_path)
@@ -120,6 +245,7 @@ class Daemon(FileSystemEventHandler):
             'addshare': self._add_share,
             'removeshare': self._remove_share,
             'removeshareduser': self._remove_shared_user,
+            'sync': self._sync_command,
         }
 
     def _build_directory(self, path):
@@ -236,7 +362,7 @@ class Daemon(FileSystemEventHandler):
             "<file_path>":('<timestamp>', '<md5>')
         }
         """
-        self.client_snapshot = {}
+        self.client_snapshot = CompactSnapshot()
         for dirpath, dirs, files in os.walk(self.cfg['sharing_path']):
             for filename in files:
                 filepath = os.path.join(dirpath, filename)
@@ -252,12 +378,10 @@ class Daemon(FileSystemEventHandler):
             "shared/<user>/<file_path>":('<timestamp>', '<md5>')
         }
         """
-        response = self.conn_mng.dispatch_request('get_server_snapshot', '')
+        response = self.conn_mng.dispatch_request('get_server_snapshot',
+                                                  {'consumer': SnapshotCollector(['shared_files'])})
         if response['successful']:
-            try:
-                self.shared_snapshot = response['content']['shared_files']
-            except KeyError:
-                self.shared_snapshot = {}
+            self.shared_snapshot = response['content']['shared_files']
         else:
             self.stop(1, '\nReceived None snapshot. Server down?\n')
 
@@ -410,32 +534,12 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                            'Impossible to find the following file in stored data (client_snapshot):\n'
                            '{}'.format(abs_path))
 
-    def _sync_process(self, server_timestamp, server_dir_tree, shared_dir_tree={}):
+    def _sync_process(self, diff):
         # Makes the synchronization logic and return a list of commands to launch
-        # for server synchronization
-
-        def _filter_tree_difference(client_dir_tree, server_dir_tree):
-            # process local dir_tree and server dir_tree
-            # and makes a diffs classification
-            # return a dict representing that classification
-            # E.g. { 'new_on_server'     : <[<filepath>, ...]>,  # files in server, but not in client
-            # 'modified'          : <[<filepath>, ...]>,  # files in server and client, but different
-            # 'new_on_client'     : <[<filepath>, ...]>,  # files not in server, but in client
-            # }
-            client_files = set(client_dir_tree.keys())
-            server_files = set(server_dir_tree.keys())
-
-            new_on_server = list(server_files.difference(client_files))
-            new_on_client = list(client_files.difference(server_files))
-            modified = []
-
-            for filepath in server_files.intersection(client_files):
-                # check files md5
-
-                if server_dir_tree[filepath][1] != client_dir_tree[filepath][1]:
-                    modified.append(filepath)
-
-            return {'new_on_server': new_on_server, 'modified': modified, 'new_on_client': new_on_client}
+        # for server synchronization.
+        # <diff> is the SnapshotDiff of the server snapshot: diff.files classifies the user files
+        # (new_on_server, modified, new_on_client) and keeps the server_files that differ,
+        # diff.shared_files the same for the shared files
 
         def _check_md5(dir_tree, md5):
             result = []
@@ -444,29 +548,34 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                     result.append(k)
             return result
 
+        server_timestamp = diff.server_timestamp
         local_timestamp = self.local_dir_state['last_timestamp']
-        tree_diff = _filter_tree_difference(self.client_snapshot, server_dir_tree)
-        shared_tree_diff = _filter_tree_difference(self.shared_snapshot, shared_dir_tree)
+        tree_diff = diff.files
+        server_dir_tree = tree_diff.server_files
+        shared_tree_diff = diff.shared_files
         sync_commands = []
 
         if self._is_directory_modified():
-            if local_timestamp == server_timestamp:
-                logger.debug('local_timestamp == server_timestamp and directory IS modified')
+            # If no server file is newer than the last sync, only the client has changed: a file renamed here
+            # must not be renamed back
+            if local_timestamp == server_timestamp or tree_diff.newest is None or \
+                    tree_diff.newest <= local_timestamp:
+                logger.debug('no changes on server and directory IS modified')
                 logger.debug(tree_diff)
                 # simple case: the client has the command
                 # it sends all folder modifications to server
 
                 # files in server but not in client: remove them from server
-                for filepath in tree_diff['new_on_server']:
+                for filepath in tree_diff.new_on_server:
                     sync_commands.append(('delete', filepath))
                     # self.conn_mng.dispatch_request('delete', {'filepath': filepath})
 
                 # files modified in client: send modified files to server
-                for filepath in tree_diff['modified']:
+                for filepath in tree_diff.modified:
                     sync_commands.append(('modify', filepath))
 
                 # files in client but not in server: upload them to server
-                for filepath in tree_diff['new_on_client']:
+                for filepath in tree_diff.new_on_client:
                     sync_commands.append(('upload', filepath))
                     # self.conn_mng.dispatch_request('upload', {'filepath': filepath})
 
@@ -476,7 +585,7 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                 assert local_timestamp <= server_timestamp, 'ERROR something bad happen during SYNC process, ' \
                                                             'local_timestamp > di server_timestamp '
                 # the server has the command
-                for filepath in tree_diff['new_on_server']:
+                for filepath in tree_diff.new_on_server:
                     file_timestamp, md5 = server_dir_tree[filepath]
                     existed_filepaths_on_client = _check_md5(self.client_snapshot, md5)
                     # If i found at least one path in client_snapshot with the same md5 of filepath this mean in the
@@ -485,9 +594,9 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                     if existed_filepaths_on_client:
                         # it's a copy or a move
                         for path in existed_filepaths_on_client:
-                            if path in tree_diff['new_on_client']:
+                            if path in tree_diff.new_on_client:
                                 if self._make_move_on_client(path, filepath):
-                                    tree_diff['new_on_client'].remove(path)
+                                    tree_diff.new_on_client.remove(path)
                                     break
                                 else:
                                     self.stop(0, 'move failed on in SYNC: src_path: {}, dest_path: {}'.format(path,
@@ -509,7 +618,7 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                             sync_commands.append(('delete', filepath))
                             # self.conn_mng.dispatch_request('delete', {'filepath': filepath})
 
-                for filepath in tree_diff['modified']:
+                for filepath in tree_diff.modified:
                     file_timestamp, md5 = server_dir_tree[filepath]
 
                     if file_timestamp < local_timestamp:
@@ -526,7 +635,7 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                         sync_commands.append(('upload', conflicted_path))
                         # self.conn_mng.dispatch_request('upload', {'filepath': conflicted_path})
 
-                for filepath in tree_diff['new_on_client']:
+                for filepath in tree_diff.new_on_client:
                     sync_commands.append(('upload', filepath))
                     # self.conn_mng.dispatch_request('upload', {'filepath': filepath})
 
@@ -535,9 +644,8 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                 logger.debug('local_timestamp == server_timestamp and directory IS NOT modified')
                 logger.debug(tree_diff)
                 # it's the best case. Client and server are already synchronized
-                for key in tree_diff:
-                    assert not tree_diff[key], 'local_timestamp == server_timestamp but tree_diff is not empty!\n' \
-                                               'tree_diff:\n{}'.format(tree_diff)
+                assert not (tree_diff.new_on_server or tree_diff.modified or tree_diff.new_on_client), \
+                    'local_timestamp == server_timestamp but tree_diff is not empty!\ntree_diff:\n{}'.format(tree_diff)
                 sync_commands = []
             else:  # local_timestamp < server_timestamp
                 logger.debug('local_timestamp < server_timestamp and directory IS NOT modified')
@@ -545,7 +653,7 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                 assert local_timestamp <= server_timestamp, 'ERROR something bad happen during SYNC process, ' \
                                                             'local_timestamp > di server_timestamp'
                 # the server has the command
-                for filepath in tree_diff['new_on_server']:
+                for filepath in tree_diff.new_on_server:
                     timestamp, md5 = server_dir_tree[filepath]
                     existed_filepaths_on_client = _check_md5(self.client_snapshot, md5)
                     # If i found at least one path in client_snapshot with the same md5 of filepath this mean that
@@ -554,9 +662,9 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                     if existed_filepaths_on_client:
                         # it's a copy or a move
                         for path in existed_filepaths_on_client:
-                            if path in tree_diff['new_on_client']:
+                            if path in tree_diff.new_on_client:
                                 if self._make_move_on_client(path, filepath):
-                                    tree_diff['new_on_client'].remove(path)
+                                    tree_diff.new_on_client.remove(path)
                                     break
                                 else:
                                     self.stop(0, 'move failed on in SYNC: src_path: {}, dest_path: {}'.format(path,
@@ -571,16 +679,18 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                         sync_commands.append(('download', filepath))
                         # self.conn_mng.dispatch_request('download', {'filepath': filepath})
 
-                for filepath in tree_diff['modified']:
-                    self._make_delete_on_client(filepath)
+                for filepath in tree_diff.modified:
+                    # The big files are kept to download only their changes (see _download_deltas)
+                    if not self._is_big_file(filepath, self.DELTA_MIN_SIZE):
+                        self._make_delete_on_client(filepath)
                     sync_commands.append(('download', filepath))
                     # self.conn_mng.dispatch_request('download', {'filepath': filepath})
 
-                for filepath in tree_diff['new_on_client']:
+                for filepath in tree_diff.new_on_client:
                     # files that have been deleted on server, so we have to delete them
                     self._make_delete_on_client(filepath)
 
-        for filepath in shared_tree_diff['new_on_client']:
+        for filepath in shared_tree_diff.new_on_client:
             # files deleted on server
             abs_filepath = self.absolutize_path(filepath)
             self.observer.skip(abs_filepath)
@@ -596,55 +706,383 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                                'Impossible to find the following file in stored data (shared_snapshot):\n'
                                '{}'.format(abs_filepath))
 
-        for filepath in shared_tree_diff['modified']:
+        for filepath in shared_tree_diff.modified:
             sync_commands.append(('download', filepath))
 
-        for filepath in shared_tree_diff['new_on_server']:
+        for filepath in shared_tree_diff.new_on_server:
             sync_commands.append(('download', filepath))
 
         return sync_commands
 
-    def sync_with_server(self):
+    def _preflight(self, files):
         """
-        Makes the synchronization with server
+        Upload by hash: tell the server the files about to be uploaded, given as (<relative path>, <md5>).
+        The server creates at once the files whose content the user already has there (see server.Preflight).
+        Return the {<path>: <server timestamp>} of those files: the others must be uploaded.
+        If the server can't do it, all the files must be uploaded.
+        :return: dict
         """
-        response = self.conn_mng.dispatch_request('get_server_snapshot', '')
+        try:
+            data = {'files': [[path, md5, os.path.getsize(self.absolutize_path(path))] for path, md5 in files]}
+        except OSError:
+            # A file has been removed meanwhile
+            return {}
+        if not data['files']:
+            return {}
+        response = self.conn_mng.dispatch_request('preflight', data)
         if not response['successful']:
-            self.stop(1, response['content'])
+            logger.warning(response['content'])
+            return {}
+        return response['content']['materialized']
 
-        server_timestamp = response['content']['server_timestamp']
-        server_snapshot = response['content']['files']
+    def _send_file(self, cmd, rel_path, md5):
+        """
+        Upload (cmd 'upload') or modify (cmd 'modify') a file on the server, unless the server already has
+        its content (see _preflight, only for the files of PREFLIGHT_MIN_SIZE at least).
+        Return the response of the connection manager.
+        """
+        materialized = {}
+        if self._is_big_file(rel_path, self.PREFLIGHT_MIN_SIZE):
+            materialized = self._preflight([(rel_path, md5)])
+        if rel_path in materialized:
+            logger.info('File content already on server, not transferred: {}'.format(rel_path))
+            return {'content': {'server_timestamp': materialized[rel_path]}, 'successful': True}
+        if cmd == 'modify':
+            return self._modify_on_server(rel_path, md5)
+        return self._upload_on_server(rel_path, md5)
 
+    def _is_big_file(self, rel_path, min_size):
+        """
+        Check if the local file <rel_path> is <min_size> bytes at least.
+        """
         try:
-            shared_files = response['content']['shared_files']
-        except KeyError:
-            shared_files = {}
+            return os.path.getsize(self.absolutize_path(rel_path)) >= min_size
+        except OSError:
+            return False
 
-        sync_commands = self._sync_process(server_timestamp, server_snapshot, shared_files)
+    def _upload_on_server(self, rel_path, md5, modify=False):
+        """
+        Upload the new file <rel_path> (or the modified one, if <modify>): only the chunks that the server doesn't
+        have if it is big (see chunking.py), otherwise, or if the server can't rebuild it, the whole file.
+        Return the response of the connection manager.
+        """
+        if self._is_big_file(rel_path, self.CHUNKS_MIN_SIZE):
+            response = self.conn_mng.dispatch_request('upload_chunks', {'filepath': rel_path, 'md5': md5,
+                                                                        'modify': modify})
+            if response['successful']:
+                return response
+            logger.warning(response['content'])
+        return self.conn_mng.dispatch_request('modify' if modify else 'upload', {'filepath': rel_path, 'md5': md5})
+
+    def _append_on_server(self, rel_path, offset, size, md5):
+        """
+        Send only the bytes appended to the file <rel_path> (see _hash_modified): the server version is <offset>
+        bytes long, the new one <size>. If the server can't append them, send the whole file (see _modify_on_server).
+        Return the response of the connection manager.
+        """
+        response = self.conn_mng.dispatch_request('append', {'filepath': rel_path, 'offset': offset, 'size': size,
+                                                             'md5': md5})
+        if response['successful']:
+            return response
+        logger.warning(response['content'])
+        return self._modify_on_server(rel_path, md5)
+
+    def _modify_on_server(self, rel_path, md5):
+        """
+        Send the modified file <rel_path> to the server: only its changes if it is big (see delta.py),
+        otherwise, or if the server can't rebuild it, as a new file (see _upload_on_server).
+        Return the response of the connection manager.
+        """
+        if self._is_big_file(rel_path, self.DELTA_MIN_SIZE):
+            response = self.conn_mng.dispatch_request('modify_delta', {'filepath': rel_path, 'md5': md5})
+            if response['successful']:
+                return response
+            logger.warning(response['content'])
+        return self._upload_on_server(rel_path, md5, modify=True)
+
+    def _download_deltas(self, paths):
+        """
+        Update the big local files of <paths> (relative paths), downloading only their changes (see delta.py).
+        The files that can't be updated are removed, to be downloaded.
+        Return the {<path>: <md5>} of the updated files.
+        :return: dict
+        """
+        downloaded = {}
+        for path in paths:
+            if not self._is_big_file(path, self.DELTA_MIN_SIZE):
+                continue
+            response = self.conn_mng.dispatch_request('download_delta', {'filepath': path,
+                                                                         'skip': self.observer.skip})
+            if response['successful']:
+                downloaded[path] = response['content']
+            else:
+                logger.warning(response['content'])
+                abs_path = self.absolutize_path(path)
+                self.observer.skip(abs_path)
+                os.remove(abs_path)
+        return downloaded
+
+    def _upload_archive(self, files):
+        """
+        Upload together the small files of <files>, given as (<relative path>, <md5>), if they are at least
+        ARCHIVE_MIN_FILES, in tar archives of ARCHIVE_MAX_SIZE bytes at most.
+        Return the {<path>: <server timestamp>} of the uploaded files: the others must be uploaded one by one.
+        :return: dict
+        """
+        small_files = []
+        for path, md5 in files:
+            try:
+                size = os.path.getsize(self.absolutize_path(path))
+            except OSError:
+                continue
+            if size <= self.ARCHIVE_FILE_MAX_SIZE:
+                small_files.append((path, md5, size))
+        if len(small_files) < self.ARCHIVE_MIN_FILES:
+            return {}
+
+        archives = [[]]
+        archive_size = 0
+        for path, md5, size in small_files:
+            if archive_size + size > self.ARCHIVE_MAX_SIZE and archives[-1]:
+                archives.append([])
+                archive_size = 0
+            archives[-1].append([path, md5])
+            archive_size += size
+
+        stored = {}
+        for archive in archives:
+            response = self.conn_mng.dispatch_request('upload_archive', {'files': archive})
+            if not response['successful']:
+                logger.warning(response['content'])
+                continue
+            stored.update(response['content']['stored'])
+            for path, status in response['content']['failed'].iteritems():
+                logger.warning('File refused by the server in the archive (status {}): {}'.format(status, path))
+        logger.info('{:,} files uploaded in {} archive(s)'.format(len(stored), len(archives)))
+        return stored
+
+    def _download_archive(self, paths, server_count):
+        """
+        Download together the files <paths> (relative paths), if they are at least ARCHIVE_MIN_FILES,
+        in tar archives requesting ARCHIVE_DOWNLOAD_PATHS files at most; when all the <server_count> user files
+        are to download (i.e. a new device) they are requested in a single archive of the whole user directory.
+        Return the {<path>: <md5>} of the downloaded files: the others must be downloaded one by one.
+        :return: dict
+        """
+        if len(paths) < self.ARCHIVE_MIN_FILES:
+            return {}
+        archives = []
+        own_paths = [path for path in paths if not self._is_shared_file(path)]
+        if own_paths and len(own_paths) == server_count:
+            archives.append({'subtree': '', 'files': own_paths})
+            paths = [path for path in paths if self._is_shared_file(path)]
+        for i in range(0, len(paths), self.ARCHIVE_DOWNLOAD_PATHS):
+            archives.append({'files': paths[i:i + self.ARCHIVE_DOWNLOAD_PATHS]})
+
+        downloaded = {}
+        for archive in archives:
+            archive['skip'] = self.observer.skip
+            response = self.conn_mng.dispatch_request('download_archive', archive)
+            if not response['successful']:
+                logger.warning(response['content'])
+                continue
+            downloaded.update(response['content'])
+        logger.info('{:,} files downloaded in {} archive(s)'.format(len(downloaded), len(archives)))
+        return downloaded
+
+    def flush_uploads(self):
+        """
+        Upload the files of the pending create events (see on_created): together, if they are many.
+        """
+        if not self.pending_uploads:
+            return
+        files, self.pending_uploads = self.pending_uploads, []
+        if len(files) >= self.ARCHIVE_MIN_FILES:
+            uploaded = self._preflight(files)
+            uploaded.update(self._upload_archive([(path, md5) for path, md5 in files if path not in uploaded]))
+        else:
+            uploaded = None
+        for path, md5 in files:
+            if uploaded is None:
+                response = self._send_file('upload', path, md5)
+            elif path in uploaded:
+                response = {'content': {'server_timestamp': uploaded[path]}, 'successful': True}
+            else:
+                # Already checked by the preflight
+                response = self._upload_on_server(path, md5)
+            if response['successful']:
+                event_timestamp = response['content']['server_timestamp']
+                self.client_snapshot[path] = [event_timestamp, md5]
+                self.update_local_dir_state(event_timestamp)
+            else:
+                self.stop(1, response['content'])
+        logger.debug('Create events completed.')
+
+    def _delete_on_server(self, paths):
+        """
+        Delete the files or directories <paths> (relative paths) on the server, sending up to ACTIONS_BATCH_SIZE
+        deletes per request, and remove their files from the client_snapshot.
+        Return the server timestamp of the last delete, or None if no file has been deleted.
+        :return: int or None
+        """
+        last_timestamp = None
+        for start in range(0, len(paths), self.ACTIONS_BATCH_SIZE):
+            batch = paths[start:start + self.ACTIONS_BATCH_SIZE]
+            if len(batch) == 1:
+                response = self.conn_mng.dispatch_request('delete', {'filepath': batch[0]})
+            else:
+                response = self.conn_mng.dispatch_request(
+                    'batch', {'actions': [{'cmd': 'delete', 'filepath': path} for path in batch]})
+            if not response['successful']:
+                self.stop(1, response['content'])
+            if len(batch) == 1:
+                results = [{'status': 200, 'server_timestamp': response['content']['server_timestamp']}]
+            else:
+                results = response['content']['results']
+
+            for path, result in zip(batch, results):
+                abs_path = self.absolutize_path(path)
+                if result['status'] != 200:
+                    logger.warning('Failed to delete file on server (status {}): {}'.format(result['status'], abs_path))
+                    continue
+                last_timestamp = result['server_timestamp']
+                if path in self.client_snapshot:
+                    self.client_snapshot.pop(path)
+                    logger.info('Deleted file on server.\nDeleted filepath: {}'.format(abs_path))
+                elif self._pop_subtree(path):
+                    logger.info('Deleted directory on server.\nDeleted path: {}'.format(abs_path))
+                else:
+                    logger.warning('WARNING inconsistency error during delete operation!\n'
+                                   'Impossible to find the following file in stored data (client_snapshot):\n'
+                                   '{}'.format(abs_path))
+        return last_timestamp
+
+    def _pop_subtree(self, path):
+        """
+        Remove from the client_snapshot the files under the directory <path>, and return them.
+        :return: list of (<path>, [<timestamp>, '<md5>'])
+        """
+        files = list(self.client_snapshot.iter_subtree(path))
+        for filepath, _ in files:
+            self.client_snapshot.pop(filepath)
+        return files
+
+    def _move_dir(self, src, dst):
+        """
+        Move the directory <src> to <dst> (relative paths) on the server with a single action, and update
+        the client_snapshot. If <src> is still there it's a copy (see on_moved).
+        Return False if the files must be moved one by one instead (shared paths, server failure).
+        :return: bool
+        """
+        if self._is_shared_file(src) or self._is_shared_file(dst):
+            return False
+        if not any(True for _ in self.client_snapshot.iter_subtree(src)):
+            return False
+        cmd = 'copy' if os.path.exists(self.absolutize_path(src)) else 'move'
+        response = self.conn_mng.dispatch_request(cmd, {'src': src, 'dst': dst})
+        if not response['successful']:
+            logger.warning('Failed to {} the directory {} on server, trying file by file.\n{}'.format(
+                cmd, src, response['content']))
+            return False
+        event_timestamp = response['content']['server_timestamp']
+        files = self._pop_subtree(src) if cmd == 'move' else list(self.client_snapshot.iter_subtree(src))
+        for path, (_, md5) in files:
+            self.client_snapshot[dst + path[len(src):]] = [event_timestamp, md5]
+        self.update_local_dir_state(event_timestamp)
+        logger.info('Directory {} on server: {} files.\nFrom path: {}\nTo path: {}'.format(
+            ('copied', 'moved')[cmd == 'move'], len(files), src, dst))
+        return True
+
+    def flush_moves(self):
+        """
+        Send to the server the pending move events (see dispatch): a single action for each moved directory,
+        that replaces the events of its files and subdirectories.
+        """
+        if not self.pending_moves:
+            return
+        events, self.pending_moves = self.pending_moves, []
+        dir_moves = sorted((self.relativize_path(e.src_path), self.relativize_path(e.dest_path))
+                           for e in events if e.is_directory)
+        # The moves of the subdirectories are part of the move of their parent (sorted before them)
+        moved_dirs = []
+        for src, dst in dir_moves:
+            if not any(src.startswith(moved + '/') for moved in moved_dirs) and self._move_dir(src, dst):
+                moved_dirs.append(src)
+        for e in events:
+            rel_src_path = self.relativize_path(e.src_path)
+            if not e.is_directory and not any(rel_src_path.startswith(moved + '/') for moved in moved_dirs):
+                self.on_moved(e)
+
+    def flush_deletes(self):
+        """
+        Delete on the server the files deleted by the pending delete events (see on_deleted).
+        """
+        if not self.pending_deletes:
+            return
+        paths, self.pending_deletes = self.pending_deletes, []
+        last_timestamp = self._delete_on_server(paths)
+        if last_timestamp is not None:
+            self.update_local_dir_state(last_timestamp)
+        logger.debug('Delete events completed.')
+
+    def sync_with_server(self):
+        """
+        Makes the synchronization with server.
+        The pages of the server snapshot are compared with the local snapshots as they arrive (see SnapshotDiff):
+        only the server files that differ are kept.
+        Return False if nothing had changed, on the server (see ConnectionManager.do_get_server_snapshot)
+        or here, since the last synchronization.
+        :return: bool
+        """
+        diff = SnapshotDiff(self.client_snapshot, self.shared_snapshot)
+        etag = None if self._is_directory_modified() else self.snapshot_etag
+        response = self.conn_mng.dispatch_request('get_server_snapshot', {'consumer': diff, 'etag': etag})
+        if not response['successful']:
+            self.stop(1, response['content'])
+        if response.get('not_modified'):
+            return False
+
+        server_timestamp = diff.server_timestamp
+        server_snapshot = diff.files.server_files
+        shared_files = diff.shared_files.server_files
+
+        sync_commands = self._sync_process(diff)
 
         # Initialize the variable where we put the timestamp of the last operation we did
         last_operation_timestamp = server_timestamp
 
+        # The files to upload whose content is already on the server are created by the preflight.
+        upload_md5s = dict((path, self.hash_file(self.absolutize_path(path)))
+                           for command, path in sync_commands if command in ('modify', 'upload'))
+        materialized = self._preflight(upload_md5s.items())
+        # Many small files are sent together
+        materialized.update(self._upload_archive([(path, md5) for path, md5 in upload_md5s.iteritems()
+                                                  if path not in materialized]))
+
+        # The big files changed on the server are updated with their changes, many other files are downloaded together
+        download_paths = [path for command, path in sync_commands if command == 'download']
+        downloaded = self._download_deltas(download_paths)
+        downloaded.update(self._download_archive([path for path in download_paths if path not in downloaded],
+                                                 diff.files.server_count))
+
+        # The deletes are sent together (see _delete_on_server)
+        deleted_timestamp = self._delete_on_server([path for command, path in sync_commands if command == 'delete'])
+        if deleted_timestamp is not None:
+            last_operation_timestamp = deleted_timestamp
+
         # makes all synchronization commands
         for command, path in sync_commands:
             if command == 'delete':
-                abs_path = self.absolutize_path(path)
-                response = self.conn_mng.dispatch_request(command, {'filepath': path})
-                if response['successful']:
-                    last_operation_timestamp = response['content']['server_timestamp']
-                    if self.client_snapshot.pop(path, 'ERROR') != 'ERROR':
-                        logger.info('Deleted file on server during SYNC.\nDeleted filepath: {}'.format(abs_path))
-                    else:
-                        logger.warning('WARNING inconsistency error during delete operation!\n'
-                                       'Impossible to find the following file in stored data (client_snapshot):\n'
-                                       '{}'.format(abs_path))
-                else:
-                    self.stop(1, response['content'])
+                continue
 
             elif command == 'modify' or command == 'upload':
                 abs_path = self.absolutize_path(path)
-                new_md5 = self.hash_file(abs_path)
-                response = self.conn_mng.dispatch_request(command, {'filepath': path, 'md5': new_md5})
+                if path in materialized:
+                    response = {'content': {'server_timestamp': materialized[path]}, 'successful': True}
+                elif command == 'modify':
+                    response = self._modify_on_server(path, upload_md5s[path])
+                else:
+                    response = self._upload_on_server(path, upload_md5s[path])
                 if response['successful']:
                     last_operation_timestamp = response['content']['server_timestamp']
                     cmd_type = ('Modified', 'Updated')[command == 'modify']
@@ -654,19 +1092,36 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
 
             else:  # command == 'download'
                 abs_path = self.absolutize_path(path)
-                # Skip next operation to prevent watchdog to see this download
-                self.observer.skip(abs_path)
-                response = self.conn_mng.dispatch_request(command, {'filepath': path})
+                if path in downloaded:
+                    response = {'successful': True}
+                else:
+                    # Skip next operation to prevent watchdog to see this download
+                    self.observer.skip(abs_path)
+                    response = self.conn_mng.dispatch_request(command, {'filepath': path})
                 if response['successful']:
                     logger.info('Downloaded file from server during SYNC.\nDownloaded filepath: {}'.format(abs_path))
-                    if self._is_shared_file(path):
-                        self.shared_snapshot[path] = shared_files[path]
+                    snapshot, server_files = ((self.shared_snapshot, shared_files) if self._is_shared_file(path)
+                                              else (self.client_snapshot, server_snapshot))
+                    if path in downloaded:
+                        # The file can have changed on the server after its snapshot: the md5 is the downloaded one
+                        snapshot[path] = [server_files[path][0], downloaded[path]]
                     else:
-                        self.client_snapshot[path] = server_snapshot[path]
+                        snapshot[path] = server_files[path]
                 else:
                     self.stop(1, response['content'])
 
         self.update_local_dir_state(last_operation_timestamp)
+        self.snapshot_etag = response.get('etag')
+        return True
+
+    def _sync(self):
+        """
+        Synchronize with the server, and schedule the next poll (see PollScheduler).
+        """
+        self.server_changed.clear()
+        changed = self.sync_with_server()
+        listening = self.change_listener is not None and self.change_listener.listening
+        self.poll_scheduler.polled(changed, self.SAFETY_POLL_INTERVAL if listening else None)
 
     def _is_shared_file(self, path):
         """
@@ -749,8 +1204,17 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
             logger.warning('You are writing file in path: {}\n'
                            'This is a read-only folder, so it will not be synchronized with server'
                            .format(rel_new_path))
+        elif data['cmd'] == 'upload':
+            # Copying a folder makes a create event for each file: while more events are coming, the uploads are
+            # kept waiting, to send the small files together (see flush_uploads).
+            self.pending_uploads.append((rel_new_path, new_md5))
+            if not self._more_events():
+                self.flush_uploads()
         else:
-            response = self.conn_mng.dispatch_request(data['cmd'], data['file'])
+            if data['cmd'] == 'copy':
+                response = self.conn_mng.dispatch_request(data['cmd'], data['file'])
+            else:
+                response = self._send_file(data['cmd'], rel_new_path, new_md5)
             if response['successful']:
                 event_timestamp = response['content']['server_timestamp']
                 self.client_snapshot[rel_new_path] = [event_timestamp, new_md5]
@@ -771,6 +1235,7 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
         :param e: event object with information about what has happened
         """
         logger.info('Move event from path : {}\n to path: {}'.format(e.src_path, e.dest_path))
+        self.file_sizes.pop(e.src_path, None)
         rel_src_path = self.relativize_path(e.src_path)
         rel_dest_path = self.relativize_path(e.dest_path)
 
@@ -789,12 +1254,7 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
         if source_shared and not dest_shared:  # file moved from shared path to not shared path
             # upload the file
             new_md5 = self.hash_file(e.dest_path)
-            data = {
-                'filepath': rel_dest_path,
-                'md5': new_md5
-            }
-
-            response = self.conn_mng.dispatch_request('upload', data)
+            response = self._send_file('upload', rel_dest_path, new_md5)
             if response['successful']:
                 event_timestamp = response['content']['server_timestamp']
                 self.client_snapshot[rel_dest_path] = [event_timestamp, new_md5]
@@ -876,12 +1336,8 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
         :param e: event object with information about what has happened
         """
         logger.info('Modify event on file: {}'.format(e.src_path))
-        new_md5 = self.hash_file(e.src_path)
         rel_path = self.relativize_path(e.src_path)
-        data = {
-            'filepath': rel_path,
-            'md5': new_md5
-        }
+        offset, size, new_md5 = self._hash_modified(e.src_path, self.client_snapshot.get(rel_path, [None, None])[1])
         if self._is_shared_file(rel_path):
             # if it has modified a file tracked by shared snapshot, then force the re-download of it
             try:
@@ -891,7 +1347,10 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
         else:
             # Send data to connection manager dispatcher and check return value.
             # If all go right update client_snapshot and local_dir_state
-            response = self.conn_mng.dispatch_request('modify', data)
+            if offset is not None:
+                response = self._append_on_server(rel_path, offset, size, new_md5)
+            else:
+                response = self._send_file('modify', rel_path, new_md5)
             if response['successful']:
                 event_timestamp = response['content']['server_timestamp']
                 self.client_snapshot[rel_path] = [event_timestamp, new_md5]
@@ -910,6 +1369,7 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
         :param e: event object with information about what has happened
         """
         logger.info('Delete event on file: {}'.format(e.src_path))
+        self.file_sizes.pop(e.src_path, None)
         rel_path = self.relativize_path(e.src_path)
         if self._is_shared_file(rel_path):
             # if it has modified a file tracked by shared snapshot, then force the re-download of it
@@ -918,19 +1378,68 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
             except KeyError:
                 pass
         else:
-            # Send data to connection manager dispatcher and check return value.
-            # If all go right update client_snapshot and local_dir_state
-            response = self.conn_mng.dispatch_request('delete', {'filepath': rel_path})
-            if response['successful']:
-                event_timestamp = response['content']['server_timestamp']
-                if self.client_snapshot.pop(rel_path, 'ERROR') == 'ERROR':
-                    logger.warning('WARNING inconsistency error during delete operation!\n'
-                                    'Impossible to find the following file in stored data (client_snapshot):\n'
-                                    '{}'.format(e.src_path))
-                self.update_local_dir_state(event_timestamp)
-                logger.debug('Delete event completed.')
-            else:
-                self.stop(1, response['content'])
+            # Deleting a folder makes a delete event for each file: while more events are coming, the deletes are
+            # kept waiting, to send them together (see flush_deletes).
+            self.pending_deletes.append(rel_path)
+            if not self._more_events():
+                self.flush_deletes()
+
+    def on_dir_deleted(self, e):
+        """
+        Manage the delete event of a directory, that comes after the delete events of its files: the pending
+        deletes of its files are replaced by a single delete of the directory.
+        :param e: event object with information about what has happened
+        """
+        rel_path = self.relativize_path(e.src_path)
+        prefix = rel_path + '/'
+        if self._is_shared_file(rel_path) or any(prefix.startswith(path + '/') for path in self.pending_deletes):
+            # Already deleted with a parent directory
+            return
+        if any(True for _ in self.client_snapshot.iter_subtree(rel_path)):
+            logger.info('Delete event on directory: {}'.format(e.src_path))
+            self.pending_deletes = [path for path in self.pending_deletes if not path.startswith(prefix)]
+            self.pending_deletes.append(rel_path)
+        if not self._more_events():
+            self.flush_deletes()
+
+    def _more_events(self):
+        """
+        Return True if the observer has more events to dispatch.
+        """
+        return self.observer is not None and not self.observer.event_queue.empty()
+
+    def dispatch(self, event):
+        """
+        Dispatch the watchdog events.
+        An operation on a directory makes an event for each of its files and subdirectories (the directory events
+        come last): the create, move and delete events are kept waiting while more events are queued, to send
+        each directory operation as a single action (see flush_moves and on_dir_deleted) and the new files
+        together (see flush_uploads). The pending events of the other kinds are sent before any event.
+        """
+        self.poll_scheduler.activity()
+        if event.event_type != EVENT_TYPE_CREATED:
+            self.flush_uploads()
+        if event.event_type != EVENT_TYPE_MOVED:
+            self.flush_moves()
+        if event.event_type != EVENT_TYPE_DELETED:
+            self.flush_deletes()
+
+        if event.event_type == EVENT_TYPE_MOVED:
+            self.pending_moves.append(event)
+            if not self._more_events():
+                self.flush_moves()
+        elif event.event_type == EVENT_TYPE_DELETED and event.is_directory:
+            self.on_dir_deleted(event)
+        else:
+            FileSystemEventHandler.dispatch(self, event)
+
+    def on_idle(self):
+        """
+        Called by the observer when there are no more events to dispatch.
+        """
+        self.flush_uploads()
+        self.flush_moves()
+        self.flush_deletes()
 
     def _get_cmdmanager_request(self, socket):
         """
@@ -969,12 +1478,16 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
         Intial operation for observing.
         We create the client_snapshot, load the information stored inside local_dir_state and create observer.
         """
+        # From now on the requests send the session token instead of the password
+        self.conn_mng.dispatch_request('get_token')
         self.build_client_snapshot()
         self.build_shared_snapshot()
         self.load_local_dir_state()
         self.create_observer()
         self.observer.start()
         self.sync_with_server()
+        self.change_listener = ChangeListener(self.conn_mng, self.server_changed.set)
+        self.change_listener.start()
 
     def create_observer(self):
         """
@@ -1045,7 +1558,6 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
         r_list = [self.listener_socket]
         self.daemon_state = 'started'
         self.running = 1
-        polling_counter = 0
         try:
             while self.running:
                 r_ready, w_ready, e_ready = select.select(r_list, [], [], TIMEOUT_LISTENER_SOCK)
@@ -1095,16 +1607,15 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
                             r_list.remove(s)
 
                 if self.cfg.get('activate'):
-                    # synchronization polling
-                    # makes the polling every 3 seconds, so it waits six cycle (0.5 * 6 = 3 seconds)
-                    # maybe optimizable but now functional
-                    polling_counter += 1
-                    if polling_counter == 6:
-                        polling_counter = 0
-                        self.sync_with_server()
+                    # Sync when the server notifies a change (within TIMEOUT_LISTENER_SOCK), or when a poll
+                    # is due (see PollScheduler), in case the server can't notify or a notification is lost
+                    if self.server_changed.is_set() or self.poll_scheduler.is_due():
+                        self._sync()
 
         except KeyboardInterrupt:
             self.stop(0)
+        if self.change_listener is not None:
+            self.change_listener.stop()
         if self.cfg.get('activate'):
             self.observer.stop()
             self.observer.join()
@@ -1146,6 +1657,13 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
 
         return self.conn_mng.dispatch_request('removeshareduser', data)
 
+    def _sync_command(self, data):
+        """
+        Synchronize with the server now (cmdmanager 'sync' command).
+        """
+        self._sync()
+        return {'content': 'Synchronized with the server', 'successful': True}
+
     def stop(self, exit_status, exit_message=None):
         """
         Stop the Daemon components (observer and communication with command_manager).
@@ -1216,17 +1734,63 @@ since it is outside the <{}> sharing path!'.format(dir_path, sharing_path)
         md5hash = hashlib.md5()
         try:
             f1 = open(file_path, 'rb')
+            size = 0
             while True:
                 # Read file in as little chunks
                 buf = f1.read(chunk_size)
                 if not buf:
                     break
                 md5hash.update(buf)
+                size += len(buf)
+            self._save_size(file_path, size)
             f1.close()
             return md5hash.hexdigest()
         except (OSError, IOError) as e:
             self.stop(1, 'ERROR during hash of file: {}\nError happened: '.format(file_path, e))
 
+    def _save_size(self, file_path, size):
+        """
+        Keep the <size> of the hashed file <file_path> if it is big, to check later if it has only grown
+        (see _hash_modified).
+        """
+        if size >= self.APPEND_MIN_SIZE:
+            self.file_sizes[file_path] = size
+        else:
+            self.file_sizes.pop(file_path, None)
+
+    def _hash_modified(self, file_path, old_md5):
+        """
+        Hash the modified file <file_path> and check if it has only grown since it has been hashed (i.e. a log):
+        its old content, the first <old size> bytes, must still have the md5 <old_md5> of the synced version.
+        The file is read once, checking the md5 of the old content on the way: any change before the end of
+        the old content is detected, only the bytes after it can be sent (see _append_on_server).
+        Return the (<old size>, <size>, <md5>) of the appended file, otherwise (None, None, <md5>).
+        :return: tuple
+        """
+        old_size = self.file_sizes.get(file_path)
+        if old_size is None or old_md5 is None:
+            return None, None, self.hash_file(file_path)
+        md5hash = hashlib.md5()
+        size = 0
+        try:
+            with open(file_path, 'rb') as fp:
+                while size < old_size:
+                    buf = fp.read(min(2 ** 16, old_size - size))
+                    if not buf:
+                        break
+                    md5hash.update(buf)
+                    size += len(buf)
+                # hexdigest() doesn't end the hash: the appended bytes are added to the same md5
+                grown = size == old_size and md5hash.hexdigest() == old_md5
+                for buf in iter(lambda: fp.read(2 ** 16), ''):
+                    md5hash.update(buf)
+                    size += len(buf)
+        except (OSError, IOError):
+            return None, None, self.hash_file(file_path)
+        self._save_size(file_path, size)
+        if grown and size > old_size:
+            return old_size, size, md5hash.hexdigest()
+        return None, None, md5hash.hexdigest()
 
 def create_log_file_handler():
     # create file handler which logs even info messages
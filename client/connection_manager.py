@@ -5,26 +5,161 @@
 #
 # files:
 # - GET /files/ - ottiene la lista dei file sul server con relativi metadati necessari e/o md5
-# - GET /files/<path> - scarica un file
+#   (json o formato binario di snapshot_codec con Accept, compressa con gzip o deflate con Accept-Encoding;
+#   a pagine con i parametri limit e after, il token della pagina successiva è nell'header X-PyBox-Next-Page)
+# - GET /files/<path> - scarica un file (304 senza contenuto se If-None-Match è l'md5 del file locale)
+# - HEAD /files/<path> - dimensione, md5 (ETag) e timestamp (X-PyBox-Timestamp) del file, senza il contenuto
 # - POST /files/<path> - crea un file
 # - PUT /files/<path> - modifica un file
+# - PATCH /files/<path> - parametri offset, md5 e data: aggiunge data in coda al file (di offset byte)
 # actions:
 # - POST /actions/copy - parametri src, dest
 # - POST /actions/delete - parametro path
 # - POST /actions/move - parametri src, dest
+# - POST /actions/batch - parametro actions: lista di azioni eseguite in ordine con una sola richiesta
 # ---------
 # shares:
 # - POST /shares/<root_path>/<user> - crea (se necessario) lo share, e l’utente che “vede” la condivisione
 # - DELETE /shares/<root_path> - elimina del tutto lo share
 # - DELETE /shares/<root_path>/<user> - elimina l’utente dallo share
+# tokens:
+# - POST /tokens - scambia le credenziali dell'utente con un token di sessione
+# preflight:
+# - POST /preflight - parametro files: crea i file il cui contenuto è già sul server, restituisce quelli da caricare
+# archives:
+# - POST /archives - carica molti file insieme in un archivio tar (md5 negli header pax dei file)
+# - GET /archives - scarica molti file insieme in un archivio tar: parametri path (ripetuto) o subtree
+# deltas:
+# - GET /signatures/<path> - firma a blocchi del file, per caricarne solo le modifiche (PUT /files/<path> con delta)
+# - POST /deltas/<path> - parametro signature: scarica solo le modifiche del file (md5 nell'header X-PyBox-MD5)
+# chunks:
+# - POST /chunks - parametro chunks: md5 dei chunk di un file, restituisce quelli che il server non ha
+#   (POST/PUT /files/<path> con chunks, sent e data ricostruisce il file dai chunk)
+# notifications:
+# - GET /notifications - parametri since e timeout: attende una versione dei dati dell'utente più recente di since
+#   (long-poll, o Server-Sent Events con Accept: text/event-stream)
 
 import requests
+from requests.auth import AuthBase, _basic_auth_str
 import urllib
 import json
 import os
+import hashlib
+import tarfile
+import tempfile
 import logging
 import keyring
 
+import delta
+import chunking
+import snapshot_codec
+from snapshot import SnapshotCollector
+
+# The pax header of the archive members with the md5 of the file
+ARCHIVE_MD5_HEADER = 'PYBOX.md5'
+# The response header with the md5 of a file downloaded as a delta
+DELTA_MD5_HEADER = 'X-PyBox-MD5'
+# The response header with the token of the next page of the snapshot
+NEXT_PAGE_HEADER = 'X-PyBox-Next-Page'
+
+
+class SessionTokenAuth(AuthBase):
+    """
+    Basic authentication that sends the session token in place of the user password.
+    When the server refuses the token (i.e. it is expired) a new one is requested to the
+    connection manager and the request is sent again, only once.
+    """
+    def __init__(self, conn_mng, user, token):
+        self.conn_mng = conn_mng
+        self.user = user
+        self.token = token
+
+    def __call__(self, r):
+        r.headers['Authorization'] = _basic_auth_str(self.user, self.token)
+        r.register_hook('response', self.handle_401)
+        return r
+
+    def handle_401(self, r, **kwargs):
+        if r.status_code != 401:
+            return r
+        new_auth = self.conn_mng.refresh_token()
+        if not new_auth:
+            return r
+        # Consume content and release the original connection to allow the new request to reuse it
+        r.content
+        r.raw.release_conn()
+        prep = r.request.copy()
+        prep.headers['Authorization'] = _basic_auth_str(new_auth.user, new_auth.token)
+        _r = r.connection.send(prep, **kwargs)
+        _r.history.append(r)
+        _r.request = prep
+        return _r
+
+
+class ArchiveStream(object):
+    """
+    Request body of a tar archive of the (<path>, <md5>) <files> of the directory <root>, made while it is sent:
+    every file is read only when it is its turn, so there is no copy of the archive and the upload starts at once.
+    The files are sized when the stream is created, so the length of the archive is known (the server needs
+    a Content-Length): a file that changes meanwhile is cut or padded to that size, then the server finds
+    its md5 wrong, and a file removed meanwhile is all padding.
+    """
+    CHUNK_SIZE = 2 ** 16
+
+    def __init__(self, root, files):
+        self._members = []
+        self._length = tarfile.BLOCKSIZE * 2
+        for path, md5 in files:
+            filepath = os.path.join(root, path)
+            stat = os.stat(filepath)
+            info = tarfile.TarInfo(path.encode('utf-8'))
+            info.size = stat.st_size
+            info.mtime = stat.st_mtime
+            info.pax_headers = {ARCHIVE_MD5_HEADER: md5}
+            header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8')
+            self._members.append((filepath, header, info.size))
+            self._length += len(header) + info.size + self._padding(info.size)
+        self._blocks = self._iter_blocks()
+        self._buffer = ''
+
+    @staticmethod
+    def _padding(size):
+        return -size % tarfile.BLOCKSIZE
+
+    def _iter_blocks(self):
+        for filepath, header, size in self._members:
+            yield header
+            try:
+                fp = open(filepath, 'rb')
+            except IOError:
+                fp = None
+            remaining = size
+            while remaining:
+                chunk = fp and fp.read(min(self.CHUNK_SIZE, remaining)) or tarfile.NUL * min(self.CHUNK_SIZE, remaining)
+                remaining -= len(chunk)
+                yield chunk
+            if fp is not None:
+                fp.close()
+            yield tarfile.NUL * self._padding(size)
+        yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return self._blocks
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            self._buffer += block
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
 
 class ConnectionManager(object):
     # This is the char filter for url encoder, this list of char aren't translated in percent style
@@ -34,6 +169,11 @@ class ConnectionManager(object):
                           requests.exceptions.ConnectionError,
                           requests.exceptions.MissingSchema)
 
+    # The files of a page of the server snapshot, and the downloads of the pages started again at most
+    # when the snapshot changes between two pages (see do_get_server_snapshot)
+    SNAPSHOT_PAGE_SIZE = 10000
+    SNAPSHOT_ATTEMPTS = 3
+
     def __init__(self, cfg):
         self.class_logger = logging.getLogger('daemon.con_mng')
         self.load_cfg(cfg)
@@ -44,7 +184,9 @@ class ConnectionManager(object):
         :param cfg: Dictionary where is contained the configuration
         """
         self.cfg = cfg
-        self.auth = (self.cfg.get('user'), keyring.get_password('PyBox', self.cfg.get('user', '')))
+        self.credentials = (self.cfg.get('user'), keyring.get_password('PyBox', self.cfg.get('user', '')))
+        # The user credentials are used until a session token is obtained (see do_get_token)
+        self.auth = self.credentials
 
         # example of self.base_url = 'http://localhost:5000/API/V1/'
         self.base_url = ''.join([self.cfg['server_address'], self.cfg['api_suffix']])
@@ -52,6 +194,13 @@ class ConnectionManager(object):
         self.actions_url = ''.join([self.base_url, 'actions/'])
         self.shares_url = ''.join([self.base_url, 'shares/'])
         self.users_url = ''.join([self.base_url, 'users/'])
+        self.tokens_url = ''.join([self.base_url, 'tokens'])
+        self.preflight_url = ''.join([self.base_url, 'preflight'])
+        self.archives_url = ''.join([self.base_url, 'archives'])
+        self.signatures_url = ''.join([self.base_url, 'signatures/'])
+        self.deltas_url = ''.join([self.base_url, 'deltas/'])
+        self.chunks_url = ''.join([self.base_url, 'chunks'])
+        self.notifications_url = ''.join([self.base_url, 'notifications'])
 
     def dispatch_request(self, command, args=None):
         method_name = ''.join(['do_', command])
@@ -77,6 +226,35 @@ class ConnectionManager(object):
                                'EXCEPTION CATCHED: {}'.format(e),
                     'successful': False}
 
+    def do_get_token(self, data=None):
+        """
+        Exchange the user credentials for a session token, that will be sent instead of the password
+        by the next requests so that the server doesn't verify the password hash every time.
+        If the token can't be obtained, the next requests keep using the user credentials.
+        """
+        self.class_logger.debug('do_get_token: URL: {}'.format(self.tokens_url))
+        try:
+            r = requests.post(self.tokens_url, auth=self.credentials)
+            r.raise_for_status()
+            token = r.json()['token']
+        except ConnectionManager.EXCEPTIONS_CATCHED + (ValueError, KeyError) as e:
+            self.auth = self.credentials
+            return {'content': 'Failed to get the session token, user credentials will be used.\n'
+                               'EXCEPTION CATCHED: {}'.format(e),
+                    'successful': False}
+        self.auth = SessionTokenAuth(self, self.credentials[0], token)
+        return {'content': 'Session token received', 'successful': True}
+
+    def refresh_token(self):
+        """
+        Replace the refused session token with a new one.
+        Return the new SessionTokenAuth, or None if the user credentials must be used from now on.
+        """
+        self.class_logger.info('Session token refused, asking a new one.')
+        self.do_get_token()
+        if isinstance(self.auth, SessionTokenAuth):
+            return self.auth
+
     def do_register(self, data):
         """
         Send registration user request
@@ -209,18 +387,32 @@ class ConnectionManager(object):
 
     # files
 
+    @staticmethod
+    def _file_md5(path, chunk_len=2 ** 16):
+        h = hashlib.md5()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_len), ''):
+                h.update(chunk)
+        return h.hexdigest()
+
     def do_download(self, data):
         url = ''.join([self.files_url, data['filepath']])
         encoded_url = urllib.quote(url, ConnectionManager.ENCODER_FILTER)
         self.class_logger.debug('{}: URL: {} - DATA: {} '.format('do_download', url, data))
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        headers = {}
+        if os.path.isfile(filepath):
+            # The server answers 304 without the content if the local file is its current version
+            headers['If-None-Match'] = '"{}"'.format(self._file_md5(filepath))
         try:
-            r = requests.get(encoded_url, auth=self.auth)
+            r = requests.get(encoded_url, auth=self.auth, headers=headers)
             r.raise_for_status()
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
             return {'content': 'Failed to download file from server.\n'
                                'Path: {}\nError: {}'.format(data['filepath'], e),
                     'successful': False}
-        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        if r.status_code == 304:
+            return {'successful': True}
         dirpath, filename = os.path.split(filepath)
         # Create all missing directories
         if not os.path.isdir(dirpath):
@@ -262,6 +454,256 @@ class ConnectionManager(object):
                                'Path: {}\nError: {}'.format(data['filepath'], e),
                     'successful': False}
 
+    def do_preflight(self, data):
+        """
+        Upload by hash: send the [<path>, <md5>, <size>] list of the files to upload (data['files']).
+        The server creates the files whose content it already has, and returns their server timestamps
+        ('materialized') and the paths still to upload ('needed').
+        """
+        self.class_logger.debug('{}: URL: {} - DATA: {} '.format('do_preflight', self.preflight_url, data))
+        try:
+            r = requests.post(self.preflight_url, auth=self.auth, data={'files': json.dumps(data['files'])})
+            r.raise_for_status()
+            return {'content': r.json(), 'successful': True}
+        except ConnectionManager.EXCEPTIONS_CATCHED as e:
+            return {'content': 'Failed to send the files to upload to the server.\n'
+                               'Error: {}'.format(e),
+                    'successful': False}
+
+    def do_upload_archive(self, data):
+        """
+        Upload many files together as a tar archive: data['files'] is the list of [<path>, <md5>].
+        The server creates (or replaces) the files, and returns their server timestamps ('stored')
+        and the errors of the files it refused ('failed').
+        """
+        self.class_logger.debug('{}: URL: {} - {} files'.format('do_upload_archive', self.archives_url,
+                                                                len(data['files'])))
+        try:
+            archive = ArchiveStream(self.cfg['sharing_path'], data['files'])
+            r = requests.post(self.archives_url, auth=self.auth, data=archive,
+                              headers={'Content-Type': 'application/x-tar'})
+            r.raise_for_status()
+            return {'content': r.json(), 'successful': True}
+        except ConnectionManager.EXCEPTIONS_CATCHED + (IOError, OSError) as e:
+            return {'content': 'Failed to upload {} files to the server.\n'
+                               'Error: {}'.format(len(data['files']), e),
+                    'successful': False}
+
+    @staticmethod
+    def _copy_file(src, dst):
+        """
+        Copy the content of the file object <src> to <dst>, and return its md5.
+        """
+        h = hashlib.md5()
+        for chunk in iter(lambda: src.read(2 ** 16), ''):
+            h.update(chunk)
+            dst.write(chunk)
+        return h.hexdigest()
+
+    def _write_file(self, path, md5, skip, write):
+        """
+        Write the file <path> calling write(<file object>), that returns the md5 of the written content,
+        through a temporary file of the same directory that is moved in place (replacing the existing file)
+        only if the md5 is the expected one.
+        Both the paths are passed to <skip> before the events of the writing (see SkipObserver).
+        Return True if the file has been written.
+        """
+        filepath = os.path.join(self.cfg['sharing_path'], path)
+        dirpath, filename = os.path.split(filepath)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        fd, tmp_filepath = tempfile.mkstemp(dir=dirpath, prefix='.{}.'.format(filename), suffix='.part')
+        skip(tmp_filepath)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                written_md5 = write(fp)
+            if written_md5 != md5:
+                self.class_logger.warning('Wrong md5 of the downloaded file {}'.format(path))
+                skip(tmp_filepath)
+                return False
+            skip(filepath)
+            os.rename(tmp_filepath, filepath)
+            return True
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+
+    def do_download_archive(self, data):
+        """
+        Download many files together as a tar archive, read as a stream while it is received.
+        data['files'] is the list of the relative paths to download, that are requested one by one
+        or, if data['subtree'] is given, as all the files under that directory ('' for all the user files).
+        Each file is written atomically (see _write_file), calling data['skip'] with its paths.
+        Return the {<path>: <md5>} of the written files: the others must be downloaded one by one.
+        """
+        params = {'subtree': data['subtree']} if 'subtree' in data else {'path': data['files']}
+        wanted = set(data['files'])
+        self.class_logger.debug('{}: URL: {} - {} files'.format('do_download_archive', self.archives_url, len(wanted)))
+        try:
+            r = requests.get(self.archives_url, auth=self.auth, params=params, stream=True)
+            r.raise_for_status()
+        except ConnectionManager.EXCEPTIONS_CATCHED as e:
+            return {'content': 'Failed to download {} files from the server.\n'
+                               'Error: {}'.format(len(wanted), e),
+                    'successful': False}
+        downloaded = {}
+        try:
+            tar = tarfile.open(fileobj=r.raw, mode='r|', encoding='utf-8')
+            for member in tar:
+                path = member.name.decode('utf-8')
+                # The server can send files not requested (i.e. new in the subtree), they are left to the next sync
+                if path not in wanted or not member.isfile():
+                    continue
+                md5 = member.pax_headers.get(ARCHIVE_MD5_HEADER)
+                member_file = tar.extractfile(member)
+                if self._write_file(path, md5, data['skip'], lambda fp: self._copy_file(member_file, fp)):
+                    downloaded[path] = md5
+            tar.close()
+        except ConnectionManager.EXCEPTIONS_CATCHED + (tarfile.TarError, IOError, OSError, UnicodeDecodeError) as e:
+            # The files written before the error are kept
+            self.class_logger.warning('Archive download interrupted after {} files: {}'.format(len(downloaded), e))
+        return {'content': downloaded, 'successful': True}
+
+    def do_modify_delta(self, data):
+        """
+        Modify a file on the server sending only its changes: the delta (see delta.py) of the file
+        against the signature of the server version. Return the response of the server, like do_modify.
+        """
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        url = urllib.quote(''.join([self.signatures_url, data['filepath']]), ConnectionManager.ENCODER_FILTER)
+        self.class_logger.debug('{}: URL: {} - DATA: {} '.format('do_modify_delta', url, data))
+        try:
+            r = requests.get(url, auth=self.auth)
+            r.raise_for_status()
+            signature = delta.parse_signature(r.content)
+            with open(filepath, 'rb') as fp, tempfile.TemporaryFile() as delta_file:
+                for block in delta.delta(fp, signature):
+                    delta_file.write(block)
+                delta_file.seek(0)
+                url = urllib.quote(''.join([self.files_url, data['filepath']]), ConnectionManager.ENCODER_FILTER)
+                r = requests.put(url, auth=self.auth, files={'delta': delta_file}, data={'md5': data['md5']})
+            r.raise_for_status()
+            return {'content': r.json(), 'successful': True}
+        except ConnectionManager.EXCEPTIONS_CATCHED + (IOError, ValueError) as e:
+            return {'content': 'Failed to send the changes of the file to the server.\n'
+                               'Path: {}\nError: {}'.format(data['filepath'], e),
+                    'successful': False}
+
+    def do_download_delta(self, data):
+        """
+        Update a file from the server receiving only its changes: the delta (see delta.py) of the server version
+        against the signature of the local file, that is rebuilt atomically (see _write_file) calling data['skip']
+        with its paths. Return the md5 of the rebuilt file.
+        """
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        url = urllib.quote(''.join([self.deltas_url, data['filepath']]), ConnectionManager.ENCODER_FILTER)
+        self.class_logger.debug('{}: URL: {} - DATA: {} '.format('do_download_delta', url, data))
+        try:
+            with open(filepath, 'rb') as fp:
+                signature = delta.signature(fp, os.fstat(fp.fileno()).st_size)
+            r = requests.post(url, auth=self.auth, files={'signature': ('signature', signature)}, stream=True)
+            r.raise_for_status()
+            md5 = r.headers[DELTA_MD5_HEADER]
+            with open(filepath, 'rb') as base:
+                if self._write_file(data['filepath'], md5, data['skip'], lambda fp: delta.patch(base, r.raw, fp)):
+                    return {'content': md5, 'successful': True}
+            error = 'wrong md5'
+        except ConnectionManager.EXCEPTIONS_CATCHED + (IOError, OSError, KeyError, ValueError) as e:
+            error = e
+        return {'content': 'Failed to download the changes of the file from the server.\n'
+                           'Path: {}\nError: {}'.format(data['filepath'], error),
+                'successful': False}
+
+    def do_upload_chunks(self, data):
+        """
+        Upload a file (or modify it, if data['modify']) sending only the chunks that the server doesn't have
+        (see chunking.py): the server rebuilds the file from the list of its chunks.
+        Return the response of the server, like do_upload.
+        """
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        url = urllib.quote(''.join([self.files_url, data['filepath']]), ConnectionManager.ENCODER_FILTER)
+        self.class_logger.debug('{}: URL: {} - DATA: {} '.format('do_upload_chunks', url, data))
+        try:
+            with open(filepath, 'rb') as fp, tempfile.TemporaryFile() as sent_file:
+                chunks = chunking.file_chunks(fp)
+                md5s = []
+                for md5, _ in chunks:
+                    if md5 not in md5s:
+                        md5s.append(md5)
+                r = requests.post(self.chunks_url, auth=self.auth, data={'chunks': json.dumps(md5s)})
+                r.raise_for_status()
+                needed = set(r.json()['needed'])
+
+                sent = []
+                offset = 0
+                for md5, size in chunks:
+                    if md5 in needed:
+                        needed.remove(md5)
+                        fp.seek(offset)
+                        sent_file.write(fp.read(size))
+                        sent.append(md5)
+                    offset += size
+                self.class_logger.info('Chunks of {}: {:,} of {:,} bytes sent'.format(data['filepath'],
+                                                                                     sent_file.tell(), offset))
+                sent_file.seek(0)
+                method = requests.put if data.get('modify') else requests.post
+                r = method(url, auth=self.auth, files={'data': sent_file},
+                           data={'chunks': json.dumps(chunks), 'sent': json.dumps(sent), 'md5': data['md5']})
+            r.raise_for_status()
+            return {'content': r.json(), 'successful': True}
+        except ConnectionManager.EXCEPTIONS_CATCHED + (IOError, ValueError, KeyError) as e:
+            return {'content': 'Failed to upload the chunks of the file to the server.\n'
+                               'Path: {}\nError: {}'.format(data['filepath'], e),
+                    'successful': False}
+
+    def do_append(self, data):
+        """
+        Modify a file on the server sending only the bytes appended to it: the file is data['size'] bytes long,
+        the server version data['offset'] bytes (the md5 of the whole file is checked by the server).
+        Return the response of the server, like do_modify.
+        """
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        url = urllib.quote(''.join([self.files_url, data['filepath']]), ConnectionManager.ENCODER_FILTER)
+        self.class_logger.debug('{}: URL: {} - DATA: {} '.format('do_append', url, data))
+        try:
+            with open(filepath, 'rb') as fp, tempfile.TemporaryFile() as appended:
+                fp.seek(data['offset'])
+                # The file can grow meanwhile: the md5 is of its first data['size'] bytes
+                remaining = data['size'] - data['offset']
+                while remaining:
+                    chunk = fp.read(min(2 ** 16, remaining))
+                    if not chunk:
+                        raise IOError('File truncated: {}'.format(filepath))
+                    appended.write(chunk)
+                    remaining -= len(chunk)
+                appended.seek(0)
+                r = requests.patch(url, auth=self.auth, files={'data': appended},
+                                   data={'offset': data['offset'], 'md5': data['md5']})
+            r.raise_for_status()
+            return {'content': r.json(), 'successful': True}
+        except ConnectionManager.EXCEPTIONS_CATCHED + (IOError,) as e:
+            return {'content': 'Failed to append to the file on the server.\n'
+                               'Path: {}\nError: {}'.format(data['filepath'], e),
+                    'successful': False}
+
+    def do_wait_changes(self, data):
+        """
+        Wait for a version of the user data on the server newer than data['since'], data['timeout'] seconds
+        at most, and return the current version. Without data['since'] return it at once.
+        The server redirects the request to its transfer service, that serves the notifications.
+        """
+        params = {'timeout': data['timeout']}
+        if data.get('since') is not None:
+            params['since'] = data['since']
+        try:
+            # The server responds after data['timeout'] seconds at most
+            r = requests.get(self.notifications_url, auth=self.auth, params=params, timeout=data['timeout'] + 30)
+            r.raise_for_status()
+            return {'content': r.json()['version'], 'successful': True}
+        except ConnectionManager.EXCEPTIONS_CATCHED + (requests.exceptions.Timeout, ValueError, KeyError) as e:
+            return {'content': 'Failed to wait for the changes on the server.\nError: {}'.format(e),
+                    'successful': False}
+
     # actions:
 
     def do_move(self, data):
@@ -303,14 +745,84 @@ class ConnectionManager(object):
                                'Src path: {}\nDest Path: {}\nError: {}'.format(data['src'], data['dst'], e),
                     'successful': False}
 
+    def do_batch(self, data):
+        """
+        Send many actions in a single request: data['actions'] is the list of
+        {'cmd': 'delete', 'filepath': <path>} and {'cmd': 'copy' | 'move', 'src': <path>, 'dst': <path>}.
+        The server applies them in order, and returns the status of each one ('results').
+        """
+        url = ''.join([self.actions_url, 'batch'])
+        self.class_logger.debug('{}: URL: {} - DATA: {} '.format('do_batch', url, data))
+        try:
+            r = requests.post(url, auth=self.auth, data={'actions': json.dumps(data['actions'])})
+            r.raise_for_status()
+            return {'content': r.json(), 'successful': True}
+        except ConnectionManager.EXCEPTIONS_CATCHED as e:
+            return {'content': 'Failed to send {} actions to the server.\n'
+                               'Error: {}'.format(len(data['actions']), e),
+                    'successful': False}
+
+    @staticmethod
+    def _parse_snapshot(body, content_type):
+        if content_type.startswith(snapshot_codec.CONTENT_TYPE):
+            return snapshot_codec.decode(body)
+        return json.loads(body)
+
+    def _get_snapshot_pages(self, first_page, consumer):
+        """
+        Give to <consumer> the pages of the server snapshot, from the response <first_page>: each one is
+        downloaded when the previous one has been consumed, and then dropped.
+        Return the result of the consumer, or None if the snapshot changed on the server before the last page.
+        """
+        consumer.start()
+        r = first_page
+        while True:
+            consumer.add_page(self._parse_snapshot(r.content, r.headers.get('Content-Type', '')))
+            token = r.headers.get(NEXT_PAGE_HEADER)
+            if not token:
+                return consumer.finish()
+            r = requests.get(self.files_url, auth=self.auth, headers=self._snapshot_headers(),
+                             params={'limit': self.SNAPSHOT_PAGE_SIZE, 'after': token})
+            if r.status_code == 409:
+                return None
+            r.raise_for_status()
+
+    @staticmethod
+    def _snapshot_headers():
+        return {'Accept': '{}, application/json;q=0.5'.format(snapshot_codec.CONTENT_TYPE)}
+
     def do_get_server_snapshot(self, data):
+        """
+        Get the server snapshot, downloaded in pages of SNAPSHOT_PAGE_SIZE files that are given to
+        data['consumer'] as they arrive (see snapshot.SnapshotDiff), and started again if the snapshot changes
+        in the meantime. Return the result of the consumer; without it the pages are collected
+        (see snapshot.SnapshotCollector).
+        The response has the ETag of the snapshot ('etag'): if it is sent back as data['etag'] and the snapshot
+        has not changed, the server responds with a 304 without body, and 'not_modified' is True (the content
+        is None).
+        The snapshot is asked in the binary format of snapshot_codec, compressed (requests asks gzip or deflate
+        and decompresses the body), and the server can send json instead.
+        """
+        data = data or {}
         url = self.files_url
         self.class_logger.debug('{}: URL: {} - DATA: {} '.format('do_get_server_snapshot', url, data))
 
+        consumer = data.get('consumer') or SnapshotCollector()
+        headers = self._snapshot_headers()
+        if data.get('etag'):
+            headers['If-None-Match'] = data['etag']
         try:
-            r = requests.get(url, auth=self.auth)
-            r.raise_for_status()
-            return {'content': r.json(), 'successful': True}
+            for _ in range(self.SNAPSHOT_ATTEMPTS):
+                r = requests.get(url, auth=self.auth, headers=headers, params={'limit': self.SNAPSHOT_PAGE_SIZE})
+                r.raise_for_status()
+                if r.status_code == 304:
+                    return {'content': None, 'successful': True, 'not_modified': True}
+                content = self._get_snapshot_pages(r, consumer)
+                if content is not None:
+                    return {'content': content, 'successful': True, 'not_modified': False,
+                            'etag': r.headers.get('ETag')}
+                self.class_logger.debug('The server snapshot changed while downloading its pages')
+            return {'content': 'Failed to get server snapshot: it is changing too fast', 'successful': False}
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
             return {'content': 'Failed to get server snapshot, maybe server down?\nError: {}'.format(e),
                     'successful': False}
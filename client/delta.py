@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Block-level delta of a file against an older version of it, in the way of rsync:
+ - the side that has the old version computes its signature: the weak (adler32, that can be rolled)
+   and the strong (md5) checksum of each block;
+ - the side that has the new version looks for those blocks at any offset of the file, rolling the weak checksum
+   byte by byte, and sends the delta: instructions to copy the old blocks, and the new data in between;
+ - the side that has the old version rebuilds the new one (patch) and checks its md5.
+So a change costs about its size plus a block, wherever it is in the file.
+
+Signature: <file size> <block size> then <weak> <strong> for each block.
+Delta: <block size> then COPY <first block> <number of blocks> or DATA <length> <data> instructions.
+
+The same module is in the client and in the server: test_delta.py of the server fails if the copies differ.
+"""
+
+import math
+import zlib
+import struct
+import hashlib
+
+
+BLOCK_MIN_SIZE = 2 ** 10
+BLOCK_MAX_SIZE = 2 ** 17
+# The new data is sent in pieces of this size at most
+DATA_MAX_SIZE = 2 ** 16
+READ_SIZE = 2 ** 20
+
+COPY = 'C'
+DATA = 'D'
+
+_SIGNATURE_HEADER = struct.Struct('>QI')
+_BLOCK = struct.Struct('>I16s')
+_DELTA_HEADER = struct.Struct('>I')
+_COPY = struct.Struct('>II')
+_DATA = struct.Struct('>I')
+
+# The modulus of adler32
+_MOD = 65521
+
+
+def block_size(file_size):
+    """
+    Return the block size for a file of <file_size> bytes: about its square root, as rsync does.
+    :return: int
+    """
+    return max(BLOCK_MIN_SIZE, min(BLOCK_MAX_SIZE, int(math.sqrt(file_size)) & ~7))
+
+
+def weak_checksum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def signature(fp, file_size):
+    """
+    Return the signature of the (old) file <fp> of <file_size> bytes.
+    :return: str
+    """
+    size = block_size(file_size)
+    parts = []
+    length = 0
+    for block in iter(lambda: fp.read(size), ''):
+        parts.append(_BLOCK.pack(weak_checksum(block), hashlib.md5(block).digest()))
+        length += len(block)
+    # The real size, if the file has changed meanwhile
+    return _SIGNATURE_HEADER.pack(length, size) + ''.join(parts)
+
+
+def parse_signature(data):
+    """
+    Return the (<block size>, <blocks>, <last block>) of a signature. <blocks> maps the weak checksums of the full
+    blocks to {<strong checksum>: <block index>}, <last block> is the (<strong checksum>, <block index>, <length>)
+    of the last block if it is shorter, otherwise None.
+    Raise ValueError if the signature is malformed.
+    :return: tuple
+    """
+    if len(data) < _SIGNATURE_HEADER.size:
+        raise ValueError('Truncated signature')
+    file_size, size = _SIGNATURE_HEADER.unpack_from(data)
+    count, rest = divmod(len(data) - _SIGNATURE_HEADER.size, _BLOCK.size)
+    if not size or rest or count != (file_size + size - 1) // size:
+        raise ValueError('Malformed signature')
+    blocks = {}
+    last = None
+    for index in xrange(count):
+        weak, strong = _BLOCK.unpack_from(data, _SIGNATURE_HEADER.size + index * _BLOCK.size)
+        if index == count - 1 and file_size % size:
+            last = (strong, index, file_size % size)
+        else:
+            blocks.setdefault(weak, {}).setdefault(strong, index)
+    return size, blocks, last
+
+
+def _copy(first, count):
+    return COPY + _COPY.pack(first, count)
+
+
+def _data(data):
+    return DATA + _DATA.pack(len(data)) + data
+
+
+def delta(fp, parsed_signature):
+    """
+    Yield the delta (as strings) of the (new) file <fp> against the old version of <parsed_signature>
+    (see parse_signature). The file is read once, READ_SIZE bytes at a time.
+    """
+    size, blocks, last = parsed_signature
+    yield _DELTA_HEADER.pack(size)
+
+    buf = ''
+    # The window to match is buf[start:start + size], the new data not sent yet is buf[literal:start]
+    start = literal = 0
+    # The (<first block>, <number of blocks>) of the copy not sent yet, to join the consecutive blocks
+    copy = None
+    weak = a = b = None
+    eof = False
+    while True:
+        if not eof and len(buf) - start <= size:
+            chunk = fp.read(READ_SIZE)
+            buf = buf[literal:] + chunk
+            start -= literal
+            literal = 0
+            eof = not chunk
+            continue
+        if len(buf) - start < size:
+            break
+        if weak is None:
+            weak = weak_checksum(buffer(buf, start, size))
+            a, b = weak & 0xffff, weak >> 16
+
+        candidates = blocks.get(weak)
+        index = candidates and candidates.get(hashlib.md5(buffer(buf, start, size)).digest())
+        if index is not None:
+            if literal < start:
+                if copy:
+                    yield _copy(*copy)
+                    copy = None
+                yield _data(buf[literal:start])
+            if copy and copy[0] + copy[1] == index:
+                copy = (copy[0], copy[1] + 1)
+            else:
+                if copy:
+                    yield _copy(*copy)
+                copy = (index, 1)
+            start += size
+            literal = start
+            weak = None
+            continue
+
+        if len(buf) - start == size:
+            # End of file: no byte to roll in
+            break
+        # Roll the window of a byte
+        out_byte, in_byte = ord(buf[start]), ord(buf[start + size])
+        a = (a - out_byte + in_byte) % _MOD
+        b = (b - size * out_byte + a - 1) % _MOD
+        weak = (b << 16) | a
+        start += 1
+        if start - literal >= DATA_MAX_SIZE:
+            if copy:
+                yield _copy(*copy)
+                copy = None
+            yield _data(buf[literal:start])
+            literal = start
+
+    # The rest of the file is shorter than a block: it can be the last block
+    tail = buf[start:]
+    if last and len(tail) == last[2] and hashlib.md5(tail).digest() == last[0]:
+        if literal < start:
+            if copy:
+                yield _copy(*copy)
+                copy = None
+            yield _data(buf[literal:start])
+        if copy and copy[0] + copy[1] == last[1]:
+            copy = (copy[0], copy[1] + 1)
+        else:
+            if copy:
+                yield _copy(*copy)
+            copy = (last[1], 1)
+        literal = len(buf)
+    if copy:
+        yield _copy(*copy)
+    for offset in xrange(literal, len(buf), DATA_MAX_SIZE):
+        yield _data(buf[offset:min(offset + DATA_MAX_SIZE, len(buf))])
+
+
+def _read(fp, length):
+    """
+    Read exactly <length> bytes of the delta <fp>. Raise ValueError if it is truncated.
+    """
+    chunks = []
+    while length:
+        chunk = fp.read(length)
+        if not chunk:
+            raise ValueError('Truncated delta')
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
+
+
+def patch(base, delta_fp, out):
+    """
+    Write to <out> the new file rebuilt from the old version <base> and the delta read from <delta_fp>,
+    and return its md5. Raise ValueError if the delta is malformed.
+    :return: str
+    """
+    h = hashlib.md5()
+    size, = _DELTA_HEADER.unpack(_read(delta_fp, _DELTA_HEADER.size))
+    while True:
+        op = delta_fp.read(1)
+        if not op:
+            break
+        if op == COPY:
+            first, count = _COPY.unpack(_read(delta_fp, _COPY.size))
+            base.seek(first * size)
+            remaining = count * size
+            while remaining:
+                # The last block can be shorter
+                chunk = base.read(min(READ_SIZE, remaining))
+                if not chunk:
+                    break
+                h.update(chunk)
+                out.write(chunk)
+                remaining -= len(chunk)
+        elif op == DATA:
+            length, = _DATA.unpack(_read(delta_fp, _DATA.size))
+            data = _read(delta_fp, length)
+            h.update(data)
+            out.write(data)
+        else:
+            raise ValueError('Unknown delta instruction {!r}'.format(op))
+    return h.hexdigest()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact in-memory representation of the client directory snapshots.
+
+The daemon keeps a snapshot entry (<timestamp>, <md5>) for every file of the sharing folder.
+Stored as a plain dict of 2-items lists with 32-chars hex digests, each entry costs hundreds of
+bytes of python objects, that become gigabytes with millions of files.
+
+CompactSnapshot keeps the same mapping interface of the old dict
+({'<filepath>': [<timestamp>, '<md5>'], ...}) but it stores:
+ - every directory prefix only once (entries are grouped by their directory name);
+ - a single packed str record per file instead of a list of two objects;
+ - the md5 as its 16 raw bytes instead of the 32 hex digits.
+
+The server snapshot arrives in pages (see ConnectionManager.do_get_server_snapshot), that are given to a consumer:
+a SnapshotDiff compares them with the local snapshots as they come and keeps only the files that differ,
+a SnapshotCollector keeps them all.
+"""
+
+import struct
+import binascii
+from collections import MutableMapping
+
+
+# A record is <timestamp><raw md5> packed in a single str
+_RECORD = struct.Struct('!q16s')
+_MIN_TIMESTAMP, _MAX_TIMESTAMP = -2 ** 63, 2 ** 63 - 1
+
+
+def pack_md5(md5):
+    """
+    Return the 16 raw bytes of the given md5 hex digest,
+    or None if <md5> is not a lowercase md5 hex digest.
+    :param md5: str
+    :return: str
+    """
+    if isinstance(md5, basestring) and len(md5) == 32:
+        try:
+            raw = binascii.unhexlify(md5)
+        except TypeError:
+            return None
+        # Only lowercase digests can be restored exactly as they were given
+        if binascii.hexlify(raw) == md5:
+            return raw
+    return None
+
+
+def pack_record(timestamp, md5):
+    """
+    Return the compact form of a (<timestamp>, <md5>) snapshot value:
+     - the raw md5 alone (16 bytes) if the timestamp is empty ('', as in the client built snapshot);
+     - the packed timestamp and raw md5 (24 bytes) if the timestamp is an integer;
+     - the (<timestamp>, <md5>) tuple itself for any other value.
+    :return: str or tuple
+    """
+    raw_md5 = pack_md5(md5)
+    if raw_md5 is not None:
+        if timestamp == '':
+            return raw_md5
+        if isinstance(timestamp, (int, long)) and not isinstance(timestamp, bool) and \
+                _MIN_TIMESTAMP <= timestamp <= _MAX_TIMESTAMP:
+            return _RECORD.pack(timestamp, raw_md5)
+    return (timestamp, md5)
+
+
+def unpack_record(record):
+    """
+    Inverse of pack_record.
+    :param record: str or tuple
+    :return: list
+    """
+    if type(record) is tuple:
+        return list(record)
+    if len(record) == 16:
+        return ['', binascii.hexlify(record)]
+    timestamp, raw_md5 = _RECORD.unpack(record)
+    return [timestamp, binascii.hexlify(raw_md5)]
+
+
+def _split(path):
+    """
+    Split the path in (dirname, basename). NB: path == _join(*_split(path))
+    """
+    dirname, _, basename = path.rpartition('/')
+    return dirname, basename
+
+
+def _join(dirname, basename):
+    if dirname:
+        return ''.join([dirname, '/', basename])
+    return basename
+
+
+class CompactSnapshot(MutableMapping):
+    """
+    Memory efficient replacement of the {'<filepath>': [<timestamp>, '<md5>']} snapshot dict.
+
+    Values are rebuilt as new [<timestamp>, '<md5>'] lists on every access, so modifying a
+    returned value does not change the snapshot: assign it again instead.
+    """
+    def __init__(self, data=None):
+        # {'<dirname>': {'<basename>': <record>}}: the dirname dict keys are the interned prefixes.
+        self._dirs = {}
+        self._len = 0
+        if data:
+            self.update(data)
+
+    def __getitem__(self, path):
+        dirname, basename = _split(path)
+        try:
+            return unpack_record(self._dirs[dirname][basename])
+        except KeyError:
+            raise KeyError(path)
+
+    def __setitem__(self, path, value):
+        timestamp, md5 = value
+        dirname, basename = _split(path)
+        files = self._dirs.get(dirname)
+        if files is None:
+            files = self._dirs[dirname] = {}
+        if basename not in files:
+            self._len += 1
+        files[basename] = pack_record(timestamp, md5)
+
+    def __delitem__(self, path):
+        dirname, basename = _split(path)
+        files = self._dirs.get(dirname)
+        if files is None or basename not in files:
+            raise KeyError(path)
+        del files[basename]
+        if not files:
+            del self._dirs[dirname]
+        self._len -= 1
+
+    def __contains__(self, path):
+        dirname, basename = _split(path)
+        return basename in self._dirs.get(dirname, ())
+
+    def __iter__(self):
+        for dirname, files in self._dirs.iteritems():
+            for basename in files:
+                yield _join(dirname, basename)
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, dict(self.iteritems()))
+
+    def iteritems(self):
+        for dirname, files in self._dirs.iteritems():
+            for basename, record in files.iteritems():
+                yield _join(dirname, basename), unpack_record(record)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iter_subtree(self, path):
+        """
+        Yield the (<path>, [<timestamp>, '<md5>']) couples of all the files under the directory <path>.
+        """
+        prefix = path.rstrip('/') + '/'
+        for dirname, files in self._dirs.iteritems():
+            if (dirname + '/').startswith(prefix):
+                for basename, record in files.iteritems():
+                    yield _join(dirname, basename), unpack_record(record)
+
+    def iter_directory(self, dirname):
+        """
+        Yield the paths of the files directly in the directory <dirname> ('' for the root).
+        """
+        for basename in self._dirs.get(dirname, ()):
+            yield _join(dirname, basename)
+
+    def directory_sizes(self):
+        """
+        Return the {<dirname>: <number of files directly in it>} of the snapshot.
+        """
+        return dict((dirname, len(files)) for dirname, files in self._dirs.iteritems())
+
+    def clear(self):
+        self._dirs.clear()
+        self._len = 0
+
+    def copy(self):
+        return self.__class__(self.iteritems())
+
+
+def _path_key(path):
+    # The order of the server snapshot pages: by the names of the directories and of the file
+    return path.split('/')
+
+
+def _is_under(path, dirname):
+    return not dirname or path == dirname or path.startswith(dirname + '/')
+
+
+class TreeDiff(object):
+    """
+    Difference between a local CompactSnapshot and the files of the server snapshot, given page by page (see add):
+     - new_on_server: the paths of the server files missing here;
+     - modified: the paths of the server files with another md5 here;
+     - server_files: the {'<filepath>': [<timestamp>, '<md5>']} of those server files (the others are dropped);
+     - new_on_client: the paths of the local files missing on the server (set by finish, after the last page);
+     - server_count and newest: the number of server files and their newest timestamp (None if there are none).
+
+    The pages come sorted by path (see _path_key), so the files of a directory are all given before the
+    pages move out of it: only the directories along the current path keep the local files seen on
+    the server, until the missing ones are known. If the pages are not in order the result is the same,
+    the memory is not bounded by the depth of the tree anymore.
+    """
+    def __init__(self, local_snapshot):
+        self._local = local_snapshot
+        self.new_on_server = []
+        self.modified = []
+        self.server_files = {}
+        self.new_on_client = None
+        self.server_count = 0
+        self.newest = None
+        # {<dirname>: <number of its local files not seen on the server yet>}
+        self._unseen_counts = local_snapshot.directory_sizes()
+        # {<dirname>: set of its local files seen on the server}, for the directories not completed yet
+        self._seen = {}
+        self._new_on_client = set()
+        self._dirname = None
+
+    def __repr__(self):
+        return '{}(new_on_server={!r}, modified={!r}, new_on_client={!r})'.format(
+            self.__class__.__name__, self.new_on_server, self.modified, self.new_on_client)
+
+    def add(self, files):
+        """
+        Compare the server <files> ({'<filepath>': [<timestamp>, '<md5>']}) of a page.
+        """
+        for path in sorted(files, key=_path_key):
+            timestamp, md5 = files[path]
+            self.server_count += 1
+            if self.newest is None or timestamp > self.newest:
+                self.newest = timestamp
+            dirname = _split(path)[0]
+            if dirname != self._dirname:
+                self._enter(dirname)
+            local = self._local.get(path)
+            if local is None:
+                self.new_on_server.append(path)
+                self.server_files[path] = [timestamp, md5]
+                continue
+            if path in self._new_on_client:
+                # Its directory has been left before (pages out of order)
+                self._new_on_client.discard(path)
+            elif dirname in self._unseen_counts:
+                self._unseen_counts[dirname] -= 1
+                if self._unseen_counts[dirname]:
+                    self._seen.setdefault(dirname, set()).add(path)
+                else:
+                    # All the local files of the directory are on the server
+                    del self._unseen_counts[dirname]
+                    self._seen.pop(dirname, None)
+            if local[1] != md5:
+                self.modified.append(path)
+                self.server_files[path] = [timestamp, md5]
+
+    def _enter(self, dirname):
+        for left in [seen_dirname for seen_dirname in self._seen if not _is_under(dirname, seen_dirname)]:
+            self._leave(left)
+        self._dirname = dirname
+
+    def _leave(self, dirname):
+        seen = self._seen.pop(dirname, ())
+        if self._unseen_counts.pop(dirname, 0):
+            self._new_on_client.update(path for path in self._local.iter_directory(dirname) if path not in seen)
+
+    def finish(self):
+        """
+        Set new_on_client, after the last page.
+        """
+        for dirname in list(self._seen):
+            self._leave(dirname)
+        # The local directories without files on the server
+        for dirname in self._unseen_counts:
+            self._new_on_client.update(self._local.iter_directory(dirname))
+        self._unseen_counts = {}
+        self.new_on_client = sorted(self._new_on_client)
+        self._new_on_client = set()
+
+
+class SnapshotCollector(object):
+    """
+    Consumer of the pages of the server snapshot (see ConnectionManager.do_get_server_snapshot) that collects
+    their <sections> ('files' and 'shared_files') in CompactSnapshots.
+    """
+    def __init__(self, sections=('files', 'shared_files')):
+        self.sections = sections
+        self.content = None
+
+    def start(self):
+        self.content = dict((section, CompactSnapshot()) for section in self.sections)
+        self.content['server_timestamp'] = None
+
+    def add_page(self, page):
+        self.content['server_timestamp'] = page.get('server_timestamp')
+        for section in self.sections:
+            self.content[section].update(page.get(section, {}))
+
+    def finish(self):
+        return self.content
+
+
+class SnapshotDiff(object):
+    """
+    Consumer of the pages of the server snapshot that compares them with the local snapshots as they arrive
+    (see TreeDiff): the user files with <client_snapshot> (files), the shared ones with <shared_snapshot>
+    (shared_files). The pages are not kept: the memory depends on the files that differ.
+    """
+    def __init__(self, client_snapshot, shared_snapshot):
+        self._client_snapshot = client_snapshot
+        self._shared_snapshot = shared_snapshot
+        self.server_timestamp = None
+        self.files = self.shared_files = None
+
+    def start(self):
+        self.server_timestamp = None
+        self.files = TreeDiff(self._client_snapshot)
+        self.shared_files = TreeDiff(self._shared_snapshot)
+
+    def add_page(self, page):
+        self.server_timestamp = page.get('server_timestamp')
+        self.files.add(page.get('files', {}))
+        self.shared_files.add(page.get('shared_files', {}))
+
+    def finish(self):
+        self.files.finish()
+        self.shared_files.finish()
+        return self
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact binary encoding of the snapshot responses of GET /files/, negotiated with the Accept header
+(see Files.get and ConnectionManager.do_get_server_snapshot). The json snapshot repeats the long directory
+prefixes of every path and spells every md5 as 32 hex digits in quotes: this format sends
+the paths sorted and prefix-compressed, and the md5s as their 16 raw bytes.
+
+A document is {'server_timestamp': <int>, <section>: {'<path>': [<timestamp>, '<md5>']}, ...}
+(the sections are 'files' and, for the whole snapshot, 'shared_files'). It is encoded as:
+
+    MAGIC, server timestamp (q), number of sections (B)
+    for every section:
+        name length (B), name (utf-8), number of files N (I)
+        N prefix lengths (H): the bytes in common with the path before
+        N suffix lengths (H)
+        the N suffixes (utf-8), concatenated
+        N timestamps (q)
+        N md5s, 16 raw bytes each
+        number of md5s that are not hex digests M (I), then M times: index (I), length (H), value (utf-8)
+
+All the numbers are little endian. Every column is read with a single struct.unpack, so decoding is
+a short loop per file. The timestamps must be integers, as the server ones.
+The same module is in the client (the client and the server are installed separately):
+test_snapshot_codec.py of the server fails if the copies differ.
+"""
+
+import struct
+import binascii
+
+
+CONTENT_TYPE = 'application/x-pybox-snapshot'
+MAGIC = 'PYBS\x01'
+LAST_SERVER_TIMESTAMP = 'server_timestamp'
+
+_HEADER = struct.Struct('<qB')
+_COUNT = struct.Struct('<I')
+_EXTRA = struct.Struct('<IH')
+_NO_DIGEST = '\x00' * 16
+
+
+def _raw_md5(md5):
+    """
+    Return the 16 raw bytes of a lowercase md5 hex digest, or None for any other value.
+    """
+    if isinstance(md5, basestring) and len(md5) == 32:
+        try:
+            raw = binascii.unhexlify(md5)
+        except TypeError:
+            return None
+        if binascii.hexlify(raw) == md5:
+            return raw
+    return None
+
+
+def _common_prefix(a, b):
+    """
+    Return the length of the common prefix of <a> and <b> (at most 0xffff), by bisection of slices.
+    """
+    low, high = 0, min(len(a), len(b), 0xffff)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _encode_section(name, files):
+    items = sorted((path.encode('utf-8'), value) for path, value in files.iteritems())
+    prefixes, suffix_lengths, suffixes, timestamps, digests, extras = [], [], [], [], [], []
+    previous = ''
+    for index, (path, (timestamp, md5)) in enumerate(items):
+        prefix = _common_prefix(path, previous)
+        prefixes.append(prefix)
+        suffix_lengths.append(len(path) - prefix)
+        suffixes.append(path[prefix:])
+        timestamps.append(timestamp)
+        raw = _raw_md5(md5)
+        if raw is None:
+            raw = _NO_DIGEST
+            value = unicode(md5).encode('utf-8')
+            extras.append(_EXTRA.pack(index, len(value)) + value)
+        digests.append(raw)
+        previous = path
+    count = len(items)
+    name = name.encode('utf-8')
+    return ''.join([chr(len(name)), name, _COUNT.pack(count),
+                    struct.pack('<{}H'.format(count), *prefixes),
+                    struct.pack('<{}H'.format(count), *suffix_lengths),
+                    ''.join(suffixes),
+                    struct.pack('<{}q'.format(count), *timestamps),
+                    ''.join(digests),
+                    _COUNT.pack(len(extras))] + extras)
+
+
+def encode(document):
+    """
+    Return the binary encoding of the snapshot <document>; the sections can be SnapshotTrees.
+    :return: str
+    """
+    sections = sorted(name for name in document if name != LAST_SERVER_TIMESTAMP)
+    return ''.join([MAGIC, _HEADER.pack(document[LAST_SERVER_TIMESTAMP], len(sections))] +
+                   [_encode_section(name, document[name]) for name in sections])
+
+
+class _Reader(object):
+    def __init__(self, data, offset):
+        self.data = data
+        self.offset = offset
+
+    def read(self, size):
+        if self.offset + size > len(self.data):
+            raise ValueError('Truncated snapshot')
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return chunk
+
+    def unpack(self, fmt):
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+
+def _decode_section(reader):
+    name = reader.read(ord(reader.read(1))).decode('utf-8')
+    count, = reader.unpack('<I')
+    prefixes = reader.unpack('<{}H'.format(count))
+    suffix_lengths = reader.unpack('<{}H'.format(count))
+    suffixes = reader.read(sum(suffix_lengths))
+    timestamps = reader.unpack('<{}q'.format(count))
+    digests = reader.read(16 * count)
+    hexlify = binascii.hexlify
+    paths = []
+    previous = ''
+    offset = 0
+    for prefix, length in zip(prefixes, suffix_lengths):
+        previous = previous[:prefix] + suffixes[offset:offset + length]
+        offset += length
+        paths.append(previous.decode('utf-8'))
+    md5s = [hexlify(digests[i:i + 16]) for i in xrange(0, 16 * count, 16)]
+    extras, = reader.unpack('<I')
+    for _ in xrange(extras):
+        index, length = reader.unpack('<IH')
+        md5s[index] = reader.read(length).decode('utf-8')
+    return name, dict(zip(paths, map(list, zip(timestamps, md5s))))
+
+
+def decode(data):
+    """
+    Return the snapshot document of the binary encoding <data>.
+    Raise ValueError if <data> is not a valid encoding.
+    :return: dict
+    """
+    if not data.startswith(MAGIC):
+        raise ValueError('Not a binary snapshot')
+    reader = _Reader(data, len(MAGIC))
+    try:
+        server_timestamp, sections = reader.unpack(_HEADER.format)
+        document = {LAST_SERVER_TIMESTAMP: server_timestamp}
+        for _ in xrange(sections):
+            name, files = _decode_section(reader)
+            document[name] = files
+    except (struct.error, UnicodeDecodeError, IndexError) as e:
+        raise ValueError('Invalid binary snapshot: {}'.format(e))
+    return document
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import unittest
+import StringIO
+
+import chunking
+
+
+def chunks_of(data):
+    return list(chunking.iter_chunks(StringIO.StringIO(data)))
+
+
+class TestChunking(unittest.TestCase):
+    DATA = os.urandom(2 ** 21)
+
+    def test_chunks_rebuild_the_file(self):
+        chunks = chunks_of(self.DATA)
+        self.assertEqual(''.join(chunks), self.DATA)
+        self.assertTrue(all(len(chunk) <= chunking.CHUNK_MAX_SIZE for chunk in chunks))
+        self.assertTrue(all(len(chunk) >= chunking.CHUNK_MIN_SIZE for chunk in chunks[:-1]))
+        self.assertEqual(chunking.file_chunks(StringIO.StringIO(self.DATA)),
+                         [[hashlib.md5(chunk).hexdigest(), len(chunk)] for chunk in chunks])
+
+    def test_boundaries_depend_on_content(self):
+        """
+        An insertion changes the chunks around it only.
+        """
+        chunks = chunks_of(self.DATA)
+        new_chunks = chunks_of('prefix' + self.DATA[:2 ** 20] + 'inserted' + self.DATA[2 ** 20:])
+        self.assertLessEqual(len(set(new_chunks) - set(chunks)), 2)
+
+    def test_max_size(self):
+        # No boundary in a constant content
+        chunks = chunks_of('\0' * (2 * chunking.CHUNK_MAX_SIZE + 1))
+        self.assertEqual([len(chunk) for chunk in chunks], [chunking.CHUNK_MAX_SIZE, chunking.CHUNK_MAX_SIZE, 1])
+
+    def test_small_files(self):
+        self.assertEqual(chunks_of(''), [])
+        self.assertEqual(chunks_of('small'), ['small'])
+
+
+if __name__ == '__main__':
+    unittest.main()
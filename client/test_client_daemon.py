@@ -9,6 +9,7 @@ import json
 import time
 
 from mock import Mock
+from watchdog.events import FileMovedEvent, DirMovedEvent, FileDeletedEvent, DirDeletedEvent, FileCreatedEvent
 
 import client_daemon
 import tstutils
@@ -158,11 +159,36 @@ class FakeConnMng(object):
         self.received_data = ''
 
     def dispatch_request(self, cmd, data):
+        if cmd == 'preflight':
+            # The fake server has none of the file contents (see Daemon._preflight)
+            return {'content': {'materialized': {}, 'needed': [path for path, _, _ in data['files']]},
+                    'successful': True}
         self.called_cmd = cmd
         self.received_data = data
+        if cmd == 'batch':
+            return {'content': {'results': [{'status': 200, 'server_timestamp': time.time()*10000}
+                                            for _ in data['actions']]},
+                    'successful': True}
+        if cmd == 'upload_archive':
+            return {'content': {'stored': dict((path, time.time()*10000) for path, _ in data['files']), 'failed': {}},
+                    'successful': True}
         return {'content': {'server_timestamp': time.time()*10000}, 'successful': True}
 
 
+class FakeConnMngWithContents(FakeConnMng):
+    """
+    Fake connection manager of a server that already has all the file contents.
+    """
+    MATERIALIZED_TIMESTAMP = 1234
+
+    def dispatch_request(self, cmd, data):
+        if cmd == 'preflight':
+            return {'content': {'materialized': dict((path, self.MATERIALIZED_TIMESTAMP) for path, _, _ in data['files']),
+                                'needed': []},
+                    'successful': True}
+        return FakeConnMng.dispatch_request(self, cmd, data)
+
+
 class FileFakeEvent(object):
     """
     Class that simulates a file related event sent from watchdog.
@@ -200,6 +226,9 @@ class FakeEventQueue(object):
     def task_done(self):
         pass
 
+    def empty(self):
+        return True
+
 
 class TestClientDaemonConfig(unittest.TestCase):
     def setUp(self):
@@ -632,6 +661,82 @@ class TestClientDaemonSync(unittest.TestCase):
         self.daemon.observer.stop()
         self.daemon.observer.join()
 
+    def sync_process(self, server_timestamp, server_dir_tree, shared_dir_tree={}):
+        """
+        Run _sync_process with the diff of the given server snapshot, sent as a single page.
+        """
+        self.daemon.client_snapshot = client_daemon.CompactSnapshot(self.daemon.client_snapshot)
+        diff = client_daemon.SnapshotDiff(self.daemon.client_snapshot, self.daemon.shared_snapshot)
+        diff.start()
+        diff.add_page({'server_timestamp': server_timestamp, 'files': server_dir_tree,
+                       'shared_files': shared_dir_tree})
+        return self.daemon._sync_process(diff.finish())
+
+    def test_download_archive(self):
+        """
+        Test SYNC: the files to download are downloaded together, as the whole user directory on a new device
+        """
+        server_snapshot = dict(('Work/file{}.txt'.format(i), [1000, 'md5 {}'.format(i)]) for i in range(10))
+        shared_paths = ['shared/owner/Music/song{}.mp3'.format(i) for i in range(3)]
+
+        def download_archive(cmd, data):
+            return {'content': dict((path, 'md5') for path in data['files']), 'successful': True}
+        conn_mng = Mock(dispatch_request=Mock(side_effect=download_archive))
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.assertEqual(self.daemon._download_archive(shared_paths, len(server_snapshot)), {})
+            self.assertFalse(conn_mng.dispatch_request.called)
+
+            downloaded = self.daemon._download_archive(sorted(server_snapshot) + shared_paths, len(server_snapshot))
+            self.assertEqual(sorted(downloaded), sorted(server_snapshot) + shared_paths)
+            requests = [data for (cmd, data), _ in conn_mng.dispatch_request.call_args_list]
+            self.assertEqual(requests[0]['subtree'], '')
+            self.assertEqual(sorted(requests[0]['files']), sorted(server_snapshot))
+            self.assertEqual(requests[1]['files'], shared_paths)
+            self.assertNotIn('subtree', requests[1])
+            self.assertEqual(requests[1]['skip'], self.daemon.observer.skip)
+
+    def test_sync_not_modified(self):
+        """
+        Test SYNC: nothing is done if the server snapshot and the local directory have not changed
+        since the last synchronization (the server gets the ETag of its snapshot)
+        """
+        self.daemon.client_snapshot = client_daemon.CompactSnapshot(base_dir_tree)
+        self.daemon.update_local_dir_state(timestamp_generator())
+        self.daemon.snapshot_etag = '"etag"'
+        server_timestamp = timestamp_generator()
+
+        def get_server_snapshot(cmd, data):
+            if data['etag'] == '"etag"':
+                return {'content': None, 'successful': True, 'not_modified': True}
+            consumer = data['consumer']
+            consumer.start()
+            consumer.add_page({'server_timestamp': server_timestamp, 'files': base_dir_tree})
+            return {'content': consumer.finish(), 'successful': True, 'not_modified': False, 'etag': '"new etag"'}
+        conn_mng = Mock(dispatch_request=Mock(side_effect=get_server_snapshot))
+        self.daemon._sync_process = Mock(return_value=[])
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.assertFalse(self.daemon.sync_with_server())
+            self.assertFalse(self.daemon._sync_process.called)
+
+            # Modified here: the whole snapshot is compared
+            self.daemon.client_snapshot['new.txt'] = [timestamp_generator(), 'md5']
+            self.assertTrue(self.daemon.sync_with_server())
+            diff = self.daemon._sync_process.call_args[0][0]
+            self.assertEqual(diff.files.new_on_client, ['new.txt'])
+            self.assertEqual(self.daemon.snapshot_etag, '"new etag"')
+
+    def test_sync_command(self):
+        """
+        Test SYNC: the 'sync' command of the cmdmanager syncs at once, then a poll is scheduled
+        """
+        self.daemon.sync_with_server = Mock(return_value=False)
+        self.daemon.poll_scheduler.next_poll = 0
+        self.daemon.server_changed.set()
+        self.assertTrue(self.daemon.INTERNAL_COMMANDS['sync'](())['successful'])
+        self.assertTrue(self.daemon.sync_with_server.called)
+        self.assertFalse(self.daemon.server_changed.is_set())
+        self.assertFalse(self.daemon.poll_scheduler.is_due())
+
     ####################### DIRECTORY NOT MODIFIED #####################################
     def test_sync_process_move_on_server(self):
         """
@@ -660,7 +765,7 @@ class TestClientDaemonSync(unittest.TestCase):
         src = 'file1.txt'
         dst = 'move_folder/file1.txt'
 
-        self.assertEqual(self.daemon._sync_process(server_timestamp, server_dir_tree), [])
+        self.assertEqual(self.sync_process(server_timestamp, server_dir_tree), [])
         self.assertEqual(self.daemon.operation_happened, 'move: src '+src+' dst: '+dst)
 
     def test_sync_process_copy_on_server(self):
@@ -690,7 +795,7 @@ class TestClientDaemonSync(unittest.TestCase):
         src = 'file1.txt'
         dst = 'copy_folder/file1.txt'
 
-        self.assertEqual(self.daemon._sync_process(server_timestamp, server_dir_tree), [])
+        self.assertEqual(self.sync_process(server_timestamp, server_dir_tree), [])
         self.assertEqual(self.daemon.operation_happened, 'copy: src '+src+' dst: '+dst)
 
     def test_sync_process_new_on_server(self):
@@ -714,7 +819,7 @@ class TestClientDaemonSync(unittest.TestCase):
 
         new_global_md5_client = self.daemon.md5_of_client_snapshot()
 
-        self.assertEqual(self.daemon._sync_process(server_timestamp, server_dir_tree),
+        self.assertEqual(self.sync_process(server_timestamp, server_dir_tree),
                          [('download', 'new_file_on_server.txt')])
         # Local Directory is NOT MODIFIED
         self.assertEqual(new_global_md5_client, old_global_md5_client)
@@ -743,7 +848,7 @@ class TestClientDaemonSync(unittest.TestCase):
 
         new_global_md5_client = self.daemon.md5_of_client_snapshot()
 
-        self.assertEqual(self.daemon._sync_process(server_timestamp, server_dir_tree),
+        self.assertEqual(self.sync_process(server_timestamp, server_dir_tree),
                          [('download', 'new_file_on_server.txt'), ('upload', 'new_file_on_client.txt')])
 
         # Local Directory is MODIFIED
@@ -772,7 +877,7 @@ class TestClientDaemonSync(unittest.TestCase):
 
         new_global_md5_client = self.daemon.md5_of_client_snapshot()
 
-        self.assertEqual(self.daemon._sync_process(server_timestamp, server_dir_tree), [('modify', 'file.txt')])
+        self.assertEqual(self.sync_process(server_timestamp, server_dir_tree), [('modify', 'file.txt')])
 
         # Local Directory is MODIFIED
         self.assertNotEqual(new_global_md5_client, old_global_md5_client)
@@ -1056,7 +1161,7 @@ class TestClientDaemonSync(unittest.TestCase):
         # file_timestamp < client_timestamp
         server_dir_tree.update({'new_file': (server_timestamp - 2, 'md5md6jkshkfv')})
         self.assertEqual(
-            self.daemon._sync_process(server_timestamp, server_dir_tree),
+            self.sync_process(server_timestamp, server_dir_tree),
             [('delete', 'new_file')])
 
     def test_sync_process_ts_equal(self):
@@ -1089,7 +1194,7 @@ class TestClientDaemonSync(unittest.TestCase):
         # local_dir is modified,
         # client_ts == server_ts
         # test the delete of new_file_on_server
-        self.assertEqual(self.daemon._sync_process(server_timestamp, server_dir_tree),
+        self.assertEqual(self.sync_process(server_timestamp, server_dir_tree),
                          [('delete', 'new_file_on_server'), ('modify', 'file_test.txt'), ('upload', 'file.txt')])
 
     def mock_move_on_client(self, src, dst):
@@ -1131,12 +1236,28 @@ class TestClientDaemonSync(unittest.TestCase):
         self.daemon.client_snapshot.update({'new_file_': (server_timestamp - 2, 'md5md6jkshkfv')})
 
         # the new file have to be uploaded
-        self.assertEqual(self.daemon._sync_process(server_timestamp, server_dir_tree), [('upload', 'new_file_')])
+        self.assertEqual(self.sync_process(server_timestamp, server_dir_tree), [('upload', 'new_file_')])
 
         # assure the move
         self.assertIn('folder/file_test_moved.txt', self.daemon.client_snapshot)
         self.assertNotIn('file_test_move.txt', self.daemon.client_snapshot)
 
+    def test_sync_process_move_on_client(self):
+        """
+        Test SYNC: server_timestamp > client_timestamp, but no server file is newer than the client timestamp
+        Directory MODIFIED: the file renamed on the client is not renamed back
+        """
+        server_timestamp = timestamp_generator()
+        self.daemon.local_dir_state['last_timestamp'] = server_timestamp - 5
+        server_dir_tree = {'a.txt': [server_timestamp - 10, 'md5_of_a']}
+        self.daemon.local_dir_state['global_md5'] = 'old global md5'
+        self.daemon.client_snapshot = {'b.txt': [server_timestamp - 1, 'md5_of_a']}
+        self.daemon._make_move_on_client = self.mock_move_on_client
+
+        self.assertEqual(sorted(self.sync_process(server_timestamp, server_dir_tree)),
+                         [('delete', 'a.txt'), ('upload', 'b.txt')])
+        self.assertEqual(self.daemon.client_snapshot, {'b.txt': [server_timestamp - 1, 'md5_of_a']})
+
     def test_sync_process_copy_on_client(self):
         """
         Test SYNC: server_timestamp > client_timestamp test COPY on server
@@ -1170,7 +1291,7 @@ class TestClientDaemonSync(unittest.TestCase):
         self.daemon._make_copy_on_client = self.mock_copy_on_client
 
         # dir is modified so i've to find an upload
-        self.assertEqual(self.daemon._sync_process(server_timestamp, server_dir_tree),
+        self.assertEqual(self.sync_process(server_timestamp, server_dir_tree),
                          [('upload', 'another_file_modified.txt')])
 
         # the file copied must be in the client snapshot after the copy
@@ -1200,7 +1321,7 @@ class TestClientDaemonSync(unittest.TestCase):
         server_dir_tree['file_test_conflicted.txt'] = (server_timestamp - 4, '987456321')
 
         expected_value = ''.join(['file_test_conflicted.txt', '.conflicted'])
-        self.assertEqual(self.daemon._sync_process(server_timestamp, server_dir_tree), [('upload', expected_value)])
+        self.assertEqual(self.sync_process(server_timestamp, server_dir_tree), [('upload', expected_value)])
 
     def test_sync_process_stupid_case(self):
         """
@@ -1221,7 +1342,7 @@ class TestClientDaemonSync(unittest.TestCase):
         self.daemon.local_dir_state['last_timestamp'] = server_timestamp
         self.daemon.local_dir_state['global_md5'] = self.daemon.md5_of_client_snapshot()
 
-        self.assertEqual(self.daemon._sync_process(server_timestamp, server_dir_tree),
+        self.assertEqual(self.sync_process(server_timestamp, server_dir_tree),
                          [])
 
     ################ TEST EVENTS ####################
@@ -1282,6 +1403,201 @@ class TestClientDaemonSync(unittest.TestCase):
             # Check state after event
             self.assertNotIn(filename, self.daemon.client_snapshot)
 
+    def test_modify_on_server_delta(self):
+        """
+        Test EVENTS: only the changes of a big modified file are sent, else its new chunks, else the whole file
+        """
+        filepath = os.path.join(TEST_SHARING_FOLDER, 'big.bin')
+        FileFakeEvent.create_file(filepath, content='x' * max(self.daemon.DELTA_MIN_SIZE, self.daemon.CHUNKS_MIN_SIZE))
+        responses = {'modify_delta': {'content': 'error', 'successful': False},
+                     'upload_chunks': {'content': 'error', 'successful': False},
+                     'modify': {'content': {'server_timestamp': 1000}, 'successful': True}}
+        conn_mng = Mock(dispatch_request=Mock(side_effect=lambda cmd, data: responses[cmd]))
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.assertEqual(self.daemon._modify_on_server('big.bin', 'md5'), responses['modify'])
+            self.assertEqual([args[0] for args, _ in conn_mng.dispatch_request.call_args_list],
+                             ['modify_delta', 'upload_chunks', 'modify'])
+            self.assertTrue(conn_mng.dispatch_request.call_args_list[1][0][1]['modify'])
+
+            responses['modify_delta'] = responses['modify']
+            conn_mng.dispatch_request.reset_mock()
+            self.assertEqual(self.daemon._modify_on_server('big.bin', 'md5'), responses['modify'])
+            self.assertEqual([args[0] for args, _ in conn_mng.dispatch_request.call_args_list], ['modify_delta'])
+
+            # A small file is sent whole
+            conn_mng.dispatch_request.reset_mock()
+            FileFakeEvent.create_file(filepath, content='x')
+            self.daemon._modify_on_server('big.bin', 'md5')
+            self.assertEqual([args[0] for args, _ in conn_mng.dispatch_request.call_args_list], ['modify'])
+
+    def test_upload_on_server_chunks(self):
+        """
+        Test EVENTS: a big new file is uploaded by chunks, a small one whole
+        """
+        FileFakeEvent.create_file(os.path.join(TEST_SHARING_FOLDER, 'big.bin'), content='x' * self.daemon.CHUNKS_MIN_SIZE)
+        FileFakeEvent.create_file(os.path.join(TEST_SHARING_FOLDER, 'small.txt'), content='x')
+        conn_mng = FakeConnMng()
+        conn_mng.dispatch_request = Mock(side_effect=conn_mng.dispatch_request)
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.assertTrue(self.daemon._upload_on_server('big.bin', 'md5')['successful'])
+            self.assertTrue(self.daemon._upload_on_server('small.txt', 'md5')['successful'])
+        self.assertEqual([args for args, _ in conn_mng.dispatch_request.call_args_list],
+                         [('upload_chunks', {'filepath': 'big.bin', 'md5': 'md5', 'modify': False}),
+                          ('upload', {'filepath': 'small.txt', 'md5': 'md5'})])
+
+    def test_on_modified_appended(self):
+        """
+        Test EVENTS: only the bytes appended to a big file are hashed and sent, the other changes are sent as usual
+        """
+        filepath = os.path.join(TEST_SHARING_FOLDER, 'file.log')
+        content = 'old line\n' * (self.daemon.APPEND_MIN_SIZE // 9 + 1)
+        FileFakeEvent.create_file(filepath, content=content)
+        self.daemon.client_snapshot['file.log'] = [1000, self.daemon.hash_file(filepath)]
+        with open(filepath, 'a') as fp:
+            fp.write('new line\n')
+        content += 'new line\n'
+        with replace_conn_mng(self.daemon, FakeConnMng()):
+            self.daemon.on_modified(FileFakeEvent(src_path=filepath))
+            self.assertEqual(self.daemon.conn_mng.called_cmd, 'append')
+            self.assertEqual(self.daemon.conn_mng.received_data,
+                             {'filepath': 'file.log', 'offset': len(content) - 9, 'size': len(content),
+                              'md5': hashlib.md5(content).hexdigest()})
+            self.assertEqual(self.daemon.client_snapshot['file.log'][1], hashlib.md5(content).hexdigest())
+
+            # Not an append: the middle of the old content has changed before the new bytes are appended
+            middle = len(content) // 2
+            content = content[:middle] + 'changed!' + content[middle + 8:] + 'new line\n'
+            FileFakeEvent.create_file(filepath, content=content)
+            self.daemon.on_modified(FileFakeEvent(src_path=filepath))
+            self.assertEqual(self.daemon.conn_mng.called_cmd, 'modify_delta')
+            self.assertEqual(self.daemon.client_snapshot['file.log'][1], hashlib.md5(content).hexdigest())
+
+            # Not an append: the old content has changed
+            content = 'changed' + content
+            FileFakeEvent.create_file(filepath, content=content)
+            self.daemon.on_modified(FileFakeEvent(src_path=filepath))
+            self.assertEqual(self.daemon.conn_mng.called_cmd, 'modify_delta')
+            self.assertEqual(self.daemon.client_snapshot['file.log'][1], hashlib.md5(content).hexdigest())
+
+    def test_append_on_server_fail(self):
+        """
+        Test EVENTS: the whole file is sent if the server can't append to it
+        """
+        responses = {'append': {'content': 'error', 'successful': False},
+                     'modify': {'content': {'server_timestamp': 1000}, 'successful': True}}
+        FileFakeEvent.create_file(os.path.join(TEST_SHARING_FOLDER, 'file.log'), content='x')
+        conn_mng = Mock(dispatch_request=Mock(side_effect=lambda cmd, data: responses[cmd]))
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.assertEqual(self.daemon._append_on_server('file.log', 0, 1, 'md5'), responses['modify'])
+        self.assertEqual([args[0] for args, _ in conn_mng.dispatch_request.call_args_list], ['append', 'modify'])
+
+    def test_on_deleted_many_files(self):
+        """
+        Test EVENTS: the deletes of consecutive delete events are sent together, when no more events are queued
+        """
+        filenames = ['file{}.txt'.format(i) for i in range(3)]
+        with replace_conn_mng(self.daemon, FakeConnMng()):
+            create_base_dir_tree(filenames)
+            self.daemon.client_snapshot = base_dir_tree.copy()
+            # More events are queued
+            self.daemon.observer.event_queue.empty = Mock(return_value=False)
+            for filename in filenames:
+                self.daemon.on_deleted(FileFakeEvent(src_path=os.path.join(TEST_SHARING_FOLDER, filename)))
+            self.assertEqual(self.daemon.conn_mng.called_cmd, '')
+            self.assertEqual(self.daemon.pending_deletes, filenames)
+
+            self.daemon.on_idle()
+            self.assertEqual(self.daemon.conn_mng.called_cmd, 'batch')
+            self.assertEqual(self.daemon.conn_mng.received_data,
+                             {'actions': [{'cmd': 'delete', 'filepath': filename} for filename in filenames]})
+            self.assertEqual(self.daemon.pending_deletes, [])
+            for filename in filenames:
+                self.assertNotIn(filename, self.daemon.client_snapshot)
+
+    def test_delete_on_server_in_batches(self):
+        """
+        Test EVENTS: no more than ACTIONS_BATCH_SIZE deletes are sent in a request
+        """
+        filenames = ['file{}.txt'.format(i) for i in range(3)]
+        conn_mng = FakeConnMng()
+        conn_mng.dispatch_request = Mock(side_effect=conn_mng.dispatch_request)
+        with replace_conn_mng(self.daemon, conn_mng):
+            create_base_dir_tree(filenames)
+            self.daemon.client_snapshot = base_dir_tree.copy()
+            self.daemon.ACTIONS_BATCH_SIZE = 2
+            self.assertIsNotNone(self.daemon._delete_on_server(filenames))
+            self.assertEqual([call[0][0] for call in conn_mng.dispatch_request.call_args_list], ['batch', 'delete'])
+            self.assertEqual(conn_mng.received_data, {'filepath': 'file2.txt'})
+            for filename in filenames:
+                self.assertNotIn(filename, self.daemon.client_snapshot)
+
+    def dispatch_events(self, events):
+        """
+        Dispatch <events> as if they were queued together, and return the commands sent to the server.
+        """
+        conn_mng = FakeConnMng()
+        conn_mng.dispatch_request = Mock(side_effect=conn_mng.dispatch_request)
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.daemon.observer.event_queue.empty = Mock(return_value=False)
+            for event in events:
+                self.daemon.dispatch(event)
+            self.daemon.on_idle()
+        return [(call[0][0], call[0][1]) for call in conn_mng.dispatch_request.call_args_list]
+
+    def test_directory_moved(self):
+        """
+        Test EVENTS: the events of a moved directory are sent as a single move
+        """
+        filenames = ['project/main.py', 'project/lib/util.py', 'other.txt']
+        create_base_dir_tree(filenames)
+        self.daemon.client_snapshot = client_daemon.CompactSnapshot(base_dir_tree)
+        folder = lambda path: os.path.join(TEST_SHARING_FOLDER, path)
+        events = [FileMovedEvent(folder('project/main.py'), folder('renamed/main.py')),
+                  FileMovedEvent(folder('project/lib/util.py'), folder('renamed/lib/util.py')),
+                  DirMovedEvent(folder('project/lib'), folder('renamed/lib')),
+                  DirMovedEvent(folder('project'), folder('renamed'))]
+
+        self.assertEqual(self.dispatch_events(events), [('move', {'src': 'project', 'dst': 'renamed'})])
+        self.assertEqual(sorted(self.daemon.client_snapshot), ['other.txt', 'renamed/lib/util.py', 'renamed/main.py'])
+        self.assertEqual(self.daemon.client_snapshot['renamed/main.py'][1], base_dir_tree['project/main.py'][1])
+        self.assertEqual(self.daemon.pending_moves, [])
+
+    def test_directory_deleted(self):
+        """
+        Test EVENTS: the events of a deleted directory are sent as a single delete
+        """
+        filenames = ['project/main.py', 'project/lib/util.py', 'other.txt']
+        create_base_dir_tree(filenames)
+        self.daemon.client_snapshot = client_daemon.CompactSnapshot(base_dir_tree)
+        folder = lambda path: os.path.join(TEST_SHARING_FOLDER, path)
+        events = [FileDeletedEvent(folder('project/main.py')), FileDeletedEvent(folder('project/lib/util.py')),
+                  FileDeletedEvent(folder('other.txt')),
+                  DirDeletedEvent(folder('project/lib')), DirDeletedEvent(folder('project'))]
+
+        self.assertEqual(self.dispatch_events(events),
+                         [('batch', {'actions': [{'cmd': 'delete', 'filepath': 'other.txt'},
+                                                 {'cmd': 'delete', 'filepath': 'project'}]})])
+        self.assertEqual(len(self.daemon.client_snapshot), 0)
+
+    def test_created_files_uploaded_together(self):
+        """
+        Test EVENTS: many new small files are uploaded in an archive
+        """
+        create_base_dir_tree([])
+        self.daemon.client_snapshot = client_daemon.CompactSnapshot()
+        events = []
+        for i in range(self.daemon.ARCHIVE_MIN_FILES):
+            event = FileCreatedEvent(os.path.join(TEST_SHARING_FOLDER, 'new', 'file{}.txt'.format(i)))
+            FileFakeEvent.create_file(event.src_path, content='content {}'.format(i))
+            events.append(event)
+
+        commands = self.dispatch_events(events)
+        self.assertEqual([cmd for cmd, _ in commands], ['preflight', 'upload_archive'])
+        self.assertEqual(sorted(path for path, _ in commands[1][1]['files']),
+                         sorted('new/file{}.txt'.format(i) for i in range(self.daemon.ARCHIVE_MIN_FILES)))
+        self.assertEqual(self.daemon.client_snapshot['new/file0.txt'][1], hashlib.md5('content 0').hexdigest())
+        self.assertEqual(self.daemon.pending_uploads, [])
+
     def test_on_created(self):
         """"
         Test EVENTS: test on created event of watchdog, expect a upload requests
@@ -1306,6 +1622,36 @@ class TestClientDaemonSync(unittest.TestCase):
             # Check state after event
             self.assertIn(filename, self.daemon.client_snapshot)
 
+    def test_on_created_with_content_on_server(self):
+        """
+        Test EVENTS: test on created event of watchdog when the server already has the file content:
+        the file must not be uploaded
+        """
+        filename = 'file.txt'
+        src_filepath = os.path.join(TEST_SHARING_FOLDER, filename)
+        content = 'content of file'
+        self.daemon.PREFLIGHT_MIN_SIZE = len(content)
+        with replace_conn_mng(self.daemon, FakeConnMngWithContents()):
+            create_base_dir_tree([])
+            self.daemon.client_snapshot = base_dir_tree.copy()
+            self.daemon.on_created(FileFakeEvent(src_path=src_filepath, src_content=content))
+            self.assertEqual(self.daemon.conn_mng.called_cmd, '')
+            self.assertEqual(self.daemon.client_snapshot[filename],
+                             [FakeConnMngWithContents.MATERIALIZED_TIMESTAMP, hashlib.md5(content).hexdigest()])
+
+    def test_on_created_small_file_not_preflighted(self):
+        """
+        Test EVENTS: a single small file is uploaded without asking the server if it has its content
+        """
+        filename = 'file.txt'
+        content = 'content of file'
+        with replace_conn_mng(self.daemon, FakeConnMngWithContents()):
+            create_base_dir_tree([])
+            self.daemon.client_snapshot = base_dir_tree.copy()
+            self.daemon.on_created(FileFakeEvent(src_path=os.path.join(TEST_SHARING_FOLDER, filename),
+                                                 src_content=content))
+            self.assertEqual(self.daemon.conn_mng.called_cmd, 'upload')
+
     def test_modify_event_from_on_created_event(self):
         """"
         Test EVENTS: test on created event of watchdog, expect a modify requests
@@ -1436,6 +1782,76 @@ class TestClientDaemonSync(unittest.TestCase):
             self.assertIn(dst_filename, self.daemon.client_snapshot)
 
 
+class TestChangeListener(unittest.TestCase):
+    def test_change_listener(self):
+        """
+        Test the changes notified by the server: on_change is called at each new version, the failures stop
+        the listening until the next successful request
+        """
+        versions = [1, 1, 2, None, 3, 4]
+        sent_versions = []
+        changes = []
+        listener = client_daemon.ChangeListener(None, lambda: changes.append(listener.listening))
+        listener.RETRY_DELAY = 0
+
+        def dispatch_request(cmd, data):
+            sent_versions.append(data['since'])
+            if len(sent_versions) == len(versions):
+                listener.stop()
+            version = versions[len(sent_versions) - 1]
+            if version is None:
+                self.assertTrue(listener.listening)
+                return {'content': 'error', 'successful': False}
+            return {'content': version, 'successful': True}
+
+        listener.conn_mng = Mock(dispatch_request=Mock(side_effect=dispatch_request))
+        listener.run()
+        self.assertEqual(sent_versions, [None, 1, 1, 2, None, 3])
+        self.assertEqual(changes, [True])
+        self.assertTrue(listener.listening)
+
+
+class TestPollScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.scheduler = client_daemon.PollScheduler(now=lambda: self.now)
+
+    def next_interval(self):
+        return self.scheduler.next_poll - self.now
+
+    def test_backoff(self):
+        """
+        Test the polls are less and less frequent while nothing changes, up to MAX_INTERVAL (with some jitter)
+        """
+        self.assertFalse(self.scheduler.is_due())
+        self.now += self.scheduler.MIN_INTERVAL
+        self.assertTrue(self.scheduler.is_due())
+        jitter = self.scheduler.JITTER
+        interval = self.scheduler.MIN_INTERVAL
+        for _ in range(20):
+            self.scheduler.polled(False)
+            interval = min(interval * 2, self.scheduler.MAX_INTERVAL)
+            self.assertTrue(interval * (1 - jitter) <= self.next_interval() <= interval * (1 + jitter))
+        self.assertEqual(self.scheduler.interval, self.scheduler.MAX_INTERVAL)
+
+    def test_activity(self):
+        """
+        Test the polls are frequent again after a change
+        """
+        for _ in range(10):
+            self.scheduler.polled(False)
+        self.scheduler.polled(True)
+        self.assertLessEqual(self.next_interval(), self.scheduler.MIN_INTERVAL * (1 + self.scheduler.JITTER))
+        for _ in range(10):
+            self.scheduler.polled(False)
+        self.scheduler.activity()
+        self.assertEqual(self.next_interval(), self.scheduler.MIN_INTERVAL)
+
+    def test_fixed_interval(self):
+        self.scheduler.polled(False, 300)
+        self.assertEqual(self.next_interval(), 300)
+
+
 @contextmanager
 def replace_conn_mng(daemon, fake):
     original, daemon.conn_mng = daemon.conn_mng, fake
@@ -1790,5 +2206,18 @@ class SkipObserverTest(unittest.TestCase):
         self.skip_observer._dispatch_event.assert_called_once_with(event,
                                                                    watch)
 
+    def test_on_idle_without_lock(self):
+        """
+        The handlers complete their waiting operations (see Daemon.on_idle) without holding the observer lock.
+        """
+        watch = 'watch'
+        locked = []
+        handler = Mock()
+        handler.on_idle.side_effect = lambda: locked.append(self.skip_observer._lock.locked())
+        self.skip_observer._handlers[watch] = set([handler])
+        self.skip_observer._dispatch_event = Mock()
+        self.skip_observer.dispatch_events(FakeEventQueue(FileFakeEvent(src_path='folder/file.txt'), watch), 'timeout')
+        self.assertEqual(locked, [False])
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,6 +3,7 @@
 
 import unittest
 import json
+from mock import Mock
 
 import client_cmdmanager
 import tstutils
@@ -252,6 +253,14 @@ class TestDoQuitDoEOF(unittest.TestCase):
         self.commandparser = client_cmdmanager.CommandParser()
         self.line = 'linelinelineline'
 
+    def test_do_sync(self):
+        """
+        Verify do_sync sends the sync command to the daemon
+        """
+        self.commandparser._send_to_daemon = Mock(return_value={'content': 'Synchronized', 'successful': True})
+        self.assertTrue(self.commandparser.do_sync(self.line)['successful'])
+        self.commandparser._send_to_daemon.assert_called_once_with({'sync': ()})
+
     def test_do_quit(self):
         """
         Verify do_quit
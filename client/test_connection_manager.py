@@ -3,12 +3,23 @@
 
 import unittest
 from connection_manager import ConnectionManager
+import delta
+import chunking
+import snapshot_codec
+from snapshot import CompactSnapshot, SnapshotDiff
 import os
 import json
 import httpretty
+import requests
 import time
 import shutil
 import urllib
+import urlparse
+import base64
+import hashlib
+import tarfile
+import StringIO
+from mock import Mock, patch
 
 # API:
 # - GET /diffs, con parametro timestamp
@@ -88,6 +99,8 @@ class TestConnectionManager(unittest.TestCase):
         self.actions_url = ''.join([self.base_url, 'actions/'])
         self.shares_url = ''.join([self.base_url, 'shares/'])
         self.user_url = ''.join([self.base_url, 'users/'])
+        self.tokens_url = ''.join([self.base_url, 'tokens'])
+        self.preflight_url = ''.join([self.base_url, 'preflight'])
 
         self.cm = ConnectionManager(self.cfg)
 
@@ -428,6 +441,20 @@ class TestConnectionManager(unittest.TestCase):
         response = self.cm.do_download(data)
         self.assertEqual(response['successful'], True)
 
+    @httpretty.activate
+    def test_download_not_modified(self):
+        url = ''.join((self.files_url, 'file.txt'))
+        httpretty.register_uri(httpretty.GET, url, status=304)
+        filepath = os.path.join(self.cfg['sharing_path'], 'file.txt')
+        with open(filepath, 'w') as f:
+            f.write('content')
+
+        response = self.cm.do_download({'filepath': 'file.txt'})
+        self.assertEqual(response, {'successful': True})
+        self.assertEqual(httpretty.last_request().headers['If-None-Match'],
+                         '"{}"'.format(hashlib.md5('content').hexdigest()))
+        self.assertEqual(open(filepath).read(), 'content')
+
     @httpretty.activate
     def test_download_file_not_exists(self):
         url = ''.join((self.files_url, 'file.tx'))
@@ -594,7 +621,7 @@ class TestConnectionManager(unittest.TestCase):
     @httpretty.activate
     def test_get_server_snapshot(self):
         url = self.files_url
-        msg = {'files': 'foo.txt'}
+        msg = {'server_timestamp': 1000, 'files': {'foo.txt': [1000, 'md5']}, 'shared_files': {}}
         js = json.dumps(msg)
 
         httpretty.register_uri(httpretty.GET, url, status=201,
@@ -605,6 +632,80 @@ class TestConnectionManager(unittest.TestCase):
         self.assertTrue(response['successful'])
         self.assertEqual(response['content'], msg)
 
+    @httpretty.activate
+    def test_get_server_snapshot_not_modified(self):
+        msg = {'server_timestamp': 1000, 'files': {'foo.txt': [1000, 'md5']}, 'shared_files': {}}
+        httpretty.register_uri(httpretty.GET, self.files_url,
+                               responses=[httpretty.Response(body=json.dumps(msg), status=200, etag='"etag"',
+                                                             content_type='application/json'),
+                                          httpretty.Response(body='', status=304)])
+        response = self.cm.do_get_server_snapshot('')
+        self.assertEqual(response, {'content': msg, 'successful': True, 'not_modified': False, 'etag': '"etag"'})
+        self.assertNotIn('If-None-Match', httpretty.last_request().headers)
+
+        response = self.cm.do_get_server_snapshot({'etag': response['etag']})
+        self.assertEqual(response, {'content': None, 'successful': True, 'not_modified': True})
+        self.assertEqual(httpretty.last_request().headers['If-None-Match'], '"etag"')
+
+    @httpretty.activate
+    def test_get_server_snapshot_binary(self):
+        msg = {'server_timestamp': 1000, 'files': {u'foo.txt': [1000, hashlib.md5('foo').hexdigest()]},
+               'shared_files': {}}
+        httpretty.register_uri(httpretty.GET, self.files_url, status=200, body=snapshot_codec.encode(msg),
+                               content_type=snapshot_codec.CONTENT_TYPE)
+        response = self.cm.do_get_server_snapshot('')
+        self.assertEqual(response, {'content': msg, 'successful': True, 'not_modified': False, 'etag': None})
+        self.assertTrue(httpretty.last_request().headers['Accept'].startswith(snapshot_codec.CONTENT_TYPE))
+
+    def snapshot_page(self, files, shared_files, next_page=None, server_timestamp=1000):
+        headers = {'X-PyBox-Next-Page': next_page} if next_page else {}
+        return httpretty.Response(body=json.dumps({'server_timestamp': server_timestamp, 'files': files,
+                                                   'shared_files': shared_files}),
+                                  status=200, content_type='application/json', adding_headers=headers)
+
+    @httpretty.activate
+    def test_get_server_snapshot_pages(self):
+        httpretty.register_uri(httpretty.GET, self.files_url, responses=[
+            self.snapshot_page({'a.txt': [1000, 'md5 a'], 'b.txt': [1000, 'md5 b']}, {}, 'token'),
+            self.snapshot_page({'c.txt': [1000, 'md5 c']}, {'shared/user/d.txt': [1000, 'md5 d']})])
+        response = self.cm.do_get_server_snapshot('')
+        self.assertEqual(response['content'], {'server_timestamp': 1000,
+                                               'files': {'a.txt': [1000, 'md5 a'], 'b.txt': [1000, 'md5 b'],
+                                                         'c.txt': [1000, 'md5 c']},
+                                               'shared_files': {'shared/user/d.txt': [1000, 'md5 d']}})
+        self.assertEqual(httpretty.last_request().querystring,
+                         {'limit': [str(self.cm.SNAPSHOT_PAGE_SIZE)], 'after': ['token']})
+
+    @httpretty.activate
+    def test_get_server_snapshot_changed_between_pages(self):
+        httpretty.register_uri(httpretty.GET, self.files_url, responses=[
+            self.snapshot_page({'a.txt': [1000, 'md5 a']}, {}, 'token'),
+            httpretty.Response(body='', status=409),
+            self.snapshot_page({'a.txt': [2000, 'new md5 a']}, {}, 'new token', 2000),
+            self.snapshot_page({'b.txt': [2000, 'md5 b']}, {}, server_timestamp=2000)])
+        response = self.cm.do_get_server_snapshot('')
+        self.assertEqual(response['content'], {'server_timestamp': 2000,
+                                               'files': {'a.txt': [2000, 'new md5 a'], 'b.txt': [2000, 'md5 b']},
+                                               'shared_files': {}})
+
+    @httpretty.activate
+    def test_get_server_snapshot_diff(self):
+        # The pages are compared as they arrive, and compared again if the snapshot changes meanwhile
+        httpretty.register_uri(httpretty.GET, self.files_url, responses=[
+            self.snapshot_page({'a.txt': [1000, 'md5 a']}, {}, 'token'),
+            httpretty.Response(body='', status=409),
+            self.snapshot_page({'a.txt': [2000, 'new md5 a']}, {}, 'new token', 2000),
+            self.snapshot_page({'b.txt': [2000, 'md5 b']}, {'shared/user/d.txt': [1000, 'md5 d']},
+                               server_timestamp=2000)])
+        diff = SnapshotDiff(CompactSnapshot({'a.txt': [1000, 'md5 a'], 'c.txt': [1000, 'md5 c']}), CompactSnapshot())
+        response = self.cm.do_get_server_snapshot({'consumer': diff})
+        self.assertIs(response['content'], diff)
+        self.assertEqual(diff.server_timestamp, 2000)
+        self.assertEqual((diff.files.new_on_server, diff.files.modified, diff.files.new_on_client),
+                         (['b.txt'], ['a.txt'], ['c.txt']))
+        self.assertEqual(diff.files.server_files, {'a.txt': [2000, 'new md5 a'], 'b.txt': [2000, 'md5 b']})
+        self.assertEqual(diff.shared_files.new_on_server, ['shared/user/d.txt'])
+
     @httpretty.activate
     def test_get_server_snapshot_fail(self):
         url = self.files_url
@@ -616,5 +717,316 @@ class TestConnectionManager(unittest.TestCase):
         self.assertFalse(response['successful'])
         self.assertIsInstance(response['content'], str)
 
+    @httpretty.activate
+    def test_get_token(self):
+        """
+        After do_get_token the requests must send the session token as password.
+        """
+        httpretty.register_uri(httpretty.POST, self.tokens_url, status=201,
+                               body=json.dumps({'token': 'session-token', 'expires_in': 3600}),
+                               content_type="application/json")
+        httpretty.register_uri(httpretty.GET, self.files_url, status=200,
+                               body=json.dumps({}), content_type="application/json")
+
+        response = self.cm.do_get_token()
+        self.assertTrue(response['successful'])
+        response = self.cm.do_get_server_snapshot('')
+        self.assertTrue(response['successful'])
+        self.assertEqual(httpretty.last_request().headers['Authorization'],
+                         'Basic ' + base64.b64encode('{}:session-token'.format(self.cfg['user'])))
+
+    @httpretty.activate
+    def test_preflight(self):
+        files = [['Music/song.mp3', 'a' * 32, 100], ['Work/new.txt', 'b' * 32, 10]]
+        content = {'materialized': {'Music/song.mp3': 1000}, 'needed': ['Work/new.txt'], 'server_timestamp': 1000}
+        httpretty.register_uri(httpretty.POST, self.preflight_url, status=200,
+                               body=json.dumps(content), content_type="application/json")
+
+        response = self.cm.do_preflight({'files': files})
+        self.assertEqual(response, {'content': content, 'successful': True})
+        sent_files = urlparse.parse_qs(httpretty.last_request().body)['files'][0]
+        self.assertEqual(json.loads(sent_files), files)
+
+    @httpretty.activate
+    def test_preflight_fail(self):
+        httpretty.register_uri(httpretty.POST, self.preflight_url, status=404)
+        self.assertFalse(self.cm.do_preflight({'files': []})['successful'])
+
+    def test_upload_archive(self):
+        content = {'stored': {'foo.txt': 1000}, 'failed': {}, 'server_timestamp': 1000}
+        sent = {}
+
+        def fake_post(url, data, **kwargs):
+            # httpretty records only the last block of a streamed body
+            sent.update(url=url, length=len(data), archive=data.read(), headers=kwargs['headers'])
+            return Mock(json=Mock(return_value=content), raise_for_status=Mock())
+
+        with patch('connection_manager.requests.post', fake_post):
+            response = self.cm.do_upload_archive({'files': [['foo.txt', 'test_md5']]})
+        self.assertEqual(response, {'content': content, 'successful': True})
+        self.assertEqual(sent['url'], self.base_url + 'archives')
+        self.assertEqual(sent['headers']['Content-Type'], 'application/x-tar')
+        # The archive is streamed with its length
+        self.assertEqual(sent['length'], len(sent['archive']))
+        tar = tarfile.open(fileobj=StringIO.StringIO(sent['archive']))
+        member = tar.next()
+        self.assertEqual(member.name, 'foo.txt')
+        self.assertEqual(member.pax_headers['PYBOX.md5'], 'test_md5')
+        self.assertEqual(tar.extractfile(member).read(), 'foo.txt :)')
+
+    def test_upload_archive_missing_file(self):
+        response = self.cm.do_upload_archive({'files': [['missing.txt', 'test_md5']]})
+        self.assertFalse(response['successful'])
+
+    @httpretty.activate
+    def test_download_archive(self):
+        files = {'Work/new.txt': 'new', 'Work/bad.txt': 'bad', 'foo.txt': 'new foo', '../escape.txt': 'escape'}
+        buf = StringIO.StringIO()
+        tar = tarfile.open(fileobj=buf, mode='w', format=tarfile.PAX_FORMAT)
+        for path, content in sorted(files.items()):
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            md5 = hashlib.md5('other' if path == 'Work/bad.txt' else content).hexdigest()
+            info.pax_headers = {'PYBOX.md5': md5}
+            tar.addfile(info, StringIO.StringIO(content))
+        tar.close()
+        httpretty.register_uri(httpretty.GET, self.base_url + 'archives', status=200, body=buf.getvalue(),
+                               content_type='application/x-tar')
+        skip = Mock()
+
+        response = self.cm.do_download_archive({'files': ['Work/new.txt', 'Work/bad.txt', 'foo.txt'], 'skip': skip})
+        self.assertEqual(response, {'content': {'Work/new.txt': hashlib.md5('new').hexdigest(),
+                                                'foo.txt': hashlib.md5('new foo').hexdigest()},
+                                    'successful': True})
+        self.assertEqual(httpretty.last_request().querystring['path'], ['Work/new.txt', 'Work/bad.txt', 'foo.txt'])
+        sharing_path = self.cfg['sharing_path']
+        self.assertEqual(open(os.path.join(sharing_path, 'Work/new.txt')).read(), 'new')
+        self.assertEqual(open(os.path.join(sharing_path, 'foo.txt')).read(), 'new foo')
+        self.assertFalse(os.path.exists(os.path.join(sharing_path, 'Work/bad.txt')))
+        self.assertFalse(os.path.exists(os.path.join(sharing_path, os.pardir, 'escape.txt')))
+        self.assertEqual(sorted(name for name in os.listdir(os.path.join(sharing_path, 'Work'))), ['new.txt'])
+        skipped = [args[0] for args, _ in skip.call_args_list]
+        self.assertIn(os.path.join(sharing_path, 'foo.txt'), skipped)
+        self.assertNotIn(os.path.join(sharing_path, 'Work/bad.txt'), skipped)
+
+    @httpretty.activate
+    def test_download_archive_fail(self):
+        httpretty.register_uri(httpretty.GET, self.base_url + 'archives', status=500)
+        response = self.cm.do_download_archive({'files': ['foo.txt'], 'subtree': '', 'skip': Mock()})
+        self.assertFalse(response['successful'])
+        self.assertEqual(httpretty.last_request().path, '/API/V1/archives?subtree=')
+
+    @httpretty.activate
+    def test_modify_delta(self):
+        old = os.urandom(2 ** 16)
+        new = old[:1000] + 'changed' + old[1000:]
+        with open(os.path.join(TEST_SHARING_FOLDER, 'big.bin'), 'wb') as fp:
+            fp.write(new)
+        httpretty.register_uri(httpretty.GET, self.base_url + 'signatures/big.bin', status=200,
+                               body=delta.signature(StringIO.StringIO(old), len(old)))
+        content = {'server_timestamp': 1000}
+        sent = {}
+
+        def fake_put(url, files, data, **kwargs):
+            sent.update(url=url, delta=files['delta'].read(), md5=data['md5'])
+            return Mock(json=Mock(return_value=content), raise_for_status=Mock())
+
+        with patch('connection_manager.requests.put', fake_put):
+            response = self.cm.do_modify_delta({'filepath': 'big.bin', 'md5': 'test_md5'})
+        self.assertEqual(response, {'content': content, 'successful': True})
+        self.assertEqual((sent['url'], sent['md5']), (self.files_url + 'big.bin', 'test_md5'))
+        self.assertLess(len(sent['delta']), 2 * delta.block_size(len(old)))
+        out = StringIO.StringIO()
+        delta.patch(StringIO.StringIO(old), StringIO.StringIO(sent['delta']), out)
+        self.assertEqual(out.getvalue(), new)
+
+    @httpretty.activate
+    def test_modify_delta_fail(self):
+        httpretty.register_uri(httpretty.GET, self.base_url + 'signatures/foo.txt', status=200, body='bad signature')
+        self.assertFalse(self.cm.do_modify_delta({'filepath': 'foo.txt', 'md5': 'test_md5'})['successful'])
+
+    @httpretty.activate
+    def test_download_delta(self):
+        new = 'foo.txt :(' * 1000
+        httpretty.register_uri(httpretty.POST, self.base_url + 'deltas/foo.txt', status=200,
+                               body=lambda request, uri, headers: (200, headers, self.make_delta(request, new)),
+                               adding_headers={'X-PyBox-MD5': hashlib.md5(new).hexdigest()})
+        skip = Mock()
+
+        response = self.cm.do_download_delta({'filepath': 'foo.txt', 'skip': skip})
+        self.assertEqual(response, {'content': hashlib.md5(new).hexdigest(), 'successful': True})
+        filepath = os.path.join(TEST_SHARING_FOLDER, 'foo.txt')
+        self.assertEqual(open(filepath).read(), new)
+        self.assertIn(filepath, [args[0] for args, _ in skip.call_args_list])
+        self.assertEqual(os.listdir(TEST_SHARING_FOLDER), ['foo.txt'])
+
+    @staticmethod
+    def make_delta(request, new):
+        """
+        Return the delta of <new> against the signature uploaded with the fake <request>.
+        """
+        signature = request.body.split('\r\n\r\n', 1)[1].rsplit('\r\n--', 1)[0]
+        return ''.join(delta.delta(StringIO.StringIO(new), delta.parse_signature(signature)))
+
+    @httpretty.activate
+    def test_download_delta_wrong_md5(self):
+        httpretty.register_uri(httpretty.POST, self.base_url + 'deltas/foo.txt', status=200,
+                               body=lambda request, uri, headers: (200, headers, self.make_delta(request, 'new')),
+                               adding_headers={'X-PyBox-MD5': hashlib.md5('other').hexdigest()})
+        response = self.cm.do_download_delta({'filepath': 'foo.txt', 'skip': Mock()})
+        self.assertFalse(response['successful'])
+        self.assertEqual(open(os.path.join(TEST_SHARING_FOLDER, 'foo.txt')).read(), 'foo.txt :)')
+        self.assertEqual(os.listdir(TEST_SHARING_FOLDER), ['foo.txt'])
+
+    @httpretty.activate
+    def test_upload_chunks(self):
+        stored = os.urandom(2 ** 19)
+        content = stored[:2 ** 18] + 'new data' + stored[2 ** 18:]
+        with open(os.path.join(TEST_SHARING_FOLDER, 'big.bin'), 'wb') as fp:
+            fp.write(content)
+        stored_md5s = set(md5 for md5, _ in chunking.file_chunks(StringIO.StringIO(stored)))
+
+        def needed_chunks(request, uri, headers):
+            md5s = json.loads(urlparse.parse_qs(request.body)['chunks'][0])
+            return 200, headers, json.dumps({'needed': [md5 for md5 in md5s if md5 not in stored_md5s]})
+        httpretty.register_uri(httpretty.POST, self.base_url + 'chunks', body=needed_chunks,
+                               content_type='application/json')
+        content_response = {'server_timestamp': 1000}
+        sent = {}
+
+        post = requests.post
+
+        def fake_post(url, data, files=None, **kwargs):
+            # httpretty records only the last block of a streamed body
+            if files is None:
+                return post(url, data=data, **kwargs)
+            sent.update(url=url, data=files['data'].read(), form=data)
+            return Mock(json=Mock(return_value=content_response), raise_for_status=Mock())
+
+        with patch('connection_manager.requests.post', fake_post):
+            response = self.cm.do_upload_chunks({'filepath': 'big.bin', 'md5': 'test_md5'})
+        self.assertEqual(response, {'content': content_response, 'successful': True})
+        self.assertEqual(sent['url'], self.files_url + 'big.bin')
+        self.assertEqual(sent['form']['md5'], 'test_md5')
+        chunks = json.loads(sent['form']['chunks'])
+        self.assertEqual(sum(size for _, size in chunks), len(content))
+        # Only the chunks around the new data are sent
+        self.assertLess(len(sent['data']), 3 * chunking.CHUNK_MAX_SIZE)
+        sent_md5s = json.loads(sent['form']['sent'])
+        self.assertEqual(sent_md5s, [md5 for md5, _ in chunks if md5 not in stored_md5s])
+        self.assertEqual(hashlib.md5(sent['data']).hexdigest(),
+                         hashlib.md5(''.join(chunk for chunk in chunking.iter_chunks(StringIO.StringIO(content))
+                                             if hashlib.md5(chunk).hexdigest() in sent_md5s)).hexdigest())
+
+    @httpretty.activate
+    def test_upload_chunks_fail(self):
+        httpretty.register_uri(httpretty.POST, self.base_url + 'chunks', status=500)
+        self.assertFalse(self.cm.do_upload_chunks({'filepath': 'foo.txt', 'md5': 'test_md5'})['successful'])
+
+    def test_append(self):
+        with open(os.path.join(TEST_SHARING_FOLDER, 'file.log'), 'wb') as fp:
+            # Appended while the file was sent
+            fp.write('old line\n' * 100 + 'new line\n' + 'newer line\n')
+        content = {'server_timestamp': 1000}
+        sent = {}
+
+        def fake_patch(url, files, data, **kwargs):
+            sent.update(url=url, data=files['data'].read(), offset=data['offset'], md5=data['md5'])
+            return Mock(json=Mock(return_value=content), raise_for_status=Mock())
+
+        with patch('connection_manager.requests.patch', fake_patch):
+            response = self.cm.do_append({'filepath': 'file.log', 'offset': 900, 'size': 909, 'md5': 'test_md5'})
+        self.assertEqual(response, {'content': content, 'successful': True})
+        self.assertEqual(sent, {'url': self.files_url + 'file.log', 'data': 'new line\n', 'offset': 900,
+                                'md5': 'test_md5'})
+
+    @httpretty.activate
+    def test_append_fail(self):
+        with open(os.path.join(TEST_SHARING_FOLDER, 'file.log'), 'wb') as fp:
+            fp.write('old line\n' * 100 + 'new line\n')
+        httpretty.register_uri(httpretty.PATCH, self.files_url + 'file.log', status=409)
+        self.assertFalse(self.cm.do_append({'filepath': 'file.log', 'offset': 900, 'size': 909,
+                                            'md5': 'test_md5'})['successful'])
+        # The file is shorter than the hashed content
+        self.assertFalse(self.cm.do_append({'filepath': 'file.log', 'offset': 900, 'size': 1000,
+                                            'md5': 'test_md5'})['successful'])
+
+    @httpretty.activate
+    def test_wait_changes(self):
+        httpretty.register_uri(httpretty.GET, self.base_url + 'notifications', status=200,
+                               body=json.dumps({'version': 1234}), content_type='application/json')
+        response = self.cm.do_wait_changes({'since': 1000, 'timeout': 60})
+        self.assertEqual(response, {'content': 1234, 'successful': True})
+        self.assertEqual(httpretty.last_request().querystring, {'since': ['1000'], 'timeout': ['60']})
+        self.cm.do_wait_changes({'since': None, 'timeout': 60})
+        self.assertEqual(httpretty.last_request().querystring, {'timeout': ['60']})
+
+    @httpretty.activate
+    def test_wait_changes_redirected(self):
+        # The server serves the notifications on its transfer service, on the same host
+        transfer_url = TEST_SERVER_ADDRESS + ':5001/API/V1/notifications'
+        httpretty.register_uri(httpretty.GET, self.base_url + 'notifications', status=307,
+                               location=transfer_url + '?since=1000&timeout=60')
+        httpretty.register_uri(httpretty.GET, transfer_url, status=200,
+                               body=json.dumps({'version': 1234}), content_type='application/json')
+        response = self.cm.do_wait_changes({'since': 1000, 'timeout': 60})
+        self.assertEqual(response, {'content': 1234, 'successful': True})
+        self.assertEqual(httpretty.last_request().querystring, {'since': ['1000'], 'timeout': ['60']})
+        self.assertIn('Authorization', httpretty.last_request().headers)
+
+    @httpretty.activate
+    def test_wait_changes_fail(self):
+        httpretty.register_uri(httpretty.GET, self.base_url + 'notifications', status=404)
+        self.assertFalse(self.cm.do_wait_changes({'since': 1000, 'timeout': 60})['successful'])
+
+    @httpretty.activate
+    def test_batch(self):
+        actions = [{'cmd': 'delete', 'filepath': 'Work/old.txt'},
+                   {'cmd': 'move', 'src': 'Work/file.txt', 'dst': 'Music/file.txt'}]
+        content = {'results': [{'status': 404}, {'status': 200, 'server_timestamp': 1000}], 'server_timestamp': 1000}
+        httpretty.register_uri(httpretty.POST, self.actions_url + 'batch', status=200,
+                               body=json.dumps(content), content_type="application/json")
+
+        response = self.cm.do_batch({'actions': actions})
+        self.assertEqual(response, {'content': content, 'successful': True})
+        sent_actions = urlparse.parse_qs(httpretty.last_request().body)['actions'][0]
+        self.assertEqual(json.loads(sent_actions), actions)
+
+    @httpretty.activate
+    def test_batch_fail(self):
+        httpretty.register_uri(httpretty.POST, self.actions_url + 'batch', status=500)
+        self.assertFalse(self.cm.do_batch({'actions': []})['successful'])
+
+    @httpretty.activate
+    def test_get_token_fail(self):
+        """
+        If the token can't be obtained the user credentials must be used.
+        """
+        httpretty.register_uri(httpretty.POST, self.tokens_url, status=404)
+
+        response = self.cm.do_get_token()
+        self.assertFalse(response['successful'])
+        self.assertEqual(self.cm.auth, self.cm.credentials)
+
+    @httpretty.activate
+    def test_refused_token_is_refreshed(self):
+        """
+        When the token is refused (i.e. expired), a new token must be requested and the request sent again.
+        """
+        httpretty.register_uri(httpretty.POST, self.tokens_url,
+                               responses=[httpretty.Response(body=json.dumps({'token': token}), status=201)
+                                          for token in ('old-token', 'new-token')],
+                               content_type="application/json")
+        httpretty.register_uri(httpretty.GET, self.files_url,
+                               responses=[httpretty.Response(body='', status=401),
+                                          httpretty.Response(body=json.dumps({}), status=200)],
+                               content_type="application/json")
+
+        self.cm.do_get_token()
+        response = self.cm.do_get_server_snapshot('')
+        self.assertTrue(response['successful'])
+        self.assertEqual(httpretty.last_request().headers['Authorization'],
+                         'Basic ' + base64.b64encode('{}:new-token'.format(self.cfg['user'])))
+
 if __name__ == '__main__':
     unittest.main()
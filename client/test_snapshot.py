@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import unittest
+
+from snapshot import CompactSnapshot, TreeDiff, pack_record, unpack_record
+
+
+TEST_TREE = {
+    'file1.txt': [1000L, hashlib.md5('file1').hexdigest()],
+    'documents/diaco.txt': [1001L, hashlib.md5('diaco').hexdigest()],
+    'documents/work/report.odt': [1002L, hashlib.md5('report').hexdigest()],
+    'images/image.txt': ['', hashlib.md5('image').hexdigest()],
+}
+
+
+class TestPackRecord(unittest.TestCase):
+    def test_hex_digest(self):
+        md5 = hashlib.md5('foo').hexdigest()
+        self.assertEqual(len(pack_record('', md5)), 16)
+        self.assertEqual(unpack_record(pack_record('', md5)), ['', md5])
+        self.assertEqual(len(pack_record(14159265358979L, md5)), 24)
+        self.assertEqual(unpack_record(pack_record(14159265358979L, md5)), [14159265358979L, md5])
+
+    def test_not_compactable_values(self):
+        """
+        Values that can't be packed must be returned untouched.
+        """
+        md5 = hashlib.md5('foo').hexdigest()
+        for value in (['', 'fake_md5'], [1, md5.upper()], [1, 'z' * 32], [1.5, md5], [2 ** 70, md5], [None, md5]):
+            self.assertEqual(unpack_record(pack_record(*value)), value)
+
+
+class TestCompactSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = CompactSnapshot(TEST_TREE)
+
+    def test_equal_to_dict(self):
+        self.assertEqual(self.snapshot, TEST_TREE)
+        self.assertEqual(TEST_TREE, self.snapshot)
+        self.assertEqual(len(self.snapshot), len(TEST_TREE))
+
+    def test_getitem(self):
+        for path, value in TEST_TREE.iteritems():
+            self.assertEqual(self.snapshot[path], value)
+        self.assertRaises(KeyError, self.snapshot.__getitem__, 'documents/missing.txt')
+        self.assertRaises(KeyError, self.snapshot.__getitem__, 'missing_dir/diaco.txt')
+
+    def test_contains(self):
+        self.assertIn('documents/work/report.odt', self.snapshot)
+        self.assertNotIn('documents/work', self.snapshot)
+        self.assertNotIn('report.odt', self.snapshot)
+
+    def test_overwrite(self):
+        new_md5 = hashlib.md5('new content').hexdigest()
+        self.snapshot['file1.txt'] = (2000L, new_md5)
+        self.assertEqual(self.snapshot['file1.txt'], [2000L, new_md5])
+        self.assertEqual(len(self.snapshot), len(TEST_TREE))
+
+    def test_pop(self):
+        value = self.snapshot.pop('documents/work/report.odt')
+        self.assertEqual(value, TEST_TREE['documents/work/report.odt'])
+        self.assertEqual(len(self.snapshot), len(TEST_TREE) - 1)
+        self.assertEqual(self.snapshot.pop('documents/work/report.odt', 'ERROR'), 'ERROR')
+        # The emptied directory must not be kept in memory
+        self.assertNotIn('documents/work', self.snapshot._dirs)
+
+    def test_iteration(self):
+        self.assertEqual(sorted(self.snapshot), sorted(TEST_TREE))
+        self.assertEqual(sorted(self.snapshot.iteritems()), sorted(TEST_TREE.iteritems()))
+        self.assertEqual(sorted(self.snapshot.keys()), sorted(TEST_TREE.keys()))
+
+    def test_iter_subtree(self):
+        self.assertEqual(sorted(path for path, _ in self.snapshot.iter_subtree('documents')),
+                         ['documents/diaco.txt', 'documents/work/report.odt'])
+        self.assertEqual(dict(self.snapshot.iter_subtree('documents/work/')),
+                         {'documents/work/report.odt': TEST_TREE['documents/work/report.odt']})
+        self.assertEqual(list(self.snapshot.iter_subtree('doc')), [])
+
+    def test_copy(self):
+        snapshot_copy = self.snapshot.copy()
+        snapshot_copy.pop('file1.txt')
+        self.assertIn('file1.txt', self.snapshot)
+        self.assertIsInstance(snapshot_copy, CompactSnapshot)
+
+    def test_directory_prefix_is_stored_once(self):
+        snapshot = CompactSnapshot()
+        for i in xrange(10):
+            snapshot['very/long/directory/prefix/file{}.txt'.format(i)] = [i, hashlib.md5(str(i)).hexdigest()]
+        self.assertEqual(snapshot._dirs.keys(), ['very/long/directory/prefix'])
+
+    def test_directories(self):
+        self.assertEqual(sorted(self.snapshot.iter_directory('documents')), ['documents/diaco.txt'])
+        self.assertEqual(list(self.snapshot.iter_directory('')), ['file1.txt'])
+        self.assertEqual(list(self.snapshot.iter_directory('videos')), [])
+        self.assertEqual(self.snapshot.directory_sizes(), {'': 1, 'documents': 1, 'documents/work': 1, 'images': 1})
+
+
+class TestTreeDiff(unittest.TestCase):
+    SERVER_FILES = {
+        'file1.txt': [1000L, hashlib.md5('file1').hexdigest()],
+        'documents/diaco.txt': [1005L, hashlib.md5('new diaco').hexdigest()],
+        'documents/work/new.odt': [1006L, hashlib.md5('new').hexdigest()],
+        'music/song.mp3': [1003L, hashlib.md5('song').hexdigest()],
+    }
+
+    def diff(self, pages):
+        diff = TreeDiff(CompactSnapshot(TEST_TREE))
+        for page in pages:
+            diff.add(page)
+        diff.finish()
+        return diff
+
+    def check(self, diff):
+        self.assertEqual(sorted(diff.new_on_server), ['documents/work/new.odt', 'music/song.mp3'])
+        self.assertEqual(diff.modified, ['documents/diaco.txt'])
+        self.assertEqual(diff.new_on_client, ['documents/work/report.odt', 'images/image.txt'])
+        self.assertEqual(sorted(diff.server_files),
+                         ['documents/diaco.txt', 'documents/work/new.odt', 'music/song.mp3'])
+        self.assertEqual((diff.server_count, diff.newest), (4, 1006L))
+
+    def test_pages(self):
+        # The pages of the server are sorted by path: 'documents/...' comes before 'file1.txt'
+        paths = sorted(self.SERVER_FILES, key=lambda path: path.split('/'))
+        self.check(self.diff([{path: self.SERVER_FILES[path]} for path in paths]))
+        self.check(self.diff([self.SERVER_FILES]))
+
+    def test_pages_out_of_order(self):
+        paths = sorted(self.SERVER_FILES, key=lambda path: path.split('/'), reverse=True)
+        self.check(self.diff([{path: self.SERVER_FILES[path]} for path in paths]))
+
+    def test_only_current_directories_kept(self):
+        local = CompactSnapshot(('dir{}/file{}.txt'.format(i, j), [1000L, hashlib.md5(str(j)).hexdigest()])
+                                for i in range(3) for j in range(3))
+        diff = TreeDiff(local)
+        # dir1/file2.txt has been deleted on the server
+        diff.add({'dir0/file0.txt': local['dir0/file0.txt'], 'dir0/file1.txt': local['dir0/file1.txt'],
+                  'dir1/file0.txt': local['dir1/file0.txt']})
+        self.assertEqual(diff._seen.keys(), ['dir1'])
+        diff.add({'dir1/file1.txt': local['dir1/file1.txt'], 'dir2/file0.txt': local['dir2/file0.txt']})
+        self.assertEqual(diff._seen.keys(), ['dir2'])
+        diff.add({'dir2/file1.txt': local['dir2/file1.txt'], 'dir2/file2.txt': local['dir2/file2.txt']})
+        diff.finish()
+        self.assertEqual(diff.new_on_client, ['dir0/file2.txt', 'dir1/file2.txt'])
+        self.assertEqual((diff.new_on_server, diff.modified), ([], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Content addressed store of the file contents, so that the same content is kept on disk only once,
+whatever the users and the paths that have it.
+
+Every stored content is a blob file named by its md5 (<root>/<md5[:2]>/<md5>), and the user files with
+that content are hard links to it. So copying a file is adding a link, and the reference count of a blob
+is the link count of its inode, kept by the filesystem itself: a delete (os.remove), a move (os.rename)
+or the replacement of a file (os.rename of the new content over it) update it atomically.
+NB: the user files must never be written in place, nor their times set, since that would change all the files
+sharing the content.
+
+A blob whose only link is the blob itself is garbage, removed by BlobStore.collect_garbage (a periodic job).
+
+When a link can't be made (too many links, different filesystems), the file is cloned with a reflink where the
+filesystem supports it (btrfs, xfs, ...): the clone shares the data extents, so it is as fast as a link, and
+the filesystem copies them only when one of the two files is written. A real copy is the last resort.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+import filecmp
+import binascii
+
+
+# ioctl(dest_fd, FICLONE, src_fd): make dest share all the data extents of src (Linux >= 4.5)
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """
+    Create <dst> as a copy-on-write clone of <src>.
+    Raise IOError (EOPNOTSUPP, EINVAL, EXDEV, ...) if the filesystem can't clone <src> into <dst>.
+    """
+    with open(src, 'rb') as src_fp:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fp.fileno())
+        except IOError:
+            os.close(dst_fd)
+            os.remove(dst)
+            raise
+        os.close(dst_fd)
+
+
+def clone_file(src, dst):
+    """
+    Create <dst> with the content of <src>: a reflink if the filesystem supports it, otherwise a real copy.
+    """
+    try:
+        reflink(src, dst)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            raise
+        shutil.copyfile(src, dst)
+
+
+class BlobStore(object):
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, md5):
+        """
+        Return the path of the blob of the content <md5>.
+        :return: str
+        """
+        return os.path.join(self.root, md5[:2], md5)
+
+    @staticmethod
+    def _temp_path(filepath):
+        dirname, filename = os.path.split(filepath)
+        return os.path.join(dirname, '.{}.{}.link'.format(filename, binascii.hexlify(os.urandom(8))))
+
+    def link(self, src, dst):
+        """
+        Make <dst> a hard link of <src> (a copy that shares its content), replacing <dst> if it exists.
+        If no more links of <src> can be made (too many links, or different filesystems), <dst> is a clone.
+        """
+        tmp_dst = self._temp_path(dst)
+        try:
+            os.link(src, tmp_dst)
+        except OSError as e:
+            if e.errno not in (errno.EMLINK, errno.EXDEV, errno.EPERM):
+                raise
+            clone_file(src, tmp_dst)
+        os.rename(tmp_dst, dst)
+
+    def add(self, filepath, md5):
+        """
+        Store the content of <filepath> (whose md5 is <md5>) as a blob, if it is a new content, otherwise
+        replace <filepath> with a link to the stored blob (so its content is kept once).
+        The stored blob must have the same bytes: md5 collisions can be made, and the blob can be the upload
+        of another user. A different content is kept as it is, unlinked.
+        """
+        blob = self.path(md5)
+        while True:
+            try:
+                os.link(filepath, blob)
+                return
+            except OSError as e:
+                if e.errno == errno.ENOENT and not os.path.isdir(os.path.dirname(blob)):
+                    try:
+                        os.makedirs(os.path.dirname(blob))
+                    except OSError:
+                        # Created by another request meanwhile
+                        pass
+                    continue
+                if e.errno == errno.EMLINK:
+                    # The file can't be a link of the blob: keep it as it is
+                    return
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if os.path.getsize(blob) != os.path.getsize(filepath) or \
+                        not filecmp.cmp(blob, filepath, shallow=False):
+                    return
+                self.link(blob, filepath)
+                return
+            except OSError as e:
+                # The blob has been collected meanwhile: store it again.
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _iter_blobs(self):
+        """
+        Yield the (path, os.stat result) of every blob.
+        """
+        if not os.path.isdir(self.root):
+            return
+        for dirname in os.listdir(self.root):
+            dirpath = os.path.join(self.root, dirname)
+            for filename in os.listdir(dirpath):
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    yield filepath, os.lstat(filepath)
+                except OSError:
+                    # Removed meanwhile
+                    pass
+
+    def collect_garbage(self):
+        """
+        Remove the blobs not linked by any user file.
+        A user file linked after the check keeps its content, it is just not shared anymore.
+        :return: (int, int), the number of removed blobs and the freed bytes
+        """
+        removed, freed = 0, 0
+        for filepath, stat in self._iter_blobs():
+            if stat.st_nlink == 1:
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    continue
+                removed += 1
+                freed += stat.st_size
+        return removed, freed
+
+    def stats(self):
+        """
+        Return the number of blobs, their bytes, the number of user files linked to them and their bytes:
+        linked bytes / bytes is the deduplication ratio.
+        :return: dict
+        """
+        stats = {'blobs': 0, 'bytes': 0, 'links': 0, 'linked_bytes': 0}
+        for _, stat in self._iter_blobs():
+            stats['blobs'] += 1
+            stats['bytes'] += stat.st_size
+            stats['links'] += stat.st_nlink - 1
+            stats['linked_bytes'] += stat.st_size * (stat.st_nlink - 1)
+        return stats
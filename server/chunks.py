@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Store of the chunks of the uploaded files, to upload only the chunks that the server doesn't have yet.
+
+The client cuts the big files in content-defined chunks (the boundaries depend on the content around them, so an
+insertion or a removal changes the chunks near it only) and sends the list of their md5s: the server asks for
+the missing ones, then rebuilds the file from the stored chunks (see server.Files._assemble_upload).
+So a renamed export, a versioned copy or a file with appended data costs about its new bytes only,
+whatever the path of the file that had the other ones.
+
+The chunks are kept for each user, and a user can only use the chunks it has uploaded: a shared store would tell
+anyone if a chunk exists, and give its bytes to anyone who knows its md5 and size (a file made of that chunk only).
+Every chunk is a file named by its md5 (<root>/<user key>/<md5[:2]>/<md5>, see ChunkStore.user_key). The rebuilt
+files are stored in the blob store
+as usual, so the chunks are a cache of the recently used contents: a chunk unused for a while is removed by
+ChunkStore.collect_garbage (a periodic job), and its next upload sends it again.
+"""
+
+import os
+import time
+import hashlib
+import binascii
+
+
+class ChunkStore(object):
+    # Bytes of the biggest chunk accepted
+    CHUNK_MAX_SIZE = 2 ** 20
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def user_key(username):
+        """
+        Return the name of the directory of the chunks of <username>, safe for any username.
+        :return: str
+        """
+        if isinstance(username, unicode):
+            username = username.encode('utf-8')
+        return hashlib.md5(username).hexdigest()
+
+    def path(self, username, md5):
+        """
+        Return the path of the chunk <md5> of <username>.
+        :return: str
+        """
+        return os.path.join(self.root, self.user_key(username), md5[:2], md5)
+
+    def has(self, username, md5):
+        """
+        Check if the chunk <md5> of <username> is stored, and keep it for another while if it is.
+        :return: bool
+        """
+        try:
+            os.utime(self.path(username, md5), None)
+        except OSError:
+            return False
+        return True
+
+    def add(self, username, md5, data):
+        """
+        Store the chunk <data> of <username>, whose md5 is <md5>. A stored chunk is replaced atomically by the same
+        content.
+        """
+        chunk_path = self.path(username, md5)
+        dirname = os.path.dirname(chunk_path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Created by another request meanwhile
+                pass
+        tmp_path = os.path.join(dirname, '.{}.{}.tmp'.format(md5, binascii.hexlify(os.urandom(8))))
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_path, chunk_path)
+
+    def assemble(self, username, md5s, fp):
+        """
+        Write the chunks <md5s> of <username> in the file object <fp>, and return the md5 of the written content.
+        Raise KeyError if a chunk is missing.
+        :return: str
+        """
+        h = hashlib.md5()
+        for md5 in md5s:
+            try:
+                with open(self.path(username, md5), 'rb') as chunk_fp:
+                    data = chunk_fp.read()
+            except IOError:
+                raise KeyError(md5)
+            h.update(data)
+            fp.write(data)
+        return h.hexdigest()
+
+    def collect_garbage(self, max_age):
+        """
+        Remove the chunks unused for <max_age> seconds.
+        :return: (int, int), the number of removed chunks and the freed bytes
+        """
+        removed, freed = 0, 0
+        if not os.path.isdir(self.root):
+            return removed, freed
+        expiry = time.time() - max_age
+        for user_dir in os.listdir(self.root):
+            for dirname in os.listdir(os.path.join(self.root, user_dir)):
+                dirpath = os.path.join(self.root, user_dir, dirname)
+                for filename in os.listdir(dirpath):
+                    filepath = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(filepath)
+                        if stat.st_mtime >= expiry:
+                            continue
+                        os.remove(filepath)
+                    except OSError:
+                        continue
+                    removed += 1
+                    freed += stat.st_size
+        return removed, freed
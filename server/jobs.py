@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-process background jobs of the server.
+
+The request handlers enqueue the slow work that the client doesn't need to wait for
+(i.e. sending emails) and a background thread runs it. A failing job is retried later, with an
+exponential backoff, up to <max_attempts> times.
+The queue can be saved in a json file, so the pending jobs survive a server restart.
+
+Periodic jobs (i.e. the cleanup of the expired data) are scheduled with JobQueue.schedule:
+they are not saved, since they are scheduled again at every start.
+
+Example:
+    >>> queue = JobQueue()
+    >>> queue.register('greet', lambda name: None)
+    >>> queue.enqueue('greet', ('world',))
+    >>> queue.run_pending()
+    1
+"""
+
+import os
+import time
+import json
+import logging
+import threading
+
+
+logger = logging.getLogger('Server log')
+
+
+class JobQueue(object):
+    # Max seconds the runner thread sleeps between two checks of the queue
+    POLL_INTERVAL = 5
+
+    def __init__(self, max_attempts=5, retry_delay=30):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.filename = None
+        # {'<job name>': <function>}
+        self._handlers = {}
+        # Pending jobs: [{'name': .., 'args': [..], 'run_at': <time>, 'attempts': <int>}]
+        self._jobs = []
+        # Periodic jobs: {'<job name>': [<interval>, <next run time>]}
+        self._periodic = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def register(self, name, func):
+        """
+        Set the function that runs the jobs called <name>.
+        """
+        self._handlers[name] = func
+
+    def open(self, filename):
+        """
+        Load the pending jobs saved in <filename> (if it exists) and keep saving the queue there.
+        """
+        with self._cond:
+            self.filename = filename
+            if os.path.exists(filename):
+                with open(filename, 'rb') as fp:
+                    self._jobs.extend(json.load(fp))
+                logger.info('Loaded {} pending jobs'.format(len(self._jobs)))
+
+    def _save(self):
+        if self.filename is None:
+            return
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as fp:
+            json.dump(self._jobs, fp)
+        os.rename(tmp_filename, self.filename)
+
+    def enqueue(self, name, args=(), delay=0):
+        """
+        Add the job <name>(*args) to the queue, to be run in <delay> seconds.
+        The arguments must be json serializable.
+        """
+        if name not in self._handlers:
+            raise KeyError('Unknown job "{}"'.format(name))
+        with self._cond:
+            self._jobs.append({'name': name, 'args': list(args), 'run_at': time.time() + delay, 'attempts': 0})
+            self._save()
+            self._cond.notify()
+
+    def schedule(self, name, interval, delay=0):
+        """
+        Run the job <name>() every <interval> seconds, the first time in <delay> seconds.
+        """
+        if name not in self._handlers:
+            raise KeyError('Unknown job "{}"'.format(name))
+        with self._cond:
+            self._periodic[name] = [interval, time.time() + delay]
+            self._cond.notify()
+
+    def clear(self):
+        """
+        Remove all the pending and periodic jobs.
+        """
+        with self._cond:
+            self._jobs = []
+            self._periodic.clear()
+            self._save()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def _pop_due_jobs(self, now):
+        with self._cond:
+            due = [job for job in self._jobs if job['run_at'] <= now]
+            if due:
+                self._jobs = [job for job in self._jobs if job['run_at'] > now]
+            for name, periodic in self._periodic.iteritems():
+                if periodic[1] <= now:
+                    periodic[1] = now + periodic[0]
+                    due.append({'name': name, 'args': [], 'run_at': now, 'attempts': 0, 'periodic': True})
+            return due
+
+    def run_pending(self, now=None):
+        """
+        Run the jobs due by <now> (default: the current time) and return how many of them have been run.
+        """
+        if now is None:
+            now = time.time()
+        due = self._pop_due_jobs(now)
+        retries = []
+        for job in due:
+            try:
+                self._handlers[job['name']](*job['args'])
+            except Exception:
+                job['attempts'] += 1
+                if job.get('periodic'):
+                    # Periodic jobs are not retried: they will run again anyway.
+                    logger.exception('Periodic job "{}" failed.'.format(job['name']))
+                elif job['attempts'] >= self.max_attempts:
+                    logger.exception('Job "{}" failed {} times, dropped.'.format(job['name'], job['attempts']))
+                else:
+                    logger.warning('Job "{}" failed, it will be retried.'.format(job['name']), exc_info=True)
+                    job['run_at'] = now + self.retry_delay * 2 ** (job['attempts'] - 1)
+                    retries.append(job)
+        if due:
+            with self._cond:
+                self._jobs.extend(retries)
+                self._save()
+        return len(due)
+
+    def _next_run_delay(self):
+        with self._cond:
+            times = [job['run_at'] for job in self._jobs] + [periodic[1] for periodic in self._periodic.itervalues()]
+        if not times:
+            return self.POLL_INTERVAL
+        return max(0, min(min(times) - time.time(), self.POLL_INTERVAL))
+
+    def _run(self):
+        while True:
+            self.run_pending()
+            with self._cond:
+                if self._stopped:
+                    return
+                self._cond.wait(self._next_run_delay())
+                if self._stopped:
+                    return
+
+    def start(self):
+        """
+        Start the runner thread.
+        """
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='JobQueue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the runner thread, waiting the end of the running jobs.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per-user locking of the server data, so that the requests can be served by more threads.
+
+Every read-modify-write of the data (and of the files) of an user must be done holding its lock.
+When an operation involves more users (i.e. a share), their locks are acquired together with
+UserLocks.lock(*usernames), always in the same (sorted) order: two threads locking overlapping groups
+of users can't deadlock. For the same reason, a thread holding some user locks must not acquire
+other ones (re-acquiring an already held lock is fine, since the locks are reentrant).
+
+InterProcessUserLocks extends the locking to more processes sharing the same data (see store.py).
+"""
+
+import os
+import zlib
+import fcntl
+import threading
+from contextlib import contextmanager
+
+
+class UserLocks(object):
+    """
+    A reentrant lock for each user, created when first needed.
+    If given, on_acquire(*usernames) is called by lock() as soon as the locks are held
+    (i.e. to reload the data of those users changed by other processes).
+    """
+    def __init__(self, on_acquire=None):
+        self.on_acquire = on_acquire
+        self._locks = {}
+        self._registry_lock = threading.Lock()
+
+    def _key(self, username):
+        """
+        Return the key of the lock of <username>: the locks are acquired in key order.
+        """
+        return username
+
+    def _new_lock(self, key):
+        return threading.RLock()
+
+    def _get_by_key(self, key):
+        with self._registry_lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = self._new_lock(key)
+            return lock
+
+    def get(self, username):
+        """
+        Return the lock of <username>.
+        :return: threading.RLock
+        """
+        return self._get_by_key(self._key(username))
+
+    @contextmanager
+    def lock(self, *usernames):
+        """
+        Context manager that holds the locks of all the given users.
+        """
+        locks = [self._get_by_key(key) for key in sorted(set(self._key(username) for username in usernames))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            if self.on_acquire is not None:
+                self.on_acquire(*usernames)
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @contextmanager
+    def lock_group(self, username, related):
+        """
+        Context manager that holds the locks of <username> and of the users returned by related(<username>)
+        (i.e. the recipients of its shares), and gives the set of the locked users.
+        The related users must be changed only holding the lock of <username>.
+        """
+        while True:
+            with self.lock(username):
+                group = set(related(username))
+            group.add(username)
+            with self.lock(*group):
+                # The related users may have changed before locking them all: retry in that case.
+                if set(related(username)) <= group:
+                    yield group
+                    return
+
+
+class InterProcessLock(object):
+    """
+    Reentrant lock held by a thread of a process against the other threads and the other processes.
+    The inter-process part is an exclusive fcntl lock on the byte <offset> of the given file.
+    """
+    def __init__(self, fd, offset):
+        self._fd = fd
+        self._offset = offset
+        self._thread_lock = threading.RLock()
+        # Reentrant acquisitions by the owner thread (changed only holding _thread_lock)
+        self._count = 0
+
+    def acquire(self, blocking=True):
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if self._count == 0:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.lockf(self._fd, flags, 1, self._offset)
+            except IOError:
+                self._thread_lock.release()
+                if blocking:
+                    raise
+                return False
+        self._count += 1
+        return True
+
+    def release(self):
+        self._count -= 1
+        if self._count == 0:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._offset)
+        self._thread_lock.release()
+
+
+class InterProcessUserLocks(UserLocks):
+    """
+    User locks shared by all the processes that use the same lock file.
+
+    The users are mapped on <stripes> locks (a byte of the lock file each), so users sharing a stripe
+    exclude each other too. The stripes are acquired in order, so no deadlock is possible.
+    NB: the lock file must be opened again after a fork (fcntl locks are not inherited by child processes),
+    and not opened elsewhere in the process (closing any descriptor of the file releases its fcntl locks).
+    """
+    def __init__(self, filename, stripes=4096, on_acquire=None):
+        UserLocks.__init__(self, on_acquire)
+        self.stripes = stripes
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0600)
+
+    def _key(self, username):
+        if isinstance(username, unicode):
+            username = username.encode('utf-8')
+        return zlib.crc32(username) % self.stripes
+
+    def _new_lock(self, key):
+        return InterProcessLock(self._fd, key)
+
+    def close(self):
+        os.close(self._fd)
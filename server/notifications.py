@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Notifications of the changes of the user data, so that the clients wait for a change instead of asking
+the snapshot every few seconds.
+
+Every user has a version, renewed at every change of its data or of the files shared with it
+(see server.notify_changes). A client sends the last version it knows and waits for a newer one, with a
+long-poll request or with a stream of Server-Sent Events. Both are served only by the event loop of the
+transfer service, that holds many idle connections with a single thread (ChangeNotifier.subscribe, see
+transfers.py): the Flask app redirects them there (see server.Notifications), a thread of its own would be
+held by each waiting client. The versions are timestamps, so the versions of an user given by the workers
+of the multi-process server are comparable: a client moving to another worker gets a sync more at most.
+"""
+
+import json
+import time
+import threading
+
+
+# A comment line of the event stream, sent to keep the idle connections open
+SSE_KEEPALIVE = ': keepalive\n\n'
+
+
+def sse_event(version):
+    """
+    Return the Server-Sent Event of the new <version>.
+    :return: str
+    """
+    return 'event: change\ndata: {}\n\n'.format(json.dumps({'version': version}))
+
+
+class ChangeNotifier(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        # {<username>: set of listeners}, called with the new version
+        self._listeners = {}
+        self._last_version = 0
+
+    def version(self, username):
+        """
+        Return the current version of <username> (0 if it has not changed yet).
+        :return: int
+        """
+        with self._lock:
+            return self._versions.get(username, 0)
+
+    def notify(self, *usernames):
+        """
+        Make a new version for each of <usernames> and call their listeners with it.
+        :return: int, the new version
+        """
+        with self._lock:
+            version = self._last_version = max(self._last_version + 1, int(time.time() * 10000))
+            listeners = []
+            for username in usernames:
+                self._versions[username] = version
+                listeners.extend(self._listeners.get(username, ()))
+        for listener in listeners:
+            listener(version)
+        return version
+
+    def subscribe(self, username, listener):
+        """
+        Call listener(<version>) at every change of <username>, until unsubscribe().
+        Return the current version.
+        :return: int
+        """
+        with self._lock:
+            self._listeners.setdefault(username, set()).add(listener)
+            return self._versions.get(username, 0)
+
+    def unsubscribe(self, username, listener):
+        with self._lock:
+            listeners = self._listeners.get(username)
+            if listeners is not None:
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[username]
+
+    def listeners(self):
+        """
+        Return the number of listeners.
+        :return: int
+        """
+        with self._lock:
+            return sum(len(listeners) for listeners in self._listeners.itervalues())
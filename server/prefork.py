@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Multi-process server: the master process binds the server socket and forks <workers> worker processes,
+that accept the connections on the same socket and serve each request with a new thread.
+
+The workers share the user data through a UserStore (see store.py) and lock the users against each other
+with inter-process locks (see locks.py); each worker keeps in memory the data it uses, and reloads the
+users changed by the other workers when it locks them (see server.refresh_userdata).
+With --transfer-port, another process serves the streaming file transfers (see transfers.py).
+The master restarts the workers that die.
+
+To start it, go to the server directory and type:
+
+    $ python prefork.py --workers 4 [--port 5000] [--debug | --verbose | -v <level>]
+
+The first time, the users of the single process server (userdata.json) are copied into the store.
+"""
+import os
+import json
+import errno
+import signal
+import logging
+import argparse
+
+import werkzeug.serving
+
+import server
+from store import UserStore
+from transfers import TransferServer
+
+
+logger = server.logger
+
+
+def migrate_userdata():
+    """
+    Copy the users saved by the single process server into the store, if it is empty.
+    :return: int, the number of copied users
+    """
+    store = UserStore(server.USERSTORE_FILENAME)
+    try:
+        if not store.is_empty() or not os.path.exists(server.USERDATA_FILENAME):
+            return 0
+        with open(server.USERDATA_FILENAME, 'rb') as fp:
+            data = json.load(fp, 'utf-8')
+        for username, single_user_data in data.iteritems():
+            store.save(username, json.dumps(single_user_data))
+        logger.info('{:,} user(s) copied from {} to {}'.format(
+            len(data), server.USERDATA_FILENAME, server.USERSTORE_FILENAME))
+        return len(data)
+    finally:
+        store.close()
+
+
+class PreforkServer(object):
+    def __init__(self, host, port, workers, transfer_port=None):
+        self.workers = workers
+        # Bound by the master and inherited by the workers
+        self.httpd = werkzeug.serving.make_server(host, port, server.app, threaded=True)
+        # Served by the last worker (index <workers>)
+        self.transfers = None if transfer_port is None else TransferServer(host, transfer_port)
+        # The Flask app redirects the notifications to it (see server.Notifications)
+        server.TRANSFER_PORT = transfer_port
+        # {<pid>: <worker index>}
+        self.children = {}
+        self.stopping = False
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            exit_code = 0
+            try:
+                server.setup_server(index)
+                if index == self.workers:
+                    self.transfers.serve_forever()
+                else:
+                    self.httpd.serve_forever()
+            except Exception:
+                logger.exception('Worker {} failed'.format(index))
+                exit_code = 1
+            finally:
+                # Never go back to the master code
+                os._exit(exit_code)
+        self.children[pid] = index
+        logger.info('Worker {} started (pid {})'.format(index, pid))
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        """
+        Start the workers and restart the dead ones, until the master gets SIGTERM or SIGINT.
+        """
+        # The shared files are created before forking, so the workers don't race to create them.
+        migrate_userdata()
+        server.load_secret_key()
+        server.init_root_structure()
+        for index in range(self.workers + (self.transfers is not None)):
+            self._spawn(index)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            index = self.children.pop(pid, None)
+            if index is not None and not self.stopping:
+                logger.warning('Worker {} died (status {}): restarting it'.format(index, status))
+                self._spawn(index)
+        self.httpd.server_close()
+        if self.transfers is not None:
+            self.transfers.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of worker processes [default: %(default)s].')
+    parser.add_argument('-H', '--host', default='0.0.0.0',
+                        help='set host address to run the server. [default: %(default)s].')
+    parser.add_argument('-p', '--port', type=int, default=5000,
+                        help='set port to run the server. [default: %(default)s].')
+    parser.add_argument('--transfer-port', type=int,
+                        help='serve the file downloads and uploads on this port too, streaming them '
+                             '(see transfers.py).')
+    parser.add_argument('--debug', default=False, action='store_true',
+                        help='set console verbosity level to DEBUG (4) [default: %(default)s]')
+    parser.add_argument('--verbose', default=False, action='store_true',
+                        help='set console verbosity level to INFO (3) [default: %(default)s]. \
+                        Ignored if --debug option is set.')
+    parser.add_argument('-v', '--verbosity', type=int, choices=range(5), nargs='?',
+                        help='set console verbosity: 0=CRITICAL, 1=ERROR, 2=WARN, 3=INFO, 4=DEBUG. \
+                        [default: %(default)s]. Ignored if --verbose or --debug option is set.')
+    args = parser.parse_args()
+
+    server.configure_production()
+    if args.debug:
+        server.console_handler.setLevel(logging.DEBUG)
+    elif args.verbose:
+        server.console_handler.setLevel(logging.INFO)
+    elif args.verbosity:
+        levels = [logging.CRITICAL, logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
+        server.console_handler.setLevel(levels[args.verbosity])
+
+    PreforkServer(args.host, args.port, args.workers, args.transfer_port).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 import ConfigParser
 import os
+import sys
 import json
 import shutil
 import logging
@@ -11,20 +12,40 @@ import hashlib
 import time
 import string
 import re
+import tempfile
+import tarfile
+import threading
+import functools
+import zlib
+import base64
+import urlparse
 
 join = os.path.join
 normpath = os.path.normpath
 abspath = os.path.abspath
 
 
-from flask import Flask, make_response, request, abort, jsonify
+from flask import Flask, Response, make_response, request, abort, jsonify, redirect
+from flask.json import JSONEncoder
 from flask.ext.httpauth import HTTPBasicAuth
 from flask.ext.restful import Resource, Api
 from flask.ext.mail import Mail, Message
 from werkzeug import secure_filename
+from werkzeug.exceptions import HTTPException
 from passlib.hash import sha256_crypt
 import passwordmeter
 
+from snapshot import SnapshotTree
+from sessions import SessionTokens, CredentialsCache
+from jobs import JobQueue
+from locks import UserLocks, InterProcessUserLocks
+from store import UserStore
+from blobs import BlobStore
+from chunks import ChunkStore
+from notifications import ChangeNotifier
+import snapshot_codec
+import delta
+
 __title__ = 'PyBOX'
 
 # HTTP STATUS CODES
@@ -36,16 +57,33 @@ HTTP_UNAUTHORIZED = 401
 HTTP_FORBIDDEN = 403
 HTTP_NOT_FOUND = 404
 HTTP_CONFLICT = 409
+HTTP_INTERNAL_SERVER_ERROR = 500
 #HTTP 204 No Content: The server successfully processed the request, but is not
 #returning any content. Usually used as a response to a successful delete request.
 HTTP_DELETED = 204 
+HTTP_NOT_MODIFIED = 304
+HTTP_TEMPORARY_REDIRECT = 307
 
 FILE_ROOT = 'filestorage'
+# The uploads are written here, then moved in the user directory
+UPLOADS_DIR = os.path.join(FILE_ROOT, '.uploads')
+# The file contents, shared by all the files that have them (see blobs.py)
+BLOBS_DIR = os.path.join(FILE_ROOT, '.blobs')
+# The chunks of the recently uploaded files (see chunks.py)
+CHUNKS_DIR = os.path.join(FILE_ROOT, '.chunks')
 
 URL_PREFIX = '/API/V1'
 SERVER_DIRECTORY = os.path.dirname(__file__)
 # Users login data are stored in a json file in the server
 USERDATA_FILENAME = 'userdata.json'
+# The key that signs the session tokens, created at the first launch
+SECRET_KEY_FILENAME = 'secret_key'
+# The pending background jobs (i.e. emails not sent yet) are stored here
+JOBS_FILENAME = 'jobs.json'
+# Multi-process mode (see prefork.py)
+USERSTORE_FILENAME = 'userdata.sqlite'
+USERLOCKS_FILENAME = 'userdata.locks'
+WORKER_JOBS_FILENAME = 'jobs.{}.json'
 PASSWORD_RECOVERY_EMAIL_TEMPLATE_FILE_PATH = os.path.join(SERVER_DIRECTORY,
                                                           'password_recovery_email_template.txt')
 SIGNUP_EMAIL_TEMPLATE_FILE_PATH = os.path.join(SERVER_DIRECTORY,
@@ -53,6 +91,33 @@ SIGNUP_EMAIL_TEMPLATE_FILE_PATH = os.path.join(SERVER_DIRECTORY,
 
 USER_ACTIVATION_TIMEOUT = 60 * 60 * 24 * 3 * 10000 # expires after 3 days
 USER_RECOVERPASS_TIMEOUT = 60 * 60 * 24 * 2 * 10000  # expires after 2 days (arbitrarily)
+SESSION_TOKEN_MAX_AGE = 60 * 60  # seconds
+CREDENTIALS_CACHE_SIZE = 1024
+CREDENTIALS_CACHE_TTL = 60 * 5  # seconds
+EXPIRED_DATA_SWEEP_INTERVAL = 60 * 60  # seconds
+STORE_CHANGES_MAX_AGE = 60 * 60 * 24  # seconds
+BLOBS_GC_INTERVAL = 60 * 60  # seconds
+CHUNKS_GC_INTERVAL = 60 * 60  # seconds
+CHUNKS_MAX_AGE = 60 * 60 * 24 * 30  # seconds
+NOTIFICATIONS_TIMEOUT = 60  # seconds
+# The port of the transfer service, that serves the notifications (see Notifications), None if it is not running
+TRANSFER_PORT = None
+STORE_WATCH_INTERVAL = 0.5  # seconds
+# The pax header of the archive members with the md5 of the file (see Archives)
+ARCHIVE_MD5_HEADER = 'PYBOX.md5'
+# The response header with the md5 of the file sent as a delta (see Deltas) or described by Files.head
+DELTA_MD5_HEADER = 'X-PyBox-MD5'
+# The response header with the server timestamp of the file or of the snapshot (see Files.head)
+TIMESTAMP_HEADER = 'X-PyBox-Timestamp'
+
+# The representations of the snapshot offered to the clients, the first is the default (see negotiate_snapshot)
+SNAPSHOT_CONTENT_TYPES = ['application/json', snapshot_codec.CONTENT_TYPE]
+SNAPSHOT_ENCODINGS = ['gzip', 'deflate']
+SNAPSHOT_COMPRESSION_LEVEL = 6
+# The biggest page of the paginated snapshot (see Files.snapshot_page)
+SNAPSHOT_MAX_PAGE_SIZE = 100000
+# The response header with the token of the next page of the snapshot
+NEXT_PAGE_HEADER = 'X-PyBox-Next-Page'
 
 # json/dict key to access to the user directory snapshot:
 SNAPSHOT = 'files'
@@ -108,6 +173,17 @@ console_handler.setFormatter(console_formatter)
 # Server initialization
 # =====================
 userdata = {}
+# Every read-modify-write of the data of an user must hold its lock (see locks.py)
+user_locks = UserLocks()
+# The json of each user saved in USERDATA_FILENAME (see save_userdata)
+_userdata_json = {}
+_save_lock = threading.Lock()
+# In multi-process mode the user data is saved in the UserStore shared by the workers (see open_store)
+store = None
+# Last change of the store seen by this worker, and the users changed by the other workers since then
+_last_change_id = 0
+_stale_users = set()
+_stale_lock = threading.Lock()
 
 app = Flask(__name__)
 app.testing = __name__ != '__main__'  # Reasonable assumption?
@@ -130,8 +206,34 @@ EMAIL_REG_OBJ = re.compile(r'^[A-Z0-9]'  # the first char must be alphanumeric (
                            r'\.[A-Z]{2,4}$',  # domain extension: 2, 3 or 4 letters
                            re.IGNORECASE | re.VERBOSE)
 
+# The md5s sent by the clients name files of the blob and chunk stores
+MD5_REG_OBJ = re.compile(r'^[0-9a-f]{32}$')
+
+
+
+class SnapshotJSONEncoder(JSONEncoder):
+    """
+    Json encoder that writes the SnapshotTree objects as the usual {'<path>': [<timestamp>, '<md5>']} objects.
+    """
+    def default(self, o):
+        if isinstance(o, SnapshotTree):
+            return dict(o.iteritems())
+        return JSONEncoder.default(self, o)
+
+app.json_encoder = SnapshotJSONEncoder
+
 api = Api(app)
 auth = HTTPBasicAuth()
+# Replaced by the persistent key in main()
+app.config['SECRET_KEY'] = os.urandom(24)
+credentials_cache = CredentialsCache(CREDENTIALS_CACHE_SIZE, CREDENTIALS_CACHE_TTL)
+# Started in main(). Without the runner thread (i.e. in tests) the jobs wait for job_queue.run_pending()
+job_queue = JobQueue()
+
+blob_store = BlobStore(BLOBS_DIR)
+chunk_store = ChunkStore(CHUNKS_DIR)
+# The clients waiting for the changes of their users (see notifications.py)
+notifier = ChangeNotifier()
 
 
 def validate_email(address):
@@ -183,12 +285,12 @@ def check_path(path, username):
     True
     >>> check_path('Photos/../../ciao.txt', 'paperino')
     False
+    >>> check_path('../paperino2/ciao.txt', 'paperino')
+    False
     """
     path = os.path.abspath(join(FILE_ROOT, username, path))
     root = os.path.abspath(join(FILE_ROOT, username))
-    if root in path:
-        return True
-    return False
+    return path == root or path.startswith(root + os.sep)
 
 
 def userpath2serverpath(username, path=''):
@@ -211,23 +313,32 @@ def now_timestamp():
     return long(time.time()*10000)
 
 
-def file_timestamp(filepath):
+def _encrypt_password(password):
     """
-    Return the long of last modification timestamp of <filepath> (i.e. long(os.path.getmtime(filepath))).
-
-    :param filepath: str
-    :return: long
+    Return the password encrypted as a string.
+    :rtype : str
     """
+    return sha256_crypt.encrypt(password)
 
-    return long(os.path.getmtime(filepath)*10000)
 
+def load_secret_key(filename=SECRET_KEY_FILENAME):
+    """
+    Return the secret key stored in <filename>, creating it if needed.
+    :return: str
+    """
+    if not os.path.exists(filename):
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(24).encode('hex'))
+        os.chmod(filename, 0600)
+    return _read_file(filename).strip()
 
-def _encrypt_password(password):
+
+def session_tokens():
     """
-    Return the password encrypted as a string.
-    :rtype : str
+    Return the SessionTokens signed with the current app secret key.
+    :return: SessionTokens
     """
-    return sha256_crypt.encrypt(password)
+    return SessionTokens(app.config['SECRET_KEY'], SESSION_TOKEN_MAX_AGE)
 
 
 def init_root_structure():
@@ -270,6 +381,15 @@ def init_user_directory(username, default_dirs=DEFAULT_USER_DIRS):
     return compute_dir_state(dirpath)
 
 
+def _decode_user(single_user_data):
+    if SNAPSHOT in single_user_data:
+        single_user_data[SNAPSHOT] = SnapshotTree(single_user_data[SNAPSHOT])
+    # The shared files are computed from the owners' snapshots (see shared_view),
+    # so drop the copies saved by older server versions.
+    single_user_data.pop(SHARED_FILES, None)
+    return single_user_data
+
+
 def load_userdata():
     data = {}
     try:
@@ -279,19 +399,60 @@ def load_userdata():
         # If the user data file does not exists, don't raise an exception.
         # (the file will be created with the first user creation)
         pass
+    for single_user_data in data.itervalues():
+        _decode_user(single_user_data)
     logger.debug('Registered user(s): {}'.format(', '.join(data.keys())))
     logger.info('{:,} registered user(s) found'.format(len(data)))
     return data
 
 
-def save_userdata():
+def _serialize_user(username):
+    if username in userdata:
+        _userdata_json[username] = json.dumps(userdata[username], 'utf-8', indent=4, cls=SnapshotJSONEncoder)
+    else:
+        _userdata_json.pop(username, None)
+
+
+def save_userdata(*usernames):
     """
     Save module level <userdata> dict to disk as json.
+
+    The json of every user is cached, so only the data of the given <usernames> (whose locks the caller
+    must hold) is serialized again, plus the users never serialized before.
+    Without <usernames> the data of all users is serialized again: the caller must not hold any user lock.
+    In multi-process mode the data of each user is saved in the store instead.
     :return: None
     """
-    with open(USERDATA_FILENAME, 'wb') as fp:
-        json.dump(userdata, fp, 'utf-8', indent=4)
-    logger.info('Saved {:,} users'.format(len(userdata)))
+    if store is not None:
+        for username in usernames or userdata.keys():
+            with user_locks.lock(username):
+                _serialize_user(username)
+                store.save(username, _userdata_json.pop(username, None))
+        notify_changes(*usernames)
+        return
+    for username in usernames or userdata.keys():
+        with user_locks.lock(username):
+            _serialize_user(username)
+    for username in userdata.keys():
+        if username not in _userdata_json:
+            lock = user_locks.get(username)
+            # If someone else holds the lock, it will save this user itself.
+            if lock.acquire(False):
+                try:
+                    _serialize_user(username)
+                finally:
+                    lock.release()
+    with _save_lock:
+        users_json = [(json.dumps(username), user_json) for username, user_json in _userdata_json.items()
+                      if username in userdata]
+        tmp_filename = USERDATA_FILENAME + '.tmp'
+        with open(tmp_filename, 'wb') as fp:
+            fp.write('{\n')
+            fp.write(',\n'.join('{}: {}'.format(*user_item) for user_item in users_json))
+            fp.write('\n}\n')
+        os.rename(tmp_filename, USERDATA_FILENAME)
+    logger.info('Saved {:,} users'.format(len(users_json)))
+    notify_changes(*usernames)
 
 
 def reset_userdata():
@@ -299,6 +460,137 @@ def reset_userdata():
     Clear userdata dictionary.
     """
     userdata.clear()
+    _userdata_json.clear()
+
+
+def open_store(worker_id=None):
+    """
+    Switch to the multi-process mode: load the user data from the UserStore shared by the workers and
+    save it there, and lock the users against the other workers too.
+    :param worker_id: int, the id of this worker in the store change log (default: the process id)
+    """
+    global store, user_locks, _last_change_id
+    store = UserStore(USERSTORE_FILENAME, worker_id)
+    user_locks = InterProcessUserLocks(USERLOCKS_FILENAME, on_acquire=refresh_userdata)
+    with _stale_lock:
+        # The changes made while loading are seen again at the next refresh
+        _last_change_id = store.last_change()
+        _stale_users.clear()
+    reset_userdata()
+    for username, single_user_data in store.load_all().iteritems():
+        userdata[username] = _decode_user(single_user_data)
+    logger.info('{:,} registered user(s) found in the store'.format(len(userdata)))
+
+
+def close_store():
+    """
+    Go back to the single process mode.
+    """
+    global store, user_locks
+    store.close()
+    user_locks.close()
+    store = None
+    user_locks = UserLocks()
+
+
+def refresh_userdata(*usernames):
+    """
+    Reload the data of the given users (whose locks the caller must hold) changed by the other workers.
+    Called whenever user locks are acquired (see UserLocks.on_acquire); it does nothing in single process mode.
+    """
+    global _last_change_id
+    if store is None:
+        return
+    with _stale_lock:
+        _last_change_id, changed = store.changes_since(_last_change_id)
+        if changed is None:
+            # This worker lost track of the changes: reload every user
+            changed = store.usernames() | set(userdata)
+        _stale_users.update(changed)
+        to_reload = _stale_users.intersection(usernames)
+        _stale_users.difference_update(to_reload)
+    for username in to_reload:
+        single_user_data = store.load(username)
+        if single_user_data is None:
+            userdata.pop(username, None)
+        else:
+            userdata[username] = _decode_user(single_user_data)
+        credentials_cache.invalidate(username)
+        logger.debug('User "{}" reloaded from the store'.format(username))
+
+
+def watch_store_changes(interval=STORE_WATCH_INTERVAL):
+    """
+    Notify the changes of the users made by the other workers (see notify_changes), looking for them
+    in the store every <interval> seconds. Run by a thread of each worker of the multi-process mode,
+    until the store is closed.
+    """
+    watched_store = store
+    change_id = watched_store.last_change()
+    while store is watched_store:
+        time.sleep(interval)
+        change_id, changed = watched_store.changes_since(change_id)
+        if changed is None:
+            # This worker lost track of the changes: notify every user
+            changed = set(userdata)
+        if changed:
+            notify_changes(*changed)
+
+
+def collect_blobs():
+    """
+    Remove the file contents not used by any file anymore. Periodic job.
+    """
+    removed, freed = blob_store.collect_garbage()
+    stats = blob_store.stats()
+    logger.info('Removed {:,} unused blobs ({:,} bytes) - {:,} blobs ({:,} bytes) used by {:,} files ({:,} bytes)'
+                .format(removed, freed, stats['blobs'], stats['bytes'], stats['links'], stats['linked_bytes']))
+
+
+def collect_chunks():
+    """
+    Remove the chunks unused for CHUNKS_MAX_AGE. Periodic job.
+    """
+    removed, freed = chunk_store.collect_garbage(CHUNKS_MAX_AGE)
+    logger.info('Removed {:,} unused chunks ({:,} bytes)'.format(removed, freed))
+
+
+def prune_store_changes():
+    """
+    Remove the old changes from the store log. Periodic job of the multi-process mode.
+    """
+    store.prune_changes(STORE_CHANGES_MAX_AGE)
+
+
+def user_locked(method):
+    """
+    Decorator of the Resource methods with an <username> argument: run them holding the lock of that user.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with user_locks.lock(kwargs['username']):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _share_recipients(owner):
+    """
+    Return the users that the shares of <owner> are shared with.
+    :return: set
+    """
+    if owner not in userdata:
+        return set()
+    return set(user for users in userdata[owner].get('shared_with_others', {}).values() for user in users)
+
+
+def _share_owners(username):
+    """
+    Return the users that share something with <username>.
+    :return: set
+    """
+    if username not in userdata:
+        return set()
+    return set(owner for owner, paths in userdata[username].get('shared_with_me', {}).items() if paths)
 
 
 def _is_shared_with_others(path, username):
@@ -312,24 +604,217 @@ def _is_shared_with_others(path, username):
     return False
 
 
-@auth.verify_password
+def shared_view(username):
+    """
+    Return the snapshot of the files shared with <username>, with keys in the form 'shared/<owner>/<path>'.
+
+    Shares are mount references ('shared_with_me': {<owner>: [<root path>, ...]}), so the view is
+    computed at read time from the owners' snapshots and the owners' writes never touch the recipients' data.
+    :param username: str
+    :return: SnapshotTree
+    """
+    view = SnapshotTree()
+    for owner, root_paths in userdata[username]['shared_with_me'].iteritems():
+        if owner not in userdata:
+            continue
+        owner_snapshot = userdata[owner][SNAPSHOT]
+        for root_path in root_paths:
+            for path, record in owner_snapshot.iter_subtree(root_path):
+                view.link_record('shared/{0}/{1}'.format(owner, path), record)
+    return view
+
+
+def iter_shared_sorted(username, after=None):
+    """
+    Yield the ('shared/<owner>/<path>', FileRecord) couples of shared_view(<username>) sorted as
+    SnapshotTree.iter_sorted, starting after the path <after>, from the owners' snapshots: the view is not built,
+    so a page of the shared files costs the seek to <after> and its files only (see Files.snapshot_page).
+    The caller must hold the locks of the user and of the owners.
+    """
+    after_names = after.split('/') if after else None
+    for owner, root_paths in sorted(userdata[username]['shared_with_me'].iteritems()):
+        if owner not in userdata:
+            continue
+        prefix = ['shared', owner]
+        owner_after = None
+        if after_names is not None:
+            if after_names[:2] == prefix:
+                owner_after = '/'.join(after_names[2:])
+            elif after_names > prefix:
+                continue
+        # The root paths in the sorted order of their names, without the ones under another root
+        roots = []
+        for root_path in sorted((path.rstrip('/') for path in root_paths), key=lambda path: path.split('/')):
+            if not roots or not (root_path + '/').startswith(roots[-1] + '/'):
+                roots.append(root_path)
+        for root_path in roots:
+            for path, record in userdata[owner][SNAPSHOT].iter_sorted(owner_after, root_path):
+                yield 'shared/{0}/{1}'.format(owner, path), record
+
+
+def file_record(username, path):
+    """
+    Return the [<timestamp>, <md5>] of the file <path> of <username>, that can be a 'shared/<owner>/<path>' file
+    shared with the user (see Files.file_to_download), or None if it is not in the snapshot.
+    The caller must hold the locks of the user and of the owner.
+    :return: list or None
+    """
+    if path.startswith('shared/'):
+        _, username, path = path.split('/', 2)
+    if username not in userdata:
+        return None
+    return userdata[username][SNAPSHOT].get(normpath(path))
+
+
+def snapshot_etag(username, subtree=None):
+    """
+    Return the ETag of the snapshot of <username>, or of its <subtree> (that has no shared files).
+    It is made of the server timestamps, renewed at every change of the files, so that the snapshot is not
+    serialized to answer the request of an unchanged one. The shared files count as the timestamps of the
+    owners and the shared paths.
+    The caller must hold the locks of the user and of the owners.
+    :return: str
+    """
+    validators = [userdata[username][LAST_SERVER_TIMESTAMP]]
+    if subtree is not None:
+        validators.append(subtree)
+    else:
+        for owner, root_paths in sorted(userdata[username]['shared_with_me'].iteritems()):
+            if owner in userdata and root_paths:
+                validators.append([owner, userdata[owner][LAST_SERVER_TIMESTAMP], sorted(root_paths)])
+    return hashlib.md5(json.dumps(validators)).hexdigest()
+
+
+def http_date(timestamp):
+    """
+    Return the server <timestamp> as the datetime of an HTTP date (they have the resolution of a second).
+    :return: datetime.datetime
+    """
+    return datetime.datetime.utcfromtimestamp(timestamp // 10000)
+
+
+def is_not_modified(etag, timestamp=None, if_none_match=None, if_modified_since=None):
+    """
+    Check the validators of the request: If-None-Match against <etag> or, without it,
+    If-Modified-Since against the server <timestamp>.
+    They are the ones of the Flask request, unless the transfer service gives them
+    (parsed with werkzeug.http.parse_etags and parse_date, see transfers.py).
+    :return: bool
+    """
+    if if_none_match is None and if_modified_since is None:
+        if_none_match, if_modified_since = request.if_none_match, request.if_modified_since
+    if if_none_match:
+        return if_none_match.contains(etag)
+    if timestamp is not None and if_modified_since:
+        return http_date(timestamp) <= if_modified_since
+    return False
+
+
+def set_validators(response, etag, timestamp=None):
+    """
+    Set the ETag of <response> and, if the server <timestamp> is given, its Last-Modified date.
+    :return: the response
+    """
+    response.set_etag(etag)
+    if timestamp is not None:
+        response.last_modified = http_date(timestamp)
+    return response
+
+
+def negotiate_snapshot():
+    """
+    Return the (<content type>, <content encoding>) of the snapshot representation preferred by the client
+    with the Accept and Accept-Encoding headers: json or the binary format of snapshot_codec,
+    compressed with gzip or deflate or not compressed (None).
+    :return: tuple
+    """
+    content_type = request.accept_mimetypes.best_match(SNAPSHOT_CONTENT_TYPES) or SNAPSHOT_CONTENT_TYPES[0]
+    return content_type, request.accept_encodings.best_match(SNAPSHOT_ENCODINGS)
+
+
+def representation_etag(etag, content_type, encoding):
+    """
+    Return the ETag of a representation of the snapshot whose ETag is <etag>: every representation has its own.
+    :return: str
+    """
+    if content_type != SNAPSHOT_CONTENT_TYPES[0]:
+        etag += '-bin'
+    if encoding is not None:
+        etag += '-' + encoding
+    return etag
+
+
+def compress(data, encoding, level=SNAPSHOT_COMPRESSION_LEVEL):
+    """
+    Return <data> compressed for the 'gzip' or 'deflate' (a zlib stream) content <encoding>.
+    :return: str
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | (16 if encoding == 'gzip' else 0))
+    return compressor.compress(data) + compressor.flush()
+
+
+def snapshot_response(document, content_type, encoding):
+    """
+    Return the response with the snapshot <document> in the representation given by negotiate_snapshot().
+    The json is compact, without the indentation of jsonify.
+    """
+    if content_type == snapshot_codec.CONTENT_TYPE:
+        body = snapshot_codec.encode(document)
+    else:
+        body = json.dumps(document, cls=SnapshotJSONEncoder, separators=(',', ':'))
+    if encoding is not None:
+        body = compress(body, encoding)
+    response = make_response(body)
+    response.mimetype = content_type
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def notify_changes(*usernames):
+    """
+    Wake the clients waiting for the changes of <usernames> and of the recipients of their shares,
+    that see their files (see notifications.py). Called whenever the data of an user is saved.
+    The recipients are notified of any change of the owner (then their sync finds nothing new if it was not shared).
+    """
+    if not usernames:
+        return
+    recipients = set(usernames)
+    for username in usernames:
+        recipients.update(_share_recipients(username))
+    notifier.notify(*recipients)
+
+
 def verify_password(username, password):
     """
     We redefine this function to check password with the encrypted one.
+    The password can be a session token too (see Tokens). The password hash is verified only
+    if the credentials are not in the credentials_cache.
+    The user is locked just to read its data, so that in multi-process mode the changes made by the
+    other workers (i.e. a new password) are loaded (see refresh_userdata).
     """
     if not username:
         # Warning/info?
         return False
-    single_user_data = userdata.get(username)
+    with user_locks.lock(username):
+        single_user_data = userdata.get(username)
     if single_user_data:
         stored_pw = single_user_data.get(PWD)
         assert stored_pw is not None, 'Server error: user data must contain a password!'
+        if session_tokens().check(password, username, stored_pw) or \
+                credentials_cache.check(username, password, stored_pw):
+            return True
         res = sha256_crypt.verify(password, stored_pw)
+        if res:
+            credentials_cache.add(username, password, stored_pw)
     else:
         logger.info('User "{}" does not exist'.format(username))
         res = False
     return res
 
+# Registered without the decorator syntax, that doesn't return the function (it is used by transfers.py too).
+auth.verify_password(verify_password)
+
 
 def activate_user(username, encrypted_password):
     """
@@ -347,10 +832,9 @@ def activate_user(username, encrypted_password):
                         USER_IS_ACTIVE: True,
                         'shared_with_me': {},
                         'shared_with_others': {},
-                        'shared_files': {}
                         }
     userdata[username] = single_user_data
-    save_userdata()
+    save_userdata(username)
     response = 'User "{}" activated.\n'.format(username), HTTP_OK
 
     logger.debug(response)
@@ -371,7 +855,7 @@ def create_user(username, password, activation_code):
                                                  'activation_code': activation_code}
                             }
         userdata[username] = single_user_data
-        save_userdata()
+        save_userdata(username)
         response = 'User activation email sent to {}'.format(username), HTTP_CREATED
     else:
         raise ServerInternalError('Unexpected error: username and password must not be empty here!!!\n'
@@ -424,6 +908,50 @@ def send_email(subject, sender, recipients, text_body):
     return msg
 
 
+def _send_email_job(subject, sender, recipients, text_body):
+    with app.app_context():
+        send_email(subject, sender, recipients, text_body)
+
+
+def send_email_later(subject, sender, recipients, text_body):
+    """
+    Enqueue the sending of an email in the job_queue, so the request doesn't wait for the smtp server.
+    If the sending fails, it is retried later.
+    """
+    job_queue.enqueue('send_email', (subject, sender, recipients, text_body))
+
+
+def _is_activation_expired(single_user_data):
+    return now_timestamp() - single_user_data[USER_CREATION_DATA][USER_CREATION_TIME] > USER_ACTIVATION_TIMEOUT
+
+
+def _is_recoverpass_expired(recoverpass_data):
+    return now_timestamp() - recoverpass_data['timestamp'] >= USER_RECOVERPASS_TIMEOUT
+
+
+def sweep_expired_data():
+    """
+    Remove the expired pending users and the expired password recovery codes. Periodic job.
+    """
+    def has_expired_recoverpass(single_user_data):
+        return 'recoverpass_data' in single_user_data and \
+            _is_recoverpass_expired(single_user_data['recoverpass_data'])
+
+    expired_pending_users = Users._clean_inactive_users()
+    expired_recoverpass_users = []
+    for username, single_user_data in userdata.items():
+        if has_expired_recoverpass(single_user_data):
+            with user_locks.lock(username):
+                # Check it again holding the lock
+                if username in userdata and has_expired_recoverpass(userdata[username]):
+                    userdata[username].pop('recoverpass_data')
+                    expired_recoverpass_users.append(username)
+    logger.info('Expired pending users: {} - expired password recovery codes: {}'.format(
+        expired_pending_users, len(expired_recoverpass_users)))
+    if expired_pending_users or expired_recoverpass_users:
+        save_userdata(*(expired_pending_users + expired_recoverpass_users))
+
+
 class Users(Resource):
     @staticmethod
     def _clean_inactive_users():
@@ -432,12 +960,17 @@ class Users(Resource):
         and return a list of them.
         :return: list
         """
-        to_remove = [username for (username, data) in userdata.iteritems()
-                     if userdata[username][USER_IS_ACTIVE] is False and
-                     now_timestamp() - data[USER_CREATION_DATA][USER_CREATION_TIME] >
-                     USER_ACTIVATION_TIMEOUT]
-        for username in to_remove:
-            userdata.pop(username)
+        def is_expired(single_user_data):
+            return single_user_data[USER_IS_ACTIVE] is False and _is_activation_expired(single_user_data)
+
+        to_remove = []
+        for username, data in userdata.items():
+            if is_expired(data):
+                with user_locks.lock(username):
+                    # Check it again holding the lock: it could have been activated meanwhile.
+                    if username in userdata and is_expired(userdata[username]):
+                        userdata.pop(username)
+                        to_remove.append(username)
         return to_remove
 
     @auth.login_required
@@ -486,6 +1019,7 @@ class Users(Resource):
 
             abort(HTTP_FORBIDDEN)
 
+    @user_locked
     def post(self, username):
         """
         A not-logged user is asking to register himself.
@@ -519,19 +1053,21 @@ class Users(Resource):
                       )
         text_body = text_body_template.substitute(values)
 
-        send_email(subject, sender, recipients, text_body)
+        send_email_later(subject, sender, recipients, text_body)
 
         return create_user(username, password, activation_code)
 
+    @user_locked
     def put(self, username):
         """
         Activate user using activation code sent by email, or reset its password.
         """
-        # create a list of all usernames with flag active: False
-
-        # Pending users cleanup
-        expired_pending_users = self._clean_inactive_users()
-        logger.info('Expired pending users: {}'.format(expired_pending_users))
+        # NB: the expired pending users are removed by the sweep_expired_data job,
+        # here only the requested one is checked.
+        if username in userdata and userdata[username][USER_IS_ACTIVE] is False and \
+                _is_activation_expired(userdata[username]):
+            userdata.pop(username)
+            save_userdata(username)
 
         if username in userdata:
             if userdata[username][USER_IS_ACTIVE] is True:
@@ -550,13 +1086,15 @@ class Users(Resource):
 
                 if recoverpass_stuff:
                     recoverpass_code = recoverpass_stuff['recoverpass_code']
-                    recoverpass_timestamp = recoverpass_stuff['timestamp']
                     if request_recoverpass_code == recoverpass_code and \
-                            (now_timestamp() - recoverpass_timestamp < USER_RECOVERPASS_TIMEOUT):
+                            not _is_recoverpass_expired(recoverpass_stuff):
                         userdata[username][PWD] = new_password
                         enc_pass = _encrypt_password(new_password)
                         userdata[username][PWD] = enc_pass
+                        # The session tokens are bound to the old password: they are refused from now on.
+                        credentials_cache.invalidate(username)
                         userdata[username].pop('recoverpass_data')
+                        save_userdata(username)
                         return 'Password changed succesfully', HTTP_OK
                 # NB: old generated tokens are refused, but, currently, they are not removed from userdata.
                 return 'Invalid code', HTTP_NOT_FOUND
@@ -587,6 +1125,7 @@ class Users(Resource):
             return 'Error: username not found!\n', HTTP_NOT_FOUND
 
     @auth.login_required
+    @user_locked
     def delete(self, username):
         """
         Delete all logged user's files and data. Remove also inactive users.
@@ -603,7 +1142,8 @@ class Users(Resource):
             shutil.rmtree(userpath2serverpath(username))
 
         userdata.pop(username)
-        save_userdata()
+        credentials_cache.invalidate(username)
+        save_userdata(username)
         return 'User "{}" removed.\n'.format(username), HTTP_OK
 
 
@@ -614,6 +1154,7 @@ class UsersRecoverPassword(Resource):
     Use case: the user has forgotten its password and wants to recover it.
     NB: recover the old password is not even possible since it's stored encrypted.
     """
+    @user_locked
     def post(self, username):
         """
         Handle the request for change the user's password
@@ -636,7 +1177,7 @@ class UsersRecoverPassword(Resource):
                       )
         text_body = text_body_template.substitute(values)
 
-        send_email(subject, sender, recipients, text_body)
+        send_email_later(subject, sender, recipients, text_body)
 
         if userdata[username][USER_IS_ACTIVE] is True:
             # create or update 'recoverpass_data' key.
@@ -644,137 +1185,212 @@ class UsersRecoverPassword(Resource):
                 'recoverpass_code': recoverpass_code,
                 'timestamp': now_timestamp()
                 }
-            save_userdata()
+            save_userdata(username)
 
         elif userdata[username][USER_IS_ACTIVE] is False:
             userdata[username][USER_CREATION_DATA] = {'creation_timestamp': now_timestamp(),
                                                       'activation_code': recoverpass_code}
-            save_userdata()
+            save_userdata(username)
         # the else case is already covered in the first if
 
         return 'Reset email sent to {}'.format(username), HTTP_ACCEPTED
 
 
+class Tokens(Resource):
+    """
+    Exchange the user credentials for a session token.
+
+    The client can send the token as password of the next requests (until it expires),
+    so the server doesn't have to verify the password hash every time.
+    """
+    @auth.login_required
+    def post(self):
+        username = auth.username()
+        token = session_tokens().issue(username, userdata[username][PWD])
+        return {'token': token, 'expires_in': SESSION_TOKEN_MAX_AGE}, HTTP_CREATED
+
+
 class Actions(Resource):
+    # The string fields of each action of a batch (see _batch)
+    ACTION_FIELDS = {'delete': ('filepath',), 'copy': ('src', 'dst'), 'move': ('src', 'dst')}
+
+    @property
+    def commands(self):
+        return {'delete': self._delete,
+                'copy': self._copy,
+                'move': self._move,
+                }
+
     @auth.login_required
     def post(self, cmd):
         username = auth.username()
-        methods = {'delete': self._delete,
-                   'copy': self._copy,
-                   'move': self._move,
-                   }
+        if cmd == 'batch':
+            return self._batch(username)
+        # The recipients are locked too, since the delete of a shared path can remove the share.
+        with user_locks.lock_group(username, _share_recipients):
+            try:
+                last_server_timestamp = self.commands[cmd](username, request.form)
+            except KeyError:
+                abort(HTTP_NOT_FOUND)
+            else:
+                save_userdata(username)
+                return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+
+    def _batch(self, username):
+        """
+        Apply in order the actions of the 'actions' form field, a json list of
+        [{'cmd': 'delete', 'filepath': <path>}, {'cmd': 'copy' | 'move', 'src': <path>, 'dst': <path>}, ...],
+        under one lock and with one save of the user data.
+        An action that fails doesn't stop the following ones: return the status of each action,
+        and its timestamp if it succeeded:
+        {'results': [{'status': int[, LAST_SERVER_TIMESTAMP: int]}, ...], LAST_SERVER_TIMESTAMP: int}
+        An action with a missing or non-string field gets 400, an unknown command 404, an error of the file system
+        500. The user data is saved anyway, so that it matches the changes already made on disk.
+        """
         try:
-            resp = methods[cmd](username)
-        except KeyError:
-            abort(HTTP_NOT_FOUND)
-        else:
-            save_userdata()
-            return resp
+            actions = json.loads(request.form['actions'])
+            if not all(isinstance(action, dict) for action in actions):
+                raise TypeError
+        except (KeyError, ValueError, TypeError):
+            abort(HTTP_BAD_REQUEST)
+
+        results = []
+        with user_locks.lock_group(username, _share_recipients):
+            try:
+                for action in actions:
+                    results.append(self._batch_action(username, action))
+            finally:
+                save_userdata(username)
+            last_server_timestamp = userdata[username][LAST_SERVER_TIMESTAMP]
+        logger.info('Batch of {:,} actions: {:,} failed'.format(
+            len(actions), sum(1 for result in results if result['status'] != HTTP_OK)))
+        return jsonify({'results': results, LAST_SERVER_TIMESTAMP: last_server_timestamp})
 
-    def _delete(self, username):
+    def _batch_action(self, username, action):
         """
-        Delete a file for a given <filepath>, and return the current server timestamp in a json.
-        json format: {LAST_SERVER_TIMESTAMP: int}
+        Apply an <action> of a batch and return its result (see _batch).
+        :return: dict
         """
-        filepath = request.form['filepath']
+        cmd = action.get('cmd')
+        if not isinstance(cmd, basestring) or cmd not in self.commands:
+            return {'status': HTTP_NOT_FOUND}
+        if not all(isinstance(action.get(field), basestring) for field in self.ACTION_FIELDS[cmd]):
+            return {'status': HTTP_BAD_REQUEST}
+        try:
+            last_server_timestamp = self.commands[cmd](username, action)
+        except KeyError:
+            return {'status': HTTP_NOT_FOUND}
+        except HTTPException as e:
+            return {'status': e.code}
+        except (OSError, IOError) as e:
+            logger.error('Batch action {} of "{}" failed: {}'.format(action, username, e))
+            return {'status': HTTP_INTERNAL_SERVER_ERROR}
+        return {'status': HTTP_OK, LAST_SERVER_TIMESTAMP: last_server_timestamp}
+
+    def _delete(self, username, args):
+        """
+        Delete a file (or a directory with all its files) for a given <filepath>, and return the current
+        server timestamp. The caller must hold the user lock and save the user data.
+        :return: int
+        """
+        filepath = args['filepath']
 
-        if not check_path(filepath, username):
+        if not check_path(filepath, username) or normpath(filepath) == '.':
             abort(HTTP_FORBIDDEN)
 
         abspath = os.path.abspath(join(FILE_ROOT, username, filepath))
 
-        try:
-            os.remove(abspath)
-        except OSError:
-            # This error raises when the file is missing
-            abort(HTTP_NOT_FOUND)
+        if os.path.isdir(abspath):
+            shutil.rmtree(abspath)
+            userdata[username][SNAPSHOT].remove_subtree(normpath(filepath))
+        else:
+            try:
+                os.remove(abspath)
+            except OSError:
+                # This error raises when the file is missing
+                abort(HTTP_NOT_FOUND)
+            userdata[username]['files'].pop(normpath(filepath))
         self._clear_dirs(os.path.dirname(abspath), username)
 
         # file deleted, last_server_timestamp is set to current timestamp
         last_server_timestamp = now_timestamp()
         userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
-        userdata[username]['files'].pop(normpath(filepath))
-
-        if _is_shared_with_others(filepath, username):
-            auto_remove_share = False
-            shared_path = filepath.split('/')[0]
-            # check if must be removed the share
-            shared_abspath = os.path.abspath(join(FILE_ROOT, username, shared_path))
-
-            if not os.path.exists(shared_abspath):
-                # maybe difficult to understand this check:
-                # if share_abspath is a file then the previous code has deleted it so it must be removed automatically
-                # by the share
-                #
-                # if share_abspath is a folder then we have 2 case:
-                # if the folder exist then it means that it isn't empty, otherwise the _clear_dirs function would have
-                # deleted it
-                # if the folder doesn't exists then it must be removed from share
-                auto_remove_share = True
-
-            for user in userdata[username]['shared_with_others'][shared_path]:
-                res = 'shared/{0}/{1}'.format(username, filepath)
-                userdata[user]['shared_files'].pop(res)
-                if auto_remove_share:
-                    userdata[user]['shared_with_me'][username].remove(shared_path)
-
-            if auto_remove_share:
-                userdata[username]['shared_with_others'].pop(shared_path)
-
-        save_userdata()
-        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
-
-    def _copy(self, username):
-        """
-        Copy a file from a given source path to a destination path and return the current server timestamp
-        in a json file.jso
-        userdata[username]n format: {LAST_SERVER_TIMESTAMP: int}
-        """
-
-        src = request.form['src']
-        dst = request.form['dst']
+        self._remove_share_if_gone(filepath, username)
+
+        return last_server_timestamp
+
+    def _copy(self, username, args):
+        """
+        Copy a file (or a directory with all its files) from a given source path to a destination path and
+        return the current server timestamp. The caller must hold the user lock and save the user data.
+        :return: int
+        """
+
+        src = args['src']
+        dst = args['dst']
         server_src = userpath2serverpath(username, src)
         server_dst = userpath2serverpath(username, dst)
 
-        if not (check_path(src, username) or check_path(dst, username)):
+        if not (check_path(src, username) and check_path(dst, username)) or normpath(src) == '.':
             abort(HTTP_FORBIDDEN)
 
+        if os.path.isdir(server_src):
+            return self._copy_dir(username, normpath(src), normpath(dst))
+
         if os.path.isfile(server_src):
             if not os.path.exists(os.path.dirname(server_dst)):
                 os.makedirs(os.path.dirname(server_dst))
-            shutil.copy(server_src, server_dst)
+            # The copy shares the content of the source (see blobs.py)
+            blob_store.link(server_src, server_dst)
         else:
             abort(HTTP_NOT_FOUND)
 
-        last_server_timestamp = file_timestamp(server_dst)
+        last_server_timestamp = now_timestamp()
 
         _, md5 = userdata[username]['files'][normpath(src)]
         userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
         userdata[username]['files'][normpath(dst)] = [last_server_timestamp, md5]
 
-        # if path is a shared path then track it in all users that have that share
-        if _is_shared_with_others(normpath(dst), username):
-            shared_path = normpath(dst).split('/')[0]
-            for user in userdata[username]['shared_with_others'][shared_path]:
-                res = 'shared/{0}/{1}'.format(username, normpath(dst))
-                userdata[user]['shared_files'][res] = [last_server_timestamp, md5]
+        return last_server_timestamp
+
+    def _copy_dir(self, username, src, dst):
+        """
+        Copy the files of the directory <src> into the new directory <dst>, with a single metadata update.
+        :return: int
+        """
+        if os.path.exists(userpath2serverpath(username, dst)):
+            abort(HTTP_CONFLICT)
+
+        last_server_timestamp = now_timestamp()
+        snapshot = userdata[username][SNAPSHOT]
+        for path, record in list(snapshot.iter_subtree(src)):
+            copy_path = dst + path[len(src):]
+            server_copy = userpath2serverpath(username, copy_path)
+            if not os.path.exists(os.path.dirname(server_copy)):
+                os.makedirs(os.path.dirname(server_copy))
+            blob_store.link(userpath2serverpath(username, path), server_copy)
+            snapshot[copy_path] = [last_server_timestamp, record.md5]
+        userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
 
-        save_userdata()
-        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+        return last_server_timestamp
 
-    def _move(self, username):
+    def _move(self, username, args):
         """
-        Move a file from a given source path to a destination path, and return the current server timestamp in a json.
-        json format: {LAST_SERVER_TIMESTAMP: int}
+        Move a file (or a directory with all its files) from a given source path to a destination path,
+        and return the current server timestamp. The caller must hold the user lock and save the user data.
+        :return: int
         """
-        src = request.form['src']
-        dst = request.form['dst']
+        src = args['src']
+        dst = args['dst']
         server_src = userpath2serverpath(username, src)
         server_dst = userpath2serverpath(username, dst)
 
-        if not (check_path(src, username) or check_path(dst, username)):
+        if not (check_path(src, username) and check_path(dst, username)) or normpath(src) == '.':
             abort(HTTP_FORBIDDEN)
 
+        if os.path.isdir(server_src):
+            return self._move_dir(username, normpath(src), normpath(dst))
+
         if os.path.isfile(server_src):
             if not os.path.exists(os.path.dirname(server_dst)):
                 os.makedirs(os.path.dirname(server_dst))
@@ -789,22 +1405,63 @@ class Actions(Resource):
         userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
         userdata[username]['files'].pop(normpath(src))
         userdata[username]['files'][normpath(dst)] = [last_server_timestamp, md5]
+        self._remove_share_if_gone(src, username)
 
-        # if path is a shared path then track it in all users that have that share
-        if _is_shared_with_others(normpath(dst), username):
-            shared_path = normpath(dst).split('/')[0]
-            for user in userdata[username]['shared_with_others'][shared_path]:
-                res = 'shared/{0}/{1}'.format(username, normpath(dst))
-                userdata[user]['shared_files'][res] = [last_server_timestamp, md5]
+        return last_server_timestamp
+
+    def _move_dir(self, username, src, dst):
+        """
+        Move the directory <src> to the new path <dst> with a single rename, moving its snapshot entries
+        and its share (if <src> is a shared folder) along.
+        :return: int
+        """
+        if dst == src or dst.startswith(src + '/'):
+            abort(HTTP_BAD_REQUEST)
+        server_src = userpath2serverpath(username, src)
+        server_dst = userpath2serverpath(username, dst)
+        if os.path.exists(server_dst):
+            abort(HTTP_CONFLICT)
+
+        if not os.path.exists(os.path.dirname(server_dst)):
+            os.makedirs(os.path.dirname(server_dst))
+        os.rename(server_src, server_dst)
+        self._clear_dirs(os.path.dirname(server_src), username)
+
+        last_server_timestamp = now_timestamp()
+        snapshot = userdata[username][SNAPSHOT]
+        snapshot.move_subtree(src, dst)
+        # For the other devices of the user the moved files are new files, so they must be newer than their state.
+        for path, record in list(snapshot.iter_subtree(dst)):
+            snapshot[path] = [last_server_timestamp, record.md5]
+        userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
+
+        if src in userdata[username]['shared_with_others'] and '/' not in dst:
+            # A shared folder renamed: the recipients keep it
+            recipients = userdata[username]['shared_with_others'].pop(src)
+            userdata[username]['shared_with_others'][dst] = recipients
+            for user in recipients:
+                root_paths = userdata[user]['shared_with_me'][username]
+                root_paths[root_paths.index(src)] = dst
+            save_userdata(*recipients)
+        else:
+            self._remove_share_if_gone(src, username)
 
-        if _is_shared_with_others(normpath(src), username):
-            shared_path = normpath(src).split('/')[0]
-            for user in userdata[username]['shared_with_others'][shared_path]:
-                res = 'shared/{0}/{1}'.format(username, normpath(src))
-                userdata[user]['shared_files'].pop(res)
+        return last_server_timestamp
 
-        save_userdata()
-        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+    @staticmethod
+    def _remove_share_if_gone(path, username):
+        """
+        Remove the share containing the deleted or moved away <path>, if its root path is gone, i.e. if it was
+        <path> itself or a folder without files left (that _clear_dirs has removed from disk too).
+        """
+        if not _is_shared_with_others(path, username):
+            return
+        shared_path = path.split('/')[0]
+        if not userdata[username][SNAPSHOT].has_subtree(shared_path):
+            recipients = userdata[username]['shared_with_others'].pop(shared_path)
+            for user in recipients:
+                userdata[user]['shared_with_me'][username].remove(shared_path)
+            save_userdata(*recipients)
 
     def _clear_dirs(self, path, root):
         """
@@ -822,6 +1479,152 @@ class Actions(Resource):
         self._clear_dirs(path_to_clear, root)
 
 
+class Archives(Resource):
+    """
+    Bulk transfers: many files in a single tar stream, to avoid the cost of a request for each (small) file.
+    The md5 of each file is in the ARCHIVE_MD5_HEADER pax header of its member.
+    """
+    @staticmethod
+    def _store_member(username, path, tar, member):
+        """
+        Store the file of the archive <member> as <path> of <username> (creating or replacing it), checking
+        its md5, and return the last server timestamp. The caller must save the user data.
+        Abort with the http error of the file.
+        :return: int
+        """
+        if not member.isfile():
+            # Links, devices...
+            abort(HTTP_FORBIDDEN)
+        md5 = member.pax_headers.get(ARCHIVE_MD5_HEADER)
+        if not md5:
+            abort(HTTP_BAD_REQUEST)
+        dirname, filename = Files._get_dirname_filename(username, path)
+
+        fd, tmp_filepath = Files.make_upload_file()
+        try:
+            member_file = tar.extractfile(member)
+            h = hashlib.md5()
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in iter(lambda: member_file.read(2 ** 16), ''):
+                    h.update(chunk)
+                    fp.write(chunk)
+            if h.hexdigest() != md5:
+                abort(HTTP_CONFLICT)
+            return Files.store_upload(username, path, tmp_filepath, md5,
+                                      overwrite=os.path.isfile(join(dirname, filename)), save=False)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+
+    @auth.login_required
+    def post(self):
+        """
+        Upload many files as a tar archive (optionally compressed with gzip or bzip2), that is the request body.
+        Each file is created, or replaced if it exists, and the user data is saved once at the end.
+        The archive is read as a stream: if it is broken, the files read before the error are stored anyway.
+        Return the timestamps of the stored files and the http errors of the others:
+        {'stored': {<path>: <timestamp>, ...}, 'failed': {<path>: <status>, ...}, LAST_SERVER_TIMESTAMP: int}
+        """
+        username = auth.username()
+        stored, failed = {}, {}
+        try:
+            tar = tarfile.open(fileobj=request.stream, mode='r|*', encoding='utf-8')
+            for member in tar:
+                if member.isdir():
+                    continue
+                try:
+                    path = member.name.decode('utf-8')
+                except UnicodeDecodeError:
+                    failed[member.name.decode('utf-8', 'replace')] = HTTP_BAD_REQUEST
+                    continue
+                try:
+                    stored[path] = self._store_member(username, path, tar, member)
+                except HTTPException as e:
+                    failed[path] = e.code
+            tar.close()
+        except tarfile.TarError as e:
+            logger.warning('Broken archive uploaded by {}: {}'.format(username, e))
+        with user_locks.lock(username):
+            if stored:
+                save_userdata(username)
+            last_server_timestamp = userdata[username][LAST_SERVER_TIMESTAMP]
+        logger.info('Archive of {:,} files uploaded: {:,} failed'.format(len(stored) + len(failed), len(failed)))
+        return jsonify({'stored': stored, 'failed': failed, LAST_SERVER_TIMESTAMP: last_server_timestamp})
+
+    @staticmethod
+    def _files_to_send(username):
+        """
+        Return the [(<path>, <server path>, <md5>), ...] of the files requested by the query string: all the files
+        under the directory 'subtree' (the whole user directory if empty, shared files not included)
+        or the files 'path' (repeated), that can be shared with the user too.
+        The requested paths that are missing or forbidden are left out, the client finds them missing.
+        :return: list
+        """
+        with user_locks.lock_group(username, _share_owners):
+            if 'subtree' in request.args:
+                subtree_path = request.args['subtree']
+                if subtree_path and not check_path(subtree_path, username):
+                    abort(HTTP_FORBIDDEN)
+                records = userdata[username][SNAPSHOT].iter_subtree(normpath(subtree_path) if subtree_path else '')
+                return [(path, userpath2serverpath(username, path), record.md5) for path, record in records]
+            files = []
+            for path in request.args.getlist('path'):
+                try:
+                    filepath = Files.file_to_download(username, path)
+                except HTTPException:
+                    continue
+                record = file_record(username, path)
+                if record is not None:
+                    files.append((path, filepath, record[1]))
+            return files
+
+    @staticmethod
+    def _tar_member(path, fp, md5, chunk_len=2 ** 16):
+        """
+        Yield the tar blocks (header and content) of the member <path> with the content of the open file <fp>.
+        The file size is taken once: the content is cut or padded to it, then the client finds the md5 wrong.
+        """
+        stat = os.fstat(fp.fileno())
+        info = tarfile.TarInfo(path.encode('utf-8'))
+        info.size = stat.st_size
+        info.mtime = stat.st_mtime
+        info.pax_headers = {ARCHIVE_MD5_HEADER: md5}
+        yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8')
+        remaining = info.size
+        while remaining:
+            chunk = fp.read(min(chunk_len, remaining)) or tarfile.NUL * min(chunk_len, remaining)
+            remaining -= len(chunk)
+            yield chunk
+        if info.size % tarfile.BLOCKSIZE:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+
+    @auth.login_required
+    def get(self):
+        """
+        Download many files as an uncompressed tar archive, streamed while the files are read.
+        The query string selects the files (see _files_to_send), i.e. GET /archives?subtree=Photos
+        or GET /archives?path=Music/song.mp3&path=shared/<owner>/Work/notes.txt
+        The user lock is held only to list the files: each file is opened when it is its turn,
+        and the files removed meanwhile are left out.
+        """
+        username = auth.username()
+        files = self._files_to_send(username)
+        logger.info('Archive of {:,} files downloaded by {}'.format(len(files), username))
+
+        def generate():
+            for path, filepath, md5 in files:
+                try:
+                    fp = open(filepath, 'rb')
+                except IOError:
+                    continue
+                with fp:
+                    for block in self._tar_member(path, fp, md5):
+                        yield block
+            yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+        return Response(generate(), mimetype='application/x-tar')
+
+
 def calculate_file_md5(fp, chunk_len=2 ** 16):
     """
     Return the md5 digest of the file content of file_path as a string
@@ -849,7 +1652,7 @@ def compute_dir_state(root_path):  # TODO: make function accepting just an usern
     :param root_path: str
     :return: dict.
     """
-    snapshot = {}
+    snapshot = SnapshotTree()
     last_timestamp = now_timestamp()
     for dirpath, dirs, files in os.walk(root_path):
         for filename in files:
@@ -881,18 +1684,18 @@ class Shares(Resource):
         if not check_path(root_path, owner):
             abort(HTTP_FORBIDDEN)
 
-        # Check if the path exists
-        path = os.path.abspath(join(FILE_ROOT, owner, root_path))   
-        if not os.path.exists(path):
-            abort(HTTP_NOT_FOUND)
+        with user_locks.lock(owner, username):
+            # Check if the path exists (as a file or a non-empty folder of the owner snapshot)
+            if not userdata[owner][SNAPSHOT].has_subtree(normpath(root_path)):
+                abort(HTTP_NOT_FOUND)
 
-        # Check if the path is sharable
-        if not self._is_sharable(root_path, owner):
-            abort(HTTP_FORBIDDEN)    
+            # Check if the path is sharable
+            if not self._is_sharable(root_path, owner):
+                abort(HTTP_FORBIDDEN)
 
-        # create the share
-        self._share(root_path, username, owner)
-        save_userdata()
+            # create the share
+            self._share(root_path, username, owner)
+            save_userdata(owner, username)
 
         return HTTP_OK
 
@@ -901,42 +1704,29 @@ class Shares(Resource):
         """API Function: delete the share"""
 
         owner = auth.username()
-        if not self._is_shared(root_path, owner):
-            abort(HTTP_NOT_FOUND)
+        with user_locks.lock_group(owner, _share_recipients):
+            if not self._is_shared(root_path, owner):
+                abort(HTTP_NOT_FOUND)
 
-        if username == '':
-            users = userdata[owner]['shared_with_others'][root_path]
-            for user in users:
-                self._remove_share_from_user(root_path, user, owner)
-                save_userdata()
-            return HTTP_DELETED
+            if username == '':
+                users = list(userdata[owner]['shared_with_others'][root_path])
+                for user in users:
+                    self._remove_share_from_user(root_path, user, owner)
+                save_userdata(owner, *users)
+                return HTTP_DELETED
 
-        if username in userdata[owner]['shared_with_others'][root_path]:
-            self._remove_share_from_user(root_path, username, owner)
-            save_userdata()
-            return HTTP_DELETED
+            if username in userdata[owner]['shared_with_others'][root_path]:
+                self._remove_share_from_user(root_path, username, owner)
+                save_userdata(owner, username)
+                return HTTP_DELETED
 
         abort(HTTP_NOT_FOUND)
 
     def _remove_share_from_user(self, root_path, username, owner):
         """Removes the share manipulating the userdata"""
 
-        path = os.path.abspath(join(FILE_ROOT, owner, root_path))
-        file_root_abs_path = os.path.abspath(FILE_ROOT)
-        if os.path.isdir(path):
-            for root, dirs, files in os.walk(path):
-                for f in files:
-                    temp_path = string.replace(root, join(file_root_abs_path, owner), '')
-                    res = 'shared/{0}/{1}'.format(owner, join(temp_path[1:], f))
-                    userdata[username]['shared_files'].pop(res)
-
-            userdata[username]['shared_with_me'][owner].remove(root_path)
-            userdata[owner]['shared_with_others'][root_path].remove(username)
-        else:  # it's a single file
-            res = 'shared/{0}/{1}'.format(owner, root_path)
-            userdata[username]['shared_files'].pop(res)
-            userdata[username]['shared_with_me'][owner].remove(root_path)
-            userdata[owner]['shared_with_others'][root_path].remove(username)
+        userdata[username]['shared_with_me'][owner].remove(root_path)
+        userdata[owner]['shared_with_others'][root_path].remove(username)
 
     def _is_shared(self, path, owner):
         """Check if the path is a valid shared path"""
@@ -957,20 +1747,10 @@ class Shares(Resource):
         # check if the share already exists
         if (path in userdata[username]['shared_with_me'][owner]) or (username in userdata[owner]['shared_with_others'][path]):
             abort(HTTP_CONFLICT)
+        # The shared files are not copied: the recipient sees them through shared_view().
         userdata[username]['shared_with_me'][owner].append(path)
         userdata[owner]['shared_with_others'][path].append(username)
 
-        # track the shared files into userdata
-        abs_path = os.path.abspath(join(FILE_ROOT, owner, path))
-        file_root_abs_path = os.path.abspath(FILE_ROOT)
-        if os.path.isdir(abs_path):
-            for root, dirs, files in os.walk(abs_path):
-                for f in files:
-                    temp_path = string.replace(root, join(file_root_abs_path, owner), '')
-                    userdata[username]['shared_files']['shared/{0}/{1}'.format(owner, join(temp_path[1:], f))] = userdata[owner]['files'][join(temp_path[1:], f)]
-        else:
-            userdata[username]['shared_files']['shared/{0}/{1}'.format(owner, path)] = userdata[owner]['files'][path]
-
     def _is_sharable(self, path, owner):
         """
         Checks if the file or folder is located in the owner main root path.
@@ -993,51 +1773,150 @@ class Files(Resource):
         Download an authenticated user file from server, if <path> is not empty,
         otherwise get a server snapshot of user directory.
         <path> is the path relative to the user local directory.
+        The snapshot can be restricted to the files under a directory with the 'subtree' query parameter
+        (i.e. GET /files/?subtree=Photos/2014).
+        The responses have validators: the md5 of the file (ETag) and its timestamp (Last-Modified),
+        or the ETag of the snapshot (see snapshot_etag). A request with the validators of the current
+        version (If-None-Match, or If-Modified-Since for a file) gets a 304 without body.
+        The snapshot is sent as json or in the binary format of snapshot_codec, compressed with gzip or deflate,
+        as the client prefers (see negotiate_snapshot).
+        The whole snapshot can be paginated with the 'limit' query parameter (see snapshot_page).
         :param path: str
         """
         logger.debug('Files.get({})'.format(repr(path)))
         username = auth.username()
         
         if path:
-            if self._is_shared_with_me(path, username):
-                _, owner, file_path = path.split('/', 2)
-                user_rootpath = join(FILE_ROOT, owner)
-                dirname = join(user_rootpath, os.path.dirname(file_path))
-                fp = file_path
-
-            else:
-                if not check_path(path, username):
-                    abort(HTTP_FORBIDDEN)
-                user_rootpath = join(FILE_ROOT, username)
-                dirname = join(user_rootpath, os.path.dirname(path))
-                fp = path
-
             # Download the file specified by <path>.
-            if not os.path.exists(dirname):
-                abort(HTTP_NOT_FOUND)
+            filepath = self.file_to_download(username, path)
             s_filename = secure_filename(os.path.split(path)[-1])
+            record = self.record_to_download(username, path)
+            if record is not None and is_not_modified(record[1], record[0]):
+                return set_validators(make_response('', HTTP_NOT_MODIFIED), record[1], record[0])
 
             try:
-                response = make_response(_read_file(join(user_rootpath, fp)))
+                response = make_response(_read_file(filepath))
             except IOError:
                 response = 'Error: file {} not found.\n'.format(path), HTTP_NOT_FOUND
             else:
                 response.headers['Content-Disposition'] = 'attachment; filename=%s' % s_filename
+                if record is not None:
+                    set_validators(response, record[1], record[0])
         else:
-            # If path is not given, return the snapshot of user directory.
-            user_rootpath = join(FILE_ROOT, username)
-            logger.debug('launch snapshot of {}...'.format(repr(user_rootpath)))
-            snapshot = userdata[username][SNAPSHOT]
-            logger.info('snapshot returned {:,} files'.format(len(snapshot)))
-            last_server_timestamp = userdata[username][LAST_SERVER_TIMESTAMP]
-            shared_files = userdata[username][SHARED_FILES]
-            response = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp,
-                                SNAPSHOT: snapshot,
-                                SHARED_FILES: shared_files})
+            subtree_path = request.args.get('subtree') or None
+            if subtree_path is not None and not check_path(subtree_path, username):
+                abort(HTTP_FORBIDDEN)
+            limit = request.args.get('limit', type=int) if subtree_path is None else None
+            if limit is not None and not 0 < limit <= SNAPSHOT_MAX_PAGE_SIZE:
+                abort(HTTP_BAD_REQUEST)
+            content_type, encoding = negotiate_snapshot()
+            next_page = None
+            # The owners of the shared files are locked too, to read their snapshots.
+            with user_locks.lock_group(username, _share_owners):
+                snapshot_version = snapshot_etag(username, subtree_path)
+                etag = representation_etag(snapshot_version, content_type, encoding)
+                if limit is not None:
+                    # Every page has its own ETag
+                    etag += '-' + hashlib.md5(json.dumps([limit, request.args.get('after')])).hexdigest()
+                if is_not_modified(etag):
+                    response = make_response('', HTTP_NOT_MODIFIED)
+                elif limit is not None:
+                    document, next_page = self.snapshot_page(username, snapshot_version, limit,
+                                                             request.args.get('after'))
+                    response = snapshot_response(document, content_type, encoding)
+                elif subtree_path is not None:
+                    # Listing of a subtree of the user directory (shared files are not included).
+                    snapshot = userdata[username][SNAPSHOT].subtree(normpath(subtree_path))
+                    response = snapshot_response({LAST_SERVER_TIMESTAMP: userdata[username][LAST_SERVER_TIMESTAMP],
+                                                  SNAPSHOT: snapshot}, content_type, encoding)
+                else:
+                    # If path is not given, return the snapshot of user directory.
+                    snapshot = userdata[username][SNAPSHOT]
+                    logger.info('snapshot returned {:,} files'.format(len(snapshot)))
+                    last_server_timestamp = userdata[username][LAST_SERVER_TIMESTAMP]
+                    shared_files = shared_view(username)
+                    response = snapshot_response({LAST_SERVER_TIMESTAMP: last_server_timestamp,
+                                                  SNAPSHOT: snapshot,
+                                                  SHARED_FILES: shared_files}, content_type, encoding)
+            set_validators(response, etag)
+            response.headers['Vary'] = 'Accept, Accept-Encoding'
+            if next_page is not None:
+                response.headers[NEXT_PAGE_HEADER] = next_page
         logger.debug(response)
         return response
+
+    @auth.login_required
+    def head(self, path=''):
+        """
+        Return the headers of get() without the body, to check a file or the snapshot without downloading it:
+        the size of the file (Content-Length), its md5 (ETag and DELTA_MD5_HEADER) and its server timestamp
+        (TIMESTAMP_HEADER and Last-Modified); the ETag and the server timestamp of the snapshot.
+        The conditional requests get a 304 as in get().
+        :param path: str
+        """
+        username = auth.username()
+        if path:
+            filepath = self.file_to_download(username, path)
+            record = self.record_to_download(username, path)
+            if record is None or not os.path.isfile(filepath):
+                abort(HTTP_NOT_FOUND)
+            timestamp, md5 = record
+            if is_not_modified(md5, timestamp):
+                return set_validators(make_response('', HTTP_NOT_MODIFIED), md5, timestamp)
+            response = set_validators(make_response(''), md5, timestamp)
+            response.headers['Content-Length'] = os.path.getsize(filepath)
+            response.headers[DELTA_MD5_HEADER] = md5
+        else:
+            with user_locks.lock_group(username, _share_owners):
+                etag = representation_etag(snapshot_etag(username), *negotiate_snapshot())
+                timestamp = userdata[username][LAST_SERVER_TIMESTAMP]
+            response = make_response('', HTTP_NOT_MODIFIED if is_not_modified(etag) else HTTP_OK)
+            response.set_etag(etag)
+        response.headers[TIMESTAMP_HEADER] = timestamp
+        return response
     
-    def _is_shared_with_me(self, path, username):
+    @staticmethod
+    def snapshot_page(username, version, limit, token=None):
+        """
+        Return the (<document>, <token of the next page or None>) of a page of the snapshot of <username>,
+        with <limit> files at most: the files sorted by path (see SnapshotTree.iter_sorted), then the shared ones
+        (see iter_shared_sorted).
+        The pages are not held on the server: the <token> of a page is the section and the path of the last file
+        of the previous page, with the <version> of the snapshot (see snapshot_etag). The snapshot can change
+        between two pages: then the page is refused (409) and the client must start again,
+        because it would miss the files moved between the pages.
+        The caller must hold the locks of the user and of the owners.
+        :return: tuple
+        """
+        section, after = SNAPSHOT, None
+        if token is not None:
+            try:
+                token_version, section, after = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+            except (TypeError, ValueError, UnicodeEncodeError):
+                abort(HTTP_BAD_REQUEST)
+            if section not in (SNAPSHOT, SHARED_FILES) or not isinstance(after, basestring):
+                abort(HTTP_BAD_REQUEST)
+            if token_version != version:
+                abort(HTTP_CONFLICT)
+        document = {LAST_SERVER_TIMESTAMP: userdata[username][LAST_SERVER_TIMESTAMP],
+                    SNAPSHOT: SnapshotTree(), SHARED_FILES: SnapshotTree()}
+        sections = [(SNAPSHOT, userdata[username][SNAPSHOT].iter_sorted),
+                    (SHARED_FILES, functools.partial(iter_shared_sorted, username))]
+        if section == SHARED_FILES:
+            sections = sections[1:]
+        count = 0
+        for name, iter_sorted in sections:
+            for path, record in iter_sorted(after):
+                if count == limit:
+                    return document, base64.urlsafe_b64encode(json.dumps([version] + last))
+                document[name].link_record(path, record)
+                last = [name, path]
+                count += 1
+            after = None
+        return document, None
+
+    @staticmethod
+    def _is_shared_with_me(path, username):
         """Check if the path belong to a shared path"""
 
         if path.split('/')[0] == 'shared':
@@ -1049,78 +1928,259 @@ class Files(Resource):
                 return True
         return False
 
-    def _update_shared_files(self, path, username, timestamp, md5):
-        """Track the path in all users that have that share"""
+    @classmethod
+    def file_to_download(cls, username, path):
+        """
+        Return the server path of the file <path> of <username> (that can be a 'shared/<owner>/<path>'
+        file shared with the user), aborting if the path is forbidden or its directory does not exist.
+        Used by get() and by the transfer service (see transfers.py).
+        :return: str
+        """
+        if cls._is_shared_with_me(path, username):
+            _, owner, file_path = path.split('/', 2)
+            user_rootpath = join(FILE_ROOT, owner)
+        else:
+            if not check_path(path, username):
+                abort(HTTP_FORBIDDEN)
+            user_rootpath = join(FILE_ROOT, username)
+            file_path = path
+        if not os.path.exists(join(user_rootpath, os.path.dirname(file_path))):
+            abort(HTTP_NOT_FOUND)
+        return join(user_rootpath, file_path)
 
-        shared_path = path.split('/')[0]
-        for user in userdata[username]['shared_with_others'][shared_path]:
-            res = 'shared/{0}/{1}'.format(username, path)
-            userdata[user]['shared_files'][res] = [timestamp, md5]
-    
-    def _get_dirname_filename(self, path):
+    @staticmethod
+    def record_to_download(username, path):
+        """
+        Return the [<timestamp>, <md5>] of the file <path> of <username> (see file_to_download and file_record),
+        or None if it is not in the snapshot.
+        :return: list or None
+        """
+        with user_locks.lock_group(username, _share_owners):
+            return file_record(username, path)
+
+    @staticmethod
+    def _get_dirname_filename(username, path):
         """
         Return dirname(directory name) and filename(file name) for a given path to complete
         post and put methods
         """
-        username = auth.username()
         dirname = os.path.dirname(path)
         dirname = (join(FILE_ROOT, username, dirname))
         filename = os.path.split(path)[-1]
 
-        if not check_path(dirname, username):
+        # check_path wants the path relative to the user directory
+        if not check_path(path, username):
             abort(HTTP_FORBIDDEN)
 
         return dirname, filename
 
-    def _update_user_path(self, username, path):
+    @staticmethod
+    def _update_user_path(username, path, md5, save=True):
         """
         Make all needed updates to <userdata> (dict and disk) after a post or a put.
-        Return the last modification int timestamp of written file.
+        Return the timestamp of the written file: the current time, not its mtime, since the stored content
+        can be old and its inode is shared with other files (see blobs.py).
+        The caller must hold the user lock.
         :param username: str
         :param path: str
+        :param md5: str, the md5 of the written file.
+        :param save: bool, False if the caller saves the user data itself.
         :return: int
         """
-        filepath = userpath2serverpath(username, path)
-        last_server_timestamp = file_timestamp(filepath)
-        new_md5 = calculate_file_md5(open(filepath, 'rb'))
+        last_server_timestamp = now_timestamp()
         userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
-        userdata[username]['files'][normpath(path)] = [last_server_timestamp, new_md5]
-
-        # if path is a shared path then update userdata to permit all user to synchronize with the share
-        if _is_shared_with_others(path, username):
-            self._update_shared_files(path, username, last_server_timestamp, new_md5)
+        userdata[username]['files'][normpath(path)] = [last_server_timestamp, md5]
 
-        save_userdata()
+        if save:
+            save_userdata(username)
         return last_server_timestamp
 
+    @staticmethod
+    def make_upload_file():
+        """
+        Create a temporary file of the file storage where an upload is written, and return its
+        (file descriptor, path). Then the file can be moved in the user directory (os.rename, see store_upload),
+        so the readers never see a partially written file, and the slow writing is done without holding
+        the user lock.
+        :return: (int, str)
+        """
+        if not os.path.isdir(UPLOADS_DIR):
+            try:
+                os.makedirs(UPLOADS_DIR)
+            except OSError:
+                # Created by another request meanwhile
+                pass
+        return tempfile.mkstemp(dir=UPLOADS_DIR)
+
+    @classmethod
+    def _save_upload(cls, upload_file):
+        """
+        Save the uploaded file in a temporary file of the file storage, and return its path.
+        :return: str
+        """
+        fd, tmp_filepath = cls.make_upload_file()
+        with os.fdopen(fd, 'wb') as fp:
+            upload_file.save(fp)
+        return tmp_filepath
+
+    @classmethod
+    def _patch_upload(cls, username, path, delta_file, md5):
+        """
+        Rebuild the uploaded version of the file <path> from its current version and the uploaded <delta_file>
+        (see delta.py) in a temporary file of the file storage, and return its path.
+        Abort if the file is missing, if the delta is malformed or if the rebuilt file doesn't match <md5>.
+        :return: str
+        """
+        fd, tmp_filepath = cls.make_upload_file()
+        try:
+            try:
+                with os.fdopen(fd, 'wb') as fp, open(userpath2serverpath(username, path), 'rb') as base:
+                    patched_md5 = delta.patch(base, delta_file, fp)
+            except IOError:
+                abort(HTTP_NOT_FOUND)
+            except ValueError:
+                abort(HTTP_BAD_REQUEST)
+            if patched_md5 != md5:
+                abort(HTTP_CONFLICT)
+        except HTTPException:
+            os.remove(tmp_filepath)
+            raise
+        return tmp_filepath
+
+    @classmethod
+    def _assemble_upload(cls, username, md5):
+        """
+        Rebuild the uploaded file from its 'chunks', the json list of the [<md5>, <size>] of its chunks (see chunks.py),
+        in a temporary file of the file storage, and return its path. The chunks that the server doesn't have
+        are uploaded as the 'data' file, in the order of the json list 'sent' of their md5s. Only the chunks
+        uploaded by <username> are used (see chunks.py).
+        Abort if a chunk is wrong or missing, or if the rebuilt file doesn't match <md5>.
+        :return: str
+        """
+        try:
+            chunks = [(str(chunk_md5), int(size)) for chunk_md5, size in json.loads(request.form['chunks'])]
+            sent = [str(chunk_md5) for chunk_md5 in json.loads(request.form.get('sent', '[]'))]
+        except (ValueError, TypeError):
+            abort(HTTP_BAD_REQUEST)
+        if not all(MD5_REG_OBJ.match(chunk_md5) for chunk_md5, _ in chunks):
+            abort(HTTP_BAD_REQUEST)
+        sizes = dict(chunks)
+        data_file = request.files.get('data')
+        for chunk_md5 in sent:
+            size = sizes.get(chunk_md5)
+            if size is None or size > ChunkStore.CHUNK_MAX_SIZE or data_file is None:
+                abort(HTTP_BAD_REQUEST)
+            data = data_file.read(size)
+            if hashlib.md5(data).hexdigest() != chunk_md5:
+                abort(HTTP_CONFLICT)
+            chunk_store.add(username, chunk_md5, data)
+
+        fd, tmp_filepath = cls.make_upload_file()
+        try:
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    assembled_md5 = chunk_store.assemble(username, [chunk_md5 for chunk_md5, _ in chunks], fp)
+            except KeyError:
+                # Not sent, and not stored (or removed meanwhile, see ChunkStore.collect_garbage)
+                abort(HTTP_CONFLICT)
+            if assembled_md5 != md5:
+                abort(HTTP_CONFLICT)
+        except HTTPException:
+            os.remove(tmp_filepath)
+            raise
+        return tmp_filepath
+
+    @classmethod
+    def _append_upload(cls, username, path, offset, data_file, md5):
+        """
+        Write the current version of the file <path>, that must be <offset> bytes long, followed by the uploaded
+        <data_file> in a temporary file of the file storage, and return its path.
+        Abort if the file is missing, if its size is not <offset> or if the new file doesn't match <md5>.
+        :return: str
+        """
+        fd, tmp_filepath = cls.make_upload_file()
+        try:
+            try:
+                with os.fdopen(fd, 'wb') as fp, open(userpath2serverpath(username, path), 'rb') as base:
+                    if os.fstat(base.fileno()).st_size != offset:
+                        abort(HTTP_CONFLICT)
+                    md5hash = hashlib.md5()
+                    for source in (base, data_file):
+                        for chunk in iter(lambda: source.read(2 ** 16), ''):
+                            md5hash.update(chunk)
+                            fp.write(chunk)
+            except IOError:
+                abort(HTTP_NOT_FOUND)
+            if md5hash.hexdigest() != md5:
+                abort(HTTP_CONFLICT)
+        except HTTPException:
+            os.remove(tmp_filepath)
+            raise
+        return tmp_filepath
+
+    @classmethod
+    def _receive_upload(cls, username, path, md5):
+        """
+        Write the uploaded content of <path> in a temporary file of the file storage, and return its path.
+        The content is the whole 'file', the 'delta' against the current version of the file (see _patch_upload)
+        or the 'chunks' of the file (see _assemble_upload). Abort if it doesn't match <md5>.
+        :return: str
+        """
+        if 'delta' in request.files:
+            return cls._patch_upload(username, path, request.files['delta'], md5)
+        if 'chunks' in request.form:
+            return cls._assemble_upload(username, md5)
+        upload_file = request.files['file']
+        if calculate_file_md5(upload_file) != md5:
+            abort(HTTP_CONFLICT)
+        return cls._save_upload(upload_file)
+
+    @classmethod
+    def store_upload(cls, username, path, tmp_filepath, md5, overwrite, save=True):
+        """
+        Move the uploaded temporary file (see make_upload_file) to <path> of <username>, update the user data
+        and return the last server timestamp. The temporary file is removed anyway.
+        If <overwrite> the file must exist (put), otherwise it must not (post).
+        Used by post(), put(), by the transfer service (see transfers.py) and by Preflight.
+        :return: int
+        """
+        try:
+            dirname, filename = cls._get_dirname_filename(username, path)
+            filepath = join(dirname, filename)
+            # If the content is already stored, the file becomes a link to it (see blobs.py)
+            blob_store.add(tmp_filepath, md5)
+            with user_locks.lock(username):
+                if overwrite:
+                    if not os.path.isfile(filepath):
+                        abort(HTTP_NOT_FOUND)
+                elif not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                elif os.path.isfile(filepath):
+                    abort(HTTP_FORBIDDEN)
+                os.rename(tmp_filepath, filepath)
+
+                # Update and save <userdata>, and return the last server timestamp.
+                return cls._update_user_path(username, path, md5, save)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+
     @auth.login_required
     def post(self, path):
         """
         Upload an authenticated user file to the server, given the path relative to the user directory.
+        In place of the whole 'file', the chunks of the file that the server doesn't have can be uploaded
+        (see _assemble_upload and Chunks).
         Return the file timestamp of the file created in the server.
         The file must not exist in the server, otherwise only return an http forbidden code.
         :param path: str
         """
         username = auth.username()
-
-        upload_file = request.files['file']
         md5 = request.form['md5']
-        dirname, filename = self._get_dirname_filename(path)
-
-        if calculate_file_md5(upload_file) != md5:
-            abort(HTTP_CONFLICT)
-
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        else:
-            if os.path.isfile(join(dirname, filename)):
-                abort(HTTP_FORBIDDEN)
-
-        filepath = join(dirname, filename)
-        upload_file.save(filepath)
+        self._get_dirname_filename(username, path)
 
-        # Update and save <userdata>, and return the last server timestamp.
-        last_server_timestamp = self._update_user_path(username, path)
+        tmp_filepath = self._receive_upload(username, path, md5)
+        last_server_timestamp = self.store_upload(username, path, tmp_filepath, md5, overwrite=False)
 
         resp = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
         resp.status_code = HTTP_CREATED
@@ -1131,36 +2191,266 @@ class Files(Resource):
         """
         Modify an authenticated user file in the server (uploading and overwriting it)
         given the path relative to the user directory. The file must exist in the server.
+        In place of the whole 'file', the 'delta' against the current version (see delta.py and Signatures)
+        or the chunks of the file that the server doesn't have (see _assemble_upload and Chunks) can be uploaded.
         Return the file timestamp of the file updated in the server.
         :param path: str
         """
         username = auth.username()
-        upload_file = request.files['file']
         md5 = request.form['md5']
-        dirname, filename = self._get_dirname_filename(path)
+        self._get_dirname_filename(username, path)
 
-        if calculate_file_md5(upload_file) != md5:
-            abort(HTTP_CONFLICT)
+        tmp_filepath = self._receive_upload(username, path, md5)
+        last_server_timestamp = self.store_upload(username, path, tmp_filepath, md5, overwrite=True)
 
-        filepath = join(dirname, filename)
-        if os.path.isfile(filepath):
-            upload_file.save(filepath)
-        else:
-            abort(HTTP_NOT_FOUND)
+        resp = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+        resp.status_code = HTTP_CREATED
+        return resp
 
-        # Update and save <userdata>, and return the last server timestamp.
-        last_server_timestamp = self._update_user_path(username, path)
+    @auth.login_required
+    def patch(self, path):
+        """
+        Append the uploaded 'data' to an authenticated user file in the server, given the path relative to the user
+        directory: the client sends only the bytes appended to the file (i.e. a log), from 'offset', the size of
+        the current version. 'md5' is the md5 of the whole new file, checked before the file is replaced.
+        Return the file timestamp of the file updated in the server.
+        :param path: str
+        """
+        username = auth.username()
+        md5 = request.form['md5']
+        self._get_dirname_filename(username, path)
+        try:
+            offset = int(request.form['offset'])
+            data_file = request.files['data']
+        except (KeyError, ValueError):
+            abort(HTTP_BAD_REQUEST)
+
+        tmp_filepath = self._append_upload(username, path, offset, data_file, md5)
+        last_server_timestamp = self.store_upload(username, path, tmp_filepath, md5, overwrite=True)
 
         resp = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
         resp.status_code = HTTP_CREATED
         return resp
 
 
+class Signatures(Resource):
+    """
+    Block signatures of the files (see delta.py), to upload only the changes of a file.
+    """
+    @auth.login_required
+    def get(self, path):
+        """
+        Return the signature of the file <path>, then the client can upload the delta of its new version against it
+        (see Files.put).
+        """
+        filepath = Files.file_to_download(auth.username(), path)
+        try:
+            with open(filepath, 'rb') as fp:
+                signature = delta.signature(fp, os.fstat(fp.fileno()).st_size)
+        except IOError:
+            abort(HTTP_NOT_FOUND)
+        response = make_response(signature)
+        response.mimetype = 'application/octet-stream'
+        return response
+
+
+class Deltas(Resource):
+    """
+    Download of the changes of a file: the client sends the signature of its old version (see delta.py).
+    """
+    @auth.login_required
+    def post(self, path):
+        """
+        Download the file <path> as the delta against the uploaded 'signature', streamed while the file is read.
+        The md5 of the file is in the DELTA_MD5_HEADER header: the client checks it against the rebuilt file
+        (the file can change before it is opened).
+        """
+        username = auth.username()
+        filepath = Files.file_to_download(username, path)
+        try:
+            signature = delta.parse_signature(request.files['signature'].read())
+        except (KeyError, ValueError):
+            abort(HTTP_BAD_REQUEST)
+        with user_locks.lock_group(username, _share_owners):
+            record = file_record(username, path)
+        if record is None:
+            abort(HTTP_NOT_FOUND)
+        try:
+            fp = open(filepath, 'rb')
+        except IOError:
+            abort(HTTP_NOT_FOUND)
+
+        def generate():
+            with fp:
+                for block in delta.delta(fp, signature):
+                    yield block
+
+        response = Response(generate(), mimetype='application/octet-stream')
+        response.headers[DELTA_MD5_HEADER] = record[1]
+        return response
+
+
+class Chunks(Resource):
+    """
+    Upload by chunks: only the chunks of a file that the server doesn't have are uploaded (see chunks.py).
+    """
+    @auth.login_required
+    def post(self):
+        """
+        Receive the md5s of the chunks of the files the client is going to upload, as the json list 'chunks',
+        and return the ones that must be uploaded: {'needed': [<md5>, ...]}
+        Only the chunks uploaded by the user count (see chunks.py). The stored ones are kept for another
+        CHUNKS_MAX_AGE.
+        """
+        username = auth.username()
+        try:
+            md5s = json.loads(request.form['chunks'])
+        except (KeyError, ValueError):
+            abort(HTTP_BAD_REQUEST)
+        if not isinstance(md5s, list) or not all(isinstance(md5, basestring) and MD5_REG_OBJ.match(md5)
+                                                 for md5 in md5s):
+            abort(HTTP_BAD_REQUEST)
+        needed = [md5 for md5 in md5s if not chunk_store.has(username, md5)]
+        logger.info('Chunks of {}: {:,} of {:,} to upload'.format(username, len(needed), len(md5s)))
+        return jsonify({'needed': needed})
+
+
+class Notifications(Resource):
+    """
+    Notifications of the changes of the user data, so that the clients sync only when something has changed
+    (see notifications.py). They are served by the transfer service only (see transfers.py): a waiting client
+    costs a socket there, a thread here.
+    """
+    def get(self):
+        """
+        Redirect the request to the transfer service, on the same host, with the same path and query:
+        wait for a version of the user data newer than 'since' (long-poll), or with the
+        'Accept: text/event-stream' header get a stream of Server-Sent Events.
+        Without the transfer service (see TRANSFER_PORT) the notifications are not served: 404.
+        """
+        if TRANSFER_PORT is None:
+            abort(HTTP_NOT_FOUND)
+        host = urlparse.urlsplit(request.host_url).hostname
+        if ':' in host:
+            host = '[{}]'.format(host)
+        return redirect('http://{}:{}{}'.format(host, TRANSFER_PORT, request.full_path.rstrip('?')),
+                        code=HTTP_TEMPORARY_REDIRECT)
+
+
+class Preflight(Resource):
+    """
+    Upload by hash: the files whose content the user can already read on the server (in its files or in
+    the files shared with it) are created without transferring them, i.e. the copies and moves made on a client.
+    The contents of the other users are not: the md5 (and the size) of a content would be enough to get it,
+    and md5 collisions can be made. They are still stored once on disk (see blobs.py).
+    """
+    @staticmethod
+    def _readable_md5s(username, md5s):
+        """
+        Return the <md5s> that are the content of a file of <username> or of a file shared with it.
+        The caller must hold the locks of the user and of the owners.
+        :return: set
+        """
+        trees = [(userdata[username][SNAPSHOT], [''])]
+        trees.extend((userdata[owner][SNAPSHOT], root_paths)
+                     for owner, root_paths in userdata[username]['shared_with_me'].iteritems() if owner in userdata)
+        readable = set()
+        for tree, root_paths in trees:
+            for root_path in root_paths:
+                for _, record in tree.iter_subtree(root_path):
+                    if record.md5 in md5s:
+                        readable.add(record.md5)
+        return readable
+
+    @staticmethod
+    def _materialize(username, path, md5, size):
+        """
+        Create or replace the file <path> of <username> with the stored content <md5>, if it is there,
+        and return the file timestamp, otherwise return None. The content must be readable by the user
+        (see _readable_md5s). The caller must hold the user lock and save the user data.
+        :return: int or None
+        """
+        record = userdata[username][SNAPSHOT].get(normpath(path))
+        filepath = userpath2serverpath(username, path)
+        if record is not None and record[1] == md5 and os.path.isfile(filepath):
+            # Already uploaded
+            return record[0]
+        blob = blob_store.path(md5)
+        try:
+            if os.path.getsize(blob) != size:
+                return None
+        except OSError:
+            return None
+        fd, tmp_filepath = Files.make_upload_file()
+        os.close(fd)
+        try:
+            blob_store.link(blob, tmp_filepath)
+        except OSError:
+            # The blob has been collected meanwhile
+            os.remove(tmp_filepath)
+            return None
+        try:
+            return Files.store_upload(username, path, tmp_filepath, md5, overwrite=os.path.isfile(filepath),
+                                      save=False)
+        except HTTPException:
+            # i.e. the path is a directory: the client will get the error uploading the file.
+            return None
+
+    @auth.login_required
+    def post(self):
+        """
+        Receive the files the client is going to upload, as the json list [[<path>, <md5>, <size>], ...]
+        of the 'files' form field. Create (or replace) the files whose content is already stored, and
+        return their timestamps and the paths still to be uploaded:
+        {'materialized': {<path>: <timestamp>, ...}, 'needed': [<path>, ...], LAST_SERVER_TIMESTAMP: int}
+        """
+        username = auth.username()
+        try:
+            files = json.loads(request.form['files'])
+            files = [(path, md5, int(size)) for path, md5, size in files]
+        except (KeyError, ValueError, TypeError):
+            abort(HTTP_BAD_REQUEST)
+        for path, md5, _ in files:
+            if not check_path(path, username):
+                abort(HTTP_FORBIDDEN)
+            if not MD5_REG_OBJ.match(md5):
+                abort(HTTP_BAD_REQUEST)
+
+        materialized, needed = {}, []
+        with user_locks.lock_group(username, _share_owners):
+            readable = self._readable_md5s(username, set(md5 for _, md5, _ in files))
+            for path, md5, size in files:
+                timestamp = self._materialize(username, path, md5, size) if md5 in readable else None
+                if timestamp is None:
+                    needed.append(path)
+                else:
+                    materialized[path] = timestamp
+            if materialized:
+                save_userdata(username)
+            last_server_timestamp = userdata[username][LAST_SERVER_TIMESTAMP]
+        logger.info('Preflight of {:,} files: {:,} to upload'.format(len(files), len(needed)))
+        return jsonify({'materialized': materialized, 'needed': needed,
+                        LAST_SERVER_TIMESTAMP: last_server_timestamp})
+
+
 api.add_resource(Files, '{}/files/<path:path>'.format(URL_PREFIX), '{}/files/'.format(URL_PREFIX))
 api.add_resource(Actions, '{}/actions/<string:cmd>'.format(URL_PREFIX))
 api.add_resource(Shares, '{}/shares/<path:root_path>/<string:username>'.format(URL_PREFIX), '{}/shares/<path:root_path>'.format(URL_PREFIX))
 api.add_resource(Users, '{}/users/<string:username>'.format(URL_PREFIX))
 api.add_resource(UsersRecoverPassword, '{}/users/<string:username>/reset'.format(URL_PREFIX))
+api.add_resource(Tokens, '{}/tokens'.format(URL_PREFIX))
+api.add_resource(Preflight, '{}/preflight'.format(URL_PREFIX))
+api.add_resource(Archives, '{}/archives'.format(URL_PREFIX))
+api.add_resource(Signatures, '{}/signatures/<path:path>'.format(URL_PREFIX))
+api.add_resource(Deltas, '{}/deltas/<path:path>'.format(URL_PREFIX))
+api.add_resource(Chunks, '{}/chunks'.format(URL_PREFIX))
+api.add_resource(Notifications, '{}/notifications'.format(URL_PREFIX))
+
+job_queue.register('send_email', _send_email_job)
+job_queue.register('sweep_expired_data', sweep_expired_data)
+job_queue.register('prune_store_changes', prune_store_changes)
+job_queue.register('collect_blobs', collect_blobs)
+job_queue.register('collect_chunks', collect_chunks)
 
 # Set the flask.ext.mail.Mail instance
 mail = configure_email()
@@ -1178,7 +2468,49 @@ def create_log_file_handler():
     return file_handler
 
 
+def configure_production():
+    """
+    Switch the imported server module (in testing mode, see app.testing) to the real configuration.
+    Called by the production entry points (see wsgi.py and prefork.py).
+    """
+    global EMAIL_SETTINGS_FILEPATH, mail
+    app.testing = False
+    app.config['MAIL_SUPPRESS_SEND'] = False
+    EMAIL_SETTINGS_FILEPATH = os.path.join(SERVER_DIRECTORY, 'email_settings.ini')
+    mail = configure_email()
+    console_handler.setLevel(logging.WARNING)
+    create_log_file_handler()
+
+
+def setup_server(worker_index=None):
+    """
+    Load the server data and start the background jobs.
+    Called by main(), by the wsgi entry point (see wsgi.py) and by every worker process of the
+    multi-process mode (see prefork.py), with its <worker_index>.
+    """
+    update_passwordmeter_terms(UNWANTED_PASS)
+
+    app.config['SECRET_KEY'] = load_secret_key()
+    init_root_structure()
+    if worker_index is None:
+        userdata.update(load_userdata())
+        job_queue.open(JOBS_FILENAME)
+    else:
+        open_store()
+        # Each worker has its own pending jobs
+        job_queue.open(WORKER_JOBS_FILENAME.format(worker_index))
+        job_queue.schedule('prune_store_changes', EXPIRED_DATA_SWEEP_INTERVAL)
+        watcher = threading.Thread(target=watch_store_changes, name='StoreWatcher')
+        watcher.daemon = True
+        watcher.start()
+    job_queue.schedule('sweep_expired_data', EXPIRED_DATA_SWEEP_INTERVAL)
+    job_queue.schedule('collect_blobs', BLOBS_GC_INTERVAL)
+    job_queue.schedule('collect_chunks', CHUNKS_GC_INTERVAL)
+    job_queue.start()
+
+
 def main():
+    global TRANSFER_PORT
     file_handler = create_log_file_handler()
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', default=False, action='store_true',
@@ -1191,6 +2523,9 @@ def main():
                         [default: %(default)s]. Ignored if --verbose or --debug option is set.')
     parser.add_argument('-H', '--host', default='0.0.0.0',
                         help='set host address to run the server. [default: %(default)s].')
+    parser.add_argument('--transfer-port', type=int,
+                        help='serve the file downloads and uploads on this port too, streaming them '
+                             '(see transfers.py).')
     args = parser.parse_args()
 
     if args.debug:
@@ -1209,11 +2544,15 @@ def main():
     logger.info('Console logging level: {}'.format(console_handler.level))
     logger.info('File logging level: {}'.format(file_handler.level))
 
-    update_passwordmeter_terms(UNWANTED_PASS)
-
-    userdata.update(load_userdata())
-    init_root_structure()
-    app.run(host=args.host, debug=args.debug)
+    setup_server()
+    if args.transfer_port:
+        # The transfers module imports this one as "server"
+        sys.modules['server'] = sys.modules[__name__]
+        from transfers import TransferServer
+        TransferServer(args.host, args.transfer_port).start()
+        TRANSFER_PORT = args.transfer_port
+    # Every request is served by a new thread (see the user_locks)
+    app.run(host=args.host, debug=args.debug, threaded=True)
 
 if __name__ == '__main__':
     main()
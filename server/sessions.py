@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cheap authentication of the repeated requests of the same client.
+
+sha256_crypt.verify is slow by design (tens of milliseconds of cpu), so verifying the password of
+every request caps the server throughput. Here there are two ways to avoid it:
+ - SessionTokens: short-lived signed tokens, given in exchange of the user credentials
+   and then sent by the client in place of the password;
+ - CredentialsCache: a bounded cache of the recently verified credentials, for the clients
+   that keep sending the password.
+
+Both are bound to the stored password hash of the user, so a password change invalidates them.
+"""
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+
+def password_generation(stored_pw):
+    """
+    Return a short fingerprint of the stored (encrypted) password, that changes with the password.
+    :param stored_pw: str
+    :return: str
+    """
+    return hashlib.sha1(stored_pw).hexdigest()[:10]
+
+
+class SessionTokens(object):
+    """
+    Issue and check the session tokens, signed with the given secret key.
+    """
+    SALT = 'session-token'
+
+    def __init__(self, secret_key, max_age):
+        self.max_age = max_age
+        self._serializer = URLSafeTimedSerializer(secret_key, salt=self.SALT)
+
+    def issue(self, username, stored_pw):
+        """
+        Return a new token for <username>.
+        :param stored_pw: str, the current encrypted password of the user.
+        :return: str
+        """
+        return self._serializer.dumps({'u': username, 'g': password_generation(stored_pw)})
+
+    def check(self, token, username, stored_pw):
+        """
+        Return True if <token> has been issued to <username> since its last password change and it is not expired.
+        """
+        try:
+            payload = self._serializer.loads(token, max_age=self.max_age)
+        except (BadSignature, SignatureExpired):
+            return False
+        if not isinstance(payload, dict):
+            return False
+        return payload.get('u') == username and payload.get('g') == password_generation(stored_pw)
+
+
+class CredentialsCache(object):
+    """
+    Bounded LRU cache of the (username, password) couples verified in the last <ttl> seconds.
+
+    Passwords are not kept: the keys are salted hashes of username, password and stored password.
+    """
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._salt = os.urandom(16)
+        # {<key>: (<username>, <expiry time>)}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, username, password, stored_pw):
+        fields = [value.encode('utf-8') if isinstance(value, unicode) else value
+                  for value in (username, password, stored_pw)]
+        return hashlib.sha256('\0'.join([self._salt] + fields)).digest()
+
+    def check(self, username, password, stored_pw):
+        """
+        Return True if the credentials have been verified (see add) and not expired yet.
+        """
+        key = self._key(username, password, stored_pw)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False
+            if entry[1] < time.time():
+                return False
+            # Move it to the most recently used end
+            self._entries[key] = entry
+            return True
+
+    def add(self, username, password, stored_pw):
+        """
+        Remember the given credentials as verified, dropping the least recently used ones if the cache is full.
+        """
+        key = self._key(username, password, stored_pw)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (username, time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        """
+        Forget all the verified credentials of <username>.
+        """
+        with self._lock:
+            for key in [key for key, entry in self._entries.iteritems() if entry[0] == username]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
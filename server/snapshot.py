@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact in-memory representation of the server-side user snapshots
+(userdata[<user>]['files'] and the views of the shared files).
+
+A SnapshotTree behaves like the old {'<path>': [<timestamp>, '<md5>']} dict, but it stores:
+ - paths in a trie of directory nodes, whose names are interned among all users;
+ - the ascii names as str instead of unicode (a quarter of the size);
+ - a single packed str record per file, with the md5 as its 16 raw bytes (as the client CompactSnapshot);
+and it allows to *link* the same packed record in more trees, so the views of the shared files of a recipient
+(see server.shared_view) reference the owner's records instead of copying them.
+
+The wire/disk format doesn't change: dict(tree.iteritems()) is the usual json object.
+See benchmarks/bench_server_memory.py for the bytes per file and per share.
+"""
+
+import struct
+import bisect
+import binascii
+from collections import MutableMapping
+
+
+SEP = '/'
+
+# A record is <timestamp><raw md5> packed in a single str
+_RECORD = struct.Struct('!q16s')
+_MIN_TIMESTAMP, _MAX_TIMESTAMP = -2 ** 63, 2 ** 63 - 1
+
+# Directory names shared by all trees (i.e. 'Music', 'Photos', 'src'...)
+_interned_names = {}
+
+
+def _compact_name(name):
+    """
+    Return the ascii <name> as str, that is equal to (and has the same hash of) the unicode one;
+    any other name is returned as it is.
+    """
+    try:
+        return name.encode('ascii')
+    except UnicodeError:
+        return name
+
+
+def _intern(name):
+    name = _compact_name(name)
+    return _interned_names.setdefault(name, name)
+
+
+def pack_md5(md5):
+    """
+    Return the 16 raw bytes of a lowercase md5 hex digest, or None for any other value.
+    """
+    if isinstance(md5, basestring) and len(md5) == 32:
+        try:
+            raw = binascii.unhexlify(md5)
+        except TypeError:
+            return None
+        if binascii.hexlify(raw) == md5:
+            return raw
+    return None
+
+
+def pack_record(timestamp, md5):
+    """
+    Return the compact form of a (<timestamp>, <md5>) snapshot value: the packed timestamp and raw md5
+    (24 bytes) if the timestamp is an integer and the md5 a digest, the (<timestamp>, <md5>) tuple otherwise.
+    :return: str or tuple
+    """
+    raw_md5 = pack_md5(md5)
+    if raw_md5 is not None and isinstance(timestamp, (int, long)) and not isinstance(timestamp, bool) and \
+            _MIN_TIMESTAMP <= timestamp <= _MAX_TIMESTAMP:
+        return _RECORD.pack(timestamp, raw_md5)
+    return (timestamp, md5)
+
+
+def unpack_record(packed):
+    """
+    Inverse of pack_record.
+    :return: list
+    """
+    if type(packed) is tuple:
+        return list(packed)
+    timestamp, raw_md5 = _RECORD.unpack(packed)
+    return [timestamp, binascii.hexlify(raw_md5)]
+
+
+class FileRecord(object):
+    """
+    The (<timestamp>, <md5>) metadata of a single file. The trees store only its <packed> form:
+    the records they return are built on access, and changing a file means assigning its path again.
+    """
+    __slots__ = ('packed',)
+
+    def __init__(self, timestamp, md5):
+        self.packed = pack_record(timestamp, md5)
+
+    @classmethod
+    def from_packed(cls, packed):
+        record = cls.__new__(cls)
+        record.packed = packed
+        return record
+
+    @property
+    def timestamp(self):
+        return self.as_list()[0]
+
+    @property
+    def md5(self):
+        return self.as_list()[1]
+
+    def as_list(self):
+        """
+        Return the record in the wire format [<timestamp>, '<md5>'].
+        """
+        return unpack_record(self.packed)
+
+
+class _Node(object):
+    """
+    A directory of the tree: <dirs> maps names to sub-nodes, <files> maps names to packed records.
+    <names> caches the sorted names of both (see sorted_names): it is reset when a name is added or removed.
+    """
+    __slots__ = ('dirs', 'files', 'names')
+
+    def __init__(self):
+        self.dirs = {}
+        self.files = {}
+        self.names = None
+
+    def sorted_names(self):
+        if self.names is None:
+            self.names = sorted(set(self.files).union(self.dirs))
+        return self.names
+
+
+class SnapshotTree(MutableMapping):
+    """
+    Mapping {'<path>': [<timestamp>, '<md5>']} backed by a directory trie.
+
+    The records are immutable: a tree where a record has been linked (see link_record) keeps it
+    when the path is assigned again in the source tree, so the views of the shared files are built at read time.
+    """
+    def __init__(self, data=None):
+        self._root = _Node()
+        self._len = 0
+        if data:
+            self.update(data)
+
+    def _find_node(self, dir_names, create=False):
+        node = self._root
+        for name in dir_names:
+            child = node.dirs.get(name)
+            if child is None:
+                if not create:
+                    return None
+                child = node.dirs[_intern(name)] = _Node()
+                node.names = None
+            node = child
+        return node
+
+    def _lookup(self, path):
+        """
+        Return the (node, filename) couple of <path>, or (None, filename) if its directory is missing.
+        """
+        names = path.split(SEP)
+        return self._find_node(names[:-1]), names[-1]
+
+    def get_record(self, path):
+        """
+        Return the FileRecord stored for <path>. Raise KeyError if missing.
+        """
+        node, filename = self._lookup(path)
+        if node is None or filename not in node.files:
+            raise KeyError(path)
+        return FileRecord.from_packed(node.files[filename])
+
+    def link_record(self, path, record):
+        """
+        Store the packed record of the given FileRecord (not a copy of it) for <path>.
+        """
+        self._store(path, record.packed)
+
+    def _store(self, path, packed):
+        names = path.split(SEP)
+        node = self._find_node(names[:-1], create=True)
+        if names[-1] not in node.files:
+            self._len += 1
+            node.names = None
+        node.files[_compact_name(names[-1])] = packed
+
+    def __getitem__(self, path):
+        return self.get_record(path).as_list()
+
+    def __setitem__(self, path, value):
+        timestamp, md5 = value
+        self._store(path, pack_record(timestamp, md5))
+
+    def __delitem__(self, path):
+        names = path.split(SEP)
+        # Keep the visited nodes to prune the directories left empty
+        nodes = [self._root]
+        for name in names[:-1]:
+            node = nodes[-1].dirs.get(name)
+            if node is None:
+                raise KeyError(path)
+            nodes.append(node)
+        try:
+            del nodes[-1].files[names[-1]]
+        except KeyError:
+            raise KeyError(path)
+        nodes[-1].names = None
+        self._len -= 1
+        self._prune(nodes, names)
+
+    @staticmethod
+    def _prune(nodes, names):
+        """
+        Remove the directories left empty along the visited <nodes> of the path <names>.
+        """
+        for depth in xrange(len(nodes) - 1, 0, -1):
+            node = nodes[depth]
+            if node.dirs or node.files:
+                break
+            del nodes[depth - 1].dirs[names[depth - 1]]
+            nodes[depth - 1].names = None
+
+    def _pop_node(self, path):
+        """
+        Detach the node of the directory <path> and return it with the number of its files,
+        or (None, 0) if <path> is not a directory of the tree.
+        """
+        names = path.rstrip(SEP).split(SEP)
+        nodes = [self._root]
+        for name in names[:-1]:
+            node = nodes[-1].dirs.get(name)
+            if node is None:
+                return None, 0
+            nodes.append(node)
+        node = nodes[-1].dirs.pop(names[-1], None)
+        if node is None:
+            return None, 0
+        nodes[-1].names = None
+        count = sum(1 for _ in self._iter_packed(node, ''))
+        self._len -= count
+        self._prune(nodes, names)
+        return node, count
+
+    def remove_subtree(self, path):
+        """
+        Remove all the files under the directory <path>, and return their number.
+        """
+        return self._pop_node(path)[1]
+
+    def move_subtree(self, src, dst):
+        """
+        Move all the files under the directory <src> under the directory <dst> (that must not be in the tree),
+        keeping their records. The directory node is moved as a whole, not file by file.
+        Return the number of moved files.
+        """
+        dst_names = dst.rstrip(SEP).split(SEP)
+        parent = self._find_node(dst_names[:-1])
+        if parent is not None and (dst_names[-1] in parent.files or dst_names[-1] in parent.dirs):
+            raise ValueError('{} is already in the tree'.format(dst))
+        node, count = self._pop_node(src)
+        if node is not None:
+            parent = self._find_node(dst_names[:-1], create=True)
+            parent.dirs[_intern(dst_names[-1])] = node
+            parent.names = None
+            self._len += count
+        return count
+
+    def __contains__(self, path):
+        node, filename = self._lookup(path)
+        return node is not None and filename in node.files
+
+    def _iter_packed(self, node, prefix):
+        for name, packed in node.files.iteritems():
+            yield prefix + name, packed
+        for name, child in node.dirs.iteritems():
+            for item in self._iter_packed(child, ''.join([prefix, name, SEP])):
+                yield item
+
+    def _iter_records(self, node, prefix):
+        from_packed = FileRecord.from_packed
+        for path, packed in self._iter_packed(node, prefix):
+            yield path, from_packed(packed)
+
+    def iterrecords(self):
+        """
+        Yield (<path>, FileRecord) couples.
+        """
+        return self._iter_records(self._root, '')
+
+    def _iter_sorted(self, node, prefix, after):
+        names = node.sorted_names()
+        start = after[0] if after else None
+        # Seek to <after> in the sorted names, instead of visiting the names before it
+        for name in names[bisect.bisect_left(names, start):] if start is not None else names:
+            on_path = name == start
+            # The file <name> comes before the files of the directory <name>, and it is not after <after> if on_path
+            if name in node.files and not on_path:
+                yield prefix + name, FileRecord.from_packed(node.files[name])
+            child = node.dirs.get(name)
+            if child is not None:
+                for item in self._iter_sorted(child, ''.join([prefix, name, SEP]), after[1:] if on_path else None):
+                    yield item
+
+    def iter_sorted(self, after=None, path=''):
+        """
+        Yield the (<path>, FileRecord) couples sorted by the names of the directories and of the file
+        (i.e. 'a/b.txt' comes before 'a.txt'), starting after the path <after> if given, of the file <path>
+        or of the files under the directory <path> (the whole tree if empty).
+        The files are yielded while the tree is visited, and the sorted names of a directory are kept until
+        it changes: a page after <after> costs a binary search in each directory along <after>, then its files.
+        """
+        after_names = after.split(SEP) if after else None
+        path = path.rstrip(SEP)
+        if not path:
+            for item in self._iter_sorted(self._root, '', after_names):
+                yield item
+            return
+        names = path.split(SEP)
+        # <after> is under <path> (or is <path>): the file <path> is not after it
+        inside = after_names is not None and after_names[:len(names)] == names
+        if after_names is not None and not inside and after_names > names:
+            # All the files under <path> come before <after>
+            return
+        parent = self._find_node(names[:-1])
+        if parent is None:
+            return
+        if names[-1] in parent.files and not inside:
+            yield path, FileRecord.from_packed(parent.files[names[-1]])
+        node = parent.dirs.get(names[-1])
+        if node is not None:
+            after_names = (after_names[len(names):] or None) if inside else None
+            for item in self._iter_sorted(node, path + SEP, after_names):
+                yield item
+
+    def iter_subtree(self, path):
+        """
+        Yield the (<path>, FileRecord) couples of the file <path>, or of all the files under the directory <path>.
+        An empty <path> means the whole tree. The cost depends on the size of the subtree only.
+        """
+        path = path.rstrip(SEP)
+        if not path:
+            for item in self.iterrecords():
+                yield item
+            return
+        names = path.split(SEP)
+        parent = self._find_node(names[:-1])
+        if parent is None:
+            return
+        packed = parent.files.get(names[-1])
+        if packed is not None:
+            yield path, FileRecord.from_packed(packed)
+        node = parent.dirs.get(names[-1])
+        if node is not None:
+            for item in self._iter_records(node, path + SEP):
+                yield item
+
+    def has_subtree(self, path):
+        """
+        Return True if <path> is a file or a (non empty) directory of the tree.
+        """
+        for _ in self.iter_subtree(path):
+            return True
+        return False
+
+    def subtree(self, path):
+        """
+        Return a new tree with the records (not copies) of the files under <path>.
+        """
+        tree = self.__class__()
+        for subpath, record in self.iter_subtree(path):
+            tree.link_record(subpath, record)
+        return tree
+
+    def __iter__(self):
+        for path, _ in self._iter_packed(self._root, ''):
+            yield path
+
+    def iteritems(self):
+        for path, packed in self._iter_packed(self._root, ''):
+            yield path, unpack_record(packed)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, dict(self.iteritems()))
+
+    def clear(self):
+        self._root = _Node()
+        self._len = 0
+
+    def copy(self):
+        """
+        Return a new tree with copies of the records.
+        """
+        return self.__class__(self.iteritems())
+
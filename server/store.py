@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+User data store shared by the worker processes of a multi-process server (see prefork.py).
+
+The data of every user is kept in a SQLite database (one json document per user), and every
+write is logged in the <changes> table with the id of the writer process. Each worker keeps its
+own in-memory copy of the users (server.userdata) and, before using a user, reloads it if another
+worker has changed it meanwhile (see server.refresh_userdata).
+
+The read-modify-write of the data of a user must be done holding its (inter-process) lock,
+see locks.InterProcessUserLocks.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+class UserStore(object):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS changes (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL,
+                                            worker INTEGER NOT NULL, timestamp REAL NOT NULL);
+    """
+    # Seconds a writer waits for the database lock
+    TIMEOUT = 30
+
+    def __init__(self, filename, worker_id=None):
+        """
+        :param worker_id: int, the id of the writer in the change log (default: the process id).
+        """
+        self.filename = filename
+        self.worker_id = os.getpid() if worker_id is None else worker_id
+        # One connection per thread: sqlite3 connections can't be shared among threads.
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.filename, timeout=self.TIMEOUT)
+            conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def is_empty(self):
+        return self._connection().execute('SELECT COUNT(*) FROM users').fetchone()[0] == 0
+
+    def load(self, username):
+        """
+        Return the data of <username> (as decoded json), or None if the user does not exist.
+        """
+        row = self._connection().execute('SELECT data FROM users WHERE username = ?', (username,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def usernames(self):
+        return set(row[0] for row in self._connection().execute('SELECT username FROM users'))
+
+    def load_all(self):
+        """
+        Return the {<username>: <data>} dict of all the users.
+        """
+        rows = self._connection().execute('SELECT username, data FROM users')
+        return dict((username, json.loads(data)) for username, data in rows)
+
+    def save(self, username, data_json):
+        """
+        Store the json data of <username>, or remove the user if <data_json> is None, and log the change.
+        """
+        with self._connection() as conn:
+            if data_json is None:
+                conn.execute('DELETE FROM users WHERE username = ?', (username,))
+            else:
+                conn.execute('INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)', (username, data_json))
+            conn.execute('INSERT INTO changes (username, worker, timestamp) VALUES (?, ?, ?)',
+                         (username, self.worker_id, time.time()))
+
+    def last_change(self):
+        """
+        Return the id of the last logged change (0 if none).
+        """
+        return self._connection().execute('SELECT COALESCE(MAX(id), 0) FROM changes').fetchone()[0]
+
+    def changes_since(self, change_id):
+        """
+        Return the id of the last logged change and the set of the users changed by the other workers
+        after the change <change_id>. The set is None if some of those changes have already been pruned
+        (see prune_changes), so the changed users are unknown.
+        :return: (int, set or None)
+        """
+        rows = self._connection().execute('SELECT id, username, worker FROM changes WHERE id > ? ORDER BY id',
+                                          (change_id,)).fetchall()
+        if not rows:
+            return change_id, set()
+        # The ids have no holes, since the writes are serialized.
+        if rows[0][0] != change_id + 1:
+            return rows[-1][0], None
+        return rows[-1][0], set(username for _, username, worker in rows if worker != self.worker_id)
+
+    def prune_changes(self, max_age):
+        """
+        Remove the changes older than <max_age> seconds (but the last one).
+        """
+        with self._connection() as conn:
+            conn.execute('DELETE FROM changes WHERE timestamp < ? AND id < (SELECT MAX(id) FROM changes)',
+                         (time.time() - max_age,))
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
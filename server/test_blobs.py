@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import hashlib
+import tempfile
+import errno
+import unittest
+
+import mock
+
+from blobs import BlobStore, clone_file
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.blobs = BlobStore(os.path.join(self.work_dir, 'blobs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def make_file(self, name, content):
+        filepath = os.path.join(self.work_dir, name)
+        with open(filepath, 'wb') as fp:
+            fp.write(content)
+        return filepath, hashlib.md5(content).hexdigest()
+
+    def test_same_content_stored_once(self):
+        first, md5 = self.make_file('first', 'content')
+        second, _ = self.make_file('second', 'content')
+        self.blobs.add(first, md5)
+        self.blobs.add(second, md5)
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertTrue(os.path.samefile(first, self.blobs.path(md5)))
+        self.assertEqual(self.blobs.stats(), {'blobs': 1, 'bytes': 7, 'links': 2, 'linked_bytes': 14})
+
+    def test_different_content_with_same_md5_not_linked(self):
+        stored, md5 = self.make_file('stored', 'content')
+        self.blobs.add(stored, md5)
+        # An upload that claims the md5 of the stored content (i.e. a collision)
+        for content in ('other!!', 'longer content'):
+            upload, _ = self.make_file('upload', content)
+            self.blobs.add(upload, md5)
+            self.assertFalse(os.path.samefile(upload, self.blobs.path(md5)))
+            self.assertEqual(open(upload).read(), content)
+        self.assertEqual(open(stored).read(), 'content')
+
+    def test_link(self):
+        src, md5 = self.make_file('src', 'content')
+        dst, _ = self.make_file('dst', 'old content')
+        self.blobs.add(src, md5)
+        self.blobs.link(src, dst)
+        self.assertTrue(os.path.samefile(src, dst))
+        self.assertEqual(open(dst).read(), 'content')
+        # No temporary link left
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['blobs', 'dst', 'src'])
+
+    def test_link_too_many_links(self):
+        src, md5 = self.make_file('src', 'content')
+        dst = os.path.join(self.work_dir, 'dst')
+        with mock.patch('os.link', side_effect=OSError(errno.EMLINK, 'Too many links')):
+            self.blobs.link(src, dst)
+        # A clone (or a copy), not a link
+        self.assertFalse(os.path.samefile(src, dst))
+        self.assertEqual(open(dst).read(), 'content')
+
+    def test_clone_file(self):
+        src, _ = self.make_file('src', 'content' * 1000)
+        dst = os.path.join(self.work_dir, 'dst')
+        clone_file(src, dst)
+        self.assertEqual(open(dst).read(), 'content' * 1000)
+        # Writing the clone doesn't change the source
+        with open(dst, 'ab') as fp:
+            fp.write('more')
+        self.assertEqual(open(src).read(), 'content' * 1000)
+
+    def test_clone_missing_file(self):
+        dst = os.path.join(self.work_dir, 'dst')
+        self.assertRaises(IOError, clone_file, os.path.join(self.work_dir, 'missing'), dst)
+        self.assertFalse(os.path.exists(dst))
+
+    def test_collect_garbage(self):
+        used, used_md5 = self.make_file('used', 'used content')
+        unused, unused_md5 = self.make_file('unused', 'unused content')
+        self.blobs.add(used, used_md5)
+        self.blobs.add(unused, unused_md5)
+        os.remove(unused)
+        self.assertEqual(self.blobs.collect_garbage(), (1, len('unused content')))
+        self.assertFalse(os.path.exists(self.blobs.path(unused_md5)))
+        self.assertTrue(os.path.exists(self.blobs.path(used_md5)))
+
+    def test_add_after_collect(self):
+        filepath, md5 = self.make_file('file', 'content')
+        self.blobs.add(filepath, md5)
+        os.remove(filepath)
+        self.blobs.collect_garbage()
+        filepath, md5 = self.make_file('file', 'content')
+        self.blobs.add(filepath, md5)
+        self.assertTrue(os.path.samefile(filepath, self.blobs.path(md5)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+import StringIO
+
+from chunks import ChunkStore
+
+USR = 'user@mail.com'
+
+
+class TestChunkStore(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.chunks = ChunkStore(os.path.join(self.work_dir, 'chunks'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def add(self, data, username=USR):
+        md5 = hashlib.md5(data).hexdigest()
+        self.chunks.add(username, md5, data)
+        return md5
+
+    def test_add_and_assemble(self):
+        md5s = [self.add('first '), self.add('second ')]
+        self.assertTrue(self.chunks.has(USR, md5s[0]))
+        self.assertFalse(self.chunks.has(USR, hashlib.md5('missing').hexdigest()))
+        # The same chunk again
+        self.add('first ')
+
+        fp = StringIO.StringIO()
+        md5 = self.chunks.assemble(USR, md5s + md5s[:1], fp)
+        self.assertEqual(fp.getvalue(), 'first second first ')
+        self.assertEqual(md5, hashlib.md5('first second first ').hexdigest())
+        self.assertEqual(os.listdir(os.path.dirname(self.chunks.path(USR, md5s[0]))), [md5s[0]])
+
+    def test_assemble_missing_chunk(self):
+        self.assertRaises(KeyError, self.chunks.assemble, USR,
+                          [self.add('chunk'), hashlib.md5('missing').hexdigest()], StringIO.StringIO())
+
+    def test_chunks_of_other_users_not_used(self):
+        md5 = self.add('chunk', u'other@mail.com')
+        self.assertFalse(self.chunks.has(USR, md5))
+        self.assertRaises(KeyError, self.chunks.assemble, USR, [md5], StringIO.StringIO())
+        self.assertTrue(self.chunks.has(u'other@mail.com', md5))
+
+    def test_collect_garbage(self):
+        old, used, new = self.add('old'), self.add('used'), self.add('new')
+        past = time.time() - 3600
+        for md5 in (old, used):
+            os.utime(self.chunks.path(USR, md5), (past, past))
+        # A chunk found by a client is kept
+        self.chunks.has(USR, used)
+        self.assertEqual(self.chunks.collect_garbage(60), (1, 3))
+        self.assertFalse(self.chunks.has(USR, old))
+        self.assertTrue(self.chunks.has(USR, used))
+        self.assertTrue(self.chunks.has(USR, new))
+
+
+if __name__ == '__main__':
+    unittest.main()
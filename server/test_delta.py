@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import unittest
+import StringIO
+
+import delta
+
+
+def make_delta(old, new):
+    signature = delta.signature(StringIO.StringIO(old), len(old))
+    return ''.join(delta.delta(StringIO.StringIO(new), delta.parse_signature(signature)))
+
+
+def apply_delta(old, delta_data):
+    out = StringIO.StringIO()
+    md5 = delta.patch(StringIO.StringIO(old), StringIO.StringIO(delta_data), out)
+    return out.getvalue(), md5
+
+
+class TestDelta(unittest.TestCase):
+    OLD = os.urandom(2 ** 20 + 123)
+
+    def check(self, old, new):
+        """
+        Check that the delta rebuilds <new> from <old>, and return its size.
+        """
+        delta_data = make_delta(old, new)
+        self.assertEqual(apply_delta(old, delta_data), (new, hashlib.md5(new).hexdigest()))
+        return len(delta_data)
+
+    def test_same_file(self):
+        self.assertLess(self.check(self.OLD, self.OLD), 20)
+
+    def test_changed_bytes(self):
+        new = self.OLD[:1000] + 'changed' + self.OLD[1007:]
+        self.assertLess(self.check(self.OLD, new), delta.block_size(len(self.OLD)) + 50)
+
+    def test_inserted_and_removed_bytes(self):
+        """
+        The blocks after an insertion or a removal are found at their new offsets, rolling the weak checksum.
+        """
+        size = delta.block_size(len(self.OLD))
+        new = self.OLD[:5000] + 'inserted' + self.OLD[5000:2 ** 19] + self.OLD[2 ** 19 + 333:]
+        self.assertLess(self.check(self.OLD, new), 3 * size)
+
+    def test_appended_and_truncated(self):
+        size = delta.block_size(len(self.OLD))
+        self.assertLess(self.check(self.OLD, self.OLD + 'appended'), size)
+        self.assertLess(self.check(self.OLD, self.OLD[:-10]), 2 * size)
+
+    def test_small_and_empty_files(self):
+        for old, new in [('', 'new'), ('old', ''), ('', ''), ('a' * 5000, 'a' * 5001), ('ab' * 3000, 'ba' * 3000)]:
+            self.check(old, new)
+        self.assertEqual(self.check(self.OLD, os.urandom(3000)), 3000 + 4 + 5)
+
+    def test_malformed_signature(self):
+        signature = delta.signature(StringIO.StringIO(self.OLD), len(self.OLD))
+        self.assertRaises(ValueError, delta.parse_signature, signature[:-1])
+        self.assertRaises(ValueError, delta.parse_signature, 'bad')
+
+    def test_malformed_delta(self):
+        delta_data = make_delta(self.OLD, self.OLD[:-10])
+        self.assertRaises(ValueError, apply_delta, self.OLD, delta_data[:-1])
+        self.assertRaises(ValueError, apply_delta, self.OLD, delta_data + 'X')
+
+    def test_same_as_client_copy(self):
+        """
+        The client has a copy of this module (the client and the server are installed separately):
+        they must not differ.
+        """
+        here = os.path.dirname(os.path.abspath(__file__))
+        client_copy = os.path.join(here, os.pardir, 'client', 'delta.py')
+        if not os.path.exists(client_copy):
+            raise unittest.SkipTest('client not found')
+        with open(os.path.join(here, 'delta.py'), 'rb') as server_module:
+            with open(client_copy, 'rb') as client_module:
+                self.assertEqual(server_module.read(), client_module.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
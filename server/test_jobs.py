@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from jobs import JobQueue
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = JobQueue(max_attempts=3, retry_delay=10)
+        self.calls = []
+        self.queue.register('record', lambda *args: self.calls.append(args))
+        self.work_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.work_dir, 'jobs.json')
+
+    def tearDown(self):
+        self.queue.stop()
+        shutil.rmtree(self.work_dir)
+
+    def failing_job(self):
+        self.calls.append('failure')
+        raise IOError('job failed')
+
+    def test_run_pending(self):
+        self.queue.enqueue('record', ('a', 1))
+        self.queue.enqueue('record', ('b', 2), delay=60)
+        self.assertEqual(self.queue.run_pending(), 1)
+        self.assertEqual(self.calls, [('a', 1)])
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.run_pending(now=time.time() + 60), 1)
+        self.assertEqual(self.calls, [('a', 1), ('b', 2)])
+
+    def test_unknown_job(self):
+        self.assertRaises(KeyError, self.queue.enqueue, 'unknown')
+
+    def test_retry_with_backoff(self):
+        self.queue.register('fail', self.failing_job)
+        self.queue.enqueue('fail')
+        now = time.time()
+        self.queue.run_pending(now)
+        # Retried after 10 seconds, then after 20 seconds, then dropped
+        self.assertEqual(self.queue.run_pending(now + 9), 0)
+        self.assertEqual(self.queue.run_pending(now + 10), 1)
+        self.assertEqual(self.queue.run_pending(now + 10 + 19), 0)
+        self.assertEqual(self.queue.run_pending(now + 10 + 20), 1)
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.calls, ['failure'] * 3)
+
+    def test_persistence(self):
+        self.queue.open(self.filename)
+        self.queue.enqueue('record', ('saved',))
+
+        new_queue = JobQueue()
+        new_queue.register('record', lambda *args: self.calls.append(args))
+        new_queue.open(self.filename)
+        self.assertEqual(len(new_queue), 1)
+        new_queue.run_pending()
+        self.assertEqual(self.calls, [('saved',)])
+
+        # The done jobs are removed from the file too
+        new_queue = JobQueue()
+        new_queue.open(self.filename)
+        self.assertEqual(len(new_queue), 0)
+
+    def test_periodic_job(self):
+        self.queue.register('fail', self.failing_job)
+        self.queue.schedule('fail', interval=60)
+        now = time.time()
+        self.assertEqual(self.queue.run_pending(now), 1)
+        # A failed periodic job is not retried before its next run
+        self.assertEqual(self.queue.run_pending(now + 59), 0)
+        self.assertEqual(self.queue.run_pending(now + 60), 1)
+        self.assertEqual(len(self.queue), 0)
+
+    def test_runner_thread(self):
+        done = threading.Event()
+        self.queue.register('done', done.set)
+        self.queue.start()
+        self.queue.enqueue('done')
+        self.assertTrue(done.wait(5))
+
+
+if __name__ == '__main__':
+    unittest.main()
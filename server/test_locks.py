@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from locks import UserLocks, InterProcessUserLocks
+
+
+class TestUserLocks(unittest.TestCase):
+    def setUp(self):
+        self.locks = UserLocks()
+
+    def test_same_lock_per_user(self):
+        self.assertIs(self.locks.get('user'), self.locks.get('user'))
+        self.assertIsNot(self.locks.get('user'), self.locks.get('other'))
+
+    def test_reentrant(self):
+        with self.locks.lock('a', 'b'):
+            with self.locks.lock('a'):
+                pass
+
+    def test_lock_excludes_other_threads(self):
+        acquired = []
+
+        def try_lock():
+            lock = self.locks.get('b')
+            acquired.append(lock.acquire(False))
+            if acquired[-1]:
+                lock.release()
+
+        with self.locks.lock('a', 'b'):
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+        self.assertEqual(acquired, [False])
+
+    def test_no_deadlock_with_overlapping_groups(self):
+        """
+        Two threads locking the same users given in opposite order must not deadlock.
+        """
+        def lock_many_times(*usernames):
+            for _ in xrange(2000):
+                with self.locks.lock(*usernames):
+                    pass
+
+        threads = [threading.Thread(target=lock_many_times, args=('a', 'b', 'c')),
+                   threading.Thread(target=lock_many_times, args=('c', 'b', 'a'))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+
+    def test_lock_group(self):
+        related = {'owner': ['a', 'b']}
+        with self.locks.lock_group('owner', lambda username: related[username]) as group:
+            self.assertEqual(group, set(['owner', 'a', 'b']))
+
+    def test_lock_group_retries_when_related_users_change(self):
+        """
+        If the related users change before their locks are acquired, they must be read again.
+        """
+        results = iter([['a'], ['a', 'b'], ['a', 'b'], ['a', 'b']])
+        with self.locks.lock_group('owner', lambda username: next(results)) as group:
+            self.assertEqual(group, set(['owner', 'a', 'b']))
+
+    def test_on_acquire(self):
+        acquired = []
+        self.locks.on_acquire = lambda *usernames: acquired.append(usernames)
+        with self.locks.lock('a', 'b'):
+            self.assertEqual(acquired, [('a', 'b')])
+
+
+class TestInterProcessUserLocks(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.work_dir, 'userdata.locks')
+        self.locks = InterProcessUserLocks(self.filename, stripes=16)
+
+    def tearDown(self):
+        self.locks.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_users_on_the_same_stripe(self):
+        self.assertIs(self.locks.get(u'user'), self.locks.get('user'))
+        self.assertEqual(len(set(self.locks.get('user{}'.format(i)) for i in range(100))), 16)
+
+    def _try_lock_in_child(self, username):
+        """
+        Try to acquire the lock of <username> in a child process and return True on success.
+        """
+        pid = os.fork()
+        if pid == 0:
+            child_locks = InterProcessUserLocks(self.filename, stripes=16)
+            acquired = child_locks.get(username).acquire(False)
+            os._exit(0 if acquired else 1)
+        return os.waitpid(pid, 0)[1] == 0
+
+    def test_lock_excludes_other_processes(self):
+        with self.locks.lock('a'):
+            with self.locks.lock('a'):
+                pass
+            self.assertFalse(self._try_lock_in_child('a'))
+        self.assertTrue(self._try_lock_in_child('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
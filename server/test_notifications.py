@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+
+from notifications import ChangeNotifier, sse_event
+
+
+class TestChangeNotifier(unittest.TestCase):
+    def setUp(self):
+        self.notifier = ChangeNotifier()
+
+    def test_notify(self):
+        self.assertEqual(self.notifier.version('user'), 0)
+        version = self.notifier.notify('user', 'other')
+        self.assertEqual(self.notifier.version('user'), version)
+        self.assertEqual(self.notifier.version('other'), version)
+        # The versions always grow, even in the same instant
+        self.assertGreater(self.notifier.notify('user'), version)
+
+    def test_subscribe(self):
+        versions = []
+        listener = lambda version: versions.append(version)
+        self.notifier.subscribe('user', listener)
+        version = self.notifier.notify('user')
+        self.notifier.unsubscribe('user', listener)
+        self.notifier.notify('user')
+        self.assertEqual(versions, [version])
+        self.assertEqual(self.notifier.listeners(), 0)
+
+    def test_sse_event(self):
+        event = sse_event(1234)
+        self.assertTrue(event.startswith('event: change\n'))
+        self.assertTrue(event.endswith('\n\n'))
+        self.assertEqual(json.loads(event.splitlines()[1][len('data: '):]), {'version': 1234})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,7 @@ Every TestCase class should use the <TEST_DIR> directory. To do it, just call 's
 """
 import unittest
 import os
+import sys
 import base64
 import shutil
 import urlparse
@@ -17,9 +18,20 @@ import hashlib
 import tempfile
 import random
 import string
+import socket
+import smtpd
+import asyncore
+import threading
+import time
+import StringIO
+import tarfile
+import errno
+import zlib
 import mock
 
 import server
+import delta
+import snapshot_codec
 from server import userpath2serverpath
 
 HTTP_OK = 200
@@ -146,7 +158,6 @@ def _manually_create_user(username, pw):
     single_user_data[server.USER_CREATION_TIME] = server.now_timestamp()
     single_user_data['shared_with_me'] = {}
     single_user_data['shared_with_others'] = {}
-    single_user_data['shared_files'] = {}
     server.userdata[username] = single_user_data
     return single_user_data
 
@@ -166,6 +177,27 @@ def _manually_remove_user(username):  # TODO: make this from server module?
         logging.debug('"%s" user directory removed' % user_dirpath)
 
 
+class RecordingSMTPServer(smtpd.SMTPServer):
+    """
+    Local smtp server, running in a thread, that keeps the received (mailfrom, rcpttos, data) messages.
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('localhost', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self._thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05, 'use_poll': True})
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.close()
+        self._thread.join()
+
+
 def setup_test_dir():
     """
     Create (if needed) <TEST_DIR> directory starting from current directory and change current directory to the new one.
@@ -302,6 +334,21 @@ class TestRequests(unittest.TestCase):
         # check that uploaded path NOT exists in username files dict
         self.assertNotIn(user_filepath, server.userdata[USR][server.SNAPSHOT])
 
+    def test_files_post_in_parent_directory(self):
+        """
+        Test that a file can't be created in the file root, just upper than the user root.
+        """
+        user_filepath = '../myfile2.dat'  # path forbidden
+        test_file, test_md5 = _make_temp_file()
+        try:
+            test = self.app.post(SERVER_FILES_API + user_filepath,
+                                 headers=make_basicauth_headers(USR, PW),
+                                 data={'file': test_file, 'md5': test_md5})
+        finally:
+            test_file.close()
+        self.assertEqual(test.status_code, server.HTTP_FORBIDDEN)
+        self.assertFalse(os.path.isfile(userpath2serverpath(USR, user_filepath)))
+
     def test_files_post_with_existent_path(self):
         """
         Test the creation of file that already exists.
@@ -733,7 +780,7 @@ class TestGetRequests(unittest.TestCase):
 
         expected_timestamp = server.userdata[USR]['server_timestamp']
         expected_snapshot = server.userdata[USR]['files']
-        expected_shared_files = server.userdata[USR]['shared_files']
+        expected_shared_files = {}
         target = {server.LAST_SERVER_TIMESTAMP: expected_timestamp,
                   server.SNAPSHOT: expected_snapshot,
                   server.SHARED_FILES: expected_shared_files}
@@ -743,11 +790,30 @@ class TestGetRequests(unittest.TestCase):
         obj = json.loads(test.data)
         self.assertEqual(obj, target)
 
+    def test_files_get_subtree_snapshot(self):
+        """
+        Test the listing of the files under a directory.
+        """
+        _create_file(USR, 'testdownload/subdir/other.txt', 'other text')
+        test = self.app.get(SERVER_FILES_API + '?subtree=testdownload',
+                            headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        obj = json.loads(test.data)
+        self.assertEqual(sorted(obj[server.SNAPSHOT]),
+                         ['testdownload/subdir/other.txt', self.USER_RELATIVE_DOWNLOAD_FILEPATH])
+        self.assertEqual(obj[server.LAST_SERVER_TIMESTAMP], server.userdata[USR][server.LAST_SERVER_TIMESTAMP])
+
+    def test_files_get_subtree_snapshot_with_tricky_path(self):
+        test = self.app.get(SERVER_FILES_API + '?subtree=../../',
+                            headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, server.HTTP_FORBIDDEN)
+
 
 class TestUsersPost(unittest.TestCase):
     def setUp(self):
         setup_test_dir()
         server.reset_userdata()
+        server.job_queue.clear()
 
         self.app = server.app.test_client()
         self.app.testing = True
@@ -805,6 +871,7 @@ class TestUsersPost(unittest.TestCase):
             test = self.app.post(urlparse.urljoin(SERVER_API,
                                                   'users/' + self.username),
                                  data={'password': self.password})
+            server.job_queue.run_pending()
         # No mail must be sent if this user already exists!
         self.assertEqual(len(outbox), 0)
 
@@ -817,6 +884,9 @@ class TestUsersPost(unittest.TestCase):
         with server.mail.record_messages() as outbox:
             self.app.post(urlparse.urljoin(SERVER_API, 'users/' + self.username),
                           data={'password': self.password})
+            # The email is sent in background
+            self.assertEqual(len(outbox), 0)
+            server.job_queue.run_pending()
         # Retrieve the generated activation code
         activation_code = server.userdata[self.username][server.USER_CREATION_DATA]['activation_code']
 
@@ -826,6 +896,46 @@ class TestUsersPost(unittest.TestCase):
         self.assertEqual(recipients, [self.username])
         self.assertIn(activation_code, body.splitlines())
 
+    def test_activation_email_retry(self):
+        """
+        The activation email must be sent again later if the smtp server is not reachable.
+        """
+        self.app.post(urlparse.urljoin(SERVER_API, 'users/' + self.username),
+                      data={'password': self.password})
+        with mock.patch('server.mail.send', side_effect=socket.error('Connection refused')):
+            server.job_queue.run_pending()
+        self.assertEqual(len(server.job_queue), 1)
+
+        with server.mail.record_messages() as outbox:
+            # Not yet...
+            server.job_queue.run_pending()
+            self.assertEqual(len(outbox), 0)
+            server.job_queue.run_pending(now=time.time() + server.job_queue.retry_delay)
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(len(server.job_queue), 0)
+
+    def test_activation_email_delivery(self):
+        """
+        Send the activation email to a local debugging smtp server.
+        """
+        smtp_server = RecordingSMTPServer()
+        smtp_server.start()
+        with mock.patch.dict(server.app.config, {'MAIL_SERVER': 'localhost', 'MAIL_PORT': smtp_server.port,
+                                                 'MAIL_USERNAME': None, 'MAIL_PASSWORD': None,
+                                                 'MAIL_SUPPRESS_SEND': False}):
+            # The new Mail instance replaces the app mail extension until the end of the test
+            with mock.patch.dict(server.app.extensions), mock.patch('server.mail', server.Mail(server.app)):
+                self.app.post(urlparse.urljoin(SERVER_API, 'users/' + self.username),
+                              data={'password': self.password})
+                server.job_queue.run_pending()
+        smtp_server.stop()
+        activation_code = server.userdata[self.username][server.USER_CREATION_DATA]['activation_code']
+
+        self.assertEqual(len(smtp_server.messages), 1)
+        mailfrom, rcpttos, data = smtp_server.messages[0]
+        self.assertEqual(rcpttos, [self.username])
+        self.assertIn(activation_code, data)
+
     def test_create_user_without_password(self):
         """
         Test the creation of a new user without password.
@@ -916,6 +1026,35 @@ class TestUsersPut(unittest.TestCase):
         server.Users._clean_inactive_users()
         self.assertNotIn(EXPUSER, server.userdata)
 
+    def test_activation_of_expired_user(self):
+        """
+        An expired pending user can't be activated even if the periodic cleanup has not removed it yet.
+        """
+        server.userdata[USR] = {server.USER_IS_ACTIVE: False,
+                                server.PWD: server._encrypt_password(PW),
+                                server.USER_CREATION_DATA: {
+                                    server.USER_CREATION_TIME: server.now_timestamp() -
+                                    server.USER_ACTIVATION_TIMEOUT - 1,
+                                    'activation_code': 'code'}}
+        test = self.app.put(SERVER_API + 'users/{}'.format(USR), data={'activation_code': 'code'})
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+        self.assertNotIn(USR, server.userdata)
+
+    def test_sweep_expired_data(self):
+        """
+        The periodic job must remove the expired pending users and password recovery codes.
+        """
+        expired_time = server.now_timestamp() - server.USER_ACTIVATION_TIMEOUT - 1
+        server.userdata['expireduser'] = {server.USER_IS_ACTIVE: False,
+                                          server.USER_CREATION_DATA: {server.USER_CREATION_TIME: expired_time}}
+        _manually_create_user(USR, PW)
+        server.userdata[USR]['recoverpass_data'] = {'recoverpass_code': 'code',
+                                                    'timestamp': server.now_timestamp() -
+                                                    server.USER_RECOVERPASS_TIMEOUT}
+        server.sweep_expired_data()
+        self.assertNotIn('expireduser', server.userdata)
+        self.assertNotIn('recoverpass_data', server.userdata[USR])
+
 
 class TestUsersDelete(unittest.TestCase):
     def setUp(self):
@@ -955,6 +1094,96 @@ class TestUsersDelete(unittest.TestCase):
         self.assertFalse(os.path.exists(user_dirpath))
 
 
+class TestTokens(unittest.TestCase):
+    TOKENS_URL = SERVER_API + 'tokens'
+
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        server.credentials_cache.clear()
+
+        self.app = server.app.test_client()
+        self.app.testing = True
+        _manually_create_user(USR, PW)
+
+    def tearDown(self):
+        _manually_remove_user(USR)
+        tear_down_test_dir()
+
+    def _get_token(self, username=USR, password=PW):
+        test = self.app.post(self.TOKENS_URL, headers=make_basicauth_headers(username, password))
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        return json.loads(test.data)['token']
+
+    def test_get_token(self):
+        test = self.app.post(self.TOKENS_URL, headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        self.assertEqual(json.loads(test.data)['expires_in'], server.SESSION_TOKEN_MAX_AGE)
+
+    def test_get_token_with_wrong_password(self):
+        test = self.app.post(self.TOKENS_URL, headers=make_basicauth_headers(USR, PW + 'a'))
+        self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+
+    def test_token_as_password(self):
+        """
+        A request authenticated with the session token must not verify the password hash.
+        """
+        token = self._get_token()
+        server.credentials_cache.clear()
+        with mock.patch('server.sha256_crypt.verify') as mock_verify:
+            test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, token))
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertFalse(mock_verify.called)
+
+    def test_token_of_other_user(self):
+        other_user, other_pw = 'other@mail.com', 'Other_85'
+        _manually_create_user(other_user, other_pw)
+        token = self._get_token(other_user, other_pw)
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, token))
+        self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+
+    def test_forged_token(self):
+        token = self._get_token()
+        payload, signature = token.rsplit('.', 1)
+        forged_token = '.'.join([payload, signature[::-1]])
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, forged_token))
+        self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+
+    def test_expired_token(self):
+        token = self._get_token()
+        server.credentials_cache.clear()
+        with mock.patch('server.SESSION_TOKEN_MAX_AGE', -1):
+            test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, token))
+        self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+
+    def test_token_refused_after_password_change(self):
+        token = self._get_token()
+        server.userdata[USR]['recoverpass_data'] = {
+            'recoverpass_code': 'ok_code',
+            'timestamp': server.now_timestamp(),
+        }
+        test = self.app.put(SERVER_API + 'users/{}'.format(USR),
+                            data={'recoverpass_code': 'ok_code', 'password': 'New.Password_85'})
+        self.assertEqual(test.status_code, HTTP_OK)
+
+        for old_password in (token, PW):
+            test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, old_password))
+            self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, 'New.Password_85'))
+        self.assertEqual(test.status_code, HTTP_OK)
+
+    def test_verified_credentials_are_cached(self):
+        """
+        The password hash must be verified only once for the same credentials.
+        """
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, HTTP_OK)
+        with mock.patch('server.sha256_crypt.verify') as mock_verify:
+            test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertFalse(mock_verify.called)
+
+
 class TestUsersGet(unittest.TestCase):
     def setUp(self):
         setup_test_dir()
@@ -987,6 +1216,7 @@ class TestUsersRecoverPassword(unittest.TestCase):
     def setUp(self):
         setup_test_dir()
         server.reset_userdata()
+        server.job_queue.clear()
         self.app = server.app.test_client()
         self.app.testing = True
 
@@ -1095,6 +1325,7 @@ class TestUsersRecoverPassword(unittest.TestCase):
         """
         with server.mail.record_messages() as outbox:
             self.app.post(urlparse.urljoin(SERVER_API, 'users/{}/reset'.format(self.active_user)))
+            server.job_queue.run_pending()
         # Retrieve the generated activation code
         recoverpass_data = server.userdata[self.active_user]['recoverpass_data']
         recoverpass_code = recoverpass_data['recoverpass_code']
@@ -1422,14 +1653,14 @@ class TestShares(unittest.TestCase):
         q = urlparse.urljoin(SERVER_SHARES_API, 'Music/' + SHAREUSR)
         share = self.app.post(q, headers=make_basicauth_headers(USR, PW))
 
-        #self.assertIn('shared/user@mail.com/Music/Music.txt', server.userdata[SHAREUSR]['shared_files'])
+        #self.assertIn('shared/user@mail.com/Music/Music.txt', server.shared_view(SHAREUSR))
 
         test = self.app.post(delete_test_url,
                              headers=make_basicauth_headers(USR, PW),
                              data={'filepath': delete_test_file_path}, follow_redirects=True)
         #Check that there is no file and no folder, as it is empty shared.
         #self.assertNotIn('Music', server.userdata[SHAREUSR]['shared_with_me'][USR])
-        self.assertNotIn('shared/user@mail.com/Music/Music.txt', server.userdata[SHAREUSR]['shared_files'])
+        self.assertNotIn('shared/user@mail.com/Music/Music.txt', server.shared_view(SHAREUSR))
 
 
     def test_copy_file_to_shared_folder(self):
@@ -1448,7 +1679,29 @@ class TestShares(unittest.TestCase):
                              headers=make_basicauth_headers(USR, PW),
                              data={'src': src_copy_test_file_path, 'dst': dst_copy_test_file_path},
                              follow_redirects=True)
-        self.assertIn('shared/user@mail.com/Work/MiscCopy.txt', server.userdata[SHAREUSR]['shared_files'])
+        self.assertIn('shared/user@mail.com/Work/MiscCopy.txt', server.shared_view(SHAREUSR))
+
+    def test_shared_view_follows_owner_changes(self):
+        """
+        Test that the recipient's shared files are computed from the owner's snapshot,
+        without storing anything in the recipient's data.
+        """
+        q = urlparse.urljoin(SERVER_SHARES_API, 'Music/' + SHAREUSR)
+        self.app.post(q, headers=make_basicauth_headers(USR, PW))
+        recipient_data = json.dumps(server.userdata[SHAREUSR], cls=server.SnapshotJSONEncoder)
+
+        upload_file, md5 = _make_temp_file()
+        self.app.post(SERVER_FILES_API + 'Music/new_song.txt',
+                      headers=make_basicauth_headers(USR, PW),
+                      data={'file': (upload_file, 'new_song.txt'), 'md5': md5})
+        self.assertEqual(json.dumps(server.userdata[SHAREUSR], cls=server.SnapshotJSONEncoder), recipient_data)
+
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(SHAREUSR, SHAREUSRPW))
+        shared_files = json.loads(test.data)[server.SHARED_FILES]
+        self.assertEqual(shared_files['shared/user@mail.com/Music/new_song.txt'],
+                         server.userdata[USR][server.SNAPSHOT]['Music/new_song.txt'])
+        self.assertIn('shared/user@mail.com/Music/Music.txt', shared_files)
+        self.assertNotIn('shared/user@mail.com/Work/Work.txt', shared_files)
 
     def test_move_file_to_shared_folder(self):
         """
@@ -1466,7 +1719,978 @@ class TestShares(unittest.TestCase):
                              headers=make_basicauth_headers(USR, PW),
                              data={'src': src_copy_test_file_path, 'dst': dst_copy_test_file_path},
                              follow_redirects=True)
-        self.assertIn('shared/user@mail.com/Work/MiscCopy.txt', server.userdata[SHAREUSR]['shared_files'])
+        self.assertIn('shared/user@mail.com/Work/MiscCopy.txt', server.shared_view(SHAREUSR))
         
+class TwoUsersTestCase(unittest.TestCase):
+    """
+    Base of the tests with two users uploading files.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        _manually_create_user(USR, PW)
+        _manually_create_user(SHAREUSR, SHAREUSRPW)
+
+    def tearDown(self):
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def upload(self, username, password, path, content, method='post'):
+        test = getattr(self.app, method)(SERVER_FILES_API + path, headers=make_basicauth_headers(username, password),
+                                         data={'file': (StringIO.StringIO(content), 'file.txt'),
+                                               'md5': hashlib.md5(content).hexdigest()})
+        self.assertEqual(test.status_code, server.HTTP_CREATED)
+
+
+class TestBlobStorage(TwoUsersTestCase):
+    """
+    The files with the same content share it on disk (see blobs.py).
+    """
+    def test_same_content_of_different_users(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        self.upload(SHAREUSR, SHAREUSRPW, 'Misc/song.mp3', 'the song')
+        self.assertTrue(os.path.samefile(userpath2serverpath(USR, 'Music/song.mp3'),
+                                         userpath2serverpath(SHAREUSR, 'Misc/song.mp3')))
+        self.assertEqual(server.blob_store.stats()['blobs'], 1)
+
+    def test_upload_keeps_the_times_of_the_shared_content(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        filepath = userpath2serverpath(USR, 'Music/song.mp3')
+        os.utime(filepath, (1000, 1000))
+        self.upload(SHAREUSR, SHAREUSRPW, 'Misc/song.mp3', 'the song')
+        self.assertTrue(os.path.samefile(filepath, userpath2serverpath(SHAREUSR, 'Misc/song.mp3')))
+        self.assertEqual(os.path.getmtime(filepath), 1000)
+        # The file timestamp is the upload time anyway
+        self.assertGreater(server.userdata[SHAREUSR][server.SNAPSHOT]['Misc/song.mp3'][0], 1000 * 10000)
+
+    def test_copy_shares_the_content(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        test = self.app.post(SERVER_ACTIONS_API + 'copy', headers=make_basicauth_headers(USR, PW),
+                             data={'src': 'Music/song.mp3', 'dst': 'Work/song.mp3'})
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertTrue(os.path.samefile(userpath2serverpath(USR, 'Music/song.mp3'),
+                                         userpath2serverpath(USR, 'Work/song.mp3')))
+
+    def test_modify_does_not_change_the_other_files(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        self.upload(SHAREUSR, SHAREUSRPW, 'Misc/song.mp3', 'the song')
+        self.upload(USR, PW, 'Music/song.mp3', 'the song, remixed', method='put')
+        self.assertEqual(open(userpath2serverpath(USR, 'Music/song.mp3')).read(), 'the song, remixed')
+        self.assertEqual(open(userpath2serverpath(SHAREUSR, 'Misc/song.mp3')).read(), 'the song')
+
+    def test_unused_content_collected(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        self.upload(SHAREUSR, SHAREUSRPW, 'Misc/song.mp3', 'the song')
+        blob = server.blob_store.path(hashlib.md5('the song').hexdigest())
+        for username, password, path in ((USR, PW, 'Music/song.mp3'), (SHAREUSR, SHAREUSRPW, 'Misc/song.mp3')):
+            server.collect_blobs()
+            self.assertTrue(os.path.exists(blob))
+            test = self.app.post(SERVER_ACTIONS_API + 'delete', headers=make_basicauth_headers(username, password),
+                                 data={'filepath': path})
+            self.assertEqual(test.status_code, HTTP_OK)
+        server.collect_blobs()
+        self.assertFalse(os.path.exists(blob))
+
+
+class TestPreflight(TwoUsersTestCase):
+    PREFLIGHT_URL = SERVER_API + 'preflight'
+
+    def preflight(self, username, password, files):
+        test = self.app.post(self.PREFLIGHT_URL, headers=make_basicauth_headers(username, password),
+                             data={'files': json.dumps(files)})
+        self.assertEqual(test.status_code, HTTP_OK)
+        return json.loads(test.data)
+
+    def test_known_content_not_uploaded(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        files = [['Misc/song.mp3', hashlib.md5('the song').hexdigest(), len('the song')],
+                 ['Misc/new.mp3', hashlib.md5('a new song').hexdigest(), len('a new song')]]
+        result = self.preflight(USR, PW, files)
+
+        self.assertEqual(result['needed'], ['Misc/new.mp3'])
+        self.assertEqual(result['materialized'].keys(), ['Misc/song.mp3'])
+        self.assertEqual(server.userdata[USR][server.SNAPSHOT]['Misc/song.mp3'],
+                         [result['materialized']['Misc/song.mp3'], files[0][1]])
+        self.assertEqual(result[server.LAST_SERVER_TIMESTAMP], result['materialized']['Misc/song.mp3'])
+        self.assertTrue(os.path.samefile(userpath2serverpath(USR, 'Music/song.mp3'),
+                                         userpath2serverpath(USR, 'Misc/song.mp3')))
+
+    def test_content_of_other_users_not_exposed(self):
+        """
+        Knowing the md5 and the size of a content of another user must not give it.
+        """
+        self.upload(SHAREUSR, SHAREUSRPW, 'Work/secret.txt', 'secret')
+        result = self.preflight(USR, PW, [['Work/stolen.txt', hashlib.md5('secret').hexdigest(), len('secret')]])
+        self.assertEqual(result['needed'], ['Work/stolen.txt'])
+        self.assertFalse(os.path.exists(userpath2serverpath(USR, 'Work/stolen.txt')))
+
+    def test_shared_content_not_uploaded(self):
+        self.upload(SHAREUSR, SHAREUSRPW, 'Music/song.mp3', 'the song')
+        test = self.app.post(urlparse.urljoin(SERVER_SHARES_API, 'Music/' + USR),
+                             headers=make_basicauth_headers(SHAREUSR, SHAREUSRPW))
+        self.assertEqual(test.status_code, HTTP_OK)
+        result = self.preflight(USR, PW, [['Work/song.mp3', hashlib.md5('the song').hexdigest(), len('the song')]])
+        self.assertEqual(result['materialized'].keys(), ['Work/song.mp3'])
+
+    def test_known_content_replaces_file(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        self.upload(USR, PW, 'Music/other.mp3', 'another song')
+        result = self.preflight(USR, PW, [['Music/other.mp3', hashlib.md5('the song').hexdigest(), 8]])
+        self.assertEqual(result['needed'], [])
+        self.assertEqual(open(userpath2serverpath(USR, 'Music/other.mp3')).read(), 'the song')
+
+    def test_already_uploaded(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        timestamp, md5 = server.userdata[USR][server.SNAPSHOT]['Music/song.mp3']
+        result = self.preflight(USR, PW, [['Music/song.mp3', md5, 8]])
+        self.assertEqual(result['materialized'], {'Music/song.mp3': timestamp})
+
+    def test_size_mismatch(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        result = self.preflight(USR, PW, [['Work/song.mp3', hashlib.md5('the song').hexdigest(), 9]])
+        self.assertEqual(result['needed'], ['Work/song.mp3'])
+        self.assertFalse(os.path.exists(userpath2serverpath(USR, 'Work/song.mp3')))
+
+    def test_wrong_requests(self):
+        headers = make_basicauth_headers(USR, PW)
+        test = self.app.post(self.PREFLIGHT_URL, headers=headers, data={'files': 'not json'})
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+        test = self.app.post(self.PREFLIGHT_URL, headers=headers,
+                             data={'files': json.dumps([['../../escape.txt', 'md5', 1]])})
+        self.assertEqual(test.status_code, server.HTTP_FORBIDDEN)
+        # The md5 names a blob: it can't be a path
+        self.upload(SHAREUSR, SHAREUSRPW, 'Work/secret.txt', 'secret')
+        test = self.app.post(self.PREFLIGHT_URL, headers=headers,
+                             data={'files': json.dumps([['Work/stolen.txt', '../../{}/Work/secret.txt'.format(SHAREUSR),
+                                                         len('secret')]])})
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+
+
+class TestBatchActions(TwoUsersTestCase):
+    BATCH_URL = SERVER_ACTIONS_API + 'batch'
+
+    def batch(self, actions):
+        test = self.app.post(self.BATCH_URL, headers=make_basicauth_headers(USR, PW),
+                             data={'actions': json.dumps(actions)})
+        self.assertEqual(test.status_code, HTTP_OK)
+        return json.loads(test.data)
+
+    def test_actions_in_order(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        self.upload(USR, PW, 'Music/old.mp3', 'old song')
+        result = self.batch([{'cmd': 'copy', 'src': 'Music/song.mp3', 'dst': 'Work/song.mp3'},
+                             {'cmd': 'move', 'src': 'Work/song.mp3', 'dst': 'Work/renamed.mp3'},
+                             {'cmd': 'delete', 'filepath': 'Music/old.mp3'}])
+
+        self.assertEqual([action['status'] for action in result['results']], [HTTP_OK] * 3)
+        self.assertEqual(result[server.LAST_SERVER_TIMESTAMP], result['results'][-1][server.LAST_SERVER_TIMESTAMP])
+        snapshot = server.userdata[USR][server.SNAPSHOT]
+        self.assertIn('Music/song.mp3', snapshot)
+        self.assertIn('Work/renamed.mp3', snapshot)
+        self.assertNotIn('Work/song.mp3', snapshot)
+        self.assertNotIn('Music/old.mp3', snapshot)
+        self.assertEqual(open(userpath2serverpath(USR, 'Work/renamed.mp3')).read(), 'the song')
+        self.assertFalse(os.path.exists(userpath2serverpath(USR, 'Music/old.mp3')))
+
+    def test_saved_once(self):
+        for i in range(5):
+            self.upload(USR, PW, 'Work/file{}.txt'.format(i), 'content')
+        with mock.patch('server.save_userdata') as save_userdata:
+            self.batch([{'cmd': 'delete', 'filepath': 'Work/file{}.txt'.format(i)} for i in range(5)])
+        save_userdata.assert_called_once_with(USR)
+        for i in range(5):
+            self.assertNotIn('Work/file{}.txt'.format(i), server.userdata[USR][server.SNAPSHOT])
+
+    def test_failed_actions(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        result = self.batch([{'cmd': 'delete', 'filepath': 'Music/missing.mp3'},
+                             {'cmd': 'delete', 'filepath': '../../escape.txt'},
+                             {'cmd': 'unknown'},
+                             {'cmd': 'move', 'src': 'Music/song.mp3', 'dst': 'Work/song.mp3'}])
+        self.assertEqual([action['status'] for action in result['results']],
+                         [server.HTTP_NOT_FOUND, server.HTTP_FORBIDDEN, server.HTTP_NOT_FOUND, HTTP_OK])
+        self.assertIn('Work/song.mp3', server.userdata[USR][server.SNAPSHOT])
+
+    def test_malformed_actions(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        self.upload(USR, PW, 'Music/other.mp3', 'other song')
+        with mock.patch('server.save_userdata') as save_userdata:
+            result = self.batch([{'cmd': 'delete', 'filepath': 'Music/song.mp3'},
+                                 {'cmd': 'delete', 'filepath': ['Music/other.mp3']},
+                                 {'cmd': 'move', 'src': 'Music/other.mp3'},
+                                 {'cmd': ['delete']},
+                                 {'cmd': 'delete', 'filepath': 'Music/other.mp3'}])
+        self.assertEqual([action['status'] for action in result['results']],
+                         [HTTP_OK, server.HTTP_BAD_REQUEST, server.HTTP_BAD_REQUEST, server.HTTP_NOT_FOUND, HTTP_OK])
+        save_userdata.assert_called_once_with(USR)
+        self.assertNotIn('Music/song.mp3', server.userdata[USR][server.SNAPSHOT])
+        self.assertNotIn('Music/other.mp3', server.userdata[USR][server.SNAPSHOT])
+
+    def test_file_system_error(self):
+        self.upload(USR, PW, 'Music/song.mp3', 'the song')
+        self.upload(USR, PW, 'Work/file.txt', 'content')
+        with mock.patch('shutil.move', side_effect=OSError(errno.EIO, 'I/O error')), \
+                mock.patch('server.save_userdata') as save_userdata:
+            result = self.batch([{'cmd': 'delete', 'filepath': 'Work/file.txt'},
+                                 {'cmd': 'move', 'src': 'Music/song.mp3', 'dst': 'Music/moved.mp3'}])
+        self.assertEqual([action['status'] for action in result['results']],
+                         [HTTP_OK, server.HTTP_INTERNAL_SERVER_ERROR])
+        save_userdata.assert_called_once_with(USR)
+        self.assertNotIn('Work/file.txt', server.userdata[USR][server.SNAPSHOT])
+        self.assertIn('Music/song.mp3', server.userdata[USR][server.SNAPSHOT])
+
+    def test_wrong_requests(self):
+        headers = make_basicauth_headers(USR, PW)
+        for data in ({}, {'actions': 'not json'}, {'actions': json.dumps(['delete'])}):
+            test = self.app.post(self.BATCH_URL, headers=headers, data=data)
+            self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+
+
+class TestDirectoryActions(TwoUsersTestCase):
+    """
+    The actions on a directory are applied to all its files at once.
+    """
+    def action(self, cmd, **data):
+        return self.app.post(SERVER_ACTIONS_API + cmd, headers=make_basicauth_headers(USR, PW), data=data)
+
+    def setUp(self):
+        TwoUsersTestCase.setUp(self)
+        self.upload(USR, PW, 'Project/main.py', 'main')
+        self.upload(USR, PW, 'Project/lib/util.py', 'util')
+
+    def test_move_directory(self):
+        inode = os.stat(userpath2serverpath(USR, 'Project/lib/util.py')).st_ino
+        test = self.action('move', src='Project', dst='Work/Old project')
+        self.assertEqual(test.status_code, HTTP_OK)
+        timestamp = json.loads(test.data)[server.LAST_SERVER_TIMESTAMP]
+
+        snapshot = server.userdata[USR][server.SNAPSHOT]
+        self.assertFalse(snapshot.has_subtree('Project'))
+        self.assertEqual(snapshot['Work/Old project/lib/util.py'], [timestamp, hashlib.md5('util').hexdigest()])
+        self.assertEqual(snapshot['Work/Old project/main.py'][0], timestamp)
+        # A single rename
+        self.assertEqual(os.stat(userpath2serverpath(USR, 'Work/Old project/lib/util.py')).st_ino, inode)
+        self.assertFalse(os.path.exists(userpath2serverpath(USR, 'Project')))
+
+    def test_move_shared_directory(self):
+        self.app.post(SERVER_SHARES_API + 'Project/' + SHAREUSR, headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(self.action('move', src='Project', dst='Renamed').status_code, HTTP_OK)
+        self.assertEqual(server.userdata[USR]['shared_with_others'], {'Renamed': [SHAREUSR]})
+        self.assertEqual(server.userdata[SHAREUSR]['shared_with_me'][USR], ['Renamed'])
+        self.assertIn('shared/{}/Renamed/main.py'.format(USR), server.shared_view(SHAREUSR))
+
+    def test_move_directory_inside_itself(self):
+        self.assertEqual(self.action('move', src='Project', dst='Project/lib/Project').status_code,
+                         server.HTTP_BAD_REQUEST)
+
+    def test_move_directory_to_existing_path(self):
+        self.upload(USR, PW, 'Work/main.py', 'main')
+        self.assertEqual(self.action('move', src='Project', dst='Work').status_code, server.HTTP_CONFLICT)
+        self.assertTrue(server.userdata[USR][server.SNAPSHOT].has_subtree('Project'))
+
+    def test_move_directory_out_of_user_root(self):
+        self.assertEqual(self.action('move', src='Project', dst='../Project').status_code, server.HTTP_FORBIDDEN)
+        self.assertEqual(self.action('move', src='.', dst='Moved').status_code, server.HTTP_FORBIDDEN)
+
+    def test_copy_directory(self):
+        test = self.action('copy', src='Project', dst='Backup/Project')
+        self.assertEqual(test.status_code, HTTP_OK)
+        snapshot = server.userdata[USR][server.SNAPSHOT]
+        self.assertEqual(snapshot['Backup/Project/lib/util.py'][1], snapshot['Project/lib/util.py'][1])
+        self.assertIn('Project/main.py', snapshot)
+        self.assertTrue(os.path.samefile(userpath2serverpath(USR, 'Project/main.py'),
+                                         userpath2serverpath(USR, 'Backup/Project/main.py')))
+
+    def test_delete_directory(self):
+        test = self.action('delete', filepath='Project')
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertFalse(server.userdata[USR][server.SNAPSHOT].has_subtree('Project'))
+        self.assertFalse(os.path.exists(userpath2serverpath(USR, 'Project')))
+        self.assertEqual(self.action('delete', filepath='').status_code, server.HTTP_FORBIDDEN)
+
+
+def make_archive(files, mode='w', md5s=None):
+    """
+    Return a tar archive of the {<path>: <content>} <files>, with their md5 in the member headers.
+    """
+    buf = StringIO.StringIO()
+    tar = tarfile.open(fileobj=buf, mode=mode, format=tarfile.PAX_FORMAT, encoding='utf-8')
+    for path, content in sorted(files.items()):
+        info = tarfile.TarInfo(path)
+        info.size = len(content)
+        info.pax_headers = {server.ARCHIVE_MD5_HEADER: (md5s or {}).get(path, hashlib.md5(content).hexdigest())}
+        tar.addfile(info, StringIO.StringIO(content))
+    tar.close()
+    return buf.getvalue()
+
+
+class TestArchiveUpload(TwoUsersTestCase):
+    ARCHIVES_URL = SERVER_API + 'archives'
+
+    def upload_archive(self, archive):
+        test = self.app.post(self.ARCHIVES_URL, headers=make_basicauth_headers(USR, PW), data=archive,
+                             content_type='application/x-tar')
+        self.assertEqual(test.status_code, HTTP_OK)
+        return json.loads(test.data)
+
+    def test_upload(self):
+        self.upload(USR, PW, 'Work/old.txt', 'old content')
+        files = dict(('Work/src/file{}.py'.format(i), 'content {}'.format(i)) for i in range(20))
+        files['Work/old.txt'] = 'new content'
+        with mock.patch('server.save_userdata') as save_userdata:
+            result = self.upload_archive(make_archive(files))
+        save_userdata.assert_called_once_with(USR)
+
+        self.assertEqual(result['failed'], {})
+        self.assertEqual(sorted(result['stored']), sorted(files))
+        snapshot = server.userdata[USR][server.SNAPSHOT]
+        for path, content in files.items():
+            self.assertEqual(snapshot[path], [result['stored'][path], hashlib.md5(content).hexdigest()])
+            self.assertEqual(open(userpath2serverpath(USR, path)).read(), content)
+        self.assertEqual(os.listdir(server.UPLOADS_DIR), [])
+
+    def test_compressed_upload(self):
+        result = self.upload_archive(make_archive({'Work/file.txt': 'content' * 100}, mode='w:gz'))
+        self.assertEqual(result['stored'].keys(), ['Work/file.txt'])
+
+    def test_failed_files(self):
+        archive = make_archive({'Work/good.txt': 'good', 'Work/bad.txt': 'bad', '../../escape.txt': 'escape'},
+                               md5s={'Work/bad.txt': hashlib.md5('other').hexdigest()})
+        result = self.upload_archive(archive)
+        self.assertEqual(result['stored'].keys(), ['Work/good.txt'])
+        self.assertEqual(result['failed'], {'Work/bad.txt': server.HTTP_CONFLICT,
+                                            '../../escape.txt': server.HTTP_FORBIDDEN})
+        self.assertNotIn('Work/bad.txt', server.userdata[USR][server.SNAPSHOT])
+        self.assertFalse(os.path.exists(os.path.join(server.FILE_ROOT, 'escape.txt')))
+
+    def test_other_user_directory_rejected(self):
+        """
+        A member can't reach the directory of another user whose name starts with the username.
+        """
+        path = '../{}2/file.txt'.format(USR)
+        self.assertEqual(self.upload_archive(make_archive({path: 'content'}))['failed'], {path: server.HTTP_FORBIDDEN})
+        self.assertFalse(os.path.exists(os.path.join(server.FILE_ROOT, USR + '2')))
+
+    def test_links_rejected(self):
+        buf = StringIO.StringIO()
+        tar = tarfile.open(fileobj=buf, mode='w', format=tarfile.PAX_FORMAT)
+        info = tarfile.TarInfo('Work/link')
+        info.type = tarfile.SYMTYPE
+        info.linkname = '/etc/passwd'
+        tar.addfile(info)
+        tar.close()
+        self.assertEqual(self.upload_archive(buf.getvalue())['failed'], {'Work/link': server.HTTP_FORBIDDEN})
+        self.assertFalse(os.path.lexists(userpath2serverpath(USR, 'Work/link')))
+
+    def test_broken_archive(self):
+        archive = make_archive({'Work/first.txt': 'first', 'Work/second.txt': 'second' * 1000})
+        result = self.upload_archive(archive[:2048])
+        self.assertEqual(result['stored'].keys(), ['Work/first.txt'])
+        self.assertIn('Work/first.txt', server.userdata[USR][server.SNAPSHOT])
+
+
+class TestArchiveDownload(TwoUsersTestCase):
+    ARCHIVES_URL = SERVER_API + 'archives'
+
+    def setUp(self):
+        TwoUsersTestCase.setUp(self)
+        self.files = {'Work/a.txt': 'a', 'Work/src/b.py': 'b' * 1000, 'Work/empty.txt': ''}
+        for path, content in self.files.items():
+            self.upload(USR, PW, path, content)
+
+    def download_archive(self, query, username=USR, password=PW):
+        """
+        Return {<path>: (<content>, <md5 header>)} of the downloaded archive.
+        """
+        test = self.app.get(self.ARCHIVES_URL + '?' + query, headers=make_basicauth_headers(username, password))
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(test.mimetype, 'application/x-tar')
+        tar = tarfile.open(fileobj=StringIO.StringIO(test.data), mode='r|', encoding='utf-8')
+        return dict((member.name, (tar.extractfile(member).read(), member.pax_headers[server.ARCHIVE_MD5_HEADER]))
+                    for member in tar)
+
+    def test_subtree(self):
+        files = self.download_archive('subtree=Work')
+        self.assertEqual(sorted(files), sorted(server.userdata[USR][server.SNAPSHOT].subtree('Work')))
+        for path, content in self.files.items():
+            self.assertEqual(files[path], (content, hashlib.md5(content).hexdigest()))
+
+    def test_paths(self):
+        files = self.download_archive('path=Work/a.txt&path=Work/missing.txt&path=../../escape.txt')
+        self.assertEqual(files, {'Work/a.txt': ('a', hashlib.md5('a').hexdigest())})
+
+    def test_shared_paths(self):
+        self.app.post(SERVER_SHARES_API + 'Work/' + SHAREUSR, headers=make_basicauth_headers(USR, PW))
+        path = 'shared/{}/Work/src/b.py'.format(USR)
+        files = self.download_archive('path=' + path, SHAREUSR, SHAREUSRPW)
+        self.assertEqual(files, {path: ('b' * 1000, hashlib.md5('b' * 1000).hexdigest())})
+        self.assertEqual(self.download_archive('path=shared/{}/Music/x.mp3'.format(USR), SHAREUSR, SHAREUSRPW), {})
+
+    def test_forbidden_subtree(self):
+        test = self.app.get(self.ARCHIVES_URL + '?subtree=../' + SHAREUSR, headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, server.HTTP_FORBIDDEN)
+
+
+class TestDeltaTransfers(TwoUsersTestCase):
+    """
+    Only the changes of the modified files are transferred (see delta.py).
+    """
+    OLD = os.urandom(2 ** 18)
+    NEW = OLD[:1000] + 'changed' + OLD[1000:]
+
+    def setUp(self):
+        TwoUsersTestCase.setUp(self)
+        self.upload(USR, PW, 'Work/big.bin', self.OLD)
+
+    def upload_delta(self, path, delta_data, md5):
+        return self.app.put(SERVER_FILES_API + path, headers=make_basicauth_headers(USR, PW),
+                            data={'delta': (StringIO.StringIO(delta_data), 'delta'), 'md5': md5})
+
+    def make_upload_delta(self, new):
+        test = self.app.get(SERVER_API + 'signatures/Work/big.bin', headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, HTTP_OK)
+        return ''.join(delta.delta(StringIO.StringIO(new), delta.parse_signature(test.data)))
+
+    def test_upload_delta(self):
+        delta_data = self.make_upload_delta(self.NEW)
+        self.assertLess(len(delta_data), 2 * delta.block_size(len(self.OLD)))
+        test = self.upload_delta('Work/big.bin', delta_data, hashlib.md5(self.NEW).hexdigest())
+        self.assertEqual(test.status_code, server.HTTP_CREATED)
+        self.assertEqual(open(userpath2serverpath(USR, 'Work/big.bin'), 'rb').read(), self.NEW)
+        self.assertEqual(server.userdata[USR][server.SNAPSHOT]['Work/big.bin'],
+                         [json.loads(test.data)[server.LAST_SERVER_TIMESTAMP], hashlib.md5(self.NEW).hexdigest()])
+
+    def test_upload_wrong_delta(self):
+        delta_data = self.make_upload_delta(self.NEW)
+        test = self.upload_delta('Work/big.bin', delta_data, hashlib.md5('other').hexdigest())
+        self.assertEqual(test.status_code, server.HTTP_CONFLICT)
+        test = self.upload_delta('Work/big.bin', delta_data[:-1], hashlib.md5(self.NEW).hexdigest())
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+        test = self.upload_delta('Work/missing.bin', delta_data, hashlib.md5(self.NEW).hexdigest())
+        self.assertEqual(test.status_code, server.HTTP_NOT_FOUND)
+        self.assertEqual(open(userpath2serverpath(USR, 'Work/big.bin'), 'rb').read(), self.OLD)
+        self.assertEqual(os.listdir(server.UPLOADS_DIR), [])
+
+    def test_download_delta(self):
+        self.upload(USR, PW, 'Work/big.bin', self.NEW, method='put')
+        signature = delta.signature(StringIO.StringIO(self.OLD), len(self.OLD))
+        test = self.app.post(SERVER_API + 'deltas/Work/big.bin', headers=make_basicauth_headers(USR, PW),
+                             data={'signature': (StringIO.StringIO(signature), 'signature')})
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(test.headers[server.DELTA_MD5_HEADER], hashlib.md5(self.NEW).hexdigest())
+        self.assertLess(len(test.data), 2 * delta.block_size(len(self.OLD)))
+        out = StringIO.StringIO()
+        delta.patch(StringIO.StringIO(self.OLD), StringIO.StringIO(test.data), out)
+        self.assertEqual(out.getvalue(), self.NEW)
+
+    def test_download_delta_errors(self):
+        test = self.app.post(SERVER_API + 'deltas/Work/big.bin', headers=make_basicauth_headers(USR, PW),
+                             data={'signature': (StringIO.StringIO('bad'), 'signature')})
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+        signature = delta.signature(StringIO.StringIO(self.OLD), len(self.OLD))
+        test = self.app.post(SERVER_API + 'deltas/Work/missing.bin', headers=make_basicauth_headers(USR, PW),
+                             data={'signature': (StringIO.StringIO(signature), 'signature')})
+        self.assertEqual(test.status_code, server.HTTP_NOT_FOUND)
+
+
+class TestAppend(TwoUsersTestCase):
+    """
+    Only the bytes appended to a file are uploaded.
+    """
+    OLD = 'line of log\n' * 1000
+    APPENDED = 'new line\n' * 10
+
+    def setUp(self):
+        TwoUsersTestCase.setUp(self)
+        self.upload(USR, PW, 'Work/file.log', self.OLD)
+
+    def append(self, path, offset, data, md5):
+        return self.app.patch(SERVER_FILES_API + path, headers=make_basicauth_headers(USR, PW),
+                              data={'data': (StringIO.StringIO(data), 'data'), 'offset': offset, 'md5': md5})
+
+    def test_append(self):
+        md5 = hashlib.md5(self.OLD + self.APPENDED).hexdigest()
+        test = self.append('Work/file.log', len(self.OLD), self.APPENDED, md5)
+        self.assertEqual(test.status_code, server.HTTP_CREATED)
+        self.assertEqual(open(userpath2serverpath(USR, 'Work/file.log'), 'rb').read(), self.OLD + self.APPENDED)
+        self.assertEqual(server.userdata[USR][server.SNAPSHOT]['Work/file.log'],
+                         [json.loads(test.data)[server.LAST_SERVER_TIMESTAMP], md5])
+
+    def test_wrong_append(self):
+        md5 = hashlib.md5(self.OLD + self.APPENDED).hexdigest()
+        # The server version is not the one the client appended to
+        test = self.append('Work/file.log', len(self.OLD) - 1, self.APPENDED, md5)
+        self.assertEqual(test.status_code, server.HTTP_CONFLICT)
+        test = self.append('Work/file.log', len(self.OLD), self.APPENDED, hashlib.md5('other').hexdigest())
+        self.assertEqual(test.status_code, server.HTTP_CONFLICT)
+        test = self.append('Work/file.log', 'bad', self.APPENDED, md5)
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+        test = self.append('Work/missing.log', 0, self.APPENDED, hashlib.md5(self.APPENDED).hexdigest())
+        self.assertEqual(test.status_code, server.HTTP_NOT_FOUND)
+        self.assertEqual(open(userpath2serverpath(USR, 'Work/file.log'), 'rb').read(), self.OLD)
+        self.assertEqual(os.listdir(server.UPLOADS_DIR), [])
+
+
+class TestNotifications(TwoUsersTestCase):
+    """
+    The clients wait for the changes of their files on the transfer service (see notifications.py and
+    test_transfers.py): the Flask app redirects them there.
+    """
+    def tearDown(self):
+        server.TRANSFER_PORT = None
+        super(TestNotifications, self).tearDown()
+
+    def test_redirect_to_transfer_service(self):
+        server.TRANSFER_PORT = 5001
+        test = self.app.get(SERVER_API + 'notifications?since=1000&timeout=10',
+                            headers=dict(make_basicauth_headers(USR, PW), Accept='text/event-stream'))
+        self.assertEqual(test.status_code, server.HTTP_TEMPORARY_REDIRECT)
+        self.assertEqual(test.headers['Location'],
+                         'http://localhost:5001{}notifications?since=1000&timeout=10'.format(SERVER_API))
+        test = self.app.get(SERVER_API + 'notifications')
+        self.assertEqual(test.headers['Location'], 'http://localhost:5001{}notifications'.format(SERVER_API))
+
+    def test_without_transfer_service(self):
+        test = self.app.get(SERVER_API + 'notifications?since=1000', headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, server.HTTP_NOT_FOUND)
+
+
+class TestConditionalRequests(TwoUsersTestCase):
+    """
+    An unchanged snapshot or file costs a 304 without body, and HEAD describes them without the body.
+    """
+    def get_snapshot(self, etag=None, query=''):
+        headers = make_basicauth_headers(USR, PW)
+        if etag:
+            headers['If-None-Match'] = etag
+        return self.app.get(SERVER_FILES_API + query, headers=headers)
+
+    def test_etag(self):
+        test = self.get_snapshot()
+        self.assertEqual(test.status_code, HTTP_OK)
+        etag = test.headers['ETag']
+        test = self.get_snapshot(etag)
+        self.assertEqual(test.status_code, 304)
+        self.assertEqual(test.data, '')
+
+        self.upload(USR, PW, 'Work/file.txt', 'content')
+        test = self.get_snapshot(etag)
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertIn('Work/file.txt', json.loads(test.data)[server.SNAPSHOT])
+        self.assertNotEqual(test.headers['ETag'], etag)
+
+    def test_shared_files_change_the_etag(self):
+        etag = self.get_snapshot().headers['ETag']
+        self.upload(SHAREUSR, SHAREUSRPW, 'Work/file.txt', 'content')
+        self.assertEqual(self.get_snapshot(etag).status_code, 304)
+        self.app.post(SERVER_SHARES_API + 'Work/' + USR, headers=make_basicauth_headers(SHAREUSR, SHAREUSRPW))
+        self.assertEqual(self.get_snapshot(etag).status_code, HTTP_OK)
+
+    def test_subtree_etag(self):
+        test = self.get_snapshot(query='?subtree=Work')
+        self.assertEqual(self.get_snapshot(test.headers['ETag'], query='?subtree=Work').status_code, 304)
+        self.assertNotEqual(test.headers['ETag'], self.get_snapshot().headers['ETag'])
+
+    def test_binary_snapshot(self):
+        self.upload(USR, PW, 'Work/file.txt', 'content')
+        headers = make_basicauth_headers(USR, PW)
+        headers['Accept'] = '{}, application/json;q=0.5'.format(snapshot_codec.CONTENT_TYPE)
+        test = self.app.get(SERVER_FILES_API, headers=headers)
+        self.assertEqual(test.mimetype, snapshot_codec.CONTENT_TYPE)
+        self.assertEqual(snapshot_codec.decode(test.data), json.loads(self.get_snapshot().data))
+
+        # Every representation has its own ETag
+        self.assertNotEqual(test.headers['ETag'], self.get_snapshot().headers['ETag'])
+        headers['If-None-Match'] = test.headers['ETag']
+        self.assertEqual(self.app.get(SERVER_FILES_API, headers=headers).status_code, 304)
+
+    def test_compressed_snapshot(self):
+        for encoding, decompress in [('gzip', lambda data: zlib.decompress(data, 16 + zlib.MAX_WBITS)),
+                                     ('deflate', zlib.decompress)]:
+            headers = make_basicauth_headers(USR, PW)
+            headers['Accept-Encoding'] = encoding
+            test = self.app.get(SERVER_FILES_API, headers=headers)
+            self.assertEqual(test.headers['Content-Encoding'], encoding)
+            self.assertEqual(json.loads(decompress(test.data)), json.loads(self.get_snapshot().data))
+
+    def get_file(self, path, **headers):
+        headers.update(make_basicauth_headers(USR, PW))
+        return self.app.get(SERVER_FILES_API + path, headers=headers)
+
+    def test_file_etag(self):
+        self.upload(USR, PW, 'Work/file.txt', 'content')
+        test = self.get_file('Work/file.txt')
+        self.assertEqual(test.headers['ETag'], '"{}"'.format(hashlib.md5('content').hexdigest()))
+        test = self.get_file('Work/file.txt', **{'If-None-Match': test.headers['ETag']})
+        self.assertEqual(test.status_code, 304)
+        self.assertEqual(test.data, '')
+
+        self.upload(USR, PW, 'Work/file.txt', 'new content', method='put')
+        test = self.get_file('Work/file.txt', **{'If-None-Match': test.headers['ETag']})
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(test.data, 'new content')
+
+    def test_file_if_modified_since(self):
+        self.upload(USR, PW, 'Work/file.txt', 'content')
+        last_modified = self.get_file('Work/file.txt').headers['Last-Modified']
+        self.assertEqual(self.get_file('Work/file.txt', **{'If-Modified-Since': last_modified}).status_code, 304)
+        test = self.get_file('Work/file.txt', **{'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(test.data, 'content')
+
+    def test_head_file(self):
+        self.upload(USR, PW, 'Work/file.txt', 'content')
+        test = self.app.head(SERVER_FILES_API + 'Work/file.txt', headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(test.data, '')
+        self.assertEqual(test.headers['Content-Length'], str(len('content')))
+        self.assertEqual(test.headers[server.DELTA_MD5_HEADER], hashlib.md5('content').hexdigest())
+        self.assertEqual(test.headers[server.TIMESTAMP_HEADER],
+                         str(server.userdata[USR][server.SNAPSHOT]['Work/file.txt'][0]))
+
+    def test_head_missing_file(self):
+        test = self.app.head(SERVER_FILES_API + 'Work/missing.txt', headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, server.HTTP_NOT_FOUND)
+
+    def test_head_snapshot(self):
+        etag = self.get_snapshot().headers['ETag']
+        test = self.app.head(SERVER_FILES_API, headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.headers['ETag'], etag)
+        self.assertEqual(test.headers[server.TIMESTAMP_HEADER],
+                         str(server.userdata[USR][server.LAST_SERVER_TIMESTAMP]))
+
+
+class TestSnapshotPages(TwoUsersTestCase):
+    """
+    The snapshot can be downloaded in pages (see Files.snapshot_page).
+    """
+    def setUp(self):
+        TwoUsersTestCase.setUp(self)
+        for path in ['Work/a.txt', 'Work/b.txt', 'Work/c/d.txt', 'e.txt']:
+            self.upload(USR, PW, path, path)
+        self.upload(SHAREUSR, SHAREUSRPW, 'Work/shared.txt', 'shared')
+        self.app.post(SERVER_SHARES_API + 'Work/' + USR, headers=make_basicauth_headers(SHAREUSR, SHAREUSRPW))
+
+    def get_page(self, limit, after=None):
+        query = {'limit': limit}
+        if after is not None:
+            query['after'] = after
+        return self.app.get(SERVER_FILES_API, query_string=query, headers=make_basicauth_headers(USR, PW))
+
+    def test_pages(self):
+        full = json.loads(self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, PW)).data)
+        files, shared_files, after = {}, {}, None
+        while True:
+            test = self.get_page(2, after)
+            self.assertEqual(test.status_code, HTTP_OK)
+            page = json.loads(test.data)
+            self.assertLessEqual(len(page[server.SNAPSHOT]) + len(page[server.SHARED_FILES]), 2)
+            self.assertEqual(page[server.LAST_SERVER_TIMESTAMP], full[server.LAST_SERVER_TIMESTAMP])
+            files.update(page[server.SNAPSHOT])
+            shared_files.update(page[server.SHARED_FILES])
+            after = test.headers.get(server.NEXT_PAGE_HEADER)
+            if after is None:
+                break
+        self.assertEqual(files, full[server.SNAPSHOT])
+        self.assertEqual(shared_files, full[server.SHARED_FILES])
+
+    def test_shared_pages(self):
+        self.upload(SHAREUSR, SHAREUSRPW, 'Music/song.mp3', 'song')
+        self.upload(SHAREUSR, SHAREUSRPW, 'Work/sub/other.txt', 'other')
+        self.app.post(SERVER_SHARES_API + 'Music/' + USR, headers=make_basicauth_headers(SHAREUSR, SHAREUSRPW))
+        full = json.loads(self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, PW)).data)
+        paths, after = [], None
+        while True:
+            test = self.get_page(1, after)
+            page = json.loads(test.data)
+            paths.extend(page[server.SNAPSHOT].keys() + page[server.SHARED_FILES].keys())
+            after = test.headers.get(server.NEXT_PAGE_HEADER)
+            if after is None:
+                break
+        shared_paths = [path for path in paths if path.startswith('shared/')]
+        self.assertEqual(shared_paths, sorted(full[server.SHARED_FILES], key=lambda path: path.split('/')))
+        self.assertEqual(len(paths), len(full[server.SNAPSHOT]) + len(full[server.SHARED_FILES]))
+
+    def test_page_etag(self):
+        first = self.get_page(2)
+        after = first.headers[server.NEXT_PAGE_HEADER]
+        test = self.app.get(SERVER_FILES_API, query_string={'limit': 2, 'after': after},
+                            headers=dict(make_basicauth_headers(USR, PW), **{'If-None-Match': first.headers['ETag']}))
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertNotEqual(test.headers['ETag'], first.headers['ETag'])
+        test = self.app.get(SERVER_FILES_API, query_string={'limit': 2, 'after': after},
+                            headers=dict(make_basicauth_headers(USR, PW), **{'If-None-Match': test.headers['ETag']}))
+        self.assertEqual(test.status_code, 304)
+
+    def test_snapshot_changed_between_pages(self):
+        after = self.get_page(2).headers[server.NEXT_PAGE_HEADER]
+        self.upload(USR, PW, 'Work/new.txt', 'new')
+        self.assertEqual(self.get_page(2, after).status_code, server.HTTP_CONFLICT)
+
+    def test_invalid_pages(self):
+        self.assertEqual(self.get_page(0).status_code, server.HTTP_BAD_REQUEST)
+        self.assertEqual(self.get_page(server.SNAPSHOT_MAX_PAGE_SIZE + 1).status_code, server.HTTP_BAD_REQUEST)
+        self.assertEqual(self.get_page(2, 'invalid token').status_code, server.HTTP_BAD_REQUEST)
+        version = json.loads(base64.urlsafe_b64decode(self.get_page(2).headers[server.NEXT_PAGE_HEADER]))[0]
+        token = base64.urlsafe_b64encode(json.dumps([version, server.SNAPSHOT, 1234]))
+        self.assertEqual(self.get_page(2, token).status_code, server.HTTP_BAD_REQUEST)
+
+
+class TestChunkedUpload(TwoUsersTestCase):
+    """
+    Only the chunks of a file that the server doesn't have are uploaded (see chunks.py).
+    """
+    CHUNKS = ['first chunk ' * 100, 'second chunk ' * 100, 'third chunk ' * 100]
+
+    def needed_chunks(self, chunks, username=USR, password=PW):
+        test = self.app.post(SERVER_API + 'chunks', headers=make_basicauth_headers(username, password),
+                             data={'chunks': json.dumps([hashlib.md5(chunk).hexdigest() for chunk in chunks])})
+        self.assertEqual(test.status_code, HTTP_OK)
+        return json.loads(test.data)['needed']
+
+    def upload_chunks(self, path, chunks, sent, username=USR, password=PW, method='post', md5=None):
+        content = ''.join(chunks)
+        sent_chunks = [chunk for chunk in chunks if hashlib.md5(chunk).hexdigest() in sent]
+        return getattr(self.app, method)(
+            SERVER_FILES_API + path, headers=make_basicauth_headers(username, password),
+            data={'chunks': json.dumps([[hashlib.md5(chunk).hexdigest(), len(chunk)] for chunk in chunks]),
+                  'sent': json.dumps(sent),
+                  'data': (StringIO.StringIO(''.join(sent_chunks)), 'data'),
+                  'md5': md5 or hashlib.md5(content).hexdigest()})
+
+    def test_upload_chunks(self):
+        needed = self.needed_chunks(self.CHUNKS)
+        self.assertEqual(needed, [hashlib.md5(chunk).hexdigest() for chunk in self.CHUNKS])
+        test = self.upload_chunks('Work/export.txt', self.CHUNKS, needed)
+        self.assertEqual(test.status_code, server.HTTP_CREATED)
+        self.assertEqual(open(userpath2serverpath(USR, 'Work/export.txt')).read(), ''.join(self.CHUNKS))
+
+        # A near-duplicate: only its new chunk is uploaded
+        chunks = self.CHUNKS[:2] + ['new chunk'] + self.CHUNKS[1:]
+        needed = self.needed_chunks(chunks)
+        self.assertEqual(needed, [hashlib.md5('new chunk').hexdigest()])
+        test = self.upload_chunks('Work/export v2.txt', chunks, needed)
+        self.assertEqual(test.status_code, server.HTTP_CREATED)
+        self.assertEqual(open(userpath2serverpath(USR, 'Work/export v2.txt')).read(), ''.join(chunks))
+
+        # Another user uploads the chunks it doesn't have, whoever has them
+        needed = self.needed_chunks(chunks, SHAREUSR, SHAREUSRPW)
+        self.assertEqual(set(needed), set(hashlib.md5(chunk).hexdigest() for chunk in chunks))
+        test = self.upload_chunks('Work/export v2.txt', chunks, needed, SHAREUSR, SHAREUSRPW)
+        self.assertEqual(test.status_code, server.HTTP_CREATED)
+        self.assertEqual(open(userpath2serverpath(SHAREUSR, 'Work/export v2.txt')).read(), ''.join(chunks))
+        self.assertEqual(server.userdata[SHAREUSR][server.SNAPSHOT]['Work/export v2.txt'][1],
+                         hashlib.md5(''.join(chunks)).hexdigest())
+
+        # Modify
+        test = self.upload_chunks('Work/export.txt', self.CHUNKS[::-1], [], method='put')
+        self.assertEqual(test.status_code, server.HTTP_CREATED)
+        self.assertEqual(open(userpath2serverpath(USR, 'Work/export.txt')).read(), ''.join(self.CHUNKS[::-1]))
+
+    def test_chunks_of_other_users_not_readable(self):
+        self.upload_chunks('Work/export.txt', self.CHUNKS, self.needed_chunks(self.CHUNKS))
+        # The md5 and the size of a chunk of another user are not enough to get it
+        chunk = self.CHUNKS[0]
+        test = self.upload_chunks('Work/stolen.txt', [chunk], [], SHAREUSR, SHAREUSRPW)
+        self.assertEqual(test.status_code, server.HTTP_CONFLICT)
+        self.assertNotIn('Work/stolen.txt', server.userdata[SHAREUSR][server.SNAPSHOT])
+
+    def test_wrong_chunks(self):
+        # Missing chunk
+        test = self.upload_chunks('Work/export.txt', self.CHUNKS, [])
+        self.assertEqual(test.status_code, server.HTTP_CONFLICT)
+        # Wrong file md5
+        needed = self.needed_chunks(self.CHUNKS)
+        test = self.upload_chunks('Work/export.txt', self.CHUNKS, needed, md5=hashlib.md5('other').hexdigest())
+        self.assertEqual(test.status_code, server.HTTP_CONFLICT)
+        self.assertNotIn('Work/export.txt', server.userdata[USR][server.SNAPSHOT])
+        self.assertEqual(os.listdir(server.UPLOADS_DIR), [])
+        # Chunk names must be md5s
+        test = self.app.post(SERVER_API + 'chunks', headers=make_basicauth_headers(USR, PW),
+                             data={'chunks': json.dumps(['../../' + USR + '/Work/Work.txt'])})
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+        test = self.app.post(SERVER_FILES_API + 'Work/stolen.txt', headers=make_basicauth_headers(USR, PW),
+                             data={'chunks': json.dumps([['../../' + SHAREUSR + '/Work/Work.txt', 10]]),
+                                   'md5': hashlib.md5('').hexdigest()})
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+
+
+class TestConcurrency(unittest.TestCase):
+    """
+    Stress test: many clients working concurrently on the same users, then check the metadata consistency.
+    """
+    USERS = ['stress{}@mail.com'.format(i) for i in range(4)]
+    CLIENTS = 12
+    OPERATIONS = 15
+
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        for user in self.USERS:
+            _manually_create_user(user, PW)
+        server.save_userdata()
+        self.errors = []
+
+    def tearDown(self):
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def check(self, response, label):
+        if response.status_code >= 400:
+            self.errors.append('{}: HTTP {}'.format(label, response.status_code))
+
+    def file_client(self, client_id):
+        """
+        Upload, modify, copy, move and delete files of an user (shared by more clients).
+        """
+        app = server.app.test_client()
+        user = self.USERS[client_id % len(self.USERS)]
+        headers = make_basicauth_headers(user, PW)
+        try:
+            for i in range(self.OPERATIONS):
+                path = 'Stress/client{}/file{}.txt'.format(client_id, i)
+                content = 'client {} file {}'.format(client_id, i)
+                md5 = hashlib.md5(content).hexdigest()
+                self.check(app.post(SERVER_FILES_API + path, headers=headers,
+                                    data={'file': (StringIO.StringIO(content), 'file.txt'), 'md5': md5}),
+                           'upload ' + path)
+                if i % 3 == 0:
+                    content += ' modified'
+                    self.check(app.put(SERVER_FILES_API + path, headers=headers,
+                                       data={'file': (StringIO.StringIO(content), 'file.txt'),
+                                             'md5': hashlib.md5(content).hexdigest()}),
+                               'modify ' + path)
+                elif i % 3 == 1:
+                    self.check(app.post(SERVER_ACTIONS_API + 'copy', headers=headers,
+                                        data={'src': path, 'dst': path + '.copy'}), 'copy ' + path)
+                    self.check(app.post(SERVER_ACTIONS_API + 'move', headers=headers,
+                                        data={'src': path + '.copy', 'dst': path + '.moved'}), 'move ' + path)
+                else:
+                    self.check(app.post(SERVER_ACTIONS_API + 'delete', headers=headers,
+                                        data={'filepath': path}), 'delete ' + path)
+        except Exception as e:
+            self.errors.append(repr(e))
+
+    def share_client(self, client_id):
+        """
+        Share folders in both directions between two users, reading their snapshots meanwhile.
+        """
+        app = server.app.test_client()
+        owner, recipient = self.USERS[client_id % 2], self.USERS[(client_id + 1) % 2]
+        try:
+            for i in range(self.OPERATIONS):
+                share_url = SERVER_SHARES_API + 'Music/' + recipient
+                self.check(app.post(share_url, headers=make_basicauth_headers(owner, PW)), 'share')
+                self.check(app.get(SERVER_FILES_API, headers=make_basicauth_headers(recipient, PW)), 'snapshot')
+                self.check(app.delete(share_url, headers=make_basicauth_headers(owner, PW)), 'unshare')
+        except Exception as e:
+            self.errors.append(repr(e))
+
+    def test_concurrent_clients(self):
+        threads = [threading.Thread(target=self.file_client, args=(i,)) for i in range(self.CLIENTS)]
+        threads += [threading.Thread(target=self.share_client, args=(i,)) for i in range(2)]
+        # Switch thread as often as possible, to make the races more likely
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(60)
+                self.assertFalse(thread.is_alive(), 'Deadlock?')
+        finally:
+            sys.setcheckinterval(check_interval)
+        self.assertEqual(self.errors, [])
+
+        saved_userdata = server.load_userdata()
+        for user in self.USERS:
+            # The snapshot must describe exactly the files on disk...
+            snapshot = server.userdata[user][server.SNAPSHOT]
+            dir_state = server.compute_dir_state(userpath2serverpath(user))[server.SNAPSHOT]
+            self.assertEqual(dict((path, md5) for path, (_, md5) in snapshot.iteritems()),
+                             dict((path, md5) for path, (_, md5) in dir_state.iteritems()))
+            # ...and it must be saved
+            self.assertEqual(saved_userdata[user][server.SNAPSHOT], snapshot)
+            self.assertEqual(server.userdata[user]['shared_with_me'].get(self.USERS[0], []), [])
+            self.assertEqual(server.userdata[user]['shared_with_others'].get('Music', []), [])
+
+
+class TestStoreMode(unittest.TestCase):
+    """
+    Multi-process mode: the user data is shared through the store, and the changes of the other workers
+    (simulated by another UserStore) must be seen.
+    """
+    NEW_PW = 'New.Password_85'
+
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        server.credentials_cache.clear()
+        server.open_store()
+        self.other_worker = server.UserStore(server.USERSTORE_FILENAME, worker_id=-1)
+
+        self.app = server.app.test_client()
+        self.app.testing = True
+        _manually_create_user(USR, PW)
+        server.save_userdata(USR)
+
+    def tearDown(self):
+        self.other_worker.close()
+        server.close_store()
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def change_password_in_other_worker(self, username, password):
+        single_user_data = self.other_worker.load(username)
+        single_user_data[server.PWD] = server._encrypt_password(password)
+        self.other_worker.save(username, json.dumps(single_user_data))
+
+    def get_snapshot(self, username, password):
+        return self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(username, password))
+
+    def test_userdata_saved_in_store(self):
+        self.assertEqual(self.other_worker.load(USR)[server.PWD], server.userdata[USR][server.PWD])
+        self.assertFalse(os.path.exists(server.USERDATA_FILENAME))
+
+    def test_upload_saved_in_store(self):
+        test_file, test_md5 = _make_temp_file()
+        test = self.app.post(SERVER_FILES_API + 'Misc/upload.txt', headers=make_basicauth_headers(USR, PW),
+                             data={'file': test_file, 'md5': test_md5})
+        self.assertEqual(test.status_code, server.HTTP_CREATED)
+        self.assertEqual(self.other_worker.load(USR)[server.SNAPSHOT]['Misc/upload.txt'][1], test_md5)
+
+    def test_password_changed_by_other_worker(self):
+        self.assertEqual(self.get_snapshot(USR, PW).status_code, HTTP_OK)
+        self.change_password_in_other_worker(USR, self.NEW_PW)
+        # The cached credentials must not be accepted anymore
+        self.assertEqual(self.get_snapshot(USR, PW).status_code, server.HTTP_UNAUTHORIZED)
+        self.assertEqual(self.get_snapshot(USR, self.NEW_PW).status_code, HTTP_OK)
+
+    def test_user_created_by_other_worker(self):
+        other_user = 'other@mail.com'
+        self.other_worker.save(other_user, json.dumps(self.other_worker.load(USR)))
+        self.assertEqual(self.get_snapshot(other_user, PW).status_code, HTTP_OK)
+
+        test = self.app.post(SERVER_API + 'users/{}'.format(other_user), data={'password': 'Other.Password_85'})
+        self.assertEqual(test.status_code, server.HTTP_CONFLICT)
+
+    def test_user_removed_by_other_worker(self):
+        self.assertEqual(self.get_snapshot(USR, PW).status_code, HTTP_OK)
+        self.other_worker.save(USR, None)
+        self.assertEqual(self.get_snapshot(USR, PW).status_code, server.HTTP_UNAUTHORIZED)
+        self.assertNotIn(USR, server.userdata)
+
+    def test_pruned_changes(self):
+        """
+        If the changes of the other workers are pruned before being seen, all the users are reloaded.
+        """
+        self.change_password_in_other_worker(USR, 'Lost.Password_85')
+        self.change_password_in_other_worker(USR, self.NEW_PW)
+        self.other_worker.prune_changes(max_age=-1)
+        self.assertEqual(self.get_snapshot(USR, self.NEW_PW).status_code, HTTP_OK)
+
+
 if __name__ == '__main__':
     unittest.main()
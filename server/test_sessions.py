@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import mock
+
+from sessions import SessionTokens, CredentialsCache
+
+
+STORED_PW = '$5$rounds=110000$saltsaltsalt$hashhashhash'
+
+
+class TestSessionTokens(unittest.TestCase):
+    def setUp(self):
+        self.tokens = SessionTokens('secret', max_age=60)
+
+    def test_check(self):
+        token = self.tokens.issue('user@mail.com', STORED_PW)
+        self.assertTrue(self.tokens.check(token, 'user@mail.com', STORED_PW))
+        self.assertFalse(self.tokens.check(token, 'other@mail.com', STORED_PW))
+        self.assertFalse(self.tokens.check(token, 'user@mail.com', STORED_PW + 'changed'))
+
+    def test_other_secret_key(self):
+        token = SessionTokens('other secret', max_age=60).issue('user@mail.com', STORED_PW)
+        self.assertFalse(self.tokens.check(token, 'user@mail.com', STORED_PW))
+
+    def test_not_a_token(self):
+        self.assertFalse(self.tokens.check('password', 'user@mail.com', STORED_PW))
+        self.assertFalse(self.tokens.check('', 'user@mail.com', STORED_PW))
+
+
+class TestCredentialsCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = CredentialsCache(max_size=3, ttl=60)
+
+    def test_check(self):
+        self.assertFalse(self.cache.check('user', 'pw', STORED_PW))
+        self.cache.add('user', 'pw', STORED_PW)
+        self.assertTrue(self.cache.check('user', 'pw', STORED_PW))
+        self.assertTrue(self.cache.check(u'user', u'pw', STORED_PW))
+        self.assertFalse(self.cache.check('user', 'wrong pw', STORED_PW))
+        self.assertFalse(self.cache.check('user', 'pw', STORED_PW + 'changed'))
+
+    def test_expiration(self):
+        self.cache.add('user', 'pw', STORED_PW)
+        with mock.patch('sessions.time.time', return_value=10 ** 12):
+            self.assertFalse(self.cache.check('user', 'pw', STORED_PW))
+        # The expired entry is removed
+        self.assertEqual(len(self.cache), 0)
+
+    def test_max_size(self):
+        for user in ('a', 'b', 'c'):
+            self.cache.add(user, 'pw', STORED_PW)
+        # 'a' becomes the most recently used, so 'b' is dropped
+        self.assertTrue(self.cache.check('a', 'pw', STORED_PW))
+        self.cache.add('d', 'pw', STORED_PW)
+        self.assertEqual(len(self.cache), 3)
+        self.assertFalse(self.cache.check('b', 'pw', STORED_PW))
+        self.assertTrue(self.cache.check('a', 'pw', STORED_PW))
+
+    def test_invalidate(self):
+        self.cache.add('user', 'pw', STORED_PW)
+        self.cache.add('user', 'other pw', STORED_PW)
+        self.cache.add('other user', 'pw', STORED_PW)
+        self.cache.invalidate('user')
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue(self.cache.check('other user', 'pw', STORED_PW))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import hashlib
+import unittest
+
+from snapshot import SnapshotTree, FileRecord
+
+
+TEST_SNAPSHOT = {
+    'WELCOME': [1000L, hashlib.md5('welcome').hexdigest()],
+    'Music/Music.txt': [1001L, hashlib.md5('music').hexdigest()],
+    'Music/rock/song.mp3': [1002L, hashlib.md5('song').hexdigest()],
+    'Work/fake.txt': [1003L, 'fake_md5'],
+}
+
+
+class TestSnapshotTree(unittest.TestCase):
+    def setUp(self):
+        self.tree = SnapshotTree(TEST_SNAPSHOT)
+
+    def test_equal_to_dict(self):
+        self.assertEqual(self.tree, TEST_SNAPSHOT)
+        self.assertEqual(len(self.tree), len(TEST_SNAPSHOT))
+
+    def test_json_roundtrip(self):
+        dumped = json.dumps(dict(self.tree.iteritems()))
+        self.assertEqual(SnapshotTree(json.loads(dumped)), TEST_SNAPSHOT)
+
+    def test_contains(self):
+        self.assertIn('Music/rock/song.mp3', self.tree)
+        self.assertNotIn('Music/rock', self.tree)
+        self.assertNotIn('Photos/photo.jpg', self.tree)
+
+    def test_delete_prunes_empty_directories(self):
+        del self.tree['Music/rock/song.mp3']
+        self.assertNotIn('rock', self.tree._root.dirs['Music'].dirs)
+        del self.tree['Music/Music.txt']
+        self.assertNotIn('Music', self.tree._root.dirs)
+        self.assertEqual(len(self.tree), len(TEST_SNAPSHOT) - 2)
+        self.assertRaises(KeyError, self.tree.__delitem__, 'Music/Music.txt')
+
+    def test_iter_subtree(self):
+        self.assertEqual(sorted(path for path, _ in self.tree.iter_subtree('Music')),
+                         ['Music/Music.txt', 'Music/rock/song.mp3'])
+        self.assertEqual([path for path, _ in self.tree.iter_subtree('Music/rock/song.mp3')],
+                         ['Music/rock/song.mp3'])
+        self.assertEqual(sorted(path for path, _ in self.tree.iter_subtree('')), sorted(TEST_SNAPSHOT))
+        self.assertEqual(list(self.tree.iter_subtree('Mus')), [])
+        self.assertEqual(list(self.tree.iter_subtree('Photos/2014')), [])
+
+    def test_iter_sorted(self):
+        self.tree['Music.txt'] = [1004L, hashlib.md5('music').hexdigest()]
+        paths = [path for path, _ in self.tree.iter_sorted()]
+        self.assertEqual(paths, ['Music/Music.txt', 'Music/rock/song.mp3', 'Music.txt', 'WELCOME', 'Work/fake.txt'])
+        for index, path in enumerate(paths):
+            self.assertEqual([subpath for subpath, _ in self.tree.iter_sorted(path)], paths[index + 1:])
+        # <after> can be a directory or a missing path
+        self.assertEqual([path for path, _ in self.tree.iter_sorted('Music/rock')][:1], ['Music/rock/song.mp3'])
+        self.assertEqual([path for path, _ in self.tree.iter_sorted('Photos')], ['WELCOME', 'Work/fake.txt'])
+
+    def test_iter_sorted_path(self):
+        self.tree['Music/rock.txt'] = [1004L, hashlib.md5('rock').hexdigest()]
+        paths = [path for path, _ in self.tree.iter_sorted(path='Music')]
+        self.assertEqual(paths, ['Music/Music.txt', 'Music/rock/song.mp3', 'Music/rock.txt'])
+        self.assertEqual([path for path, _ in self.tree.iter_sorted('Music/Music.txt', 'Music')], paths[1:])
+        self.assertEqual([path for path, _ in self.tree.iter_sorted('Music/rock', 'Music/rock/')],
+                         ['Music/rock/song.mp3'])
+        self.assertEqual([path for path, _ in self.tree.iter_sorted('Mu', 'Music')], paths)
+        self.assertEqual([path for path, _ in self.tree.iter_sorted('WELCOME', 'Music')], [])
+        self.assertEqual([path for path, _ in self.tree.iter_sorted(None, 'WELCOME')], ['WELCOME'])
+        self.assertEqual([path for path, _ in self.tree.iter_sorted('WELCOME', 'WELCOME')], [])
+        self.assertEqual(list(self.tree.iter_sorted(path='Photos')), [])
+
+    def test_sorted_names_follow_the_changes(self):
+        list(self.tree.iter_sorted())
+        self.tree['Music/Art.txt'] = [1004L, hashlib.md5('art').hexdigest()]
+        del self.tree['Music/Music.txt']
+        self.tree.move_subtree('Work', 'Music/Work')
+        self.assertEqual([path for path, _ in self.tree.iter_sorted()],
+                         ['Music/Art.txt', 'Music/Work/fake.txt', 'Music/rock/song.mp3', 'WELCOME'])
+        self.tree.remove_subtree('Music/rock')
+        self.assertEqual([path for path, _ in self.tree.iter_sorted('Music/Art.txt')],
+                         ['Music/Work/fake.txt', 'WELCOME'])
+
+    def test_has_subtree(self):
+        self.assertTrue(self.tree.has_subtree('Music/rock'))
+        self.assertTrue(self.tree.has_subtree('WELCOME'))
+        self.assertFalse(self.tree.has_subtree('Music/pop'))
+
+    def test_remove_subtree(self):
+        self.assertEqual(self.tree.remove_subtree('Music/rock'), 1)
+        self.assertEqual(self.tree.remove_subtree('Music/pop'), 0)
+        self.assertEqual(self.tree.remove_subtree('Music'), 1)
+        self.assertEqual(sorted(self.tree), ['WELCOME', 'Work/fake.txt'])
+        self.assertEqual(len(self.tree), 2)
+
+    def test_move_subtree(self):
+        record = self.tree.get_record('Music/rock/song.mp3')
+        self.assertEqual(self.tree.move_subtree('Music', 'Work/Old music'), 2)
+        self.assertEqual(sorted(self.tree), ['WELCOME', 'Work/Old music/Music.txt', 'Work/Old music/rock/song.mp3',
+                                             'Work/fake.txt'])
+        self.assertIs(self.tree.get_record('Work/Old music/rock/song.mp3').packed, record.packed)
+        self.assertEqual(len(self.tree), len(TEST_SNAPSHOT))
+        self.assertNotIn('Music', self.tree._root.dirs)
+
+    def test_move_subtree_to_existing_path(self):
+        self.assertRaises(ValueError, self.tree.move_subtree, 'Music/rock', 'Work')
+        self.assertRaises(ValueError, self.tree.move_subtree, 'Music/rock', 'Work/fake.txt')
+        self.assertEqual(self.tree, TEST_SNAPSHOT)
+
+    def test_subtree_links_records(self):
+        subtree = self.tree.subtree('Music/')
+        self.assertEqual(subtree, {'Music/Music.txt': TEST_SNAPSHOT['Music/Music.txt'],
+                                   'Music/rock/song.mp3': TEST_SNAPSHOT['Music/rock/song.mp3']})
+        self.assertIs(subtree.get_record('Music/Music.txt').packed, self.tree.get_record('Music/Music.txt').packed)
+
+    def test_linked_record_is_kept(self):
+        """
+        A record linked into another tree is immutable: the updates of its source tree don't change it.
+        """
+        shared = SnapshotTree()
+        shared.link_record('shared/owner/Music/Music.txt', self.tree.get_record('Music/Music.txt'))
+        self.tree['Music/Music.txt'] = [2000L, hashlib.md5('new music').hexdigest()]
+        self.assertEqual(shared['shared/owner/Music/Music.txt'], TEST_SNAPSHOT['Music/Music.txt'])
+
+    def test_unicode_paths(self):
+        """
+        The ascii names are stored as str, the other ones as unicode: both are found with either type.
+        """
+        self.tree[u'Music/caf\xe9.mp3'] = [1004L, hashlib.md5('cafe').hexdigest()]
+        self.tree[u'Music/song.mp3'] = [1005L, hashlib.md5('song').hexdigest()]
+        self.assertIn(u'Music/caf\xe9.mp3', self.tree)
+        self.assertIn('Music/song.mp3', self.tree)
+        self.assertIn(u'Music/Music.txt', self.tree)
+        names = dict((name, type(name)) for name in self.tree._root.dirs['Music'].files)
+        self.assertIs(names['song.mp3'], str)
+        self.assertIs(names[u'caf\xe9.mp3'], unicode)
+        self.assertEqual(json.loads(json.dumps(dict(self.tree.iteritems())))[u'Music/caf\xe9.mp3'][0], 1004L)
+
+    def test_copy_is_independent(self):
+        tree_copy = self.tree.copy()
+        tree_copy['WELCOME'] = [2000L, hashlib.md5('bye').hexdigest()]
+        self.assertEqual(self.tree['WELCOME'], TEST_SNAPSHOT['WELCOME'])
+
+    def test_record_md5(self):
+        md5 = hashlib.md5('foo').hexdigest()
+        record = FileRecord(1L, md5)
+        self.assertEqual(len(record.packed), 24)
+        self.assertEqual(record.md5, md5)
+        self.assertEqual(record.timestamp, 1L)
+        # Values that can't be packed are kept as they are
+        self.assertEqual(FileRecord(1L, '0123456789abcdef').md5, '0123456789abcdef')
+        self.assertEqual(FileRecord(1.5, md5).as_list(), [1.5, md5])
+
+
+if __name__ == '__main__':
+    unittest.main()
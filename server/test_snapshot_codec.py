@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import unittest
+
+import snapshot_codec
+from snapshot import SnapshotTree
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+class TestSnapshotCodec(unittest.TestCase):
+    DOCUMENT = {
+        'server_timestamp': 14213453542031,
+        'files': {
+            u'Music/song.mp3': [14213453542031, md5('song')],
+            u'Music/songs/other.mp3': [14213453540000, md5('other')],
+            u'Photos/2014/à la plage.jpg': [14213453530000, md5('beach')],
+            u'Photos/2014/à la montagne.jpg': [14213453530001, md5('mountain')],
+            u'notes.txt': [1, 'not an md5'],
+        },
+        'shared_files': {
+            u'shared/user/Work/file.txt': [14213453542031, md5('work')],
+        },
+    }
+
+    def test_round_trip(self):
+        self.assertEqual(snapshot_codec.decode(snapshot_codec.encode(self.DOCUMENT)), self.DOCUMENT)
+
+    def test_empty_sections(self):
+        document = {'server_timestamp': 0, 'files': {}, 'shared_files': {}}
+        self.assertEqual(snapshot_codec.decode(snapshot_codec.encode(document)), document)
+
+    def test_snapshot_tree(self):
+        document = dict(self.DOCUMENT, files=SnapshotTree(self.DOCUMENT['files']))
+        self.assertEqual(snapshot_codec.decode(snapshot_codec.encode(document)), self.DOCUMENT)
+
+    def test_smaller_than_json(self):
+        files = dict(('projects/project/src/module{}/file{}.py'.format(i // 100, i), [14213453542031 + i, md5(str(i))])
+                     for i in range(1000))
+        document = {'server_timestamp': 14213453542031, 'files': files}
+        self.assertLess(len(snapshot_codec.encode(document)), len(json.dumps(document, separators=(',', ':'))) / 2)
+
+    def test_invalid_data(self):
+        data = snapshot_codec.encode(self.DOCUMENT)
+        self.assertRaises(ValueError, snapshot_codec.decode, '{"files": {}}')
+        self.assertRaises(ValueError, snapshot_codec.decode, data[:len(data) // 2])
+
+    def test_same_as_client_copy(self):
+        """
+        The client has a copy of this module (the client and the server are installed separately):
+        they must not differ.
+        """
+        here = os.path.dirname(os.path.abspath(__file__))
+        client_copy = os.path.join(here, os.pardir, 'client', 'snapshot_codec.py')
+        if not os.path.exists(client_copy):
+            raise unittest.SkipTest('client not found')
+        with open(os.path.join(here, 'snapshot_codec.py'), 'rb') as server_module:
+            with open(client_copy, 'rb') as client_module:
+                self.assertEqual(server_module.read(), client_module.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
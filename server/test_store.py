@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from store import UserStore
+
+
+class TestUserStore(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.work_dir, 'userdata.sqlite')
+        self.store = UserStore(self.filename, worker_id=1)
+        # Another worker using the same database
+        self.other_store = UserStore(self.filename, worker_id=2)
+
+    def tearDown(self):
+        self.store.close()
+        self.other_store.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_save_and_load(self):
+        self.assertTrue(self.store.is_empty())
+        self.store.save(u'user@mail.com', json.dumps({'password': 'pw'}))
+        self.assertFalse(self.other_store.is_empty())
+        self.assertEqual(self.other_store.load('user@mail.com'), {'password': 'pw'})
+        self.assertEqual(self.other_store.load_all(), {'user@mail.com': {'password': 'pw'}})
+        self.assertEqual(self.other_store.usernames(), set(['user@mail.com']))
+
+    def test_remove(self):
+        self.store.save('user@mail.com', json.dumps({}))
+        self.store.save('user@mail.com', None)
+        self.assertIsNone(self.other_store.load('user@mail.com'))
+        self.assertTrue(self.store.is_empty())
+
+    def test_changes_since(self):
+        last_change = self.store.last_change()
+        self.store.save('mine@mail.com', json.dumps({}))
+        self.other_store.save('other@mail.com', json.dumps({}))
+        self.other_store.save('another@mail.com', json.dumps({}))
+
+        # Only the changes of the other workers are given
+        change_id, changed = self.store.changes_since(last_change)
+        self.assertEqual(change_id, self.store.last_change())
+        self.assertEqual(changed, set(['other@mail.com', 'another@mail.com']))
+        self.assertEqual(self.store.changes_since(change_id), (change_id, set()))
+        self.assertEqual(self.other_store.changes_since(last_change)[1], set(['mine@mail.com']))
+
+    def test_pruned_changes(self):
+        last_change = self.store.last_change()
+        for i in range(3):
+            self.other_store.save('user{}@mail.com'.format(i), json.dumps({}))
+        self.store.prune_changes(max_age=-1)
+        # The last change is kept, the previous ones are lost
+        change_id, changed = self.store.changes_since(last_change)
+        self.assertEqual(change_id, self.store.last_change())
+        self.assertIsNone(changed)
+
+
+if __name__ == '__main__':
+    unittest.main()
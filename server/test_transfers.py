@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import base64
+import shutil
+import socket
+import hashlib
+import httplib
+import tempfile
+import unittest
+import threading
+import time
+
+import mock
+
+import server
+from notifications import sse_event
+from transfers import TransferServer, CHUNK_SIZE
+
+USR, PW = 'transfer@mail.com', 'Transfer_85'
+
+
+class TestTransferServer(unittest.TestCase):
+    def setUp(self):
+        self.start_dir = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+        server.reset_userdata()
+        server.credentials_cache.clear()
+        single_user_data = server.init_user_directory(USR)
+        single_user_data.update({server.PWD: server._encrypt_password(PW), server.USER_IS_ACTIVE: True,
+                                 server.USER_CREATION_TIME: server.now_timestamp(),
+                                 'shared_with_me': {}, 'shared_with_others': {}})
+        server.userdata[USR] = single_user_data
+
+        self.transfers = TransferServer('127.0.0.1', 0)
+        self.transfers.start()
+
+    def tearDown(self):
+        self.transfers.stop()
+        server.reset_userdata()
+        os.chdir(self.start_dir)
+        shutil.rmtree(self.work_dir)
+
+    def request(self, method, path, body=None, password=PW, query='', headers=None):
+        headers = dict(headers or {}, Authorization='Basic ' + base64.b64encode('{}:{}'.format(USR, password)))
+        connection = httplib.HTTPConnection('127.0.0.1', self.transfers.port)
+        connection.request(method, '{}/files/{}{}'.format(server.URL_PREFIX, path, query), body, headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    def upload(self, method, path, content, md5=None):
+        return self.request(method, path, content, query='?md5={}'.format(md5 or hashlib.md5(content).hexdigest()))
+
+    def test_upload_and_download(self):
+        content = os.urandom(CHUNK_SIZE * 3 + 10)
+        status, body = self.upload('POST', 'Work/big.bin', content)
+        self.assertEqual(status, server.HTTP_CREATED)
+        self.assertEqual(json.loads(body)[server.LAST_SERVER_TIMESTAMP],
+                         server.userdata[USR][server.LAST_SERVER_TIMESTAMP])
+        self.assertEqual(server.userdata[USR][server.SNAPSHOT]['Work/big.bin'][1], hashlib.md5(content).hexdigest())
+        self.assertEqual(self.request('GET', 'Work/big.bin'), (server.HTTP_OK, content))
+        # The upload temporary file is removed
+        self.assertEqual(os.listdir(server.UPLOADS_DIR), [])
+
+    def test_upload_existing_file(self):
+        self.upload('POST', 'Work/file.txt', 'old content')
+        self.assertEqual(self.upload('POST', 'Work/file.txt', 'new content')[0], server.HTTP_FORBIDDEN)
+        self.assertEqual(self.upload('PUT', 'Work/file.txt', 'new content')[0], server.HTTP_CREATED)
+        self.assertEqual(self.request('GET', 'Work/file.txt'), (server.HTTP_OK, 'new content'))
+
+    def test_modify_missing_file(self):
+        self.assertEqual(self.upload('PUT', 'Work/missing.txt', 'content')[0], server.HTTP_NOT_FOUND)
+
+    def test_upload_with_wrong_md5(self):
+        status, _ = self.upload('POST', 'Work/file.txt', 'content', md5=hashlib.md5('other').hexdigest())
+        self.assertEqual(status, server.HTTP_CONFLICT)
+        self.assertNotIn('Work/file.txt', server.userdata[USR][server.SNAPSHOT])
+        self.assertEqual(os.listdir(server.UPLOADS_DIR), [])
+
+    def test_upload_without_md5(self):
+        self.assertEqual(self.request('POST', 'Work/file.txt', 'content')[0], server.HTTP_BAD_REQUEST)
+
+    def test_wrong_password(self):
+        self.assertEqual(self.request('GET', 'Work/file.txt', password='wrong')[0], server.HTTP_UNAUTHORIZED)
+
+    def test_forbidden_path(self):
+        self.assertEqual(self.upload('POST', '../escape.txt', 'content')[0], server.HTTP_FORBIDDEN)
+        self.assertEqual(self.request('GET', '../../userdata.json')[0], server.HTTP_FORBIDDEN)
+
+    def test_download_not_modified(self):
+        self.upload('POST', 'Work/file.txt', 'content')
+        etag = '"{}"'.format(hashlib.md5('content').hexdigest())
+        self.assertEqual(self.request('GET', 'Work/file.txt', headers={'If-None-Match': etag}),
+                         (server.HTTP_NOT_MODIFIED, ''))
+        self.upload('PUT', 'Work/file.txt', 'new content')
+        self.assertEqual(self.request('GET', 'Work/file.txt', headers={'If-None-Match': etag}),
+                         (server.HTTP_OK, 'new content'))
+
+    def test_download_missing_file(self):
+        self.assertEqual(self.request('GET', 'Work/missing.txt')[0], server.HTTP_NOT_FOUND)
+
+    def test_slow_clients_do_not_block(self):
+        """
+        Connections with an incomplete request must not stop serving the other clients.
+        """
+        slow_clients = []
+        for _ in range(50):
+            slow_client = socket.create_connection(('127.0.0.1', self.transfers.port))
+            slow_client.sendall('POST {}/files/Work/slow.txt?md5=0 HTTP/1.0\r\n'.format(server.URL_PREFIX))
+            slow_clients.append(slow_client)
+        try:
+            self.assertEqual(self.upload('POST', 'Work/fast.txt', 'content')[0], server.HTTP_CREATED)
+        finally:
+            for slow_client in slow_clients:
+                slow_client.close()
+
+    def test_blocking_calls_do_not_stop_transfers(self):
+        """
+        The password checks, user locks and saves run in the workers: a blocked one must not stop the other
+        transfers.
+        """
+        self.upload('POST', 'Work/file.txt', 'content')
+        blocked, release = threading.Event(), threading.Event()
+        verify_password = server.verify_password
+
+        def slow_verify_password(username, password):
+            if password == 'slow':
+                blocked.set()
+                release.wait(5)
+            return verify_password(username, password)
+        slow_request = threading.Thread(target=self.request, args=('GET', 'Work/file.txt'), kwargs={'password': 'slow'})
+        with mock.patch('server.verify_password', slow_verify_password):
+            slow_request.start()
+            try:
+                self.assertTrue(blocked.wait(5))
+                self.assertEqual(self.request('GET', 'Work/file.txt'), (server.HTTP_OK, 'content'))
+                self.assertEqual(self.upload('PUT', 'Work/file.txt', 'new content')[0], server.HTTP_CREATED)
+                # Served while the slow request is still blocked
+                self.assertTrue(slow_request.is_alive())
+            finally:
+                release.set()
+                slow_request.join()
+
+    def test_body_sent_with_the_header(self):
+        """
+        The body received while the request is checked by a worker is part of the upload.
+        """
+        sock = socket.create_connection(('127.0.0.1', self.transfers.port))
+        self.addCleanup(sock.close)
+        content = 'content' * 1000
+        sock.sendall('\r\n'.join(['POST {}/files/Work/file.txt?md5={} HTTP/1.0'.format(server.URL_PREFIX,
+                                                                                  hashlib.md5(content).hexdigest()),
+                                   'Authorization: Basic ' + base64.b64encode('{}:{}'.format(USR, PW)),
+                                   'Content-Length: {}'.format(len(content)), '', content]))
+        self.assertTrue(sock.makefile().read().startswith('HTTP/1.0 201'))
+        self.assertEqual(self.request('GET', 'Work/file.txt'), (server.HTTP_OK, content))
+
+    def notifications(self, query, headers=()):
+        """
+        Send a notifications request, and return the socket.
+        """
+        sock = socket.create_connection(('127.0.0.1', self.transfers.port))
+        lines = ['GET {}/notifications{} HTTP/1.0'.format(server.URL_PREFIX, query),
+                 'Authorization: Basic ' + base64.b64encode('{}:{}'.format(USR, PW))] + list(headers)
+        sock.sendall('\r\n'.join(lines) + '\r\n\r\n')
+        self.addCleanup(sock.close)
+        return sock
+
+    def wait_listeners(self, count):
+        """
+        Wait until <count> connections are waiting for a change (and no other one is open).
+        """
+        for _ in range(100):
+            if server.notifier.listeners() == self.transfers.connections() == count:
+                return
+            time.sleep(0.01)
+        self.fail('{} listeners instead of {}'.format(server.notifier.listeners(), count))
+
+    def test_notifications_long_poll(self):
+        version = server.notifier.version(USR)
+        sock = self.notifications('?since={}'.format(version))
+        self.wait_listeners(1)
+        start = time.time()
+        new_version = server.notifier.notify(USR)
+        response = sock.makefile().read()
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(response.startswith('HTTP/1.0 200'))
+        self.assertEqual(json.loads(response.split('\r\n\r\n', 1)[1]), {'version': new_version})
+        self.wait_listeners(0)
+
+    def test_notifications_timeout(self):
+        version = server.notifier.version(USR)
+        response = self.notifications('?since={}&timeout=0.1'.format(version)).makefile().read()
+        self.assertEqual(json.loads(response.split('\r\n\r\n', 1)[1]), {'version': version})
+
+    def test_notifications_stream(self):
+        sock = self.notifications('?since={}'.format(server.notifier.version(USR)), ['Accept: text/event-stream'])
+        self.wait_listeners(1)
+        versions = [server.notifier.notify(USR), server.notifier.notify(USR)]
+        stream = sock.makefile()
+        header = ''.join(iter(stream.readline, '\r\n'))
+        self.assertIn('text/event-stream', header)
+        for version in versions:
+            self.assertEqual(''.join(iter(stream.readline, '\n')) + '\n', sse_event(version))
+        # The client goes away
+        stream.close()
+        sock.close()
+        self.wait_listeners(0)
+
+    def test_many_waiting_clients(self):
+        """
+        The waiting clients cost no thread.
+        """
+        threads = threading.active_count()
+        socks = [self.notifications('?since={}'.format(server.notifier.version(USR))) for _ in range(100)]
+        self.wait_listeners(100)
+        self.assertEqual(threading.active_count(), threads)
+        server.notifier.notify(USR)
+        for sock in socks:
+            self.assertTrue(sock.makefile().read().startswith('HTTP/1.0 200'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,561 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Streaming transfer service: the file downloads and uploads of the Files resource, served by a single
+event loop thread (asyncore) instead of a thread for each request, so that many slow transfers only cost
+a socket and a buffer each. The other requests stay on the Flask app.
+
+It has the same URL scheme, authentication (password or session token) and path checks of Files:
+
+    GET  /API/V1/files/<path>              download a file (or a 'shared/<owner>/<path>' file),
+                                           304 if the If-None-Match/If-Modified-Since validators match
+    POST /API/V1/files/<path>?md5=<md5>    upload a new file
+    PUT  /API/V1/files/<path>?md5=<md5>    upload an existing file
+
+but the upload body is the raw file content (with its Content-Length), not a multipart form.
+The bodies are streamed in chunks of CHUNK_SIZE bytes: an upload is written to a temporary file
+while it is received, and a download is read from the file only when the socket can send more,
+so a slow client holds back its own transfer only (backpressure).
+
+It serves the change notifications of Notifications too (see notifications.py), the long-poll and the stream
+of Server-Sent Events, so that many idle clients waiting for a change cost a socket each:
+
+    GET  /API/V1/notifications?since=<version>[&timeout=<seconds>]
+
+The changes are notified by the threads of the Flask app: Trigger runs the handlers in the event loop thread.
+
+The loop thread does only the socket I/O (and reads and writes the chunks of the transferred files):
+the calls that can block on a lock or on a save of the user data (the password check, the snapshot lookups
+and the store of an upload) run in the threads of a WorkerPool, that pass their results back to the loop
+through the Trigger. So a slow save or a lock held by a Flask request doesn't stop the other transfers.
+
+The service runs in a thread of the server process (see server.py --transfer-port) or in a process of
+the multi-process server (see prefork.py --transfer-port).
+"""
+import os
+import json
+import base64
+import socket
+import urllib
+import urlparse
+import hashlib
+import asyncore
+import asynchat
+import logging
+import threading
+import fcntl
+import time
+import Queue
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES, parse_etags, parse_date, quote_etag, http_date
+from werkzeug import secure_filename
+
+import server
+from notifications import sse_event, SSE_KEEPALIVE
+
+
+logger = logging.getLogger('Server log')
+
+CHUNK_SIZE = 2 ** 16
+MAX_HEADER_SIZE = 2 ** 14
+# Threads of the WorkerPool
+WORKERS = 4
+FILES_URL = '{}/files/'.format(server.URL_PREFIX)
+NOTIFICATIONS_URL = '{}/notifications'.format(server.URL_PREFIX)
+
+
+class FileProducer(object):
+    """
+    asynchat producer of the content of a file, read a chunk at a time when the socket can send it.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+
+    def more(self):
+        data = self.fp.read(CHUNK_SIZE)
+        if not data:
+            self.fp.close()
+        return data
+
+
+class Trigger(asyncore.file_dispatcher):
+    """
+    Run the calls made by the other threads (i.e. the change notifications) in the event loop thread:
+    a byte written to a pipe wakes the loop.
+    """
+    def __init__(self, map):
+        read_fd, self._write_fd = os.pipe()
+        # file_dispatcher uses a copy of the file descriptor
+        asyncore.file_dispatcher.__init__(self, read_fd, map)
+        os.close(read_fd)
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, fcntl.fcntl(self._write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._calls = []
+        self._lock = threading.Lock()
+
+    def call(self, func, *args):
+        """
+        Call func(*args) in the event loop thread, as soon as possible. Thread safe.
+        """
+        with self._lock:
+            self._calls.append((func, args))
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError:
+            # The pipe is full: the loop is going to wake anyway
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        with self._lock:
+            calls, self._calls = self._calls, []
+        for func, args in calls:
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Triggered call failed')
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+
+class WorkerPool(object):
+    """
+    Threads that run the blocking calls of the handlers out of the event loop thread:
+    submit(func, callback) runs func() in a worker, then callback(<result>, <exception or None>)
+    in the event loop thread (see Trigger).
+    """
+    def __init__(self, trigger, size=WORKERS):
+        self._trigger = trigger
+        self._queue = Queue.Queue()
+        self._threads = []
+        for index in range(size):
+            thread = threading.Thread(target=self._run, name='TransferWorker-{}'.format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, callback):
+        self._queue.put((func, callback))
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            func, callback = task
+            try:
+                result, error = func(), None
+            except Exception as e:
+                if not isinstance(e, HTTPException):
+                    logger.exception('Transfer failed')
+                result, error = None, e
+            self._trigger.call(callback, result, error)
+
+    def stop(self):
+        """
+        Stop the workers when they are done with the submitted calls, and wait them.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+class TransferHandler(asynchat.async_chat):
+    """
+    A client connection: one request, then the connection is closed (HTTP/1.0).
+    """
+    ac_in_buffer_size = CHUNK_SIZE
+    ac_out_buffer_size = CHUNK_SIZE
+
+    def __init__(self, sock, map, trigger=None, workers=None):
+        asynchat.async_chat.__init__(self, sock, map)
+        self.set_terminator('\r\n\r\n')
+        # The request header; while a worker runs a call for the request (see defer), the body received so far
+        self._header = []
+        self._header_size = 0
+        # Upload in progress: the temporary file, its md5 and the request
+        self._upload_fp = None
+        self._upload_md5 = None
+        self._request = None
+        self._done = False
+        self._pending = False
+        self._trigger = trigger
+        self._workers = workers
+        # Notifications in progress: the listener subscribed to the changes of the user, the known version,
+        # if the response is an event stream, and when to respond (long-poll) or to send a keep-alive (stream)
+        self._listener = None
+        self._since = None
+        self._stream = False
+        self._deadline = None
+
+    def collect_incoming_data(self, data):
+        if self._done:
+            return
+        if self._pending:
+            self._header.append(data)
+            return
+        if self._upload_fp is not None:
+            self._upload_fp.write(data)
+            self._upload_md5.update(data)
+            return
+        self._header.append(data)
+        self._header_size += len(data)
+        if self._header_size > MAX_HEADER_SIZE:
+            self.respond(server.HTTP_BAD_REQUEST, 'Request header too long.\n')
+
+    def found_terminator(self):
+        if self._done:
+            return
+        try:
+            if self._upload_fp is None:
+                self.handle_request(''.join(self._header))
+            else:
+                self.finish_upload()
+        except HTTPException as e:
+            self.fail(e)
+        except Exception as e:
+            logger.exception('Transfer failed')
+            self.fail(e)
+
+    def fail(self, error):
+        """
+        Respond with the error of an aborted request (500 for an unexpected exception).
+        """
+        if isinstance(error, HTTPException):
+            self.respond(error.code, error.description or '')
+        else:
+            self.respond(500, 'Internal server error.\n')
+
+    def readable(self):
+        # Stop reading while a worker runs a call for the request
+        return not self._pending and asynchat.async_chat.readable(self)
+
+    def defer(self, func, callback):
+        """
+        Run func() in a worker thread, then callback(<result>) in the event loop thread,
+        or respond with the error raised by func. Without workers, run them now.
+        """
+        if self._workers is None:
+            callback(func())
+            return
+        self._pending = True
+        self._header = []
+        self.set_terminator(None)
+
+        def done(result, error):
+            self._pending = False
+            if error is not None:
+                self.fail(error)
+                return
+            try:
+                callback(result)
+            except HTTPException as e:
+                self.fail(e)
+            except Exception as e:
+                logger.exception('Transfer failed')
+                self.fail(e)
+        self._workers.submit(func, done)
+
+    def respond(self, status, body='', headers=(), producer=None):
+        """
+        Send the response and close the connection when done (unless the client has gone away).
+        """
+        if not self.connected:
+            if producer is not None:
+                producer.fp.close()
+            return
+        self._done = True
+        self.discard_upload()
+        self.set_terminator(None)
+        lines = ['HTTP/1.0 {} {}'.format(status, HTTP_STATUS_CODES.get(status, ''))]
+        if producer is None:
+            headers = list(headers) + [('Content-Length', len(body))]
+        lines.extend('{}: {}'.format(name, value) for name, value in headers)
+        lines.append('Connection: close')
+        self.push('\r\n'.join(lines) + '\r\n\r\n' + body)
+        if producer is not None:
+            self.push_with_producer(producer)
+        self.close_when_done()
+
+    def discard_upload(self):
+        if self._upload_fp is not None:
+            self._upload_fp.close()
+            self._upload_fp = None
+            if os.path.exists(self._request['tmp_filepath']):
+                os.remove(self._request['tmp_filepath'])
+
+    def handle_close(self):
+        self.discard_upload()
+        self.close()
+
+    def close(self):
+        self.stop_notifications()
+        asynchat.async_chat.close(self)
+
+    @staticmethod
+    def _authenticate(headers):
+        """
+        Return the authenticated username, aborting with 401 if the credentials are missing or wrong.
+        """
+        scheme, _, credentials = headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'basic':
+            server.abort(server.HTTP_UNAUTHORIZED)
+        try:
+            username, _, password = base64.b64decode(credentials).partition(':')
+            username, password = username.decode('utf-8'), password.decode('utf-8')
+        except (TypeError, UnicodeDecodeError):
+            server.abort(server.HTTP_UNAUTHORIZED)
+        if not server.verify_password(username, password):
+            server.abort(server.HTTP_UNAUTHORIZED)
+        return username
+
+    def handle_request(self, header):
+        lines = header.split('\r\n')
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+            headers = dict((name.strip().lower(), value.strip())
+                           for name, _, value in (line.partition(':') for line in lines[1:]))
+        except ValueError:
+            server.abort(server.HTTP_BAD_REQUEST)
+        url = urlparse.urlsplit(target)
+        if url.path == NOTIFICATIONS_URL and self._trigger is not None:
+            if method != 'GET':
+                server.abort(405)
+            query = urlparse.parse_qs(url.query)
+            stream = 'text/event-stream' in headers.get('accept', '')
+            self.defer(lambda: self._authenticate(headers),
+                       lambda username: self.start_notifications(username, query, stream))
+            return
+        if not url.path.startswith(FILES_URL):
+            server.abort(server.HTTP_NOT_FOUND)
+        path = urllib.unquote(url.path[len(FILES_URL):]).decode('utf-8')
+        if not path:
+            server.abort(server.HTTP_NOT_FOUND)
+
+        if method == 'GET':
+            self.defer(lambda: self.open_download(self._authenticate(headers), path, headers), self.start_download)
+        elif method in ('POST', 'PUT'):
+            md5 = urlparse.parse_qs(url.query).get('md5')
+            if not md5:
+                server.abort(server.HTTP_BAD_REQUEST)
+            if not headers.get('content-length', '').isdigit():
+                server.abort(411)
+            size = int(headers['content-length'])
+            self.defer(lambda: self.open_upload(self._authenticate(headers), path, md5[0], method == 'PUT'),
+                       lambda request: self.start_upload(request, size))
+        else:
+            server.abort(405)
+
+    @staticmethod
+    def open_download(username, path, request_headers):
+        """
+        Return the (<status>, <headers>, <open file or None>) of the download response. Run by a worker.
+        """
+        logger.debug('Transfer download {} of "{}"'.format(repr(path), username))
+        filepath = server.Files.file_to_download(username, path)
+        record = server.Files.record_to_download(username, path)
+        validators = []
+        if record is not None:
+            timestamp, md5 = record
+            validators = [('ETag', quote_etag(md5)), ('Last-Modified', http_date(server.http_date(timestamp)))]
+            if server.is_not_modified(md5, timestamp, parse_etags(request_headers.get('if-none-match')),
+                                      parse_date(request_headers.get('if-modified-since'))):
+                return server.HTTP_NOT_MODIFIED, validators, None
+        try:
+            fp = open(filepath, 'rb')
+        except IOError:
+            server.abort(server.HTTP_NOT_FOUND)
+        size = os.fstat(fp.fileno()).st_size
+        headers = [('Content-Type', 'application/octet-stream'),
+                   ('Content-Length', size),
+                   ('Content-Disposition', 'attachment; filename={}'.format(secure_filename(os.path.basename(path))))]
+        return server.HTTP_OK, headers + validators, fp
+
+    def start_download(self, response):
+        status, headers, fp = response
+        self.respond(status, headers=headers, producer=fp and FileProducer(fp))
+
+    def start_notifications(self, username, query, stream):
+        """
+        Wait for a version of the user data newer than 'since' (see server.Notifications): respond with it
+        (long-poll), or send an event for each new version (<stream>).
+        """
+        try:
+            since = int(query['since'][0]) if 'since' in query else None
+            timeout = max(0, min(float(query.get('timeout', [server.NOTIFICATIONS_TIMEOUT])[0]),
+                                 server.NOTIFICATIONS_TIMEOUT))
+        except ValueError:
+            server.abort(server.HTTP_BAD_REQUEST)
+        self._done = True
+        self.set_terminator(None)
+        trigger = self._trigger
+        self._listener = (username, lambda version: trigger.call(self.on_change, version))
+        version = server.notifier.subscribe(*self._listener)
+        self._stream = stream
+        if stream:
+            self._since = since or 0
+            self.push('HTTP/1.0 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                      'Connection: close\r\n\r\n')
+            self._deadline = time.time() + server.NOTIFICATIONS_TIMEOUT
+            self.on_change(version)
+        elif since is None or version > since:
+            self.respond_version(version)
+        else:
+            self._since = since
+            self._deadline = time.time() + timeout
+
+    def on_change(self, version):
+        """
+        A new <version> of the user data. Called in the event loop thread (see Trigger).
+        """
+        if self._listener is None or version <= self._since:
+            return
+        if self._stream:
+            self._since = version
+            self.push(sse_event(version))
+        else:
+            self.respond_version(version)
+
+    def check_deadline(self, now):
+        """
+        Respond to a long-poll request with the current version, or send a keep-alive comment in a stream,
+        if its deadline has come.
+        """
+        if self._listener is None or now < self._deadline:
+            return
+        if self._stream:
+            self.push(SSE_KEEPALIVE)
+            self._deadline = now + server.NOTIFICATIONS_TIMEOUT
+        else:
+            self.respond_version(server.notifier.version(self._listener[0]))
+
+    def respond_version(self, version):
+        self.stop_notifications()
+        self.respond(server.HTTP_OK, json.dumps({'version': version}), [('Content-Type', 'application/json')])
+
+    def stop_notifications(self):
+        if self._listener is not None:
+            server.notifier.unsubscribe(*self._listener)
+            self._listener = None
+
+    @staticmethod
+    def open_upload(username, path, md5, overwrite):
+        """
+        Check the path before receiving the file, and return the upload request with its temporary file.
+        Run by a worker.
+        """
+        logger.debug('Transfer upload {} of "{}"'.format(repr(path), username))
+        server.Files._get_dirname_filename(username, path)
+        fd, tmp_filepath = server.Files.make_upload_file()
+        return {'username': username, 'path': path, 'md5': md5, 'overwrite': overwrite,
+                'fd': fd, 'tmp_filepath': tmp_filepath}
+
+    def start_upload(self, request, size):
+        self._request = request
+        self._upload_fp = os.fdopen(request.pop('fd'), 'wb')
+        self._upload_md5 = hashlib.md5()
+        if not self.connected:
+            self.discard_upload()
+            return
+        # The body received while the worker was checking the request
+        data = ''.join(self._header)[:size]
+        self._header = []
+        self._upload_fp.write(data)
+        self._upload_md5.update(data)
+        if size > len(data):
+            self.set_terminator(size - len(data))
+        else:
+            self.finish_upload()
+
+    def finish_upload(self):
+        self._upload_fp.close()
+        self._upload_fp = None
+        request = self._request
+        if self._upload_md5.hexdigest() != request['md5']:
+            os.remove(request['tmp_filepath'])
+            server.abort(server.HTTP_CONFLICT)
+        self.defer(lambda: self.store_upload(request), self.finish_store)
+
+    @staticmethod
+    def store_upload(request):
+        """
+        Store the received file in the user data, and return the new server timestamp. Run by a worker.
+        """
+        try:
+            return server.Files.store_upload(request['username'], request['path'], request['tmp_filepath'],
+                                             request['md5'], request['overwrite'])
+        finally:
+            if os.path.exists(request['tmp_filepath']):
+                os.remove(request['tmp_filepath'])
+
+    def finish_store(self, last_server_timestamp):
+        self.respond(server.HTTP_CREATED, json.dumps({server.LAST_SERVER_TIMESTAMP: last_server_timestamp}),
+                     [('Content-Type', 'application/json')])
+
+
+class TransferServer(asyncore.dispatcher):
+    """
+    The listening socket of the transfer service, with its own asyncore socket map.
+    """
+    def __init__(self, host='0.0.0.0', port=0, backlog=1024):
+        self._map = {}
+        asyncore.dispatcher.__init__(self, map=self._map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+        self.port = self.socket.getsockname()[1]
+        self._thread = None
+        self._trigger = Trigger(self._map)
+        self._workers = WorkerPool(self._trigger)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            TransferHandler(pair[0], self._map, self._trigger, self._workers)
+
+    def serve_forever(self):
+        # The deadlines of the notifications are checked every second
+        while self._map:
+            asyncore.loop(timeout=1, use_poll=True, map=self._map, count=1)
+            now = time.time()
+            for handler in self._map.values():
+                if isinstance(handler, TransferHandler):
+                    handler.check_deadline(now)
+
+    def start(self):
+        """
+        Serve in a daemon thread.
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name='TransferServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Close the listening socket and all the connections, and wait the thread end.
+        """
+        self._workers.stop()
+        asyncore.close_all(self._map)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def connections(self):
+        """
+        Return the number of open client connections.
+        """
+        # The listening socket and the trigger are not
+        return len(self._map) - 2
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+WSGI entry point of the server, to run it with a threaded production WSGI server
+from the server directory, i.e.:
+
+    $ uwsgi --http :5000 --wsgi-file wsgi.py --callable app --master --processes 1 --threads 16
+    $ waitress-serve --port=5000 --threads=16 wsgi:app
+
+NB: the user data is kept in the server process memory, so run a single process (with many threads).
+To use more processes, run the multi-process server (see prefork.py).
+"""
+import server
+
+server.configure_production()
+server.setup_server()
+
+app = server.app